@@ -0,0 +1,4 @@
+"""
+Ferramentas de medição de desempenho (comandos benchmark_precisao e benchmark_desempenho) e os substitutos
+que usam (mongomock assíncrono, modelo simulado). Não são importadas pelo código da aplicação.
+"""
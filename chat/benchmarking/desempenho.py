@@ -0,0 +1,381 @@
+"""
+Medição do caminho completo dos pedidos (chat, histórico, exportação, tokens/s) sobre uma base de dados
+descartável, com um modelo simulado ou o modelo carregado, e comparação entre execuções.
+Usada pelo comando `python manage.py benchmark_desempenho` e pelos testes.
+"""
+import asyncio
+import time
+import tracemalloc
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+from unittest import mock
+
+from .mongomock_assincrono import BaseMongomockAssincrona
+from .precisao import PROMPTS_PADRAO
+
+
+class ModeloSimulado:
+    """
+    Substitui o modelo nos benchmarks do caminho dos pedidos: cada resposta tem `tokens` palavras e demora
+    o prefill mais tokens / tokens_por_segundo (a thread dorme, como se estivesse no model.generate).
+    """
+
+    def __init__(self, tokens: int = 32, tokens_por_segundo: float = 200.0, prefill_segundos: float = 0.01):
+        self.tokens = tokens
+        self.tokens_por_segundo = tokens_por_segundo
+        self.prefill_segundos = prefill_segundos
+
+    def gerar(self, chat_history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> str:
+        time.sleep(self.prefill_segundos + self.tokens / self.tokens_por_segundo)
+        return " ".join(f"palavra{i}" for i in range(self.tokens))
+
+    def contar_tokens(self, texto: str) -> int:
+        return len(texto.split())
+
+
+# Globais do mongo_service ligados à base de dados (repostos no fim de cada benchmark)
+_GLOBAIS_MONGO = ("client", "db", "chats_collection", "response_cache_collection", "buckets_collection",
+                  "export_jobs_collection", "analytics_cache_collection", "_indice_texto_disponivel")
+
+@contextmanager
+def ambiente_benchmark(mongo_uri: str = "", modelo: Optional[ModeloSimulado] = None) -> Iterator[str]:
+    """
+    Liga os serviços a uma base de dados descartável: mongomock (padrão) ou uma base nova no mongod de `mongo_uri`,
+    apagada no fim. Com `modelo`, a geração e a contagem de tokens são simuladas (ModeloSimulado); sem ele,
+    é usado o modelo carregado pelo nlp_service. A cache de respostas fica desligada, para cada pedido chegar ao modelo.
+    Devolve uma descrição da base de dados usada.
+    """
+    from django.test.utils import override_settings
+    from chat.services import inference_executor, mongo_async_service, mongo_service, nlp_service, response_cache
+
+    nome_db = f"benchmark_{uuid.uuid4().hex[:8]}"
+    anteriores = {nome: getattr(mongo_service, nome) for nome in _GLOBAIS_MONGO}
+    with ExitStack() as pilha:
+        pilha.enter_context(override_settings(
+            ALLOWED_HOSTS=["testserver"], # Host do cliente de testes do Django
+            RESPONSE_CACHE_ENABLED=False,
+            METRICS_TRACE_IDS=False,
+            MONGO_DB_NAME=nome_db,
+            **({"MONGO_URI": mongo_uri} if mongo_uri else {})
+        ))
+        for nome in _GLOBAIS_MONGO:
+            setattr(mongo_service, nome, None)
+        mongo_service.limpar_contagens_cache()
+        mongo_async_service._indice_texto_disponivel = None
+        pilha.enter_context(mock.patch.object(inference_executor, "_executor", None))
+        # Mede o caminho ASGI (cliente assíncrono), como em produção
+        pilha.enter_context(mock.patch.multiple(mongo_async_service, _ativo=True, _cliente=None, _loop_do_cliente=None))
+        if mongo_uri:
+            descricao = f"mongod ({nome_db})"
+        else:
+            import mongomock
+            descricao = "mongomock"
+            db = mongomock.MongoClient()[nome_db]
+            mongo_service.db, mongo_service.chats_collection = db, db["chats"]
+            pilha.enter_context(mock.patch.object(mongo_async_service, "get_db", lambda: BaseMongomockAssincrona(db)))
+        if modelo is not None:
+            pilha.enter_context(mock.patch.object(nlp_service, "modelo_pronto", lambda: True))
+            pilha.enter_context(mock.patch.object(nlp_service, "gerar_resposta_com_contexto", modelo.gerar))
+            pilha.enter_context(mock.patch.object(nlp_service, "contar_tokens", modelo.contar_tokens))
+        response_cache.limpar()
+        try:
+            yield descricao
+        finally:
+            if inference_executor._executor is not None:
+                inference_executor._executor.shutdown(wait=True)
+            if mongo_uri and mongo_service.client is not None:
+                mongo_service.client.drop_database(nome_db)
+                mongo_service.client.close()
+            for nome, valor in anteriores.items():
+                setattr(mongo_service, nome, valor)
+            mongo_service.limpar_contagens_cache()
+            mongo_async_service._indice_texto_disponivel = None
+
+
+def resumo_latencias(segundos: List[float]) -> Dict:
+    """ p50/p95/p99 (nearest-rank), média e máximo, em milissegundos. """
+    if not segundos:
+        return {}
+    ordenados = sorted(segundos)
+    def percentil(p):
+        return round(ordenados[max(0, -(-len(ordenados) * p // 100) - 1)] * 1000, 2)
+    return {"p50_ms": percentil(50), "p95_ms": percentil(95), "p99_ms": percentil(99),
+            "mean_ms": round(sum(ordenados) / len(ordenados) * 1000, 2), "max_ms": round(ordenados[-1] * 1000, 2)}
+
+def popular_historico(total: int, mensagens_por_chat: int = 4) -> int:
+    """
+    Acrescenta chats de exemplo (um por minuto, do mais antigo para o atual) até a coleção ter `total` documentos.
+    Devolve o número de chats inseridos.
+    """
+    from chat.services import mongo_service
+
+    collection = mongo_service.get_chats_collection()
+    existentes = collection.count_documents({})
+    agora = datetime.now(timezone.utc)
+    lote = []
+    for i in range(existentes, total):
+        criado = agora - timedelta(minutes=total - i)
+        mensagens = []
+        for j in range(mensagens_por_chat):
+            mensagem = {"role": "user" if j % 2 == 0 else "assistant", "timestamp": criado + timedelta(seconds=j),
+                        "content": f"Mensagem {j} do chat {i}: " + "texto de exemplo " * 20}
+            if mensagem["role"] == "assistant":
+                mensagem.update({"processing_time": 1.0, "model_used": "benchmark", "tokens": 60})
+            mensagens.append(mensagem)
+        lote.append({"title": f"Chat de benchmark {i}", "created_at": criado, "messages": mensagens, "model_name": "benchmark",
+                     **mongo_service.campos_resumo(mensagens, criado)})
+        if len(lote) == 1000:
+            collection.insert_many(lote, ordered=False)
+            lote = []
+    if lote:
+        collection.insert_many(lote, ordered=False)
+    mongo_service.limpar_contagens_cache()
+    return max(0, total - existentes)
+
+
+# --- Cenários ---
+
+def _correr(corrotina):
+    """ asyncio.run de um cenário; o cliente assíncrono pertence a esse loop e é fechado com ele. """
+    from chat.services import mongo_async_service
+
+    async def correr():
+        try:
+            return await corrotina
+        finally:
+            await mongo_async_service.fechar()
+    return asyncio.run(correr())
+
+def medir_chat(clientes: List[int], pedidos_por_cliente: int) -> List[Dict]:
+    """
+    POST /chat/gerar/ com N clientes em simultâneo; cada cliente envia os seus pedidos em sequência,
+    continuando a mesma conversa. Mede latência (extremo a extremo, na view) e débito.
+    """
+    from django.test import AsyncClient
+    from django.urls import reverse
+
+    resultados = []
+    for n in clientes:
+        latencias, erros = [], [0]
+
+        async def cliente(indice):
+            http = AsyncClient()
+            chat_id = None
+            for j in range(pedidos_por_cliente):
+                corpo = {"prompt": f"Pergunta {j} do cliente {indice}: explique o conceito {j}."}
+                if chat_id:
+                    corpo["chat_id"] = chat_id
+                inicio = time.perf_counter()
+                resposta = await http.post(reverse("chat:gerar_resposta"), data=corpo, content_type="application/json")
+                latencias.append(time.perf_counter() - inicio)
+                if resposta.status_code != 200:
+                    erros[0] += 1
+                    continue
+                chat_id = resposta.json()["chat_id"]
+
+        async def todos():
+            await asyncio.gather(*[cliente(i) for i in range(n)])
+
+        inicio = time.perf_counter()
+        _correr(todos())
+        segundos = time.perf_counter() - inicio
+        resultados.append({
+            "clients": n,
+            "requests": len(latencias),
+            "errors": erros[0],
+            "seconds": round(segundos, 3),
+            "requests_per_second": round(len(latencias) / segundos, 2) if segundos else 0.0,
+            "latency": resumo_latencias(latencias),
+        })
+    return resultados
+
+def medir_historico(tamanhos: List[int], paginas: List[int], repeticoes: int = 5) -> List[Dict]:
+    """ GET /chat/historico/ por tamanho da coleção e profundidade da página (seguindo os cursores keyset). """
+    from django.test import AsyncClient
+    from django.urls import reverse
+    from chat.services import mongo_async_service
+
+    async def cursor_da_pagina(pagina):
+        cursor = None
+        for _ in range(pagina - 1):
+            resultado = await mongo_async_service.get_chats_page(filters={}, per_page=10, cursor=cursor)
+            cursor = resultado["next_cursor"]
+            if cursor is None:
+                break
+        return cursor
+
+    async def pedidos(parametros):
+        http = AsyncClient()
+        latencias = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            resposta = await http.get(reverse("chat:historico"), parametros)
+            latencias.append(time.perf_counter() - inicio)
+            if resposta.status_code != 200:
+                raise RuntimeError(f"historico devolveu {resposta.status_code}")
+        return latencias
+
+    resultados = []
+    for tamanho in sorted(tamanhos):
+        popular_historico(tamanho)
+        for pagina in paginas:
+            cursor = _correr(cursor_da_pagina(pagina))
+            if pagina > 1 and cursor is None:
+                continue # A coleção não tem páginas suficientes
+            latencias = _correr(pedidos({"cursor": cursor} if cursor else {}))
+            resultados.append({"chats": tamanho, "page": pagina, "latency": resumo_latencias(latencias)})
+    return resultados
+
+def _consumir_exportacao(formato: str) -> int:
+    """ Lê a exportação inteira (como o browser) e devolve o número de bytes. """
+    from django.test import AsyncClient
+    from django.urls import reverse
+
+    async def ler():
+        resposta = await AsyncClient().get(reverse("chat:exportar_historico", args=[formato]))
+        total = 0
+        async for pedaco in resposta.streaming_content:
+            total += len(pedaco)
+        return total
+    return _correr(ler())
+
+def medir_exportacao(linhas: List[int], formatos: List[str]) -> List[Dict]:
+    """
+    GET /chat/exportar/<formato>/ por número de chats: tempo até ao último byte e pico de memória Python
+    (tracemalloc, numa segunda passagem para não afetar o tempo).
+    """
+    resultados = []
+    for total in sorted(linhas):
+        popular_historico(total)
+        for formato in formatos:
+            inicio = time.perf_counter()
+            tamanho = _consumir_exportacao(formato)
+            segundos = time.perf_counter() - inicio
+            tracemalloc.start()
+            try:
+                _consumir_exportacao(formato)
+                _, pico = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            resultados.append({
+                "chats": total,
+                "format": formato,
+                "bytes": tamanho,
+                "seconds": round(segundos, 3),
+                "chats_per_second": round(total / segundos, 1) if segundos else 0.0,
+                "peak_python_mb": round(pico / (1024 * 1024), 2),
+            })
+    return resultados
+
+def medir_tokens(prompts: List) -> Dict:
+    """
+    tokens/s de nlp_service.gerar_resposta_com_contexto (um pedido de cada vez, sem cache de respostas).
+    Cada prompt é um texto (conversa de um só turno) ou uma lista de mensagens.
+    """
+    from chat.services import nlp_service
+
+    tokens, segundos, latencias = 0, 0.0, []
+    for prompt in prompts:
+        historico = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+        inicio = time.perf_counter()
+        texto = nlp_service.gerar_resposta_com_contexto(historico)
+        duracao = time.perf_counter() - inicio
+        latencias.append(duracao)
+        segundos += duracao
+        tokens += nlp_service.contar_tokens(texto)
+    return {
+        "prompts": len(prompts),
+        "tokens": tokens,
+        "seconds": round(segundos, 3),
+        "tokens_per_second": round(tokens / segundos, 2) if segundos else 0.0,
+        "latency": resumo_latencias(latencias),
+    }
+
+
+# Conversas em que a resposta tende a repetir texto do histórico (ex: reescrever código), onde o
+# prompt lookup consegue propor tokens; os prompts de um só turno mostram o caso desfavorável.
+CONVERSAS_ESPECULATIVA = [
+    [
+        {"role": "user", "content": "Escreva uma função em Python que soma os números pares de uma lista."},
+        {"role": "assistant", "content": "def somar_pares(numeros):\n    total = 0\n    for numero in numeros:\n        if numero % 2 == 0:\n            total += numero\n    return total"},
+        {"role": "user", "content": "Repita a mesma função, mas com type hints e uma docstring."},
+    ],
+    [
+        {"role": "user", "content": "Corrija os erros: 'O relatorio foi enviado ontem para o diretor e para a equipa de vendas, que ja o aprovou.'"},
+    ],
+]
+
+def medir_especulativa(modos: List[str], prompts: Optional[List] = None) -> List[Dict]:
+    """
+    tokens/s de cada modo de decodificação especulativa face ao 'off' (sem micro-batching, para a referência
+    não incluir a janela de espera do scheduler), com os tokens aceites por passo e a taxa de aceitação.
+    """
+    from django.test.utils import override_settings
+    from chat.services import nlp_service
+
+    prompts = prompts or (CONVERSAS_ESPECULATIVA + PROMPTS_PADRAO[:2])
+    resultados = []
+    referencia = None
+    for modo in ["off"] + [m for m in modos if m != "off"]:
+        with override_settings(NLP_SPECULATIVE_MODE=modo, NLP_BATCH_ENABLED=False):
+            antes = nlp_service.estatisticas_especulacao()
+            medicao = medir_tokens(prompts)
+            depois = nlp_service.estatisticas_especulacao()
+        medicao["mode"] = modo
+        if modo == "off":
+            referencia = medicao["tokens_per_second"]
+        else:
+            passos = depois["steps"] - antes["steps"]
+            tokens = depois["tokens"] - antes["tokens"]
+            propostos = depois["proposed"] - antes["proposed"]
+            medicao.update(
+                tokens_per_step=round(tokens / passos, 3) if passos else None,
+                acceptance_rate=round((tokens - passos) / propostos, 4) if propostos else None,
+            )
+        medicao["speedup"] = round(medicao["tokens_per_second"] / referencia, 3) if referencia else None
+        resultados.append(medicao)
+    return resultados
+
+
+# --- Comparação entre execuções (ex: dois commits) ---
+
+_CHAVES_IDENTIFICADORAS = ("clients", "chats", "page", "format", "mode")
+
+def _achatar(valor, prefixo: str = "") -> Dict[str, float]:
+    """ {'caminho.da.metrica': valor} para os valores numéricos; listas indexadas pelos campos que identificam cada linha. """
+    if isinstance(valor, dict):
+        achatado = {}
+        for chave, item in valor.items():
+            if chave not in _CHAVES_IDENTIFICADORAS:
+                achatado.update(_achatar(item, f"{prefixo}.{chave}" if prefixo else chave))
+        return achatado
+    if isinstance(valor, list):
+        achatado = {}
+        for i, item in enumerate(valor):
+            rotulo = ",".join(f"{c}={item[c]}" for c in _CHAVES_IDENTIFICADORAS if isinstance(item, dict) and c in item) or str(i)
+            achatado.update(_achatar(item, f"{prefixo}[{rotulo}]"))
+        return achatado
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return {prefixo: valor}
+    return {}
+
+def comparar_resultados(anterior: Dict, atual: Dict, limiar: float = 0.10) -> List[Dict]:
+    """
+    Métricas de 'results' que variaram mais do que `limiar` (fração) entre duas execuções.
+    'regression' é True quando piorou: débitos (…per_second) mais baixos, tempos e memória mais altos.
+    """
+    antes, depois = _achatar(anterior.get("results", {})), _achatar(atual.get("results", {}))
+    variacoes = []
+    for caminho in sorted(antes.keys() & depois.keys()):
+        a, d = antes[caminho], depois[caminho]
+        if not a:
+            continue
+        variacao = (d - a) / abs(a)
+        if abs(variacao) < limiar:
+            continue
+        maior_e_melhor = caminho.endswith("per_second")
+        variacoes.append({"metric": caminho, "before": a, "after": d, "change": round(variacao, 4),
+                          "regression": variacao < 0 if maior_e_melhor else variacao > 0})
+    return variacoes
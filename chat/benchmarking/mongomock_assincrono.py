@@ -0,0 +1,48 @@
+"""
+O mongomock não tem API assíncrona: estes adaptadores dão-lhe a interface do AsyncMongoClient
+(métodos com await, find() com cursor encadeável e `async for`, aggregate() com await).
+Usados pelos benchmarks sem mongod e pelos testes das views assíncronas.
+"""
+
+
+class CursorMongomockAssincrono:
+    def __init__(self, cursor):
+        self._cursor = cursor
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+    def limit(self, n):
+        self._cursor = self._cursor.limit(n)
+        return self
+    def batch_size(self, n):
+        return self
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+    async def to_list(self, length=None):
+        return list(self._cursor)
+    async def close(self):
+        pass
+
+class ColecaoMongomockAssincrona:
+    def __init__(self, colecao):
+        self._colecao = colecao
+    def find(self, *args, **kwargs):
+        return CursorMongomockAssincrono(self._colecao.find(*args, **kwargs))
+    async def aggregate(self, *args, **kwargs):
+        return CursorMongomockAssincrono(iter(self._colecao.aggregate(*args, **kwargs)))
+    def __getattr__(self, nome):
+        metodo = getattr(self._colecao, nome)
+        async def chamar(*args, **kwargs):
+            return metodo(*args, **kwargs)
+        return chamar
+
+class BaseMongomockAssincrona:
+    def __init__(self, db):
+        self._db = db
+    def __getitem__(self, nome):
+        return ColecaoMongomockAssincrona(self._db[nome])
@@ -0,0 +1,121 @@
+"""
+Medição da geração em cada modo de precisão (tokens/s, memória, concordância entre modos).
+Usada pelo comando `python manage.py benchmark_precisao`.
+"""
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+try:
+    import resource # Só existe em POSIX
+except ImportError:
+    resource = None
+
+PROMPTS_PADRAO = [
+    "Olá! Quem é você?",
+    "Explique em poucas frases o que é aprendizagem automática.",
+    "Escreva uma função em Python que inverte uma string.",
+    "Quais são as capitais de Portugal e do Brasil?",
+    "Dê três dicas para estudar melhor para um exame.",
+]
+
+
+def pico_rss_mb() -> Optional[float]:
+    """
+    Pico de memória residente (RSS) do processo atual, em MB. Sem o módulo resource (Windows) usa o psutil,
+    se estiver instalado, e por fim o pico do tracemalloc (só a memória do Python, e só se estiver ativo).
+    """
+    if resource is not None:
+        maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux devolve KB; macOS devolve bytes
+        return round(maximo / (1024 * 1024) if sys.platform == "darwin" else maximo / 1024, 1)
+    try:
+        import psutil
+        memoria = psutil.Process().memory_info()
+        return round(getattr(memoria, "peak_wset", memoria.rss) / (1024 * 1024), 1)
+    except ImportError:
+        pass
+    if tracemalloc.is_tracing():
+        return round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+    return None
+
+def medir_geracao(tokenizer, model, prompts: List[str], max_new_tokens: int = 64, **generate_kwargs) -> Dict:
+    """
+    Gera (greedy, um prompt de cada vez) a resposta de cada prompt e mede o débito.
+    Devolve os totais e os token ids gerados por prompt (para comparar modos entre si).
+    """
+    import torch
+    from chat.services.nlp_service import SYSTEM_PROMPT
+
+    saidas = []
+    tokens_total = 0
+    segundos_total = 0.0
+    for prompt in prompts:
+        text = tokenizer.apply_chat_template(
+            [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        input_ids = tokenizer([text], return_tensors="pt").input_ids
+        inicio = time.perf_counter()
+        with torch.inference_mode():
+            generated_ids = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False, **generate_kwargs)
+        segundos_total += time.perf_counter() - inicio
+        output_ids = generated_ids[0][input_ids.shape[1]:].tolist()
+        tokens_total += len(output_ids)
+        saidas.append(output_ids)
+
+    return {
+        "prompts": len(prompts),
+        "tokens": tokens_total,
+        "seconds": round(segundos_total, 3),
+        "tokens_per_second": round(tokens_total / segundos_total, 2) if segundos_total else 0.0,
+        "outputs": saidas,
+    }
+
+def concordancia(referencia: List[List[int]], outras: List[List[int]]) -> Dict:
+    """
+    Compara as saídas de um modo com as da referência (fp32):
+    fração média de tokens iguais na mesma posição e fração de respostas idênticas.
+    """
+    fracoes = []
+    identicas = 0
+    for ref, outra in zip(referencia, outras):
+        comprimento = max(len(ref), len(outra)) or 1
+        iguais = sum(1 for a, b in zip(ref, outra) if a == b)
+        fracoes.append(iguais / comprimento)
+        identicas += int(ref == outra)
+    n = len(fracoes) or 1
+    return {
+        "token_agreement": round(sum(fracoes) / n, 4),
+        "exact_match_rate": round(identicas / n, 4),
+    }
+
+def medir_modo_precisao(precisao: str, checkpoint: str, prompts: List[str], max_new_tokens: int, resultados) -> None:
+    """
+    Corre num processo próprio (para que o pico de RSS seja só deste modo):
+    carrega o modelo na precisão pedida, mede a geração e põe o resultado na fila `resultados`.
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+    from chat.services import nlp_service
+
+    try:
+        inicio = time.perf_counter()
+        tokenizer, model, precisao_efetiva = nlp_service.carregar_modelo_e_tokenizer(precisao, checkpoint)
+        segundos_carregamento = time.perf_counter() - inicio
+        # Aquecimento, para não medir as inicializações da primeira chamada
+        medir_geracao(tokenizer, model, prompts[:1], max_new_tokens=4)
+        medicao = medir_geracao(tokenizer, model, prompts, max_new_tokens=max_new_tokens)
+        medicao.update({
+            "mode": precisao,
+            "effective_precision": precisao_efetiva,
+            "load_seconds": round(segundos_carregamento, 2),
+            "peak_rss_mb": pico_rss_mb(),
+        })
+        resultados.put(medicao)
+    except Exception as e:
+        resultados.put({"mode": precisao, "error": str(e)})
@@ -0,0 +1,60 @@
+"""
+Handler de logging não bloqueante (usado em settings.LOGGING).
+
+Os registos vão para uma fila em memória e uma thread (QueueListener) formata-os e escreve-os na consola,
+por isso um pedido nunca espera pelo stdout/stderr. A mensagem só é formatada (msg % args) nessa thread e
+apenas para os registos que passam o nível configurado.
+"""
+import logging
+import logging.handlers
+import queue
+import threading
+
+from .services import metrics
+
+
+class FilaHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler com o seu próprio QueueListener. Se a fila encher (consola muito lenta), os registos
+    novos são descartados e contados em vez de bloquear quem regista.
+    """
+
+    def __init__(self, stream=None, capacidade: int = 10000):
+        super().__init__(queue.Queue(capacidade))
+        self.destino = logging.StreamHandler(stream)
+        self.descartados = 0
+        self._lock_descartados = threading.Lock()
+        self.listener = logging.handlers.QueueListener(self.queue, self.destino)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # A formatação é feita pelo destino, na thread do listener
+        super().setFormatter(fmt)
+        self.destino.setFormatter(fmt)
+
+    def prepare(self, record):
+        # O registo não sai do processo: não é preciso formatá-lo (nem copiá-lo) aqui
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock_descartados:
+                self.descartados += 1
+
+    def close(self):
+        # Chamado no logging.shutdown() ao sair: escreve o que ainda está na fila
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.destino.close()
+        super().close()
+
+
+class TraceIdFilter(logging.Filter):
+    """ Acrescenta o ID de trace do pedido (METRICS_TRACE_IDS) a cada registo, como %(trace_id)s. """
+
+    def filter(self, record):
+        record.trace_id = metrics.trace_id.get() or "-"
+        return True
@@ -0,0 +1,167 @@
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import torch
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chat.benchmarking import desempenho
+from chat.services import nlp_service
+
+CENARIOS = ("chat", "historico", "exportacao", "tokens", "especulativa")
+
+
+def _lista_de_inteiros(texto: str):
+    try:
+        return [int(valor) for valor in texto.split(',') if valor.strip()]
+    except ValueError:
+        raise CommandError(f"Lista inválida '{texto}': use números separados por vírgula.")
+
+def _commit_atual() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark do caminho dos pedidos, sem servidor nem MongoDB reais: latência e débito de /chat/gerar/ com N clientes, "
+        "latência do histórico por tamanho e página, tempo e memória da exportação, e tokens/s da geração. "
+        "Os resultados vão para JSON, para comparar entre commits (--comparar)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cenarios', default=','.join(CENARIOS), help=f"Cenários a correr ({', '.join(CENARIOS)}).")
+        parser.add_argument('--clientes', default='1,4,16', help="Clientes em simultâneo no cenário 'chat'.")
+        parser.add_argument('--pedidos', type=int, default=5, help="Pedidos (turnos da mesma conversa) por cliente.")
+        parser.add_argument('--tamanhos', default='1000,10000', help="Número de chats na coleção no cenário 'historico'.")
+        parser.add_argument('--paginas', default='1,10,50', help="Páginas do histórico a medir (seguindo os cursores).")
+        parser.add_argument('--linhas', default='1000,10000', help="Número de chats exportados no cenário 'exportacao'.")
+        parser.add_argument('--formatos', default='json,ndjson,csv', help="Formatos de exportação.")
+        parser.add_argument('--repeticoes', type=int, default=5, help="Pedidos por medição do histórico.")
+        parser.add_argument('--mongo-uri', default='', help="Usa uma base descartável neste mongod em vez do mongomock.")
+        parser.add_argument('--modelo', default='simulado',
+                            help="'simulado' (ModeloSimulado, sem custo de modelo) ou o nome/caminho de um modelo (ex: um Qwen pequeno).")
+        parser.add_argument('--modos-especulativos', default='prompt_lookup,draft',
+                            help="Modos comparados com o 'off' no cenário 'especulativa' ('draft' só com --rascunho ou NLP_DRAFT_MODEL).")
+        parser.add_argument('--rascunho', default='', help="Modelo de rascunho para o modo 'draft' (substitui NLP_DRAFT_MODEL).")
+        parser.add_argument('--tokens-simulados', type=int, default=32, help="Tokens por resposta do modelo simulado.")
+        parser.add_argument('--tokens-por-segundo', type=float, default=200.0, help="Débito do modelo simulado.")
+        parser.add_argument('--saida', help="Guarda os resultados neste ficheiro JSON.")
+        parser.add_argument('--comparar', help="Ficheiro JSON de uma execução anterior: mostra as métricas que variaram.")
+        parser.add_argument('--limiar', type=float, default=0.10, help="Variação mínima (fração) mostrada por --comparar.")
+
+    def handle(self, *args, **options):
+        cenarios = [c.strip() for c in options['cenarios'].split(',') if c.strip()]
+        for cenario in cenarios:
+            if cenario not in CENARIOS:
+                raise CommandError(f"Cenário desconhecido '{cenario}'. Opções: {', '.join(CENARIOS)}.")
+
+        modelo = None
+        if options['modelo'] == 'simulado':
+            modelo = desempenho.ModeloSimulado(tokens=options['tokens_simulados'], tokens_por_segundo=options['tokens_por_segundo'])
+            nome_modelo = f"simulado ({options['tokens_simulados']} tokens a {options['tokens_por_segundo']} tokens/s)"
+        else:
+            nome_modelo = self._carregar_modelo(options['modelo'])
+
+        resultados = {}
+        with desempenho.ambiente_benchmark(options['mongo_uri'], modelo) as base_de_dados:
+            self.stdout.write(f"Base de dados: {base_de_dados} | modelo: {nome_modelo}")
+            if 'chat' in cenarios:
+                self.stdout.write("A medir /chat/gerar/...")
+                resultados['chat'] = desempenho.medir_chat(_lista_de_inteiros(options['clientes']), options['pedidos'])
+                for linha in resultados['chat']:
+                    self.stdout.write(
+                        f"  {linha['clients']:>4} clientes: {linha['requests_per_second']:>8} pedidos/s, "
+                        f"p50 {linha['latency'].get('p50_ms')} ms, p95 {linha['latency'].get('p95_ms')} ms, erros {linha['errors']}"
+                    )
+            if 'tokens' in cenarios:
+                self.stdout.write("A medir gerar_resposta_com_contexto...")
+                resultados['tokens'] = desempenho.medir_tokens(desempenho.PROMPTS_PADRAO)
+                self.stdout.write(f"  {resultados['tokens']['tokens_per_second']} tokens/s")
+            if 'especulativa' in cenarios:
+                if modelo is not None:
+                    self.stdout.write("Cenário 'especulativa' ignorado: requer um modelo real (--modelo).")
+                else:
+                    self.stdout.write("A medir a decodificação especulativa...")
+                    resultados['especulativa'] = self._medir_especulativa(options)
+                    for linha in resultados['especulativa']:
+                        self.stdout.write(
+                            f"  {linha['mode']:<14}{linha['tokens_per_second']:>9} tokens/s  x{linha['speedup']}"
+                            + (f"  {linha['tokens_per_step']} tokens/passo, aceitação {linha['acceptance_rate']:.1%}"
+                               if linha.get('acceptance_rate') is not None else "")
+                        )
+            if 'historico' in cenarios:
+                self.stdout.write("A medir /chat/historico/...")
+                resultados['historico'] = desempenho.medir_historico(
+                    _lista_de_inteiros(options['tamanhos']), _lista_de_inteiros(options['paginas']), options['repeticoes']
+                )
+                for linha in resultados['historico']:
+                    self.stdout.write(f"  {linha['chats']:>7} chats, página {linha['page']:>3}: p50 {linha['latency']['p50_ms']} ms")
+            if 'exportacao' in cenarios:
+                self.stdout.write("A medir /chat/exportar/...")
+                formatos = [f.strip() for f in options['formatos'].split(',') if f.strip()]
+                resultados['exportacao'] = desempenho.medir_exportacao(_lista_de_inteiros(options['linhas']), formatos)
+                for linha in resultados['exportacao']:
+                    self.stdout.write(
+                        f"  {linha['chats']:>7} chats, {linha['format']:<6}: {linha['seconds']} s, "
+                        f"{linha['chats_per_second']} chats/s, pico {linha['peak_python_mb']} MB"
+                    )
+
+        relatorio = {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'commit': _commit_atual(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'torch_threads': torch.get_num_threads(),
+                'database': base_de_dados,
+                'model': nome_modelo,
+            },
+            'options': {chave: options[chave] for chave in ('clientes', 'pedidos', 'tamanhos', 'paginas', 'linhas', 'formatos', 'repeticoes', 'modos_especulativos')},
+            'results': resultados,
+        }
+
+        if options['comparar']:
+            with open(options['comparar'], encoding='utf-8') as ficheiro:
+                anterior = json.load(ficheiro)
+            variacoes = desempenho.comparar_resultados(anterior, relatorio, options['limiar'])
+            relatorio['comparison'] = {'baseline_commit': anterior.get('commit', ''), 'changes': variacoes}
+            self.stdout.write(f"\nComparação com {options['comparar']} ({anterior.get('commit') or 'sem commit'}):")
+            for variacao in variacoes:
+                estilo = self.style.ERROR if variacao['regression'] else self.style.SUCCESS
+                self.stdout.write(estilo(f"  {variacao['metric']}: {variacao['before']} -> {variacao['after']} ({variacao['change']:+.1%})"))
+            if not variacoes:
+                self.stdout.write(f"  Nenhuma métrica variou mais de {options['limiar']:.0%}.")
+
+        if options['saida']:
+            with open(options['saida'], 'w', encoding='utf-8') as ficheiro:
+                json.dump(relatorio, ficheiro, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"Resultados guardados em {options['saida']}"))
+
+    def _medir_especulativa(self, options) -> list:
+        modos = [m.strip() for m in options['modos_especulativos'].split(',') if m.strip()]
+        for modo in modos:
+            if modo not in nlp_service.MODOS_ESPECULATIVOS:
+                raise CommandError(f"Modo especulativo desconhecido '{modo}'. Opções: {', '.join(nlp_service.MODOS_ESPECULATIVOS)}.")
+        rascunho = options['rascunho'] or settings.NLP_DRAFT_MODEL
+        if 'draft' in modos and not rascunho:
+            self.stdout.write("  Modo 'draft' ignorado: indique o modelo de rascunho com --rascunho.")
+            modos.remove('draft')
+        with override_settings(NLP_DRAFT_MODEL=rascunho):
+            return desempenho.medir_especulativa(modos)
+
+    def _carregar_modelo(self, nome: str) -> str:
+        """ Carrega o modelo pedido pelo nlp_service (tal como nos workers) e espera que fique pronto. """
+        nlp_service.iniciar_carregamento(nome=nome)
+        while not nlp_service.modelo_pronto():
+            estado = nlp_service.estado_modelo()
+            if estado['status'] == 'failed':
+                raise CommandError(f"Não foi possível carregar o modelo '{nome}': {estado['error']}")
+            time.sleep(0.2)
+        return f"{nome} ({nlp_service.estado_modelo()['precision']})"
@@ -0,0 +1,104 @@
+import json
+import multiprocessing
+import queue
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import nlp_service
+from chat.benchmarking.precisao import PROMPTS_PADRAO, concordancia, medir_modo_precisao
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara os modos de precisão da inferência em CPU (fp32, bf16, int8, checkpoint pré-quantizado): "
+        "tokens/s, pico de RSS e concordância das respostas com o fp32."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modos', default='fp32,bf16,int8',
+                            help=f"Modos a comparar, separados por vírgula ({', '.join(nlp_service.PRECISOES)}). O fp32 é sempre incluído como referência.")
+        parser.add_argument('--checkpoint', default=settings.NLP_QUANTIZED_CHECKPOINT,
+                            help="Também mede este modelo pré-quantizado (gerado com `quantizar_modelo`).")
+        parser.add_argument('--prompts', help="Ficheiro de texto com um prompt por linha (padrão: prompts de exemplo).")
+        parser.add_argument('--max-new-tokens', type=int, default=64)
+        parser.add_argument('--saida', help="Guarda os resultados neste ficheiro JSON.")
+        parser.add_argument('--timeout', type=float, default=1800,
+                            help="Segundos máximos por modo (carregamento + medição); depois disso o modo conta como falhado.")
+
+    def handle(self, *args, **options):
+        modos = [m.strip() for m in options['modos'].split(',') if m.strip()]
+        for modo in modos:
+            if modo not in nlp_service.PRECISOES:
+                raise CommandError(f"Modo desconhecido '{modo}'. Opções: {', '.join(nlp_service.PRECISOES)}.")
+        modos = ['fp32'] + [m for m in modos if m != 'fp32']
+
+        prompts = PROMPTS_PADRAO
+        if options['prompts']:
+            with open(options['prompts'], encoding='utf-8') as ficheiro:
+                prompts = [linha.strip() for linha in ficheiro if linha.strip()]
+
+        execucoes = [(modo, '') for modo in modos]
+        if options['checkpoint']:
+            execucoes.append(('auto', options['checkpoint']))
+
+        # Cada modo corre num processo novo, para que o pico de RSS não inclua os modelos anteriores
+        ctx = multiprocessing.get_context('spawn')
+        resultados = []
+        for modo, checkpoint in execucoes:
+            self.stdout.write(f"A medir {'checkpoint ' + checkpoint if checkpoint else modo}...")
+            fila = ctx.Queue()
+            processo = ctx.Process(target=medir_modo_precisao, args=(modo, checkpoint, prompts, options['max_new_tokens'], fila))
+            processo.start()
+            resultados.append(self._esperar_resultado(fila, processo, modo, options['timeout']))
+
+        referencia = resultados[0]
+        if 'error' in referencia:
+            raise CommandError(f"Falha ao medir a referência fp32: {referencia['error']}")
+        for resultado in resultados:
+            if 'error' not in resultado:
+                resultado.update(concordancia(referencia['outputs'], resultado['outputs']))
+
+        self.stdout.write(f"\n{'modo':<28}{'tokens/s':>10}{'pico RSS (MB)':>15}{'concordância':>14}{'idênticas':>11}")
+        for resultado in resultados:
+            nome = resultado.get('effective_precision', resultado['mode'])
+            if 'error' in resultado:
+                self.stdout.write(f"{nome:<28}  ERRO: {resultado['error']}")
+                continue
+            self.stdout.write(
+                f"{nome:<28}{resultado['tokens_per_second']:>10}{resultado['peak_rss_mb']:>15}"
+                f"{resultado['token_agreement']:>14.2%}{resultado['exact_match_rate']:>11.2%}"
+            )
+
+        if options['saida']:
+            for resultado in resultados:
+                resultado.pop('outputs', None)
+            with open(options['saida'], 'w', encoding='utf-8') as ficheiro:
+                json.dump({'model_name': nlp_service.nome_modelo(), 'prompts': len(prompts), 'results': resultados}, ficheiro, indent=2, ensure_ascii=False)
+            self.stdout.write(self.style.SUCCESS(f"Resultados guardados em {options['saida']}"))
+
+    def _esperar_resultado(self, fila, processo, modo: str, timeout: float) -> dict:
+        """
+        Resultado do processo de um modo. Se o processo morrer sem o enviar (ex: OOM, erro ao quantizar)
+        ou passar do tempo limite, o modo é dado como falhado em vez de bloquear o comando.
+        """
+        limite = time.monotonic() + timeout
+        while True:
+            try:
+                resultado = fila.get(timeout=1)
+                break
+            except queue.Empty:
+                pass
+            if not processo.is_alive():
+                try:
+                    resultado = fila.get(timeout=1) # Pode ter enviado o resultado mesmo antes de terminar
+                except queue.Empty:
+                    resultado = {"mode": modo, "error": f"o processo terminou sem resultado (código de saída {processo.exitcode})"}
+                break
+            if time.monotonic() >= limite:
+                processo.terminate()
+                resultado = {"mode": modo, "error": f"sem resultado ao fim de {timeout:g} segundos"}
+                break
+        processo.join()
+        return resultado
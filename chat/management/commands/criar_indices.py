@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import mongo_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Cria os índices do MongoDB em falta (listagem por data, pesquisa por texto, buckets de mensagens) "
+        "e verifica os existentes. Termina com erro se algum índice não puder ser criado."
+    )
+
+    def handle(self, *args, **options):
+        relatorio = mongo_service.garantir_indices()
+        if not relatorio:
+            raise CommandError("Não foi possível ligar ao MongoDB.")
+
+        erros = 0
+        for colecao, indices in relatorio.items():
+            for nome, estado in indices.items():
+                if estado.startswith("erro"):
+                    erros += 1
+                    self.stdout.write(self.style.ERROR(f"{colecao}.{nome}: {estado}"))
+                else:
+                    self.stdout.write(f"{colecao}.{nome}: {estado}")
+        if erros:
+            raise CommandError(f"{erros} índice(s) com problemas.")
+        self.stdout.write(self.style.SUCCESS("Índices verificados."))
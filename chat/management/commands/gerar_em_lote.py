@@ -0,0 +1,77 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import batch_inference, nlp_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Gera as respostas de um ficheiro JSONL de prompts (ou conversas) com o modelo local, em lotes ordenados "
+        "por tamanho, sem passar pelo HTTP nem pelo histórico. Os resultados vão para um JSONL de saída, que serve "
+        "também de checkpoint (--retomar)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('entrada', help="JSONL com 'prompt' ou 'messages' (e 'id' opcional) em cada linha.")
+        parser.add_argument('saida', help="JSONL de saída (uma linha por pedido, com 'response' e a contagem de tokens).")
+        parser.add_argument('--lote', type=int, default=8, help="Prompts por model.generate.")
+        parser.add_argument('--max-tokens', type=int, default=0, help="Máximo de tokens gerados por resposta (0 = MAX_NEW_TOKENS).")
+        parser.add_argument('--retomar', action='store_true', help="Continua uma execução interrompida: salta os ids já presentes na saída.")
+        parser.add_argument('--mongo', action='store_true', help="Guarda também cada resultado como um chat no MongoDB.")
+        parser.add_argument('--modelo', default='', help="Nome/caminho do modelo (por omissão, o do nlp_service).")
+
+    def handle(self, *args, **options):
+        if options['lote'] < 1:
+            raise CommandError("--lote deve ser pelo menos 1.")
+        if os.path.exists(options['saida']) and not options['retomar']:
+            raise CommandError(f"'{options['saida']}' já existe: use --retomar para continuar ou escolha outro ficheiro.")
+        try:
+            pedidos = batch_inference.ler_pedidos(options['entrada'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Erro ao ler '{options['entrada']}': {e}")
+
+        feitos = batch_inference.ids_concluidos(options['saida']) if options['retomar'] else set()
+        pendentes = [p for p in pedidos if p['id'] not in feitos]
+        self.stdout.write(f"{len(pedidos)} pedidos, {len(pedidos) - len(pendentes)} já concluídos.")
+        if not pendentes:
+            return
+
+        self.stdout.write(f"Modelo: {self._carregar_modelo(options['modelo'])}")
+        pendentes = batch_inference.ordenar_por_tamanho(pendentes)
+        totais = batch_inference.gerar(
+            pendentes, options['saida'], tamanho_lote=options['lote'], max_new_tokens=options['max_tokens'] or None,
+            guardar_mongo=options['mongo'], ao_terminar_lote=self._lote_terminado
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{totais['requests']} respostas em {totais['batches']} lotes: {totais['generated_tokens']} tokens gerados em "
+            f"{totais['seconds']}s ({totais['tokens_per_second']} tokens/s). Resultados em {options['saida']}"
+        ))
+
+    def _lote_terminado(self, medicao: dict):
+        self.stdout.write(
+            f"  Lote {medicao['batch']}/{medicao['batches']}: {medicao['size']} prompts, {medicao['prompt_tokens']} tokens de prompt "
+            f"({medicao['padding_ratio']:.0%} padding), {medicao['generated_tokens']} gerados em {medicao['seconds']}s "
+            f"({medicao['tokens_per_second']} tokens/s)"
+        )
+
+    def _carregar_modelo(self, nome: str) -> str:
+        """
+        Carrega o modelo pelo nlp_service (tal como nos workers) e espera que fique pronto.
+        A geração é sempre local, mesmo que os workers usem o servidor de inferência.
+        """
+        if nome and nlp_service.modelo_pronto() and nome != nlp_service.nome_modelo():
+            raise CommandError("Já há um modelo carregado neste processo; --modelo só pode ser usado antes do carregamento.")
+        if not nlp_service.modelo_pronto():
+            try:
+                nlp_service.iniciar_carregamento(nome=nome or None, backend='local')
+            except RuntimeError as e:
+                raise CommandError(f"{e} --modelo só pode ser usado antes do carregamento.")
+        while not nlp_service.modelo_pronto():
+            estado = nlp_service.estado_modelo()
+            if estado['status'] == 'failed':
+                raise CommandError(f"Não foi possível carregar o modelo '{nlp_service.nome_modelo()}': {estado['error']}")
+            time.sleep(0.2)
+        return f"{nlp_service.nome_modelo()} ({nlp_service.estado_modelo()['precision']})"
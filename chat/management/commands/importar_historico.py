@@ -0,0 +1,75 @@
+import gzip
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import import_service
+
+EXTENSOES = {".json": "json", ".ndjson": "ndjson", ".jsonl": "ndjson", ".csv": "csv"}
+
+
+def _abrir(caminho: str):
+    """ Abre o ficheiro (descomprimindo .gz e .zst, como os dos jobs de exportação) em modo binário. """
+    if caminho.endswith(".gz"):
+        return gzip.open(caminho, "rb"), caminho[:-3]
+    if caminho.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError("Ficheiros .zst requerem o pacote 'zstandard'.")
+        return zstandard.ZstdDecompressor().stream_reader(open(caminho, "rb"), closefd=True), caminho[:-4]
+    return open(caminho, "rb"), caminho
+
+
+class Command(BaseCommand):
+    help = (
+        "Importa chats no formato da exportação (JSON, NDJSON ou CSV, opcionalmente .gz/.zst) em lotes "
+        "(insert_many não ordenado). Os chats que já existem (mesmo _id) são ignorados, ou substituídos com --substituir."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('ficheiros', nargs='+', help="Ficheiros a importar.")
+        parser.add_argument('--formato', choices=import_service.FORMATOS_IMPORTACAO,
+                            help="Formato dos ficheiros (por omissão, deduzido da extensão).")
+        parser.add_argument('--lote', type=int, default=0, help="Chats por escrita no MongoDB (0 = IMPORT_BATCH_SIZE).")
+        parser.add_argument('--substituir', action='store_true', help="Substitui os chats que já existem em vez de os ignorar.")
+
+    def handle(self, *args, **options):
+        total = {"chats": 0, "replaced": 0, "duplicates": 0, "invalid": 0, "messages": 0}
+        inicio = time.perf_counter()
+        for caminho in options['ficheiros']:
+            try:
+                fonte, nome = _abrir(caminho)
+            except OSError as e:
+                raise CommandError(f"Não foi possível abrir '{caminho}': {e}")
+            formato = options['formato'] or next((f for ext, f in EXTENSOES.items() if nome.endswith(ext)), None)
+            if formato is None:
+                raise CommandError(f"Não foi possível deduzir o formato de '{caminho}': use --formato.")
+
+            self.stdout.write(f"A importar {caminho} ({formato})...")
+            try:
+                with fonte:
+                    resultado = import_service.importar_de(
+                        fonte, formato, tamanho_lote=options['lote'] or None, substituir=options['substituir'],
+                        ao_progredir=self._progresso
+                    )
+            except (ValueError, RuntimeError) as e:
+                raise CommandError(f"Erro ao importar '{caminho}': {e}")
+            for chave in total:
+                total[chave] += resultado[chave]
+            self.stdout.write(
+                f"  {resultado['chats']} chats novos, {resultado['replaced']} substituídos, {resultado['duplicates']} duplicados, "
+                f"{resultado['invalid']} inválidos | {resultado['messages']} mensagens em {resultado['seconds']}s "
+                f"({resultado['chats_per_second']} chats/s, {resultado['messages_per_second']} mensagens/s)"
+            )
+
+        segundos = time.perf_counter() - inicio
+        self.stdout.write(self.style.SUCCESS(
+            f"{total['chats'] + total['replaced']} chats ({total['messages']} mensagens) importados em {round(segundos, 1)}s: "
+            f"{round((total['chats'] + total['replaced']) / segundos, 1) if segundos else '-'} chats/s. "
+            f"{total['duplicates']} duplicados e {total['invalid']} inválidos ignorados."
+        ))
+
+    def _progresso(self, estatisticas: dict):
+        if estatisticas['batches'] % 10 == 0:
+            self.stdout.write(f"  {estatisticas['chats'] + estatisticas['replaced']} chats importados...")
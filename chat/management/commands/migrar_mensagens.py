@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import mongo_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Converte os chats antigos (mensagens no array 'messages' do documento) para o armazenamento "
+        "em buckets (coleção 'chat_buckets'). Pode ser interrompido e repetido sem duplicar mensagens."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limite', type=int, default=0, help="Número máximo de chats a converter (0 = todos).")
+
+    def handle(self, *args, **options):
+        collection = mongo_service.get_chats_collection()
+        if collection is None or mongo_service.get_buckets_collection() is None:
+            raise CommandError("Não foi possível ligar ao MongoDB.")
+
+        inicio = time.time()
+        cursor = collection.find({"message_storage": {"$ne": "bucketed"}}, {"messages": 1, "created_at": 1})
+        if options['limite']:
+            cursor = cursor.limit(options['limite'])
+
+        chats = mensagens = 0
+        for chat in cursor:
+            mensagens += mongo_service.converter_chat_para_buckets(chat)
+            chats += 1
+            if chats % 100 == 0:
+                self.stdout.write(f"{chats} chats convertidos...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{chats} chats ({mensagens} mensagens) convertidos para buckets em {round(time.time() - inicio, 1)}s. "
+            "Defina MONGO_MESSAGE_STORAGE=bucketed para que os chats novos também usem buckets."
+        ))
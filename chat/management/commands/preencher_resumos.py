@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.services import mongo_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Preenche os campos de resumo dos chats (message_count, last_message_preview, last_message_at, "
+        "total_processing_time, total_tokens) a partir das mensagens, para os chats criados antes destes campos. "
+        "Pode ser interrompido e repetido: cada chat é recalculado do zero."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limite', type=int, default=0, help="Número máximo de chats a preencher (0 = todos).")
+        parser.add_argument('--lote', type=int, default=100, help="Chats lidos do MongoDB de cada vez.")
+        parser.add_argument('--em-falta', action='store_true',
+                            help="Só os chats sem campos de resumo (mais rápido, mas não corrige chats com totais parciais).")
+
+    def handle(self, *args, **options):
+        collection = mongo_service.get_chats_collection()
+        if collection is None or mongo_service.get_buckets_collection() is None:
+            raise CommandError("Não foi possível ligar ao MongoDB.")
+
+        inicio = time.time()
+        query = {"last_message_preview": {"$exists": False}} if options['em_falta'] else {}
+        cursor = collection.find(
+            query, {"messages": 1, "created_at": 1, "message_storage": 1, "message_count": 1}
+        ).batch_size(max(1, options['lote']))
+        if options['limite']:
+            cursor = cursor.limit(options['limite'])
+
+        chats = ignorados = 0
+        for chat in cursor:
+            escrito = mongo_service.preencher_resumo_chat(chat)
+            if escrito is False:
+                # Recebeu uma mensagem entretanto: volta a ler o chat e tenta outra vez
+                chat = collection.find_one({"_id": chat["_id"]}, {"messages": 1, "created_at": 1, "message_storage": 1, "message_count": 1})
+                escrito = mongo_service.preencher_resumo_chat(chat) if chat else None
+            if escrito:
+                chats += 1
+            else:
+                ignorados += 1
+            if (chats + ignorados) % 1000 == 0:
+                self.stdout.write(f"{chats} chats preenchidos...")
+
+        mongo_service.limpar_contagens_cache()
+        self.stdout.write(self.style.SUCCESS(
+            f"{chats} chats preenchidos em {round(time.time() - inicio, 1)}s"
+            + (f" ({ignorados} ignorados: apagados ou alterados durante o preenchimento)." if ignorados else ".")
+            + " Execute `python manage.py criar_indices` para criar os índices das novas ordenações."
+        ))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.services import nlp_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Carrega o modelo, aplica a quantização dinâmica int8 e guarda-o em disco, para que os workers "
+        "o carreguem já quantizado (NLP_QUANTIZED_CHECKPOINT) sem repetir a conversão no arranque."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--saida', required=True, help="Caminho do ficheiro a criar (ex: modelos/qwen2-int8.pt).")
+
+    def handle(self, *args, **options):
+        inicio = time.time()
+        _, model, _ = nlp_service.carregar_modelo_e_tokenizer('int8')
+        nlp_service.guardar_checkpoint_int8(model, options['saida'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Modelo int8 guardado em {options['saida']} ({round(time.time() - inicio, 1)}s). "
+            f"Use NLP_QUANTIZED_CHECKPOINT={options['saida']} para o carregar."
+        ))
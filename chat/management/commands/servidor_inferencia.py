@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.services.inference_client import authkey
+from chat.services.inference_server import InferenceServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Inicia o servidor de inferência dedicado: N réplicas do modelo, cada uma num processo próprio. "
+        "Os workers Django ligam-se a ele com NLP_INFERENCE_BACKEND=remote."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endereco', default=settings.NLP_INFERENCE_ADDRESS,
+                            help="'host:porta' ou caminho de socket Unix (padrão: NLP_INFERENCE_ADDRESS).")
+        parser.add_argument('--replicas', type=int, default=settings.NLP_INFERENCE_REPLICAS,
+                            help="Número de cópias do modelo (processos réplica).")
+        parser.add_argument('--threads', type=int, default=settings.NLP_INFERENCE_THREADS,
+                            help="Threads intra-op do torch por réplica.")
+        parser.add_argument('--concorrencia', type=int, default=settings.NLP_BATCH_MAX_SIZE * 2,
+                            help="Pedidos atendidos em simultâneo por réplica (agrupados pelo micro-batching).")
+
+    def handle(self, *args, **options):
+        servidor = InferenceServer(
+            options['endereco'],
+            authkey(),
+            replicas=options['replicas'],
+            threads=options['threads'],
+            max_concorrencia=options['concorrencia'],
+            timeout=settings.NLP_INFERENCE_TIMEOUT_SECONDS,
+        )
+        try:
+            servidor.servir_para_sempre()
+        except KeyboardInterrupt:
+            self.stdout.write("A parar o servidor de inferência...")
+            servidor.parar()
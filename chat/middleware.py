@@ -0,0 +1,33 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .services import metrics
+
+
+class MetricasMiddleware:
+    """
+    Mede a duração de cada pedido (histograma por view, método e estado) e, com METRICS_TRACE_IDS,
+    atribui-lhe um ID de trace e devolve o Server-Timing com o tempo de cada etapa.
+    Funciona nos dois modos (WSGI e ASGI) sem forçar as views assíncronas a correr numa thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.assincrono = iscoroutinefunction(get_response)
+        if self.assincrono:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.assincrono:
+            return self.__acall__(request)
+        if not metrics.ativas():
+            return self.get_response(request)
+        estado = metrics.iniciar_pedido(request)
+        return metrics.terminar_pedido(request, self.get_response(request), estado)
+
+    async def __acall__(self, request):
+        if not metrics.ativas():
+            return await self.get_response(request)
+        estado = metrics.iniciar_pedido(request)
+        return metrics.terminar_pedido(request, await self.get_response(request), estado)
@@ -0,0 +1,218 @@
+"""
+Análise do histórico de chats (para dashboards), calculada no MongoDB com pipelines de agregação.
+
+As agregações agrupam por (dia, modelo): chats criados, mensagens por papel, tokens e um histograma
+dos tempos de processamento (processing_time tem resolução de 0,01s, por isso agrupar pelo valor dá
+percentis exatos com um resultado pequeno). Totais, séries diárias e a divisão por modelo são obtidos
+juntando essas linhas em Python.
+
+Os dias já fechados (anteriores ao dia atual, em UTC) quase nunca mudam: as suas linhas ficam guardadas na
+coleção 'analytics_daily' por filtro, e os pedidos seguintes só agregam as mensagens desde o último dia guardado.
+Só os filtros por data de criação usam esta cache: a pesquisa e o mínimo de mensagens dependem do conteúdo e do
+message_count, que mudam quando chega uma mensagem hoje (um chat antigo pode passar a corresponder).
+As escritas que mudam um dia fechado (apagar chats, importar, respostas diferidas escritas depois da meia-noite)
+incrementam a geração da cache (mongo_service.invalidar_cache_analise) e as linhas de outra geração são ignoradas.
+"""
+import hashlib
+import json
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from . import mongo_service
+
+PERCENTIS = (50, 95, 99)
+_FILTROS_COM_CACHE = ("date_from", "date_to") # Dependem só de created_at, que nunca muda
+MODELO_DESCONHECIDO = "desconhecido"
+
+
+def _chave_filtro(filters: Optional[dict]) -> str:
+    filters = {k: v for k, v in (filters or {}).items() if v}
+    return hashlib.sha1(json.dumps(filters, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _filtro_com_cache(filters: Optional[dict]) -> bool:
+    return all(chave in _FILTROS_COM_CACHE for chave, valor in (filters or {}).items() if valor)
+
+def _dia(data: datetime) -> str:
+    return data.strftime("%Y-%m-%d")
+
+def _projecao_mensagem(campo_modelo) -> dict:
+    return {
+        "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$messages.timestamp"}},
+        "model": {"$ifNull": [campo_modelo, MODELO_DESCONHECIDO]},
+        "role": "$messages.role",
+        "pt": "$messages.processing_time",
+        "tokens": {"$ifNull": ["$messages.tokens", 0]},
+        "with_tokens": {"$cond": [{"$gt": ["$messages.tokens", None]}, 1, 0]},
+    }
+
+_GRUPO_MENSAGENS = {
+    "$group": {
+        "_id": {"day": "$day", "model": "$model", "role": "$role", "pt": "$pt"},
+        "messages": {"$sum": 1},
+        "tokens": {"$sum": "$tokens"},
+        "with_tokens": {"$sum": "$with_tokens"},
+    }
+}
+
+def _agregar(filters: Optional[dict], desde: Optional[datetime]) -> List[dict]:
+    """ Linhas (dia, modelo, papel, tempo) das mensagens e (dia, modelo) dos chats, a partir de `desde`. """
+    chats = mongo_service.get_chats_collection()
+    query = mongo_service._build_mongo_query(filters)
+    linhas = []
+
+    # Chats criados por dia e modelo
+    match_chats = dict(query)
+    if desde is not None:
+        match_chats = {"$and": [query, {"created_at": {"$gte": desde}}]} if query else {"created_at": {"$gte": desde}}
+    for linha in chats.aggregate([
+        {"$match": match_chats},
+        {"$group": {
+            "_id": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                    "model": {"$ifNull": ["$model_name", MODELO_DESCONHECIDO]}},
+            "chats": {"$sum": 1},
+        }},
+    ]):
+        linhas.append({**linha["_id"], "chats": linha["chats"]})
+
+    # Mensagens dos chats com o array 'messages'
+    filtro_tempo = {"messages.timestamp": {"$gte": desde}} if desde is not None else {}
+    match_mensagens = {"$and": [query, filtro_tempo]} if query and filtro_tempo else (query or filtro_tempo)
+    pipeline = [{"$match": match_mensagens}, {"$unwind": "$messages"}]
+    if filtro_tempo:
+        pipeline.append({"$match": filtro_tempo})
+    pipeline += [{"$project": _projecao_mensagem("$model_name")}, _GRUPO_MENSAGENS]
+    linhas += [{**linha["_id"], **{k: v for k, v in linha.items() if k != "_id"}} for linha in chats.aggregate(pipeline)]
+
+    # Mensagens dos chats em buckets (o modelo vem do documento do chat)
+    buckets = mongo_service.get_buckets_collection()
+    if buckets is not None and buckets.estimated_document_count() > 0:
+        match_buckets = dict(filtro_tempo)
+        if query:
+            match_buckets["chat_id"] = {"$in": chats.distinct("_id", {"$and": [query, {"message_storage": "bucketed"}]})}
+        pipeline = [{"$match": match_buckets}, {"$unwind": "$messages"}]
+        if filtro_tempo:
+            pipeline.append({"$match": filtro_tempo})
+        pipeline += [
+            {"$lookup": {"from": chats.name, "localField": "chat_id", "foreignField": "_id", "as": "chat"}},
+            {"$project": _projecao_mensagem({"$arrayElemAt": ["$chat.model_name", 0]})},
+            _GRUPO_MENSAGENS,
+        ]
+        linhas += [{**linha["_id"], **{k: v for k, v in linha.items() if k != "_id"}} for linha in buckets.aggregate(pipeline)]
+    return linhas
+
+def _linhas_com_cache(filters: Optional[dict]) -> tuple[List[dict], int, int]:
+    """ Linhas de todos os dias: as dos dias fechados vêm da cache quando possível. Devolve (linhas, dias em cache, dias calculados). """
+    cache = mongo_service.get_analytics_cache_collection()
+    if cache is None or not getattr(settings, 'ANALYTICS_CACHE_ENABLED', True) or not _filtro_com_cache(filters):
+        linhas = _agregar(filters, None)
+        return linhas, 0, len({l["day"] for l in linhas})
+
+    # A geração lida antes de agregar: se uma escrita a incrementar entretanto, o que for guardado já nasce inválido
+    geracao = mongo_service.geracao_cache_analise(cache)
+    chave = _chave_filtro(filters)
+    prefixo = f"{chave}:{geracao}"
+    agora = datetime.now(timezone.utc)
+    hoje = _dia(agora)
+    marcador = cache.find_one({"_id": f"{prefixo}:upto"})
+    guardadas = []
+    desde = None
+    if marcador:
+        documentos = {"filter": chave, "generation": geracao}
+        guardadas = [linha for doc in cache.find({**documentos, "day": {"$lte": marcador["upto"]}}) for linha in doc["rows"]]
+        desde = datetime.strptime(marcador["upto"], "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+        # Mantém vivos (TTL) os agregados dos filtros que continuam a ser usados
+        cache.update_many(documentos, {"$set": {"last_used": agora}})
+
+    novas = _agregar(filters, desde)
+
+    # Guarda os dias novos que já fecharam
+    por_dia = defaultdict(list)
+    for linha in novas:
+        if linha["day"] and linha["day"] < hoje:
+            por_dia[linha["day"]].append(linha)
+    for dia, linhas_dia in por_dia.items():
+        cache.replace_one(
+            {"_id": f"{prefixo}:{dia}"},
+            {"_id": f"{prefixo}:{dia}", "filter": chave, "generation": geracao, "day": dia, "rows": linhas_dia, "last_used": agora},
+            upsert=True
+        )
+    ontem = _dia(agora - timedelta(days=1))
+    cache.replace_one(
+        {"_id": f"{prefixo}:upto"},
+        {"_id": f"{prefixo}:upto", "filter": chave, "generation": geracao, "upto": ontem, "last_used": agora},
+        upsert=True
+    )
+
+    dias_em_cache = len({l["day"] for l in guardadas})
+    return guardadas + novas, dias_em_cache, len({l["day"] for l in novas})
+
+
+def percentis(histograma: Dict[float, int]) -> dict:
+    """ count, média e percentis (método nearest-rank) de um histograma {valor: ocorrências}. """
+    total = sum(histograma.values())
+    if not total:
+        return {"count": 0, "avg": None, **{f"p{p}": None for p in PERCENTIS}}
+    valores = sorted(histograma.items())
+    resultado = {"count": total, "avg": round(sum(v * n for v, n in valores) / total, 3)}
+    for p in PERCENTIS:
+        posicao = max(1, math.ceil(p / 100 * total))
+        acumulado = 0
+        for valor, n in valores:
+            acumulado += n
+            if acumulado >= posicao:
+                resultado[f"p{p}"] = valor
+                break
+    return resultado
+
+def _novo_acumulador() -> dict:
+    return {"chats": 0, "messages": 0, "user_messages": 0, "assistant_messages": 0,
+            "tokens": 0, "messages_with_tokens": 0, "latencias": defaultdict(int)}
+
+def _acumular(acumulador: dict, linha: dict):
+    acumulador["chats"] += linha.get("chats", 0)
+    mensagens = linha.get("messages", 0)
+    acumulador["messages"] += mensagens
+    if linha.get("role") == "user":
+        acumulador["user_messages"] += mensagens
+    elif linha.get("role") == "assistant":
+        acumulador["assistant_messages"] += mensagens
+    acumulador["tokens"] += linha.get("tokens", 0)
+    acumulador["messages_with_tokens"] += linha.get("with_tokens", 0)
+    if linha.get("role") == "assistant" and linha.get("pt") is not None:
+        acumulador["latencias"][linha["pt"]] += mensagens
+
+def _finalizar(acumulador: dict) -> dict:
+    resultado = {k: v for k, v in acumulador.items() if k != "latencias"}
+    resultado["processing_time"] = percentis(acumulador["latencias"])
+    return resultado
+
+def analisar_historico(filters: Optional[dict] = None) -> dict:
+    """
+    Estatísticas do histórico com os mesmos filtros da listagem: totais, série diária (UTC) e divisão por modelo.
+    'tokens' soma os tokens guardados nas mensagens ('messages_with_tokens' indica quantas os têm).
+    """
+    if mongo_service.get_chats_collection() is None:
+        raise RuntimeError("Não foi possível ligar ao MongoDB.")
+    linhas, dias_em_cache, dias_calculados = _linhas_com_cache(filters)
+
+    total = _novo_acumulador()
+    por_dia = defaultdict(_novo_acumulador)
+    por_modelo = defaultdict(_novo_acumulador)
+    for linha in linhas:
+        if not linha.get("day"):
+            continue
+        _acumular(total, linha)
+        _acumular(por_dia[linha["day"]], linha)
+        _acumular(por_modelo[linha["model"]], linha)
+
+    return {
+        "filters": {k: v for k, v in (filters or {}).items() if v},
+        "totals": _finalizar(total),
+        "days": [{"date": dia, **_finalizar(por_dia[dia])} for dia in sorted(por_dia)],
+        "models": [{"model_name": modelo, **_finalizar(acc)} for modelo, acc in sorted(por_modelo.items())],
+        "cache": {"days_cached": dias_em_cache, "days_computed": dias_calculados},
+    }
@@ -0,0 +1,163 @@
+"""
+Geração em lote offline (`python manage.py gerar_em_lote`): conjuntos de prompts de avaliação ou regressão
+passados pelo modelo sem HTTP e sem escrever no histórico.
+
+- Entrada JSONL: uma linha por pedido, com 'prompt' (um só turno) ou 'messages' (conversa que termina numa
+  mensagem do utilizador) e um 'id' opcional (por omissão, o número da linha). Os restantes campos
+  (ex: a resposta esperada) passam para a saída.
+- Os pedidos são ordenados por número de tokens do prompt (do maior para o menor) e gerados em lotes com
+  _gerar_lote (um model.generate com padding à esquerda): prompts de tamanho parecido no mesmo lote
+  desperdiçam menos posições em padding.
+- Saída JSONL escrita (e sincronizada com o disco) no fim de cada lote; é também o checkpoint: ao retomar,
+  os ids que já lá estão são saltados e uma última linha incompleta (interrupção a meio da escrita) é descartada.
+- Opcionalmente, cada resultado é guardado como um chat (import_service, em lote), com um _id derivado do
+  ficheiro de saída e do id do pedido, para que retomar não duplique chats.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from bson import ObjectId
+
+from . import nlp_service
+
+logger = logging.getLogger(__name__)
+
+
+def ler_pedidos(caminho: str) -> List[Dict]:
+    """ Pedidos do ficheiro JSONL de entrada, validados: {'id', 'messages', 'linha' (o objeto original)}. """
+    pedidos, ids = [], set()
+    with open(caminho, encoding="utf-8-sig") as ficheiro:
+        for numero, texto in enumerate(ficheiro, start=1):
+            if not texto.strip():
+                continue
+            try:
+                linha = json.loads(texto)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Linha {numero} não é um JSON válido: {e}")
+            if not isinstance(linha, dict):
+                raise ValueError(f"Linha {numero}: cada pedido deve ser um objeto JSON.")
+            if isinstance(linha.get("prompt"), str):
+                mensagens = [{"role": "user", "content": linha["prompt"]}]
+            elif isinstance(linha.get("messages"), list) and linha["messages"]:
+                mensagens = [{"role": m.get("role"), "content": m.get("content") or ""} for m in linha["messages"] if isinstance(m, dict)]
+                if not mensagens or mensagens[-1]["role"] != "user":
+                    raise ValueError(f"Linha {numero}: 'messages' deve terminar numa mensagem do utilizador.")
+            else:
+                raise ValueError(f"Linha {numero}: indique 'prompt' (texto) ou 'messages' (lista).")
+            pedido_id = str(linha.get("id", numero))
+            if pedido_id in ids:
+                raise ValueError(f"Linha {numero}: id '{pedido_id}' repetido (os ids identificam os pedidos ao retomar).")
+            ids.add(pedido_id)
+            pedidos.append({"id": pedido_id, "messages": mensagens, "linha": linha})
+    return pedidos
+
+def ids_concluidos(caminho: str) -> Set[str]:
+    """
+    Ids já escritos no ficheiro de saída. Se a última linha estiver incompleta (interrupção a meio da
+    escrita), o ficheiro é cortado no fim da última linha válida.
+    """
+    if not os.path.exists(caminho):
+        return set()
+    ids, fim_valido = set(), 0
+    with open(caminho, "rb") as ficheiro:
+        for linha in ficheiro:
+            try:
+                ids.add(str(json.loads(linha)["id"]))
+            except (ValueError, KeyError, TypeError):
+                break
+            fim_valido += len(linha)
+        tamanho = ficheiro.seek(0, os.SEEK_END)
+    if fim_valido < tamanho:
+        logger.warning("A descartar %s bytes incompletos no fim de %s.", tamanho - fim_valido, caminho)
+        with open(caminho, "r+b") as ficheiro:
+            ficheiro.truncate(fim_valido)
+    return ids
+
+def ordenar_por_tamanho(pedidos: List[Dict]) -> List[Dict]:
+    """ Monta o prompt de cada pedido e ordena-os por número de tokens, do maior para o menor. """
+    for pedido in pedidos:
+        pedido["texto"] = nlp_service._montar_prompt(pedido["messages"])
+        pedido["tokens"] = nlp_service.contar_tokens(pedido["texto"])
+    return sorted(pedidos, key=lambda p: p["tokens"], reverse=True)
+
+def _id_chat(saida: str, pedido_id: str) -> ObjectId:
+    """ _id estável do chat de um pedido (o mesmo ao retomar, para a importação o reconhecer como duplicado). """
+    return ObjectId(hashlib.sha1(f"{os.path.abspath(saida)}\0{pedido_id}".encode("utf-8")).digest()[:12])
+
+def _guardar_no_mongo(lote: List[Dict], resultados: List[Dict], saida: str, segundos: float) -> List[str]:
+    from . import import_service
+
+    agora = datetime.now(timezone.utc)
+    chats = []
+    for pedido, resultado in zip(lote, resultados):
+        mensagens = [{**m, "timestamp": agora} for m in pedido["messages"]]
+        mensagens.append({
+            "role": "assistant", "content": resultado["texto"], "timestamp": agora, "processing_time": round(segundos, 2),
+            "model_used": nlp_service.nome_modelo(), "tokens": resultado["tokens_gerados"],
+        })
+        chats.append({
+            "_id": str(_id_chat(saida, pedido["id"])), "title": f"Lote: {pedido['id']}", "created_at": agora.isoformat(),
+            "model_name": nlp_service.nome_modelo(), "messages": mensagens,
+        })
+    import_service.importar(chats, tamanho_lote=len(chats))
+    return [chat["_id"] for chat in chats]
+
+def em_lotes(pedidos: List[Dict], tamanho: int) -> Iterator[List[Dict]]:
+    for inicio in range(0, len(pedidos), tamanho):
+        yield pedidos[inicio:inicio + tamanho]
+
+def gerar(pedidos: List[Dict], saida: str, tamanho_lote: int = 8, max_new_tokens: Optional[int] = None,
+          guardar_mongo: bool = False, ao_terminar_lote: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Gera as respostas dos `pedidos` (já ordenados) em lotes e acrescenta-as a `saida`, um lote de cada vez.
+    `ao_terminar_lote` recebe as medições de cada lote (tokens, tempo, tokens/s, fração de padding).
+    Devolve os totais.
+    """
+    if nlp_service.tokenizer is not None and nlp_service.tokenizer.pad_token is None:
+        nlp_service.tokenizer.pad_token = nlp_service.tokenizer.eos_token
+    totais = {"requests": 0, "batches": 0, "prompt_tokens": 0, "generated_tokens": 0, "seconds": 0.0}
+    numero_lotes = -(-len(pedidos) // tamanho_lote)
+    with open(saida, "a", encoding="utf-8") as ficheiro:
+        for numero, lote in enumerate(em_lotes(pedidos, tamanho_lote), start=1):
+            inicio = time.perf_counter()
+            resultados = nlp_service._gerar_lote([p["texto"] for p in lote], max_new_tokens=max_new_tokens)
+            segundos = time.perf_counter() - inicio
+
+            chat_ids = _guardar_no_mongo(lote, resultados, saida, segundos) if guardar_mongo else [None] * len(lote)
+            for pedido, resultado, chat_id in zip(lote, resultados, chat_ids):
+                linha = {
+                    **pedido["linha"], "id": pedido["id"], "response": resultado["texto"],
+                    "prompt_tokens": resultado["tokens_prompt"], "generated_tokens": resultado["tokens_gerados"], "batch": numero,
+                }
+                if chat_id:
+                    linha["chat_id"] = chat_id
+                ficheiro.write(json.dumps(linha, ensure_ascii=False) + "\n")
+            # O lote só conta como feito (para retomar) depois de estar no disco
+            ficheiro.flush()
+            os.fsync(ficheiro.fileno())
+
+            gerados = sum(r["tokens_gerados"] for r in resultados)
+            tokens_prompt = sum(r["tokens_prompt"] for r in resultados)
+            posicoes = len(lote) * max(r["tokens_prompt"] for r in resultados)
+            medicao = {
+                "batch": numero, "batches": numero_lotes, "size": len(lote), "prompt_tokens": tokens_prompt,
+                "generated_tokens": gerados, "seconds": round(segundos, 3),
+                "tokens_per_second": round(gerados / segundos, 1) if segundos else None,
+                "padding_ratio": round(1 - tokens_prompt / posicoes, 3) if posicoes else 0.0,
+            }
+            totais["requests"] += len(lote)
+            totais["batches"] += 1
+            totais["prompt_tokens"] += tokens_prompt
+            totais["generated_tokens"] += gerados
+            totais["seconds"] += segundos
+            if ao_terminar_lote:
+                ao_terminar_lote(medicao)
+
+    totais["seconds"] = round(totais["seconds"], 3)
+    totais["tokens_per_second"] = round(totais["generated_tokens"] / totais["seconds"], 1) if totais["seconds"] else None
+    return totais
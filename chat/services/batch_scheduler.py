@@ -0,0 +1,139 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Pedido:
+    """ Um pedido à espera na fila: o item a processar, o Future do chamador e o instante de chegada. """
+    __slots__ = ("item", "future", "chegada")
+
+    def __init__(self, item: Any):
+        self.item = item
+        self.future = Future()
+        self.chegada = time.monotonic()
+
+
+class GenerationScheduler:
+    """
+    Escalonador de micro-batching em processo.
+
+    Os pedidos são colocados numa fila; uma thread trabalhadora junta os pedidos pendentes
+    em lotes de até `max_batch_size` itens, esperando no máximo `max_wait_ms` milissegundos
+    desde o primeiro pedido do lote, e chama `processar_lote` uma única vez por lote.
+    Cada chamador recebe o seu resultado através de um Future.
+    """
+
+    def __init__(self, processar_lote: Callable[[List[Any]], List[Any]], max_batch_size: int = 4, max_wait_ms: float = 20.0):
+        self.processar_lote = processar_lote
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._fila: "queue.Queue[_Pedido]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        # Estatísticas (protegidas por _lock)
+        self._total_lotes = 0
+        self._total_pedidos = 0
+        self._maior_lote = 0
+        self._histograma_lotes: Dict[int, int] = {}
+        self._espera_total = 0.0
+        self._tempo_processamento_total = 0.0
+
+    # --- Ciclo de vida ---
+
+    def iniciar(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._parar.clear()
+            self._thread = threading.Thread(target=self._ciclo, name="generation-scheduler", daemon=True)
+            self._thread.start()
+
+    def parar(self, timeout: float = 5.0):
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submeter(self, item: Any) -> Future:
+        """ Coloca um item na fila e devolve o Future com o seu resultado. """
+        if self._thread is None or not self._thread.is_alive():
+            self.iniciar()
+        pedido = _Pedido(item)
+        self._fila.put(pedido)
+        return pedido.future
+
+    # --- Estatísticas ---
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            media = self._total_pedidos / self._total_lotes if self._total_lotes else 0.0
+            espera_media = self._espera_total / self._total_pedidos if self._total_pedidos else 0.0
+            return {
+                "queue_depth": self._fila.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": round(self.max_wait * 1000, 2),
+                "total_batches": self._total_lotes,
+                "total_requests": self._total_pedidos,
+                "avg_batch_size": round(media, 2),
+                "largest_batch": self._maior_lote,
+                "batch_size_histogram": dict(sorted(self._histograma_lotes.items())),
+                "avg_queue_wait_ms": round(espera_media * 1000, 2),
+                "total_processing_seconds": round(self._tempo_processamento_total, 3),
+            }
+
+    # --- Thread trabalhadora ---
+
+    def _recolher_lote(self) -> List[_Pedido]:
+        """ Bloqueia até haver um pedido e junta os que chegarem dentro da janela de espera. """
+        try:
+            primeiro = self._fila.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        lote = [primeiro]
+        limite = time.monotonic() + self.max_wait
+        while len(lote) < self.max_batch_size:
+            restante = limite - time.monotonic()
+            try:
+                if restante <= 0:
+                    # Janela esgotada: aproveita apenas o que já está na fila
+                    lote.append(self._fila.get_nowait())
+                else:
+                    lote.append(self._fila.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _ciclo(self):
+        while not self._parar.is_set():
+            lote = self._recolher_lote()
+            if not lote:
+                continue
+            inicio = time.monotonic()
+            for pedido in lote:
+                metrics.ESPERA_FILA.observar(inicio - pedido.chegada, queue="batch_scheduler")
+            try:
+                resultados = self.processar_lote([p.item for p in lote])
+                if len(resultados) != len(lote):
+                    raise RuntimeError(f"processar_lote devolveu {len(resultados)} resultados para {len(lote)} pedidos.")
+                for pedido, resultado in zip(lote, resultados):
+                    pedido.future.set_result(resultado)
+            except Exception as e:
+                logger.exception("Erro ao processar lote de %s pedidos no scheduler", len(lote))
+                for pedido in lote:
+                    if not pedido.future.done():
+                        pedido.future.set_exception(e)
+            fim = time.monotonic()
+            with self._lock:
+                self._total_lotes += 1
+                self._total_pedidos += len(lote)
+                self._maior_lote = max(self._maior_lote, len(lote))
+                self._histograma_lotes[len(lote)] = self._histograma_lotes.get(len(lote), 0) + 1
+                self._espera_total += sum(inicio - p.chegada for p in lote)
+                self._tempo_processamento_total += fim - inicio
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import mongo_service, nlp_service
+
+logger = logging.getLogger(__name__)
+
+# Tokens que o template do Qwen2 acrescenta a cada mensagem ("<|im_start|>role\n" ... "<|im_end|>\n")
+TOKENS_POR_MENSAGEM = 5
+
+# --- Contagem de tokens com cache (o histórico não é re-tokenizado a cada turno) ---
+_contagens: "OrderedDict[bytes, int]" = OrderedDict()
+_contagens_lock = threading.Lock()
+
+def contar_tokens_mensagem(mensagem: Dict) -> int:
+    """ Tokens que a mensagem ocupa no prompt, com a contagem do conteúdo guardada numa cache LRU. """
+    conteudo = mensagem.get("content") or ""
+    chave = hashlib.sha1(conteudo.encode("utf-8")).digest()
+    with _contagens_lock:
+        if chave in _contagens:
+            _contagens.move_to_end(chave)
+            return _contagens[chave] + TOKENS_POR_MENSAGEM
+
+    n_tokens = nlp_service.contar_tokens(conteudo)
+    with _contagens_lock:
+        _contagens[chave] = n_tokens
+        while len(_contagens) > getattr(settings, 'NLP_TOKEN_COUNT_CACHE_SIZE', 10000):
+            _contagens.popitem(last=False)
+    return n_tokens + TOKENS_POR_MENSAGEM
+
+def _inicio_da_janela(history: List[Dict], inicio_minimo: int, orcamento: int) -> int:
+    """
+    Índice da mensagem mais antiga a manter para que as mensagens recentes caibam no orçamento.
+    A última mensagem (o prompt atual) fica sempre; sempre que possível a janela começa num turno do utilizador.
+    """
+    total = 0
+    inicio = len(history)
+    for i in range(len(history) - 1, inicio_minimo - 1, -1):
+        custo = contar_tokens_mensagem(history[i])
+        if total + custo > orcamento and inicio < len(history):
+            break
+        total += custo
+        inicio = i
+    while inicio < len(history) - 1 and history[inicio].get("role") != "user":
+        inicio += 1
+    return inicio
+
+def construir_contexto(chat_id: str, history: List[Dict], resumo_guardado: Optional[Tuple[Optional[str], int]] = None,
+                       primeira_mensagem: int = 0) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Aplica o orçamento de tokens (NLP_CONTEXT_TOKEN_BUDGET) ao histórico do chat.
+    Devolve (mensagens recentes a enviar ao modelo, resumo das mensagens mais antigas ou None).
+
+    O resumo é incremental e fica guardado no documento do chat: quando a conversa deixa de caber,
+    as mensagens mais antigas são juntadas ao resumo e a janela é reduzida até NLP_CONTEXT_TRIM_RATIO
+    do orçamento. Assim o resumo só é refeito de vez em quando e o início do prompt fica estável
+    entre turnos (o que mantém a cache KV útil).
+
+    `resumo_guardado` = (resumo, mensagens resumidas), se já foi lido do MongoDB junto com o histórico.
+    `primeira_mensagem` = posição no chat de history[0] (o histórico pode vir sem as mensagens já resumidas).
+    """
+    if not history or not nlp_service.is_model_loaded:
+        return history, None
+
+    orcamento = getattr(settings, 'NLP_CONTEXT_TOKEN_BUDGET', 2048)
+    orcamento -= contar_tokens_mensagem({"content": nlp_service.SYSTEM_PROMPT})
+
+    # Caso comum: a conversa inteira cabe no orçamento e não é preciso ir buscar o resumo
+    if primeira_mensagem == 0 and sum(contar_tokens_mensagem(m) for m in history) <= orcamento:
+        return history, None
+
+    resumo, resumidas = resumo_guardado if resumo_guardado is not None else mongo_service.get_chat_summary(chat_id)
+    resumidas = min(max(0, resumidas - primeira_mensagem), len(history) - 1)
+    # Reserva espaço para o resumo (atual ou que venha a ser gerado)
+    orcamento_mensagens = orcamento - getattr(settings, 'NLP_CONTEXT_SUMMARY_MAX_TOKENS', 200)
+
+    if sum(contar_tokens_mensagem(m) for m in history[resumidas:]) <= orcamento_mensagens:
+        return history[resumidas:], resumo
+
+    alvo = int(orcamento_mensagens * getattr(settings, 'NLP_CONTEXT_TRIM_RATIO', 0.6))
+    inicio = _inicio_da_janela(history, resumidas, alvo)
+
+    logger.debug("A resumir %s mensagens antigas do chat %s.", inicio - resumidas, chat_id)
+    try:
+        resumo_novo = nlp_service.resumir_conversa(resumo, history[resumidas:inicio])
+    except Exception as e:
+        # Nada é guardado: neste turno as mensagens antigas ficam de fora da janela, e o próximo tenta resumi-las outra vez
+        logger.warning("Não foi possível atualizar o resumo do chat %s", chat_id, exc_info=True)
+        return history[inicio:], resumo
+    mongo_service.update_chat_summary(chat_id, resumo_novo, primeira_mensagem + inicio)
+    return history[inicio:], resumo_novo
@@ -0,0 +1,399 @@
+"""
+Exportação do histórico de chats.
+
+- Formatos em streaming (JSON, NDJSON, CSV), usados diretamente pela view de exportação.
+- Jobs de exportação: o pedido cria um job na coleção 'export_jobs' e uma thread em segundo plano
+  escreve o ficheiro em disco (NDJSON, CSV ou Parquet, comprimido com gzip ou zstd), atualizando o
+  progresso (chats, linhas e bytes). Jobs com os mesmos filtros e formato reutilizam o ficheiro de um
+  job anterior enquanto este for recente (EXPORT_JOB_FRESH_SECONDS).
+"""
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+from bson import ObjectId
+from django.conf import settings
+
+from . import mongo_service
+
+logger = logging.getLogger(__name__)
+
+
+# --- Formatos ---
+
+CABECALHO_CSV = [
+    'Chat_ID',
+    'Chat_Titulo',
+    'Chat_Criado_Em',
+    'Modelo',
+    'Mensagem_Role',
+    'Mensagem_Conteudo',
+    'Mensagem_Timestamp',
+    'Msg_Tempo_Processamento_Sec'
+]
+
+class _Eco:
+    """ "Ficheiro" que devolve o que lhe escrevem: permite usar o csv.writer dentro de um gerador. """
+    def write(self, value):
+        return value
+
+def linhas_tabela(chat: dict) -> Iterator[list]:
+    """ Uma linha por mensagem ("achatamos" as mensagens aninhadas), ou uma linha por chat sem mensagens. """
+    chat_id = chat.get('_id', '')
+    chat_title = chat.get('title', '')
+    chat_created_at = chat.get('created_at', '')
+    model_name = chat.get('model_name', '')
+
+    # Se não houver mensagens, escreve uma linha para o chat
+    if not chat.get('messages'):
+        yield [
+            chat_id, chat_title, chat_created_at, model_name,
+            '', '', '', '' # Células vazias para a mensagem
+        ]
+        return
+    # Itera sobre cada mensagem dentro do chat
+    for message in chat.get('messages', []):
+        yield [
+            chat_id,
+            chat_title,
+            chat_created_at,
+            model_name,
+            message.get('role', ''),
+            message.get('content', ''),
+            message.get('timestamp', ''),
+            message.get('processing_time', '') # Pega o tempo de processamento
+        ]
+
+def em_blocos(pedacos, tamanho: int = 64 * 1024):
+    """ Junta pedaços pequenos (uma linha, um chat) em blocos de ~64 KB antes de os enviar ao cliente. """
+    bloco, acumulado = [], 0
+    for pedaco in pedacos:
+        bloco.append(pedaco)
+        acumulado += len(pedaco)
+        if acumulado >= tamanho:
+            yield "".join(bloco)
+            bloco, acumulado = [], 0
+    if bloco:
+        yield "".join(bloco)
+
+def _json_chat(chat: dict, primeiro: bool) -> str:
+    return ("" if primeiro else ",\n") + json.dumps(chat, indent=2, ensure_ascii=False, default=str)
+
+def _ndjson_chat(chat: dict, primeiro: bool) -> str:
+    return json.dumps(chat, ensure_ascii=False, default=str) + "\n"
+
+def _csv_chat(chat: dict, primeiro: bool) -> str:
+    writer = csv.writer(_Eco(), delimiter=';')
+    return "".join(writer.writerow(linha) for linha in linhas_tabela(chat))
+
+# formato: (início, texto de cada chat, fim)
+PARTES_FORMATO = {
+    'json': ("[\n", _json_chat, "\n]\n"),
+    'ndjson': ("", _ndjson_chat, ""),
+    'csv': (None, _csv_chat, ""), # Início com BOM e cabeçalho: ver gerar_csv
+}
+
+def gerar_json(chats):
+    """ Array JSON escrito incrementalmente (um chat de cada vez). """
+    yield "[\n"
+    primeiro = True
+    for chat in chats:
+        yield _json_chat(chat, primeiro)
+        primeiro = False
+    yield "\n]\n"
+
+def gerar_ndjson(chats):
+    """ Um chat por linha (JSON Lines): fácil de processar linha a linha. """
+    for chat in chats:
+        yield _ndjson_chat(chat, False)
+
+def csv_cabecalho() -> str:
+    return next(gerar_csv([], bom=False))
+
+def gerar_csv(chats, bom: bool = True, cabecalho: bool = True):
+    """ CSV com uma linha por mensagem (ver linhas_tabela). """
+    writer = csv.writer(_Eco(), delimiter=';') # Usa ponto e vírgula, comum no Brasil/Excel
+    if bom:
+        yield u'\ufeff' # Adiciona BOM para o Excel entender UTF-8
+    if cabecalho:
+        yield writer.writerow(CABECALHO_CSV)
+    for chat in chats:
+        for linha in linhas_tabela(chat):
+            yield writer.writerow(linha)
+
+async def gerar_assincrono(formato: str, chats, tamanho: int = 64 * 1024):
+    """
+    Versão para as views assíncronas: o mesmo conteúdo de gerar_json/gerar_ndjson/gerar_csv a partir
+    de um iterador assíncrono de chats, já em blocos de ~64 KB (como em_blocos).
+    """
+    inicio, texto_chat, fim = PARTES_FORMATO[formato]
+    bloco = [u'\ufeff' + csv_cabecalho() if inicio is None else inicio]
+    acumulado = len(bloco[0])
+    primeiro = True
+    async for chat in chats:
+        texto = texto_chat(chat, primeiro)
+        primeiro = False
+        bloco.append(texto)
+        acumulado += len(texto)
+        if acumulado >= tamanho:
+            yield "".join(bloco)
+            bloco, acumulado = [], 0
+    bloco.append(fim)
+    yield "".join(bloco)
+
+
+# --- Jobs de exportação ---
+
+FORMATOS_JOB = ("ndjson", "csv", "parquet")
+COMPRESSOES_JOB = ("gzip", "zstd")
+EXTENSOES = {("ndjson", "gzip"): "ndjson.gz", ("ndjson", "zstd"): "ndjson.zst",
+             ("csv", "gzip"): "csv.gz", ("csv", "zstd"): "csv.zst",
+             ("parquet", "gzip"): "parquet", ("parquet", "zstd"): "parquet"}
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _obter_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'EXPORT_JOB_WORKERS', 1), thread_name_prefix="export-job")
+        return _executor
+
+def _diretorio() -> str:
+    diretorio = getattr(settings, 'EXPORT_JOBS_DIR', 'exports')
+    os.makedirs(diretorio, exist_ok=True)
+    return diretorio
+
+def _chave(filters: dict, formato: str, compressao: str) -> str:
+    """ Jobs com a mesma chave produzem o mesmo ficheiro (e podem reutilizá-lo). """
+    conteudo = {"filters": {k: v for k, v in (filters or {}).items() if v}, "format": formato, "compression": compressao}
+    return hashlib.sha1(json.dumps(conteudo, sort_keys=True).encode("utf-8")).hexdigest()
+
+def estado_publico(job: dict) -> dict:
+    """ Campos do job devolvidos pelo endpoint de estado. """
+    return {
+        "job_id": str(job["_id"]),
+        "status": job.get("status"),
+        "format": job.get("format"),
+        "compression": job.get("compression"),
+        "filters": job.get("filters", {}),
+        "chats": job.get("chats", 0),
+        "chats_total": job.get("chats_total"),
+        "rows": job.get("rows", 0),
+        "bytes": job.get("bytes", 0),
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None,
+        "error": job.get("error"),
+    }
+
+def criar_job(filters: Optional[dict], formato: str = "ndjson", compressao: str = "gzip") -> tuple[dict, bool]:
+    """
+    Cria um job de exportação (ou devolve um existente com os mesmos filtros e formato que ainda esteja
+    em curso, ou concluído há menos de EXPORT_JOB_FRESH_SECONDS). Devolve (job, reutilizado).
+    """
+    if formato not in FORMATOS_JOB:
+        raise ValueError(f"Formato de exportação inválido: '{formato}'. Use um de {FORMATOS_JOB}.")
+    if compressao not in COMPRESSOES_JOB:
+        raise ValueError(f"Compressão inválida: '{compressao}'. Use uma de {COMPRESSOES_JOB}.")
+    _verificar_dependencias(formato, compressao)
+
+    collection = mongo_service.get_export_jobs_collection()
+    if collection is None:
+        raise RuntimeError("Coleção 'export_jobs' indisponível.")
+    _limpar_jobs_antigos(collection)
+
+    filters = {k: v for k, v in (filters or {}).items() if v}
+    chave = _chave(filters, formato, compressao)
+    agora = datetime.now(timezone.utc)
+    recente = agora - timedelta(seconds=getattr(settings, 'EXPORT_JOB_FRESH_SECONDS', 3600))
+    # Um job "em curso" sem progresso há muito tempo morreu com o processo que o corria
+    vivo = agora - timedelta(seconds=getattr(settings, 'EXPORT_JOB_STALE_SECONDS', 300))
+    existente = collection.find_one(
+        {"key": chave, "$or": [
+            {"status": "done", "finished_at": {"$gte": recente}},
+            {"status": {"$in": ["pending", "running"]}, "updated_at": {"$gte": vivo}},
+        ]},
+        sort=[("created_at", -1)]
+    )
+    if existente and (existente["status"] != "done" or os.path.exists(existente.get("path", ""))):
+        return existente, True
+
+    job = {
+        "key": chave,
+        "filters": filters,
+        "format": formato,
+        "compression": compressao,
+        "status": "pending",
+        "chats": 0,
+        "rows": 0,
+        "bytes": 0,
+        "created_at": agora,
+        "updated_at": agora,
+    }
+    job["_id"] = collection.insert_one(job).inserted_id
+    _obter_executor().submit(_executar_job, job["_id"])
+    return job, False
+
+def obter_job(job_id: str) -> Optional[dict]:
+    collection = mongo_service.get_export_jobs_collection()
+    if collection is None or not ObjectId.is_valid(job_id):
+        return None
+    return collection.find_one({"_id": ObjectId(job_id)})
+
+def _verificar_dependencias(formato: str, compressao: str):
+    """ zstd e Parquet dependem de pacotes opcionais (zstandard, pyarrow). """
+    try:
+        if formato == "parquet":
+            import pyarrow # noqa: F401
+        elif compressao == "zstd":
+            import zstandard # noqa: F401
+    except ImportError as e:
+        raise ValueError(f"O formato '{formato}' com compressão '{compressao}' requer um pacote não instalado: {e.name}.")
+
+def _limpar_jobs_antigos(collection):
+    """ Remove os jobs (e ficheiros) mais antigos do que EXPORT_JOB_RETENTION_SECONDS. """
+    limite = datetime.now(timezone.utc) - timedelta(seconds=getattr(settings, 'EXPORT_JOB_RETENTION_SECONDS', 86400))
+    for job in collection.find({"created_at": {"$lt": limite}}, {"path": 1}):
+        if job.get("path") and os.path.exists(job["path"]):
+            try:
+                os.remove(job["path"])
+            except OSError:
+                pass
+        collection.delete_one({"_id": job["_id"]})
+
+
+class _ContadorBytes:
+    """ Envolve o ficheiro em disco e conta os bytes (já comprimidos) escritos. """
+
+    def __init__(self, ficheiro):
+        self.ficheiro = ficheiro
+        self.bytes = 0
+
+    def write(self, dados):
+        self.bytes += len(dados)
+        return self.ficheiro.write(dados)
+
+    def flush(self):
+        self.ficheiro.flush()
+
+    def close(self):
+        pass # O ficheiro em disco é fechado por quem o abriu
+
+    @property
+    def closed(self):
+        return self.ficheiro.closed
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes
+
+
+def _abrir_compressor(destino, compressao: str):
+    if compressao == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).stream_writer(destino, closefd=False)
+    return gzip.GzipFile(fileobj=destino, mode="wb", compresslevel=6)
+
+def _executar_job(job_id):
+    collection = mongo_service.get_export_jobs_collection()
+    job = collection.find_one({"_id": job_id})
+    if job is None:
+        return
+    inicio = time.time()
+    caminho = os.path.join(_diretorio(), f"{job_id}.{EXTENSOES[(job['format'], job['compression'])]}")
+    temporario = caminho + ".parcial"
+    progresso = {"chats": 0, "rows": 0, "bytes": 0}
+    ultimo_registo = [0.0]
+
+    def registar_progresso(forcar: bool = False):
+        # No máximo uma escrita por segundo no documento do job
+        if forcar or time.time() - ultimo_registo[0] >= 1:
+            ultimo_registo[0] = time.time()
+            collection.update_one({"_id": job_id}, {"$set": {**progresso, "updated_at": datetime.now(timezone.utc)}})
+
+    try:
+        total, _ = mongo_service.contar_chats(job["filters"])
+        collection.update_one({"_id": job_id}, {"$set": {
+            "status": "running", "chats_total": total, "started_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc)
+        }})
+
+        def chats():
+            for chat in mongo_service.iterar_chats_para_exportacao(job["filters"]):
+                progresso["chats"] += 1
+                yield chat
+
+        with open(temporario, "wb") as ficheiro:
+            contador = _ContadorBytes(ficheiro)
+            if job["format"] == "parquet":
+                _escrever_parquet(chats(), contador, job["compression"], progresso, registar_progresso)
+            else:
+                gerador = gerar_ndjson if job["format"] == "ndjson" else (lambda c: gerar_csv(c, bom=False, cabecalho=False))
+                compressor = _abrir_compressor(contador, job["compression"])
+                try:
+                    if job["format"] == "csv":
+                        compressor.write(csv_cabecalho().encode("utf-8"))
+                    for pedaco in gerador(chats()):
+                        compressor.write(pedaco.encode("utf-8"))
+                        progresso["rows"] += 1
+                        progresso["bytes"] = contador.bytes
+                        registar_progresso()
+                finally:
+                    compressor.close()
+            progresso["bytes"] = contador.bytes
+
+        os.replace(temporario, caminho)
+        collection.update_one({"_id": job_id}, {"$set": {
+            **progresso, "status": "done", "path": caminho,
+            "finished_at": datetime.now(timezone.utc), "updated_at": datetime.now(timezone.utc)
+        }})
+        logger.info("Job de exportação %s concluído: %s chats, %s bytes em %ss.", job_id, progresso['chats'], progresso['bytes'], round(time.time() - inicio, 1))
+    except Exception as e:
+        logger.exception("Erro no job de exportação %s", job_id)
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        collection.update_one({"_id": job_id}, {"$set": {
+            **progresso, "status": "failed", "error": str(e), "updated_at": datetime.now(timezone.utc)
+        }})
+
+def _escrever_parquet(chats, destino, compressao: str, progresso: dict, registar_progresso, linhas_por_grupo: int = 10000):
+    """ Parquet com uma linha por mensagem (as colunas do CSV), escrito em grupos de linhas; a compressão é a do próprio Parquet. """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(nome.lower(), pa.string()) for nome in CABECALHO_CSV[:-1]] + [("msg_tempo_processamento_sec", pa.float64())])
+    writer = pq.ParquetWriter(destino, schema, compression=compressao)
+    linhas: List[list] = []
+
+    def escrever_grupo():
+        colunas = list(zip(*linhas))
+        # '' (campo em falta) e None (ex: processing_time nulo num chat importado) ficam nulos
+        arrays = [pa.array([str(v) if v not in ('', None) else None for v in coluna], pa.string()) for coluna in colunas[:-1]]
+        arrays.append(pa.array([float(v) if v not in ('', None) else None for v in colunas[-1]], pa.float64()))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        linhas.clear()
+
+    try:
+        for chat in chats:
+            for linha in linhas_tabela(chat):
+                linhas.append(linha)
+                progresso["rows"] += 1
+            if len(linhas) >= linhas_por_grupo:
+                escrever_grupo()
+                progresso["bytes"] = destino.bytes
+                registar_progresso()
+        if linhas:
+            escrever_grupo()
+    finally:
+        writer.close()
@@ -0,0 +1,270 @@
+"""
+Importação de históricos de chats em lote (o inverso de export_service).
+
+- Leitores em streaming dos formatos da exportação: JSON (array), NDJSON (um chat por linha) e CSV
+  (uma linha por mensagem, ';' como separador). Os chats são lidos um a um, sem carregar o ficheiro inteiro.
+- Escrita em lotes de IMPORT_BATCH_SIZE chats: insert_many não ordenado (os chats que já existem, com o
+  mesmo _id, são contados como duplicados e ignorados) ou, com substituir=True, bulk_write de ReplaceOne
+  com upsert. No modo 'bucketed' as mensagens vão para a coleção 'chat_buckets', também em lote.
+"""
+import codecs
+import csv
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from . import mongo_service
+from .export_service import CABECALHO_CSV
+
+logger = logging.getLogger(__name__)
+
+FORMATOS_IMPORTACAO = ("json", "ndjson", "csv")
+
+
+# --- Leitores (ficheiro ou corpo do pedido, em bytes) ---
+
+def _pedacos_texto(fonte, tamanho: int = 64 * 1024) -> Iterator[str]:
+    """ Texto da fonte em pedaços de ~64 KB (UTF-8, com ou sem BOM; um carácter nunca fica partido). """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    while True:
+        dados = fonte.read(tamanho)
+        if not dados:
+            break
+        yield decoder.decode(dados)
+    yield decoder.decode(b"", final=True)
+
+def _linhas_texto(fonte) -> Iterator[str]:
+    """ Linhas da fonte (com o '\\n', para o csv.reader juntar os campos com quebras de linha). """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    for linha in fonte:
+        yield decoder.decode(linha)
+
+# Um valor cortado no fim do pedaço dá um erro até esta distância do fim (ex: "-Infin", "\ud83d\ude0")
+_MARGEM_VALOR_CORTADO = 16
+
+def _json_cortado(texto: str, erro: json.JSONDecodeError) -> bool:
+    """
+    Se o erro pode vir só de o chat ainda não ter chegado todo (o texto acaba a meio de um valor).
+    Um erro antes disso é JSON inválido: esperar pelo resto só acumularia o upload em memória.
+    """
+    return erro.msg.startswith("Unterminated string") or erro.pos >= len(texto) - _MARGEM_VALOR_CORTADO
+
+def ler_json(fonte) -> Iterator[dict]:
+    """ Chats de um array JSON (formato da exportação), descodificados um a um à medida que chegam. """
+    decoder = json.JSONDecoder()
+    texto, pos, abriu = "", 0, False
+    for pedaco in _pedacos_texto(fonte):
+        texto = texto[pos:] + pedaco
+        pos = 0
+        while True:
+            while pos < len(texto) and (texto[pos].isspace() or texto[pos] == ","):
+                pos += 1
+            if pos == len(texto):
+                break
+            if not abriu:
+                if texto[pos] != "[":
+                    raise ValueError("O ficheiro JSON deve conter um array de chats (formato da exportação).")
+                abriu = True
+                pos += 1
+                continue
+            if texto[pos] == "]":
+                return
+            try:
+                chat, pos = decoder.raw_decode(texto, pos)
+            except json.JSONDecodeError as e:
+                if not _json_cortado(texto, e):
+                    raise ValueError(f"JSON inválido no ficheiro: {e.msg}.")
+                break # Chat ainda incompleto: espera pelo pedaço seguinte
+            yield chat
+    if texto[pos:].strip():
+        raise ValueError("JSON inválido ou incompleto no fim do ficheiro.")
+    if not abriu:
+        raise ValueError("O ficheiro JSON deve conter um array de chats (formato da exportação).")
+    raise ValueError("JSON incompleto: o array de chats não termina com ']'.")
+
+def ler_ndjson(fonte) -> Iterator[dict]:
+    """ Um chat por linha (linhas vazias são ignoradas). """
+    for numero, linha in enumerate(_linhas_texto(fonte), start=1):
+        if linha.strip():
+            try:
+                yield json.loads(linha)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Linha {numero} não é um JSON válido: {e}")
+
+def ler_csv(fonte) -> Iterator[dict]:
+    """ Junta as linhas seguidas de cada Chat_ID num chat (a exportação escreve as mensagens de um chat juntas). """
+    linhas = csv.reader(_linhas_texto(fonte), delimiter=';')
+    cabecalho = next(linhas, None)
+    if cabecalho is None:
+        return
+    if cabecalho != CABECALHO_CSV:
+        raise ValueError(f"Cabeçalho CSV inesperado: use as colunas da exportação ({';'.join(CABECALHO_CSV)}).")
+    chat = None
+    for linha in linhas:
+        if not linha:
+            continue
+        chat_id, titulo, criado_em, modelo, role, conteudo, timestamp, tempo = (linha + [''] * len(CABECALHO_CSV))[:len(CABECALHO_CSV)]
+        if chat is None or chat["_id"] != chat_id:
+            if chat is not None:
+                yield chat
+            chat = {"_id": chat_id, "title": titulo, "created_at": criado_em, "model_name": modelo, "messages": []}
+        if role:
+            mensagem = {"role": role, "content": conteudo, "timestamp": timestamp}
+            if tempo != '':
+                mensagem["processing_time"] = tempo
+            chat["messages"].append(mensagem)
+    if chat is not None:
+        yield chat
+
+LEITORES = {"json": ler_json, "ndjson": ler_ndjson, "csv": ler_csv}
+
+
+# --- Conversão para documentos do MongoDB ---
+
+def _data(valor) -> Optional[datetime]:
+    """ Datas da exportação (ISO 8601, com ou sem 'Z'); as datas sem fuso são UTC. """
+    if valor in (None, ''):
+        return None
+    if isinstance(valor, dict) and "$date" in valor: # Extended JSON (mongoexport)
+        valor = valor["$date"]
+    if not isinstance(valor, datetime):
+        valor = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+    return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+
+def documento_importado(chat: dict) -> dict:
+    """
+    Documento da coleção 'chats' (com os campos de resumo) a partir de um chat no formato da exportação.
+    O _id é mantido, para que importar o mesmo ficheiro duas vezes não duplique chats; um chat sem _id
+    válido recebe um novo. Levanta ValueError se o chat não puder ser convertido.
+    """
+    if not isinstance(chat, dict):
+        raise ValueError("Cada chat deve ser um objeto JSON.")
+    chat_id = chat.get("_id")
+    if isinstance(chat_id, dict):
+        chat_id = chat_id.get("$oid")
+    mensagens = []
+    for mensagem in chat.get("messages") or []:
+        if not isinstance(mensagem, dict):
+            raise ValueError("Cada mensagem deve ser um objeto JSON.")
+        mensagem = {**mensagem, "content": mensagem.get("content") or "", "timestamp": _data(mensagem.get("timestamp"))}
+        if mensagem.get("processing_time") not in (None, ''):
+            mensagem["processing_time"] = float(mensagem["processing_time"])
+        mensagens.append(mensagem)
+    criado_em = _data(chat.get("created_at")) or (mensagens[0]["timestamp"] if mensagens else None) or datetime.now(timezone.utc)
+    return {
+        "_id": ObjectId(chat_id) if chat_id and ObjectId.is_valid(str(chat_id)) else ObjectId(),
+        "title": chat.get("title") or "Chat importado",
+        "created_at": criado_em,
+        "model_name": chat.get("model_name") or "desconhecido",
+        "messages": mensagens,
+        **mongo_service.campos_resumo(mensagens, criado_em),
+    }
+
+
+# --- Escrita em lotes ---
+
+def _escrever_lote(lote: List[dict], substituir: bool, estatisticas: dict):
+    collection = mongo_service.get_chats_collection()
+    em_buckets = mongo_service._armazenamento_em_buckets()
+    documentos = lote
+    if em_buckets:
+        documentos = [{**{k: v for k, v in doc.items() if k != "messages"}, "message_storage": "bucketed"} for doc in lote]
+
+    if substituir:
+        resultado = collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in documentos], ordered=False)
+        escritos = lote
+        estatisticas["replaced"] += resultado.matched_count
+        estatisticas["chats"] += resultado.upserted_count
+        # As mensagens antigas dos chats substituídos (se estavam em buckets) deixam de valer
+        buckets = mongo_service.get_buckets_collection()
+        if buckets is not None:
+            buckets.delete_many({"chat_id": {"$in": [doc["_id"] for doc in lote]}})
+    else:
+        try:
+            collection.insert_many(documentos, ordered=False)
+            falhados = set()
+        except BulkWriteError as e:
+            erros = e.details.get("writeErrors", [])
+            outros = [erro for erro in erros if erro.get("code") != 11000]
+            if outros:
+                raise
+            falhados = {erro["index"] for erro in erros}
+        escritos = [doc for i, doc in enumerate(lote) if i not in falhados]
+        estatisticas["duplicates"] += len(falhados)
+        estatisticas["chats"] += len(escritos)
+
+    if em_buckets:
+        buckets = [bucket for doc in escritos for bucket in mongo_service.documentos_buckets(doc["_id"], doc["messages"])]
+        if buckets:
+            mongo_service.get_buckets_collection().insert_many(buckets, ordered=False)
+    estatisticas["messages"] += sum(len(doc["messages"]) for doc in escritos)
+    estatisticas["batches"] += 1
+
+def _invalidar_caches(estatisticas: dict):
+    """ Os chats importados mudam as contagens e dias já fechados da análise (também nos outros processos). """
+    if estatisticas["chats"] or estatisticas["replaced"]:
+        mongo_service.invalidar_cache_analise()
+        mongo_service.limpar_contagens_cache()
+
+def importar(chats: Iterable[dict], tamanho_lote: Optional[int] = None, substituir: bool = False,
+             ao_progredir: Optional[Callable[[dict], None]] = None) -> Dict:
+    """
+    Escreve os chats (formato da exportação) em lotes de `tamanho_lote` (IMPORT_BATCH_SIZE).
+    Devolve as contagens (chats inseridos, substituídos, duplicados, inválidos, mensagens) e o débito.
+    Um erro de leitura a meio (ex: JSON cortado) levanta ValueError depois de escrever os chats já lidos.
+    `ao_progredir` é chamado com as contagens depois de cada lote.
+    """
+    if mongo_service.get_chats_collection() is None:
+        raise RuntimeError("Coleção 'chats' indisponível.")
+    tamanho_lote = max(1, tamanho_lote or getattr(settings, 'IMPORT_BATCH_SIZE', 500))
+    estatisticas = {"chats": 0, "replaced": 0, "duplicates": 0, "invalid": 0, "messages": 0, "batches": 0}
+    inicio = time.perf_counter()
+    lote: List[dict] = []
+
+    def escrever():
+        if lote:
+            _escrever_lote(lote, substituir, estatisticas)
+            lote.clear()
+            if ao_progredir:
+                ao_progredir(dict(estatisticas))
+
+    try:
+        for chat in chats:
+            try:
+                lote.append(documento_importado(chat))
+            except (ValueError, TypeError) as e:
+                estatisticas["invalid"] += 1
+                logger.warning("Chat ignorado na importação: %s", e)
+                continue
+            if len(lote) >= tamanho_lote:
+                escrever()
+    except ValueError as e:
+        escrever()
+        _invalidar_caches(estatisticas)
+        raise ValueError(f"{e} ({estatisticas['chats'] + estatisticas['replaced']} chats já importados.)")
+    escrever()
+    _invalidar_caches(estatisticas)
+    segundos = time.perf_counter() - inicio
+    escritos = estatisticas["chats"] + estatisticas["replaced"]
+    estatisticas.update(
+        seconds=round(segundos, 3),
+        chats_per_second=round(escritos / segundos, 1) if segundos else None,
+        messages_per_second=round(estatisticas["messages"] / segundos, 1) if segundos else None,
+    )
+    logger.info("Importação concluída: %s chats (%s substituídos, %s duplicados, %s inválidos), %s mensagens em %ss.",
+                estatisticas["chats"], estatisticas["replaced"], estatisticas["duplicates"], estatisticas["invalid"],
+                estatisticas["messages"], estatisticas["seconds"])
+    return estatisticas
+
+def importar_de(fonte, formato: str, **kwargs) -> Dict:
+    """ Lê `fonte` (ficheiro binário ou corpo do pedido) no `formato` dado e importa os chats (ver importar). """
+    if formato not in LEITORES:
+        raise ValueError(f"Formato de importação inválido: '{formato}'. Use um de {FORMATOS_IMPORTACAO}.")
+    return importar(LEITORES[formato](fonte), **kwargs)
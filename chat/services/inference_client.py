@@ -0,0 +1,86 @@
+"""
+Cliente do servidor de inferência dedicado (ver inference_server.py).
+Usado pelo nlp_service quando NLP_INFERENCE_BACKEND = 'remote'.
+"""
+import threading
+from multiprocessing.connection import Client
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from .inference_server import EVENTOS_TERMINAIS, parse_endereco
+
+_local = threading.local()
+
+
+def authkey() -> bytes:
+    return (settings.NLP_INFERENCE_AUTHKEY or settings.SECRET_KEY).encode("utf-8")
+
+def _fechar_ligacao():
+    conn = getattr(_local, "conn", None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+def _ligacao():
+    """ Uma ligação por thread, reutilizada entre pedidos. """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = Client(parse_endereco(settings.NLP_INFERENCE_ADDRESS), authkey=authkey())
+        _local.conn = conn
+    return conn
+
+def _pedir(tipo: str, dados: Optional[dict] = None) -> Iterator[Tuple[str, Any]]:
+    """ Envia um pedido e devolve os eventos (evento, valor) até ao evento terminal. """
+    pedido = {"tipo": tipo, "dados": dados or {}}
+    try:
+        conn = _ligacao()
+        conn.send(pedido)
+    except (OSError, EOFError):
+        # A ligação guardada pode ter caído (ex: servidor reiniciado): tenta uma vez com uma nova
+        _fechar_ligacao()
+        conn = _ligacao()
+        conn.send(pedido)
+
+    terminou = False
+    try:
+        while True:
+            evento, valor = conn.recv()
+            if evento in EVENTOS_TERMINAIS:
+                terminou = True
+            if evento == "erro":
+                raise RuntimeError(f"Erro no servidor de inferência: {valor}")
+            yield evento, valor
+            if terminou:
+                return
+    finally:
+        if not terminou:
+            # O consumidor desistiu a meio (ou a ligação falhou): a ligação fica num estado
+            # desconhecido, por isso é fechada (o servidor cancela a geração)
+            _fechar_ligacao()
+
+def gerar(history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> str:
+    for evento, valor in _pedir("gerar", {"history": history, "chat_id": chat_id, "resumo": resumo}):
+        if evento == "resultado":
+            return valor
+    return ""
+
+def gerar_stream(history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> Iterator[str]:
+    for evento, valor in _pedir("stream", {"history": history, "chat_id": chat_id, "resumo": resumo}):
+        if evento == "token":
+            yield valor
+
+def resumir(resumo_anterior: Optional[str], mensagens: List[Dict]) -> str:
+    for evento, valor in _pedir("resumir", {"resumo_anterior": resumo_anterior, "mensagens": mensagens}):
+        if evento == "resultado":
+            return valor
+    return ""
+
+def estado() -> dict:
+    for evento, valor in _pedir("estado"):
+        if evento == "resultado":
+            return valor
+    return {}
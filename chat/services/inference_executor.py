@@ -0,0 +1,111 @@
+"""
+Passagem do trabalho bloqueante (inferência, contagem de tokens, resumo do contexto) das views
+assíncronas para um pool de threads dedicado.
+
+O event loop nunca bloqueia: enquanto uma resposta é gerada, o pedido é só uma corrotina à espera,
+por isso um processo pode manter centenas de ligações de chat abertas. O número de gerações em curso
+é limitado por NLP_ASYNC_WORKERS; os restantes pedidos esperam na fila do executor sem ocupar threads.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator
+
+from django.conf import settings
+
+from . import metrics
+
+_executor = None
+_executor_lock = threading.Lock()
+_estatisticas = {"running": 0, "waiting": 0, "completed": 0}
+_estatisticas_lock = threading.Lock()
+_FIM = object()
+
+
+def _obter_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, getattr(settings, 'NLP_ASYNC_WORKERS', 8)),
+                thread_name_prefix="inferencia"
+            )
+        return _executor
+
+def _contar(**variacoes):
+    with _estatisticas_lock:
+        for chave, variacao in variacoes.items():
+            _estatisticas[chave] += variacao
+
+def _contabilizado(funcao: Callable) -> Callable:
+    """
+    Mantém as contagens de tarefas à espera / em curso (lidas por estatisticas()) e mede a espera na fila.
+    A função corre no contexto do pedido (ID de trace e tempos por etapa das métricas).
+    """
+    _contar(waiting=1)
+    contexto = contextvars.copy_context()
+    submetido = time.perf_counter()
+    def no_contexto():
+        metrics.ESPERA_FILA.observar(time.perf_counter() - submetido, queue="async_executor")
+        return funcao()
+    def executar():
+        _contar(waiting=-1, running=1)
+        try:
+            return contexto.run(no_contexto)
+        finally:
+            _contar(running=-1, completed=1)
+    return executar
+
+async def executar(funcao: Callable, *args, **kwargs):
+    """ Corre funcao(*args, **kwargs) no pool de inferência e espera pelo resultado sem bloquear o event loop. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_obter_executor(), _contabilizado(functools.partial(funcao, *args, **kwargs)))
+
+async def iterar(fabrica: Callable[[], Iterator]) -> AsyncIterator:
+    """
+    Consome um gerador síncrono (ex: o streaming da resposta) numa thread do pool e entrega os itens ao
+    event loop à medida que são produzidos. Se o consumidor desistir (cliente desligou), o gerador é
+    fechado no próximo item, o que cancela a geração.
+    """
+    loop = asyncio.get_running_loop()
+    fila: asyncio.Queue = asyncio.Queue()
+    parar = threading.Event()
+
+    def entregar(item, erro=None):
+        try:
+            loop.call_soon_threadsafe(fila.put_nowait, (item, erro))
+        except RuntimeError:
+            parar.set() # O event loop já fechou
+
+    def produzir():
+        gerador = fabrica()
+        try:
+            for item in gerador:
+                if parar.is_set():
+                    break
+                entregar(item)
+        except BaseException as e:
+            entregar(_FIM, e)
+            return
+        finally:
+            gerador.close()
+        entregar(_FIM)
+
+    loop.run_in_executor(_obter_executor(), _contabilizado(produzir))
+    try:
+        while True:
+            item, erro = await fila.get()
+            if item is _FIM:
+                if erro is not None:
+                    raise erro
+                return
+            yield item
+    finally:
+        parar.set()
+
+def estatisticas() -> dict:
+    with _estatisticas_lock:
+        return {"workers": getattr(settings, 'NLP_ASYNC_WORKERS', 8), **_estatisticas}
@@ -0,0 +1,261 @@
+"""
+Servidor de inferência dedicado.
+
+Um processo servidor aceita pedidos dos workers Django por um socket local
+(multiprocessing.connection) e distribui-os por N processos réplica, cada um com a sua
+cópia do modelo e um número fixo de threads intra-op. Assim a concorrência web
+(workers do gunicorn/uvicorn) e a concorrência de inferência (réplicas) escalam de forma independente.
+
+Protocolo: o cliente envia {'tipo': ..., 'dados': {...}} e recebe tuplos (evento, valor),
+terminando em 'resultado', 'fim' ou 'erro'. Ver inference_client.py.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+EVENTOS_TERMINAIS = ("resultado", "fim", "erro")
+
+
+def parse_endereco(endereco: str):
+    """ 'host:porta' -> (host, porta); qualquer outro valor é um caminho de socket Unix. """
+    if ":" in endereco and not endereco.startswith("/"):
+        host, porta = endereco.rsplit(":", 1)
+        return (host, int(porta))
+    return endereco
+
+
+# --- Processo réplica (dono de uma cópia do modelo) ---
+
+def _replica_main(indice: int, fila_pedidos, fila_resultados, threads: int, max_concorrencia: int):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
+    import django
+    django.setup()
+    import torch
+    from . import nlp_service
+
+    torch.set_num_threads(threads)
+
+    fila_resultados.put(("__estado__", indice, {"status": "loading", "pid": os.getpid()}))
+    nlp_service.iniciar_carregamento(backend="local") # Dentro da réplica a inferência é sempre local
+    while not nlp_service.modelo_pronto() and nlp_service.estado_modelo()["status"] != "failed":
+        time.sleep(0.2)
+    fila_resultados.put(("__estado__", indice, {**nlp_service.estado_modelo(), "pid": os.getpid()}))
+
+    cancelamentos: Dict[int, threading.Event] = {}
+
+    def atender(job_id: int, tipo: str, dados: dict):
+        try:
+            if tipo == "gerar":
+                texto = nlp_service.gerar_resposta_com_contexto(dados["history"], chat_id=dados.get("chat_id"), resumo=dados.get("resumo"))
+                fila_resultados.put((job_id, "resultado", texto))
+            elif tipo == "stream":
+                gerador = nlp_service.gerar_resposta_stream(dados["history"], chat_id=dados.get("chat_id"), resumo=dados.get("resumo"))
+                try:
+                    for pedaco in gerador:
+                        if cancelamentos[job_id].is_set():
+                            break
+                        fila_resultados.put((job_id, "token", pedaco))
+                finally:
+                    gerador.close() # Cancela o model.generate se o cliente desistiu
+                fila_resultados.put((job_id, "fim", None))
+            elif tipo == "resumir":
+                texto = nlp_service.resumir_conversa(dados.get("resumo_anterior"), dados["mensagens"])
+                fila_resultados.put((job_id, "resultado", texto))
+            else:
+                fila_resultados.put((job_id, "erro", f"Tipo de pedido desconhecido: {tipo}"))
+        except Exception as e:
+            logger.exception("Erro ao processar o pedido %s na réplica", job_id)
+            fila_resultados.put((job_id, "erro", str(e)))
+        finally:
+            cancelamentos.pop(job_id, None)
+
+    # Os pedidos são atendidos em threads e todos passam pelo scheduler da réplica: os prompts sem cache KV
+    # são agrupados em lotes e as gerações individuais (cache KV por chat, streaming) correm uma a uma entre lotes
+    with ThreadPoolExecutor(max_workers=max_concorrencia) as executor:
+        while True:
+            pedido = fila_pedidos.get()
+            if pedido is None:
+                break
+            job_id, tipo, dados = pedido
+            if tipo == "cancelar":
+                evento = cancelamentos.get(job_id)
+                if evento is not None:
+                    evento.set()
+                continue
+            cancelamentos[job_id] = threading.Event()
+            executor.submit(atender, job_id, tipo, dados)
+
+
+# --- Processo servidor (aceita ligações e encaminha pedidos para as réplicas) ---
+
+class InferenceServer:
+
+    def __init__(self, endereco: str, authkey: bytes, replicas: int = 1, threads: int = 1, max_concorrencia: int = 8,
+                 timeout: float = 300.0):
+        self.endereco = parse_endereco(endereco)
+        self.authkey = authkey
+        self.n_replicas = max(1, replicas)
+        self.threads = max(1, threads)
+        self.max_concorrencia = max(1, max_concorrencia)
+        self.timeout = timeout # Segundos sem notícias da réplica até o pedido ser dado como falhado
+        self._ctx = multiprocessing.get_context("spawn")
+        self._filas: List = []
+        self._processos: List = []
+        self._fila_resultados = None
+        self._estados: Dict[int, dict] = {}
+        self._pendentes: Dict[int, "queue.Queue"] = {}
+        self._pendentes_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._round_robin = itertools.count()
+        self._iniciado_em = time.time()
+
+    def iniciar_replicas(self):
+        self._fila_resultados = self._ctx.Queue()
+        for indice in range(self.n_replicas):
+            fila = self._ctx.Queue()
+            processo = self._ctx.Process(
+                target=_replica_main,
+                args=(indice, fila, self._fila_resultados, self.threads, self.max_concorrencia),
+                name=f"inference-replica-{indice}",
+                daemon=True
+            )
+            processo.start()
+            self._filas.append(fila)
+            self._processos.append(processo)
+            self._estados[indice] = {"status": "starting"}
+        threading.Thread(target=self._recolher_resultados, name="inference-results", daemon=True).start()
+
+    def parar(self):
+        for fila in self._filas:
+            fila.put(None)
+        for processo in self._processos:
+            processo.join(10)
+
+    def estado(self) -> dict:
+        replicas = []
+        for indice, processo in enumerate(self._processos):
+            estado = dict(self._estados.get(indice, {}))
+            if not processo.is_alive():
+                estado["status"] = "dead"
+            replicas.append({"replica": indice, **estado})
+        prontas = [r for r in replicas if r.get("status") == "ready"]
+        return {
+            "status": "ready" if prontas else ("failed" if replicas and all(r.get("status") in ("failed", "dead") for r in replicas) else "loading"),
+            "replicas": replicas,
+            "replicas_ready": len(prontas),
+            "threads_per_replica": self.threads,
+            "pending_jobs": len(self._pendentes),
+            "uptime_seconds": round(time.time() - self._iniciado_em, 1),
+        }
+
+    def _recolher_resultados(self):
+        while True:
+            job_id, evento, valor = self._fila_resultados.get()
+            if job_id == "__estado__":
+                self._estados[evento] = valor
+                continue
+            with self._pendentes_lock:
+                destino = self._pendentes.get(job_id)
+            if destino is not None:
+                destino.put((evento, valor))
+
+    def _replica_utilizavel(self, indice: int) -> bool:
+        """ False se o processo da réplica morreu ou se o modelo não carregou. """
+        if self._estados.get(indice, {}).get("status") == "failed":
+            return False
+        return indice >= len(self._processos) or self._processos[indice].is_alive()
+
+    def _escolher_replica(self, chat_id: Optional[str]) -> Optional[int]:
+        """
+        Pedidos do mesmo chat vão sempre para a mesma réplica, para aproveitar a sua cache KV.
+        As réplicas mortas ou que falharam o carregamento são saltadas; None se não houver nenhuma utilizável.
+        """
+        utilizaveis = [i for i in range(self.n_replicas) if self._replica_utilizavel(i)]
+        if not utilizaveis:
+            return None
+        if chat_id:
+            indice = zlib.crc32(str(chat_id).encode("utf-8"))
+            if indice % self.n_replicas in utilizaveis:
+                return indice % self.n_replicas
+            return utilizaveis[indice % len(utilizaveis)]
+        return utilizaveis[next(self._round_robin) % len(utilizaveis)]
+
+    def _esperar_evento(self, job_id: int, respostas: "queue.Queue", replica: int) -> tuple:
+        """
+        Próximo evento do pedido. Se a réplica morrer ou ficar `timeout` segundos sem responder,
+        devolve um evento 'erro' (e cancela o pedido na réplica) em vez de bloquear para sempre.
+        """
+        prazo = time.monotonic() + self.timeout
+        while True:
+            try:
+                return respostas.get(timeout=max(0.0, min(1.0, prazo - time.monotonic())))
+            except queue.Empty:
+                pass
+            if not self._replica_utilizavel(replica):
+                return ("erro", f"A réplica {replica} do servidor de inferência terminou a meio do pedido.")
+            if time.monotonic() >= prazo:
+                self._filas[replica].put((job_id, "cancelar", None))
+                return ("erro", f"A réplica {replica} não respondeu em {self.timeout:g} segundos.")
+
+    def _atender_ligacao(self, conn):
+        with conn:
+            while True:
+                try:
+                    pedido = conn.recv()
+                except (EOFError, OSError):
+                    return
+                tipo = pedido.get("tipo")
+                dados = pedido.get("dados") or {}
+                if tipo == "estado":
+                    conn.send(("resultado", self.estado()))
+                    continue
+
+                job_id = next(self._ids)
+                respostas = queue.Queue()
+                with self._pendentes_lock:
+                    self._pendentes[job_id] = respostas
+                replica = self._escolher_replica(dados.get("chat_id"))
+                if replica is None:
+                    with self._pendentes_lock:
+                        self._pendentes.pop(job_id, None)
+                    try:
+                        conn.send(("erro", "Nenhuma réplica do servidor de inferência está disponível."))
+                    except (EOFError, OSError):
+                        return
+                    continue
+                self._filas[replica].put((job_id, tipo, dados))
+                try:
+                    while True:
+                        evento, valor = self._esperar_evento(job_id, respostas, replica)
+                        conn.send((evento, valor))
+                        if evento in EVENTOS_TERMINAIS:
+                            break
+                except (EOFError, OSError):
+                    # O cliente desligou a meio (ex: fechou a página durante o streaming)
+                    self._filas[replica].put((job_id, "cancelar", None))
+                    return
+                finally:
+                    with self._pendentes_lock:
+                        self._pendentes.pop(job_id, None)
+
+    def servir_para_sempre(self):
+        self.iniciar_replicas()
+        with Listener(self.endereco, authkey=self.authkey) as listener:
+            logger.info("Servidor de inferência à escuta em %s com %s réplica(s) x %s thread(s).", self.endereco, self.n_replicas, self.threads)
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning("Falha ao aceitar ligação no servidor de inferência: %s", e)
+                    continue
+                threading.Thread(target=self._atender_ligacao, args=(conn,), daemon=True).start()
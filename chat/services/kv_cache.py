@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+
+def tamanho_em_bytes(cache: Any) -> int:
+    """ Memória ocupada pelos tensores de um past_key_values (DynamicCache ou formato antigo). """
+    tensores = []
+    camadas = getattr(cache, "layers", None)
+    if camadas is not None:
+        for camada in camadas:
+            tensores.extend([getattr(camada, "keys", None), getattr(camada, "values", None)])
+    else:
+        tensores.extend(getattr(cache, "key_cache", []))
+        tensores.extend(getattr(cache, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensores if hasattr(t, "numel"))
+
+def prefixo_comum(a: List[int], b: List[int]) -> int:
+    """ Número de tokens iniciais iguais entre duas sequências. """
+    limite = min(len(a), len(b))
+    i = 0
+    while i < limite and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class _Entrada:
+    __slots__ = ("token_ids", "cache", "nbytes", "ultimo_uso")
+
+    def __init__(self, token_ids: List[int], cache: Any, nbytes: int):
+        self.token_ids = token_ids
+        self.cache = cache
+        self.nbytes = nbytes
+        self.ultimo_uso = time.monotonic()
+
+
+class KVCacheStore:
+    """
+    Cache LRU de past_key_values por chat_id.
+
+    Cada entrada guarda o cache KV e os token ids que ele cobre. No turno seguinte, se o novo
+    prompt começar pelos mesmos tokens, só o sufixo novo precisa de passar pelo prefill.
+    A cache respeita um orçamento de memória (max_bytes) e descarta entradas inativas há mais
+    de idle_seconds.
+    """
+
+    def __init__(self, max_bytes: int, idle_seconds: float):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._entradas: "OrderedDict[str, _Entrada]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens_reutilizados = 0
+        self.tokens_prefill = 0
+
+    def obter(self, chat_id: str, token_ids: List[int]) -> Tuple[Optional[Any], int]:
+        """
+        Retira a entrada do chat (o chamador passa a ser dono do cache, que será alterado pelo
+        model.generate) e corta-a ao prefixo comum com token_ids.
+        Devolve (cache, tokens_reutilizados) ou (None, 0) num miss.
+        """
+        with self._lock:
+            self._remover_inativas()
+            entrada = self._entradas.pop(chat_id, None)
+            if entrada is not None:
+                self._bytes -= entrada.nbytes
+
+            reutilizaveis = 0
+            if entrada is not None:
+                # Pelo menos um token tem de ficar de fora, para o modelo calcular os logits do próximo
+                reutilizaveis = min(prefixo_comum(entrada.token_ids, token_ids), len(token_ids) - 1)
+
+            if reutilizaveis <= 0:
+                self.misses += 1
+                self.tokens_prefill += len(token_ids)
+                return None, 0
+
+            self.hits += 1
+            self.tokens_reutilizados += reutilizaveis
+            self.tokens_prefill += len(token_ids) - reutilizaveis
+
+        cache = entrada.cache
+        if cache.get_seq_length() > reutilizaveis:
+            cache.crop(reutilizaveis)
+        return cache, reutilizaveis
+
+    def guardar(self, chat_id: str, token_ids: List[int], cache: Any):
+        """ Guarda (ou substitui) o cache do chat e aplica o orçamento de memória. """
+        nbytes = tamanho_em_bytes(cache)
+        with self._lock:
+            antiga = self._entradas.pop(chat_id, None)
+            if antiga is not None:
+                self._bytes -= antiga.nbytes
+            if nbytes > self.max_bytes:
+                # Não cabe nem sozinha no orçamento
+                self.evictions += 1
+                return
+            self._entradas[chat_id] = _Entrada(list(token_ids), cache, nbytes)
+            self._bytes += nbytes
+            self._remover_inativas()
+            while self._bytes > self.max_bytes and self._entradas:
+                _, removida = self._entradas.popitem(last=False)
+                self._bytes -= removida.nbytes
+                self.evictions += 1
+
+    def remover(self, chat_id: str):
+        with self._lock:
+            entrada = self._entradas.pop(chat_id, None)
+            if entrada is not None:
+                self._bytes -= entrada.nbytes
+
+    def _remover_inativas(self):
+        """ Remove as entradas sem uso há mais de idle_seconds (chamar com o lock adquirido). """
+        limite = time.monotonic() - self.idle_seconds
+        # O OrderedDict está ordenado do uso mais antigo para o mais recente
+        while self._entradas:
+            chat_id, entrada = next(iter(self._entradas.items()))
+            if entrada.ultimo_uso >= limite:
+                break
+            del self._entradas[chat_id]
+            self._bytes -= entrada.nbytes
+            self.evictions += 1
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entradas),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "tokens_reused": self.tokens_reutilizados,
+                "tokens_prefilled": self.tokens_prefill,
+            }
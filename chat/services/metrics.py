@@ -0,0 +1,215 @@
+"""
+Métricas do caminho de um pedido (histogramas no formato de texto do Prometheus, servidos em /metrics).
+
+- HTTP: duração de cada pedido por view, método e estado (MetricasMiddleware).
+- MongoDB: duração de cada comando (find, aggregate, insert...) via monitorização de comandos do pymongo,
+  tanto no cliente síncrono como no assíncrono.
+- Templates: tempo de renderização.
+- Modelo: tokenização, prefill (até ao primeiro token), decode, tokens/s do decode e espera nas filas
+  (scheduler de micro-batching e pool de inferência das views assíncronas).
+
+Com METRICS_TRACE_IDS, cada pedido recebe um ID (ou reutiliza o X-Request-ID recebido), devolvido no
+cabeçalho X-Request-ID juntamente com um Server-Timing com o tempo gasto em cada etapa nesse pedido.
+Os valores são por processo: com vários workers, o Prometheus deve recolher cada um.
+"""
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from pymongo import monitoring
+
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BUCKETS_TOKENS_POR_SEGUNDO = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Pedido atual: ID de trace e tempo acumulado por etapa (para o Server-Timing)
+trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+_etapas: ContextVar[Optional[Dict[str, float]]] = ContextVar("etapas", default=None)
+
+
+def ativas() -> bool:
+    return getattr(settings, 'METRICS_ENABLED', True)
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _formatar_etiquetas(pares) -> str:
+    return "{" + ",".join(f'{nome}="{_escapar(valor)}"' for nome, valor in pares) + "}" if pares else ""
+
+
+class Histograma:
+    """ Histograma com etiquetas (buckets cumulativos, soma e contagem, como no Prometheus). """
+
+    def __init__(self, nome: str, ajuda: str, etiquetas: Tuple[str, ...] = (), buckets=BUCKETS_SEGUNDOS, etapa: Optional[str] = None):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.etiquetas = etiquetas
+        self.buckets = tuple(sorted(buckets))
+        self.etapa = etapa # Nome no Server-Timing (só para durações)
+        self._series: Dict[tuple, list] = {} # valores das etiquetas -> [contagens por bucket..., soma, contagem]
+        self._lock = threading.Lock()
+        _registo[nome] = self
+
+    def observar(self, valor: float, **etiquetas):
+        if not ativas():
+            return
+        chave = tuple(str(etiquetas.get(nome, "")) for nome in self.etiquetas)
+        with self._lock:
+            serie = self._series.get(chave)
+            if serie is None:
+                serie = self._series[chave] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+        if self.etapa:
+            etapas = _etapas.get()
+            if etapas is not None:
+                etapas[self.etapa] = etapas.get(self.etapa, 0.0) + valor
+
+    @contextmanager
+    def medir(self, **etiquetas):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **etiquetas)
+
+    def amostras(self) -> Dict[tuple, dict]:
+        """ {valores das etiquetas: {'buckets', 'sum', 'count'}} (usado nos testes e no benchmark). """
+        with self._lock:
+            return {chave: {"buckets": dict(zip(self.buckets, serie[:-2])), "sum": serie[-2], "count": serie[-1]}
+                    for chave, serie in self._series.items()}
+
+    def expor(self) -> str:
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+            for chave, serie in series:
+                pares = list(zip(self.etiquetas, chave))
+                for limite, contagem in zip(self.buckets, serie):
+                    linhas.append(f"{self.nome}_bucket{_formatar_etiquetas(pares + [('le', repr(float(limite)))])} {contagem}")
+                linhas.append(f"{self.nome}_bucket{_formatar_etiquetas(pares + [('le', '+Inf')])} {serie[-1]}")
+                linhas.append(f"{self.nome}_sum{_formatar_etiquetas(pares)} {serie[-2]}")
+                linhas.append(f"{self.nome}_count{_formatar_etiquetas(pares)} {serie[-1]}")
+        return "\n".join(linhas)
+
+    def limpar(self):
+        with self._lock:
+            self._series.clear()
+
+
+_registo: Dict[str, Histograma] = {}
+
+HTTP = Histograma("http_request_duration_seconds", "Duração dos pedidos HTTP (até aos cabeçalhos, nas respostas em streaming).",
+                  ("view", "method", "status"))
+MONGO = Histograma("mongo_command_duration_seconds", "Duração de cada comando enviado ao MongoDB (ida e volta).",
+                   ("command", "outcome"), etapa="mongo")
+TEMPLATE = Histograma("template_render_duration_seconds", "Tempo de renderização dos templates.", ("template",), etapa="template")
+TOKENIZACAO = Histograma("nlp_tokenization_duration_seconds", "Tempo de tokenização (template do chat, codificação, contagem).",
+                         ("operation",), etapa="tokenizacao")
+PREFILL = Histograma("nlp_prefill_duration_seconds", "Tempo até ao primeiro token gerado (processamento do prompt).", ("path",), etapa="prefill")
+DECODE = Histograma("nlp_decode_duration_seconds", "Tempo de geração dos tokens seguintes ao primeiro.", ("path",), etapa="decode")
+TOKENS_POR_SEGUNDO = Histograma("nlp_decode_tokens_per_second", "Débito do decode (tokens gerados por segundo, por lote).",
+                                ("path",), buckets=BUCKETS_TOKENS_POR_SEGUNDO)
+ESPERA_FILA = Histograma("nlp_queue_wait_seconds", "Espera na fila antes de a geração começar.", ("queue",), etapa="fila")
+
+def expor() -> str:
+    """ Todas as métricas no formato de texto do Prometheus (versão 0.0.4). """
+    return "\n".join(h.expor() for h in _registo.values()) + "\n"
+
+def limpar():
+    """ Apaga as amostras (usado nos testes). """
+    for histograma in _registo.values():
+        histograma.limpar()
+
+
+# --- MongoDB: monitorização de comandos do pymongo ---
+
+class OuvinteComandosMongo(monitoring.CommandListener):
+    """ Regista a duração de cada comando; registado nos clientes com event_listeners=[...]. """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO.observar(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        MONGO.observar(event.duration_micros / 1e6, command=event.command_name, outcome="error")
+
+def ouvintes_mongo() -> list:
+    """ event_listeners para os clientes MongoDB (vazio com as métricas desligadas). """
+    return [OuvinteComandosMongo()] if ativas() else []
+
+
+# --- Geração: prefill vs decode ---
+
+class CronometroGeracao:
+    """
+    Critério de paragem que nunca pára: é chamado uma vez por passo de geração, por isso a primeira chamada
+    marca o fim do prefill e as seguintes contam os passos de decode.
+    """
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.primeiro_token = None
+        self.passos = 0
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        if self.primeiro_token is None:
+            self.primeiro_token = time.perf_counter()
+        self.passos += 1
+        return False
+
+    def registar(self, caminho: str, tokens: Optional[int] = None):
+        """
+        Regista prefill, decode e tokens/s da geração que acabou de terminar.
+        `tokens` (gerados) só é preciso quando um passo pode produzir vários tokens (decodificação especulativa).
+        """
+        if self.primeiro_token is None:
+            return
+        fim = time.perf_counter()
+        PREFILL.observar(self.primeiro_token - self.inicio, path=caminho)
+        decode = fim - self.primeiro_token
+        DECODE.observar(decode, path=caminho)
+        tokens = self.passos if tokens is None else tokens
+        if tokens > 1 and decode > 0:
+            TOKENS_POR_SEGUNDO.observar((tokens - 1) / decode, path=caminho)
+
+
+# --- Pedidos: duração, trace ID e Server-Timing ---
+
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+def iniciar_pedido(request) -> tuple:
+    """ Prepara o contexto do pedido; devolve o que terminar_pedido precisa. """
+    tokens = []
+    if getattr(settings, 'METRICS_TRACE_IDS', False):
+        recebido = request.headers.get("X-Request-ID", "")
+        tokens.append(trace_id.set(recebido if _ID_VALIDO.match(recebido) else uuid.uuid4().hex))
+        tokens.append(_etapas.set({}))
+    return time.perf_counter(), tokens
+
+def terminar_pedido(request, response, estado: tuple):
+    inicio, tokens = estado
+    match = getattr(request, "resolver_match", None)
+    HTTP.observar(
+        time.perf_counter() - inicio,
+        view=match.view_name if match else "nao_encontrada",
+        method=request.method,
+        status=response.status_code
+    )
+    if tokens:
+        response["X-Request-ID"] = trace_id.get()
+        etapas = _etapas.get() or {}
+        if etapas:
+            response["Server-Timing"] = ", ".join(f"{nome};dur={segundos * 1000:.1f}" for nome, segundos in etapas.items())
+        for token in reversed(tokens):
+            token.var.reset(token)
+    return response
@@ -0,0 +1,300 @@
+"""
+Acesso assíncrono ao MongoDB (pymongo.AsyncMongoClient) para as views assíncronas (ASGI).
+
+Só as operações do caminho de um pedido estão aqui: registar um turno, listar/contar o histórico,
+detalhe de um chat e exportação. A construção das queries e a formatação dos resultados são as de
+mongo_service (mesmos filtros, mesma paginação, mesmo formato); as tarefas de manutenção (índices,
+migração, jobs, análise) continuam no cliente síncrono.
+
+Um AsyncMongoClient pertence ao event loop em que é usado: sob ASGI há um loop por processo e um só
+cliente (ativado pelo asgi.py). No runserver/WSGI cada pedido a uma view assíncrona corre num loop novo
+e efémero; aí as funções deste módulo delegam em mongo_service numa thread, em vez de abrirem um pool
+de ligações (com as suas threads de monitorização) por pedido.
+"""
+import asyncio
+import itertools
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import DESCENDING, AsyncMongoClient, ReturnDocument, errors as MongoErrors
+
+from . import metrics, mongo_connection, mongo_service, write_behind
+
+logger = logging.getLogger(__name__)
+
+_ativo = False # True com um event loop para toda a vida do processo (ASGI, ver ativar)
+_cliente: Optional[AsyncMongoClient] = None
+_loop_do_cliente: Optional[asyncio.AbstractEventLoop] = None
+_indice_texto_disponivel = None # None = ainda não verificado
+
+
+def ativar():
+    """ Usa o cliente assíncrono (chamado pelo asgi.py, onde o event loop dura tanto como o processo). """
+    global _ativo
+    _ativo = True
+
+def _assincrono() -> bool:
+    """ Se o pedido atual usa o cliente assíncrono; fora do loop do cliente (ou sem ASGI) usa-se mongo_service. """
+    return _ativo and (_loop_do_cliente is None or _loop_do_cliente is asyncio.get_running_loop())
+
+def get_db():
+    """
+    Base de dados no cliente assíncrono do processo (criado no primeiro uso; a ligação é preguiçosa).
+    Levanta MongoIndisponivel logo, sem contactar o servidor, enquanto o disjuntor de mongo_connection está aberto.
+    """
+    global _cliente, _loop_do_cliente
+    mongo_connection.verificar_disponivel()
+    if _cliente is None:
+        _cliente = AsyncMongoClient(settings.MONGO_URI, **mongo_connection.opcoes_cliente())
+        _loop_do_cliente = asyncio.get_running_loop()
+        mongo_connection.iniciar_vigia()
+    return _cliente[settings.MONGO_DB_NAME]
+
+async def fechar():
+    """ Fecha o cliente assíncrono (no fim do event loop dele). """
+    global _cliente, _loop_do_cliente
+    if _cliente is not None:
+        cliente, _cliente, _loop_do_cliente = _cliente, None, None
+        await cliente.close()
+
+def get_chats_collection():
+    return get_db()["chats"]
+
+def get_buckets_collection():
+    return get_db()["chat_buckets"]
+
+async def _tem_indice_texto() -> bool:
+    global _indice_texto_disponivel
+    if _indice_texto_disponivel is None:
+        try:
+            _indice_texto_disponivel = mongo_service._algum_indice_texto(await get_chats_collection().index_information())
+        except Exception:
+            return False
+    return _indice_texto_disponivel
+
+async def _chats_em_buckets_com_termo(termo: str, por_texto: bool) -> Optional[list]:
+    """ Igual a mongo_service._chats_em_buckets_com_termo. """
+    buckets = get_buckets_collection()
+    if await buckets.estimated_document_count() == 0:
+        return None
+    try:
+        cursor = await buckets.aggregate(mongo_service._pipeline_chats_em_buckets(termo, por_texto))
+        linhas = await cursor.to_list(None)
+    except MongoErrors.OperationFailure:
+        # Sem índice de texto nos buckets
+        cursor = await buckets.aggregate(mongo_service._pipeline_chats_em_buckets(termo, False))
+        linhas = await cursor.to_list(None)
+    return mongo_service._verificar_limite_buckets([linha["_id"] for linha in linhas])
+
+async def build_mongo_query(filters: Optional[dict] = None) -> dict:
+    """ Igual a mongo_service._build_mongo_query, com as leituras (índice de texto, buckets) assíncronas. """
+    if not filters:
+        return {}
+    por_texto = False
+    chat_ids = None
+    if filters.get('search_query'):
+        modo = filters.get('search_mode') or getattr(settings, 'MONGO_SEARCH_MODE', 'text')
+        por_texto = modo == 'text' and await _tem_indice_texto()
+        chat_ids = await _chats_em_buckets_com_termo(filters['search_query'], por_texto)
+    return mongo_service._montar_query(filters, por_texto, chat_ids)
+
+# --- Mensagens (array 'messages' ou buckets) ---
+
+async def _ler_mensagens_buckets(chat_oid: ObjectId, desde: int = 0) -> List[Dict]:
+    tamanho = mongo_service._tamanho_bucket()
+    primeiro = max(0, desde) // tamanho
+    cursor = get_buckets_collection().find({"chat_id": chat_oid, "seq": {"$gte": primeiro}}, {"messages": 1}).sort("seq", 1)
+    mensagens = [msg async for bucket in cursor for msg in bucket.get("messages", [])]
+    return mensagens[max(0, desde) - primeiro * tamanho:]
+
+async def _carregar_mensagens(chat: dict) -> dict:
+    if mongo_service._chat_em_buckets(chat):
+        chat["messages"] = await _ler_mensagens_buckets(chat["_id"])
+    return chat
+
+async def _acrescentar_mensagem(chat_oid: ObjectId, message: dict, projection: dict) -> Optional[dict]:
+    """ Igual a mongo_service._acrescentar_mensagem: tenta primeiro o modo de armazenamento configurado. """
+    collection = get_chats_collection()
+    modos = ("bucketed", "embedded") if mongo_service._armazenamento_em_buckets() else ("embedded", "bucketed")
+    for modo in modos:
+        if modo == "bucketed":
+            chat = await collection.find_one_and_update(
+                {"_id": chat_oid, "message_storage": "bucketed"},
+                mongo_service._atualizacao_resumo(message),
+                projection={**projection, "message_storage": 1, "message_count": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if chat is not None:
+                await get_buckets_collection().update_one(
+                    {"chat_id": chat_oid, "seq": (chat["message_count"] - 1) // mongo_service._tamanho_bucket()},
+                    {"$push": {"messages": message}, "$setOnInsert": {"created_at": message["timestamp"]}},
+                    upsert=True
+                )
+        else:
+            chat = await collection.find_one_and_update(
+                {"_id": chat_oid, "message_storage": {"$ne": "bucketed"}},
+                {**mongo_service._atualizacao_resumo(message), "$push": {"messages": message}},
+                projection={**projection, "message_storage": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        if chat is not None:
+            return chat
+    return None
+
+# --- Turnos ---
+
+async def registrar_mensagem_utilizador(chat_id: Optional[str], content: str, title: str = "Novo Chat") -> Optional[Dict]:
+    """ Versão assíncrona de mongo_service.registrar_mensagem_utilizador (mesmo resultado). """
+    if not _assincrono():
+        return await asyncio.to_thread(mongo_service.registrar_mensagem_utilizador, chat_id, content, title)
+    message = {
+        "role": "user",
+        "content": content,
+        "timestamp": datetime.now(timezone.utc)
+    }
+    try:
+        if not chat_id:
+            new_oid = (await get_chats_collection().insert_one(mongo_service._documento_novo_chat(title, message))).inserted_id
+            if mongo_service._armazenamento_em_buckets():
+                await get_buckets_collection().insert_one({"chat_id": new_oid, "seq": 0, "messages": [message], "created_at": message["timestamp"]})
+            new_id = str(new_oid)
+            logger.debug("Novo chat criado com ID: %s", new_id)
+            return {"chat_id": new_id, "messages": [message], "first_message": 0, "context_summary": None, "context_summary_upto": 0}
+
+        if not ObjectId.is_valid(chat_id):
+            logger.error("ID do chat inválido '%s' ao registar mensagem.", chat_id)
+            return None
+        if write_behind.ativo() and await asyncio.to_thread(write_behind.tem_pendentes, chat_id) \
+                and not await asyncio.to_thread(write_behind.escrever_chat, chat_id):
+            logger.error("Mensagem não registada: o chat %s tem respostas por escrever na fila de escrita diferida.", chat_id)
+            return None
+        chat = await _acrescentar_mensagem(ObjectId(chat_id), message, {"messages": 1, "context_summary": 1, "context_summary_upto": 1})
+        if not chat:
+            logger.warning("Chat com ID %s não encontrado para registar mensagem.", chat_id)
+            return None
+        first_message = 0
+        if mongo_service._chat_em_buckets(chat):
+            first_message = min(chat.get("context_summary_upto", 0), chat["message_count"] - 1)
+            messages = await _ler_mensagens_buckets(chat["_id"], desde=first_message)
+        else:
+            messages = chat.get("messages", [])
+        return {
+            "chat_id": chat_id,
+            "messages": messages,
+            "first_message": first_message,
+            "context_summary": chat.get("context_summary"),
+            "context_summary_upto": chat.get("context_summary_upto", 0),
+        }
+    except Exception as e:
+        logger.exception("Erro ao registar a mensagem do utilizador no chat %s", chat_id)
+        return None
+
+async def registrar_resposta_assistente(chat_id: str, content: str, metadata: Optional[dict] = None) -> bool:
+    """ Versão assíncrona de mongo_service.registrar_resposta_assistente. """
+    if not _assincrono():
+        return await asyncio.to_thread(mongo_service.registrar_resposta_assistente, chat_id, content, metadata)
+    if not ObjectId.is_valid(chat_id):
+        logger.error("ID do chat inválido '%s' ao registar resposta.", chat_id)
+        return False
+    message = {
+        "role": "assistant",
+        "content": content,
+        "timestamp": datetime.now(timezone.utc),
+        **(metadata or {})
+    }
+    # A escrita no ficheiro da fila (com fsync) corre fora do event loop
+    if write_behind.ativo() and await asyncio.to_thread(write_behind.enfileirar, chat_id, message):
+        return True
+    try:
+        if await _acrescentar_mensagem(ObjectId(chat_id), message, {"_id": 1}) is None:
+            logger.warning("Chat com ID %s não encontrado para registar resposta.", chat_id)
+            return False
+        return True
+    except Exception as e:
+        logger.exception("Erro ao registar a resposta do assistente no chat %s", chat_id)
+        return False
+
+# --- Histórico ---
+
+async def contar_chats(filters: Optional[dict] = None) -> tuple[int, bool]:
+    """ Versão assíncrona de mongo_service.contar_chats (partilha a mesma cache de contagens). """
+    if not _assincrono():
+        return await asyncio.to_thread(mongo_service.contar_chats, filters)
+    collection = get_chats_collection()
+    query = await build_mongo_query(filters)
+    if not query:
+        return await collection.estimated_document_count(), False
+    em_cache = mongo_service._contagem_em_cache(filters)
+    if em_cache:
+        return em_cache
+    limite = getattr(settings, 'MONGO_COUNT_LIMIT', 10000)
+    total = await collection.count_documents(query, limit=limite) if limite else await collection.count_documents(query)
+    return mongo_service._guardar_contagem(filters, total, limite)
+
+async def get_chats_page(filters: Optional[dict] = None, per_page: int = 10, cursor: Optional[str] = None, direction: str = "next",
+                         sort: Optional[str] = None) -> dict:
+    """ Versão assíncrona de mongo_service.get_chats_page (mesmos cursores e ordenações). """
+    if not _assincrono():
+        return await asyncio.to_thread(mongo_service.get_chats_page, filters, per_page, cursor, direction, sort)
+    if per_page < 1: per_page = 10
+    campo = mongo_service._campo_ordenacao(sort)
+    posicao = mongo_service.descodificar_cursor(cursor, campo)
+    para_tras = posicao is not None and direction == "prev"
+    collection = get_chats_collection()
+    try:
+        consulta = mongo_service._consulta_pagina(await build_mongo_query(filters), posicao, para_tras, per_page, campo)
+        if "pipeline" in consulta:
+            documentos = await (await collection.aggregate(consulta["pipeline"])).to_list(None)
+        else:
+            documentos = await collection.find(consulta["filter"], mongo_service.PROJECAO_LISTAGEM).sort(consulta["sort"]).limit(per_page + 1).to_list(None)
+    except Exception as e:
+        logger.exception("Erro ao buscar chats paginados")
+        return {"chats": [], "next_cursor": None, "prev_cursor": None}
+    pagina = mongo_service._montar_pagina(documentos, per_page, posicao, para_tras, campo)
+    if write_behind.ativo():
+        await asyncio.to_thread(write_behind.atualizar_listagem, pagina["chats"]) # Lê os ficheiros da fila: fora do event loop
+    return pagina
+
+async def get_chat_details(chat_id: str) -> Optional[dict]:
+    """ Versão assíncrona de mongo_service.get_chat_details. """
+    if not _assincrono():
+        return await asyncio.to_thread(mongo_service.get_chat_details, chat_id)
+    if not ObjectId.is_valid(chat_id):
+        logger.error("ID do chat inválido '%s' ao buscar detalhes.", chat_id)
+        return None
+    try:
+        pendentes = await asyncio.to_thread(write_behind.pendentes, chat_id) if write_behind.ativo() else [] # Lidas antes do chat (ver write_behind.pendentes)
+        chat = await get_chats_collection().find_one({"_id": ObjectId(chat_id)})
+        if not chat:
+            logger.warning("Chat %s não encontrado ao buscar detalhes.", chat_id)
+            return None
+        return mongo_service._formatar_detalhes(write_behind.juntar_pendentes(await _carregar_mensagens(chat), pendentes))
+    except Exception as e:
+        logger.exception("Erro ao buscar detalhes do chat %s", chat_id)
+        return None
+
+async def iterar_chats_para_exportacao(filters: Optional[dict] = None, batch_size: Optional[int] = None) -> AsyncIterator[Dict]:
+    """ Versão assíncrona de mongo_service.iterar_chats_para_exportacao: um chat de cada vez, lido em lotes. """
+    if not _assincrono():
+        # Cada lote do cursor síncrono é lido numa thread
+        batch_size = batch_size or getattr(settings, 'MONGO_EXPORT_BATCH_SIZE', 100)
+        chats = mongo_service.iterar_chats_para_exportacao(filters=filters, batch_size=batch_size)
+        try:
+            while lote := await asyncio.to_thread(list, itertools.islice(chats, batch_size)):
+                for chat in lote:
+                    yield chat
+        finally:
+            chats.close()
+        return
+    query = await build_mongo_query(filters)
+    cursor = get_chats_collection().find(query, mongo_service.CAMPOS_EXPORTACAO).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).batch_size(
+        batch_size or getattr(settings, 'MONGO_EXPORT_BATCH_SIZE', 100)
+    )
+    try:
+        async for chat in cursor:
+            yield mongo_service._serializar_para_exportacao(await _carregar_mensagens(chat))
+    finally:
+        await cursor.close()
@@ -0,0 +1,365 @@
+"""
+Gestão da ligação ao MongoDB, partilhada pelos clientes síncrono (mongo_service) e assíncrono (mongo_async_service).
+
+- Opções dos clientes a partir das settings: tamanho do pool, timeouts, compressão (zstd, snappy, zlib)
+  e read preference (opcoes_cliente).
+- Verificação de saúde em segundo plano: uma thread faz 'ping' a cada MONGO_HEALTH_CHECK_SECONDS, com um
+  cliente próprio de uma só ligação, e corre as funções registadas com ao_ligar (ex: criar os índices)
+  sempre que a ligação fica disponível.
+- Disjuntor (circuit breaker): depois de MONGO_BREAKER_FAILURES falhas seguidas (pings, ligações do pool que
+  falham ou pool limpo por um erro de rede), o MongoDB é dado como indisponível e os pedidos falham logo, sem
+  esperar pelo serverSelectionTimeoutMS. A thread volta a tentar com backoff exponencial com jitter e fecha o
+  disjuntor no primeiro ping bem-sucedido. Sem a thread (MONGO_HEALTH_CHECK_SECONDS = 0), passado o backoff
+  um pedido serve de tentativa.
+- Estatísticas do pool e do disjuntor (estatisticas), em /chat/estatisticas/ e /metrics.
+"""
+import importlib
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import pymongo
+from django.conf import settings
+from pymongo import MongoClient, errors as MongoErrors, monitoring
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MongoIndisponivel(MongoErrors.ConnectionFailure):
+    """ Levantada sem contactar o servidor enquanto o disjuntor está aberto. """
+
+
+# --- Opções dos clientes ---
+
+# Compressor -> pacote Python necessário (o zlib faz parte do Python)
+PACOTES_COMPRESSORES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+def _compressores() -> Optional[str]:
+    """ Compressores de MONGO_COMPRESSORS (por ordem de preferência) cujo pacote está instalado. """
+    disponiveis = []
+    for nome in [c.strip() for c in getattr(settings, 'MONGO_COMPRESSORS', '').split(',') if c.strip()]:
+        if nome not in PACOTES_COMPRESSORES:
+            logger.warning("Compressor desconhecido '%s' em MONGO_COMPRESSORS: ignorado.", nome)
+            continue
+        if PACOTES_COMPRESSORES[nome]:
+            try:
+                importlib.import_module(PACOTES_COMPRESSORES[nome])
+            except ImportError:
+                logger.warning("Compressor '%s' ignorado: o pacote '%s' não está instalado.", nome, PACOTES_COMPRESSORES[nome])
+                continue
+        disponiveis.append(nome)
+    return ",".join(disponiveis) or None
+
+def opcoes_cliente() -> dict:
+    """ Argumentos do MongoClient/AsyncMongoClient (pool, timeouts, compressão, read preference e monitorização). """
+    opcoes = {
+        "maxPoolSize": getattr(settings, 'MONGO_MAX_POOL_SIZE', 100),
+        "minPoolSize": getattr(settings, 'MONGO_MIN_POOL_SIZE', 0),
+        "serverSelectionTimeoutMS": getattr(settings, 'MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        "connectTimeoutMS": getattr(settings, 'MONGO_CONNECT_TIMEOUT_MS', 5000),
+        "socketTimeoutMS": getattr(settings, 'MONGO_SOCKET_TIMEOUT_MS', 20000),
+        "readPreference": getattr(settings, 'MONGO_READ_PREFERENCE', 'primary'),
+        "uuidRepresentation": 'standard',
+        "event_listeners": metrics.ouvintes_mongo() + [_ouvinte_pool], # Duração de cada comando (ver metrics) e estado do pool
+    }
+    # Sem valor (0) o pymongo usa o seu padrão: ligações inativas nunca fecham, espera por uma ligação até ao timeout
+    if getattr(settings, 'MONGO_MAX_IDLE_TIME_MS', 0):
+        opcoes["maxIdleTimeMS"] = settings.MONGO_MAX_IDLE_TIME_MS
+    if getattr(settings, 'MONGO_WAIT_QUEUE_TIMEOUT_MS', 0):
+        opcoes["waitQueueTimeoutMS"] = settings.MONGO_WAIT_QUEUE_TIMEOUT_MS
+    compressores = _compressores()
+    if compressores:
+        opcoes["compressors"] = compressores
+    return opcoes
+
+
+# --- Disjuntor ---
+
+class Disjuntor:
+    """
+    'closed' (normal) ou 'open' (MongoDB indisponível: falhar logo). Abre ao fim de `falhas_para_abrir` falhas
+    seguidas; a espera até à tentativa seguinte duplica a cada falha (de `base` até `maximo` segundos), com jitter
+    para que os vários workers não voltem a tentar todos ao mesmo tempo.
+    """
+
+    def __init__(self, falhas_para_abrir: int = 3, base: float = 0.5, maximo: float = 30.0):
+        self.falhas_para_abrir = max(1, falhas_para_abrir)
+        self.base = base
+        self.maximo = maximo
+        self.estado = "closed"
+        self.falhas = 0
+        self.aberturas = 0
+        self.ultimo_erro = None
+        self.aberto_em = None
+        self.proxima_tentativa = 0.0
+        self._lock = threading.Lock()
+
+    def espera(self) -> float:
+        """ Backoff para a tentativa seguinte: metade fixa e metade aleatória (jitter). """
+        teto = min(self.maximo, self.base * 2 ** max(0, self.falhas - 1))
+        return teto / 2 + random.uniform(0, teto / 2)
+
+    def aberto(self) -> bool:
+        return self.estado == "open"
+
+    def registar_sucesso(self):
+        with self._lock:
+            if self.estado == "open":
+                logger.info("MongoDB disponível outra vez (indisponível durante %ss).", round(time.monotonic() - self.aberto_em, 1))
+            self.estado, self.falhas, self.aberto_em = "closed", 0, None
+
+    def registar_falha(self, erro) -> float:
+        """ Conta uma falha e devolve a espera até à tentativa seguinte. """
+        with self._lock:
+            self.falhas += 1
+            self.ultimo_erro = str(erro)
+            espera = self.espera()
+            self.proxima_tentativa = time.monotonic() + espera
+            if self.estado == "closed" and self.falhas >= self.falhas_para_abrir:
+                self.estado, self.aberto_em = "open", time.monotonic()
+                self.aberturas += 1
+                logger.error("MongoDB indisponível depois de %s falhas seguidas (%s): os pedidos vão falhar logo.", self.falhas, erro)
+            return espera
+
+    def tentativa_permitida(self) -> bool:
+        """ Com o disjuntor aberto, deixa passar uma tentativa quando o backoff acaba (e adia a seguinte). """
+        with self._lock:
+            agora = time.monotonic()
+            if agora < self.proxima_tentativa:
+                return False
+            self.proxima_tentativa = agora + self.espera()
+            return True
+
+    def estatisticas(self) -> dict:
+        agora = time.monotonic()
+        return {
+            "state": self.estado,
+            "consecutive_failures": self.falhas,
+            "times_opened": self.aberturas,
+            "last_error": self.ultimo_erro,
+            "open_for_seconds": round(agora - self.aberto_em, 1) if self.aberto_em else None,
+            "retry_in_seconds": round(max(0.0, self.proxima_tentativa - agora), 1) if self.estado == "open" else None,
+        }
+
+
+disjuntor: Optional[Disjuntor] = None
+_disjuntor_lock = threading.Lock()
+
+def obter_disjuntor() -> Disjuntor:
+    global disjuntor
+    with _disjuntor_lock:
+        if disjuntor is None:
+            disjuntor = Disjuntor(
+                falhas_para_abrir=getattr(settings, 'MONGO_BREAKER_FAILURES', 3),
+                base=getattr(settings, 'MONGO_RECONNECT_BASE_SECONDS', 0.5),
+                maximo=getattr(settings, 'MONGO_RECONNECT_MAX_SECONDS', 30.0),
+            )
+        return disjuntor
+
+def disponivel() -> bool:
+    """ False enquanto o disjuntor está aberto (quem chama deve falhar logo em vez de tentar o servidor). """
+    estado = obter_disjuntor()
+    if not estado.aberto():
+        return True
+    # Sem verificação em segundo plano, um pedido serve de tentativa
+    return _vigia is None and estado.tentativa_permitida()
+
+def verificar_disponivel():
+    """ Levanta MongoIndisponivel se o disjuntor está aberto. """
+    if not disponivel():
+        raise MongoIndisponivel(f"MongoDB indisponível (disjuntor aberto): {obter_disjuntor().ultimo_erro}")
+
+
+# --- Estatísticas do pool (todos os clientes do processo) ---
+
+class OuvintePool(monitoring.ConnectionPoolListener):
+    """ Conta as ligações abertas e em uso e as falhas; as falhas de rede contam para o disjuntor. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.limpar()
+
+    def limpar(self):
+        with self._lock:
+            self.contadores = {"created": 0, "closed": 0, "checked_out": 0, "checked_in": 0,
+                               "checkout_failures": 0, "checkout_timeouts": 0, "pools_cleared": 0}
+            self.espera_total = 0.0
+
+    def _somar(self, chave: str):
+        with self._lock:
+            self.contadores[chave] += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+    def pool_cleared(self, event):
+        # O pymongo limpa o pool depois de um erro de rede com o servidor
+        self._somar("pools_cleared")
+        obter_disjuntor().registar_falha(f"pool limpo ({event.address[0]}:{event.address[1]})")
+
+    def connection_created(self, event):
+        self._somar("created")
+
+    def connection_closed(self, event):
+        self._somar("closed")
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.contadores["checked_out"] += 1
+            self.espera_total += getattr(event, "duration", 0.0) or 0.0
+        estado = obter_disjuntor()
+        # Uma ligação obtida mostra que o servidor responde: fecha o disjuntor se estava aberto e, se estava fechado,
+        # zera as falhas acumuladas (senão falhas isoladas ao longo de dias acabariam por abri-lo)
+        if estado.aberto() or estado.falhas:
+            estado.registar_sucesso()
+
+    def connection_checked_in(self, event):
+        self._somar("checked_in")
+
+    def connection_check_out_failed(self, event):
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            self._somar("checkout_timeouts") # Pool esgotado (MONGO_WAIT_QUEUE_TIMEOUT_MS): não é uma falha do servidor
+        else:
+            self._somar("checkout_failures")
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.CONN_ERROR:
+                obter_disjuntor().registar_falha(f"falha ao abrir ligação ({event.address[0]}:{event.address[1]})")
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            c = dict(self.contadores)
+            espera = self.espera_total
+        return {
+            "connections_open": c["created"] - c["closed"],
+            "connections_in_use": c["checked_out"] - c["checked_in"],
+            "max_pool_size": getattr(settings, 'MONGO_MAX_POOL_SIZE', 100),
+            "checkouts": c["checked_out"],
+            "checkout_wait_ms_avg": round(espera / c["checked_out"] * 1000, 3) if c["checked_out"] else None,
+            "checkout_failures": c["checkout_failures"],
+            "checkout_timeouts": c["checkout_timeouts"],
+            "pools_cleared": c["pools_cleared"],
+        }
+
+_ouvinte_pool = OuvintePool()
+
+
+# --- Verificação de saúde em segundo plano ---
+
+_vigia: Optional[threading.Thread] = None
+_vigia_lock = threading.Lock()
+_parar = threading.Event()
+_ao_ligar: List[Callable[[], None]] = []
+_saude = {"checks": 0, "failures": 0, "last_ok_at": None, "last_latency_ms": None}
+
+def ao_ligar(funcao: Callable[[], None]):
+    """ Regista uma função corrida (na thread de verificação) sempre que o MongoDB fica disponível. """
+    if funcao not in _ao_ligar:
+        _ao_ligar.append(funcao)
+
+def _ping(cliente) -> float:
+    inicio = time.perf_counter()
+    with pymongo.timeout(getattr(settings, 'MONGO_HEALTH_CHECK_TIMEOUT_MS', 2000) / 1000):
+        cliente.admin.command('ping')
+    return (time.perf_counter() - inicio) * 1000
+
+def _ciclo_vigia(intervalo: float):
+    cliente = None
+    ligado = False
+    while not _parar.is_set():
+        estado = obter_disjuntor()
+        try:
+            if cliente is None:
+                cliente = MongoClient(settings.MONGO_URI, maxPoolSize=1, minPoolSize=0,
+                                      serverSelectionTimeoutMS=getattr(settings, 'MONGO_HEALTH_CHECK_TIMEOUT_MS', 2000))
+            latencia = _ping(cliente)
+            _saude.update(checks=_saude["checks"] + 1, last_ok_at=time.time(), last_latency_ms=round(latencia, 2))
+            estado.registar_sucesso()
+            if not ligado:
+                ligado = True
+                logger.info("Conectado com sucesso ao MongoDB, base de dados: '%s'", settings.MONGO_DB_NAME)
+                for funcao in list(_ao_ligar):
+                    try:
+                        funcao()
+                    except Exception:
+                        logger.warning("Erro ao preparar a ligação ao MongoDB", exc_info=True)
+            espera = intervalo
+        except Exception as e:
+            _saude.update(checks=_saude["checks"] + 1, failures=_saude["failures"] + 1)
+            ligado = False
+            if isinstance(e, MongoErrors.ConfigurationError) and cliente is None:
+                logger.critical("Configuração do MongoDB inválida (%s): %s", settings.MONGO_URI, e)
+            elif estado.aberto():
+                logger.debug("MongoDB continua indisponível: %s", e)
+            else:
+                logger.warning("Falha na verificação de saúde do MongoDB: %s", e)
+            espera = estado.registar_falha(e)
+        _parar.wait(espera)
+    if cliente is not None:
+        cliente.close()
+
+def iniciar_vigia():
+    """ Inicia (uma vez por processo) a thread de verificação de saúde; MONGO_HEALTH_CHECK_SECONDS = 0 desliga-a. """
+    global _vigia
+    intervalo = getattr(settings, 'MONGO_HEALTH_CHECK_SECONDS', 10)
+    if not intervalo or _vigia is not None:
+        return
+    with _vigia_lock:
+        if _vigia is None:
+            _parar.clear()
+            _vigia = threading.Thread(target=_ciclo_vigia, args=(intervalo,), name="mongo-health-check", daemon=True)
+            _vigia.start()
+
+def parar_vigia():
+    """ Pára a thread de verificação (usado nos testes e no benchmark). """
+    global _vigia
+    with _vigia_lock:
+        if _vigia is not None:
+            _parar.set()
+            _vigia.join(timeout=5)
+            _vigia = None
+
+def reiniciar():
+    """ Volta ao estado inicial: sem thread, disjuntor fechado e contadores a zero. """
+    global disjuntor
+    parar_vigia()
+    with _disjuntor_lock:
+        disjuntor = None
+    _ouvinte_pool.limpar()
+    _saude.update(checks=0, failures=0, last_ok_at=None, last_latency_ms=None)
+
+
+# --- Exposição ---
+
+def estatisticas() -> dict:
+    """ Estado do disjuntor, da verificação de saúde e do pool (para /chat/estatisticas/). """
+    opcoes = {k: v for k, v in opcoes_cliente().items() if k != "event_listeners"}
+    return {
+        "circuit": obter_disjuntor().estatisticas(),
+        "health_check": {**_saude, "enabled": _vigia is not None},
+        "pool": _ouvinte_pool.estatisticas(),
+        "options": opcoes,
+    }
+
+def expor_metricas() -> str:
+    """ Valores atuais do pool e do disjuntor no formato de texto do Prometheus (juntos às métricas de /metrics). """
+    pool = _ouvinte_pool.estatisticas()
+    linhas = [
+        "# HELP mongo_pool_connections Ligações do pool do MongoDB (todos os clientes do processo).",
+        "# TYPE mongo_pool_connections gauge",
+        f'mongo_pool_connections{{state="open"}} {pool["connections_open"]}',
+        f'mongo_pool_connections{{state="in_use"}} {pool["connections_in_use"]}',
+        "# HELP mongo_pool_checkout_failures_total Pedidos de ligação ao pool que falharam.",
+        "# TYPE mongo_pool_checkout_failures_total counter",
+        f'mongo_pool_checkout_failures_total{{reason="error"}} {pool["checkout_failures"]}',
+        f'mongo_pool_checkout_failures_total{{reason="timeout"}} {pool["checkout_timeouts"]}',
+        "# HELP mongo_circuit_open 1 enquanto o disjuntor do MongoDB está aberto (pedidos a falhar logo).",
+        "# TYPE mongo_circuit_open gauge",
+        f"mongo_circuit_open {int(obter_disjuntor().aberto())}",
+    ]
+    return "\n".join(linhas) + "\n"
@@ -1,78 +1,449 @@
-from pymongo import MongoClient, errors as MongoErrors
+from pymongo import ASCENDING, DESCENDING, TEXT, MongoClient, ReturnDocument, UpdateOne, errors as MongoErrors
 from bson import ObjectId
 from datetime import datetime, timezone, time
 from django.conf import settings
-import traceback
-from typing import Dict, List, Optional
+import logging
+import base64
+import json
+from typing import Dict, Iterator, List, Optional
 import re
+import threading
+
+from . import metrics, mongo_connection, write_behind
+
+logger = logging.getLogger(__name__)
 
 # --- Configuração da Conexão Singleton com MongoDB ---
 client = None
 db = None
 chats_collection = None
+response_cache_collection = None
+buckets_collection = None
+export_jobs_collection = None
+analytics_cache_collection = None
+_indice_texto_disponivel = None # None = ainda não verificado
 
 def _connect_db():
+    """
+    Cria o cliente (opções de mongo_connection) sem esperar pelo servidor: a verificação de saúde corre em
+    segundo plano e cria os índices quando a ligação fica disponível. Com a verificação desligada
+    (MONGO_HEALTH_CHECK_SECONDS = 0), faz um 'ping' aqui, limitado a MONGO_HEALTH_CHECK_TIMEOUT_MS.
+    """
     global client, db, chats_collection
     if db is None:
         try:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Conectando ao MongoDB em {settings.MONGO_URI}...")
-            client = MongoClient(
-                settings.MONGO_URI,
-                serverSelectionTimeoutMS=10000,
-                connectTimeoutMS=20000,
-                socketTimeoutMS=20000,
-                uuidRepresentation='standard'
-            )
-            client.admin.command('ping')
+            logger.info("Conectando ao MongoDB em %s...", settings.MONGO_URI)
+            novo_cliente = MongoClient(settings.MONGO_URI, **mongo_connection.opcoes_cliente())
+            if getattr(settings, 'MONGO_CREATE_INDEXES', True):
+                mongo_connection.ao_ligar(garantir_indices)
+            if not getattr(settings, 'MONGO_HEALTH_CHECK_SECONDS', 10):
+                try:
+                    mongo_connection._ping(novo_cliente)
+                except Exception:
+                    novo_cliente.close()
+                    raise
+            client = novo_cliente
             db = client[settings.MONGO_DB_NAME]
             chats_collection = db["chats"]
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Conectado com sucesso ao MongoDB, base de dados: '{settings.MONGO_DB_NAME}'")
+            if getattr(settings, 'MONGO_HEALTH_CHECK_SECONDS', 10):
+                mongo_connection.iniciar_vigia()
+            else:
+                mongo_connection.obter_disjuntor().registar_sucesso()
+                logger.info("Conectado com sucesso ao MongoDB, base de dados: '%s'", settings.MONGO_DB_NAME)
+                if getattr(settings, 'MONGO_CREATE_INDEXES', True):
+                    garantir_indices()
         except Exception as e:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] ERRO CRÍTICO: Não foi possível conectar ao MongoDB. Erro: {e}")
+            logger.critical("Não foi possível conectar ao MongoDB. Erro: %s", e)
+            mongo_connection.obter_disjuntor().registar_falha(e)
             db = None
             chats_collection = None
 
 def get_chats_collection():
+    # Com o disjuntor aberto (MongoDB em baixo) falha logo, em vez de esperar pelo serverSelectionTimeoutMS
+    if not mongo_connection.disponivel():
+        return None
     if chats_collection is None:
         _connect_db()
     return chats_collection
 
+# --- Índices (criados ao ligar, ou com `python manage.py criar_indices`) ---
+
+def _indices_esperados() -> Dict[str, List[dict]]:
+    """ Índices de cada coleção: 'keys' + opções do create_index. """
+    lingua = getattr(settings, 'MONGO_TEXT_SEARCH_LANGUAGE', 'portuguese')
+    return {
+        "chats": [
+            # Serve o filtro por datas e a ordenação da listagem (o _id desempata chats criados no mesmo instante)
+            {"keys": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+            # Ordenações da listagem pelos campos de resumo (última atividade, número de mensagens)
+            {"keys": [("last_message_at", DESCENDING), ("_id", DESCENDING)]},
+            {"keys": [("message_count", DESCENDING), ("_id", DESCENDING)]},
+            # Pesquisa por texto ($text), com o título a pesar mais do que o conteúdo das mensagens
+            {"keys": [("title", TEXT), ("messages.content", TEXT)], "name": "busca_texto",
+             "weights": {"title": 5, "messages.content": 1}, "default_language": lingua},
+        ],
+        "chat_buckets": [
+            {"keys": [("chat_id", ASCENDING), ("seq", ASCENDING)], "unique": True},
+            {"keys": [("messages.content", TEXT)], "name": "busca_texto", "default_language": lingua},
+        ],
+    }
+
+def _nome_indice(indice: dict) -> str:
+    return indice.get("name") or "_".join(f"{campo}_{direcao}" for campo, direcao in indice["keys"])
+
+def garantir_indices() -> Dict[str, Dict[str, str]]:
+    """
+    Cria os índices em falta e verifica os existentes.
+    Devolve, por coleção, o estado de cada índice: 'ok' (já existia), 'criado' ou 'erro: ...'
+    (ex: um índice com o mesmo nome e opções diferentes, que tem de ser removido à mão).
+    """
+    global _indice_texto_disponivel
+    if db is None:
+        _connect_db()
+    if db is None:
+        return {}
+    relatorio = {}
+    for nome_colecao, indices in _indices_esperados().items():
+        collection = db[nome_colecao]
+        existentes = collection.index_information()
+        relatorio[nome_colecao] = {}
+        for indice in indices:
+            nome = _nome_indice(indice)
+            opcoes = {chave: valor for chave, valor in indice.items() if chave != "keys"}
+            try:
+                collection.create_index(indice["keys"], **opcoes)
+                relatorio[nome_colecao][nome] = "ok" if nome in existentes else "criado"
+            except Exception as e:
+                relatorio[nome_colecao][nome] = f"erro: {e}"
+                logger.warning("Não foi possível criar o índice '%s' em '%s': %s", nome, nome_colecao, e)
+    _indice_texto_disponivel = None
+    return relatorio
+
+def _algum_indice_texto(indices: dict) -> bool:
+    """ Se o resultado de index_information() inclui um índice de texto, com qualquer nome (partilhado com o mongo_async_service). """
+    return any("_fts" in dict(info["key"]) or "text" in dict(info["key"]).values() for info in indices.values())
+
+def _tem_indice_texto() -> bool:
+    """ Se a coleção 'chats' tem um índice de texto (verificado uma vez por processo). """
+    global _indice_texto_disponivel
+    if _indice_texto_disponivel is None:
+        collection = get_chats_collection()
+        try:
+            _indice_texto_disponivel = collection is not None and _algum_indice_texto(collection.index_information())
+        except Exception:
+            _indice_texto_disponivel = False
+    return _indice_texto_disponivel
+
+def get_response_cache_collection(ttl_seconds: int):
+    """ Coleção 'response_cache' (cache de respostas do modelo), com índice TTL em created_at. """
+    global response_cache_collection
+    if not mongo_connection.disponivel():
+        return None
+    if response_cache_collection is None:
+        if db is None:
+            _connect_db()
+        if db is None:
+            return None
+        collection = db["response_cache"]
+        try:
+            collection.create_index("created_at", expireAfterSeconds=ttl_seconds)
+        except Exception as e:
+            # Ex: o índice já existe com outro expireAfterSeconds; a cache continua a funcionar
+            logger.warning("Não foi possível criar o índice TTL da cache de respostas: %s", e)
+        response_cache_collection = collection
+    return response_cache_collection
+
+def get_export_jobs_collection():
+    """ Coleção 'export_jobs' (jobs de exportação em segundo plano), com índice para encontrar jobs reutilizáveis. """
+    global export_jobs_collection
+    if not mongo_connection.disponivel():
+        return None
+    if export_jobs_collection is None:
+        if db is None:
+            _connect_db()
+        if db is None:
+            return None
+        collection = db["export_jobs"]
+        try:
+            collection.create_index([("key", ASCENDING), ("created_at", DESCENDING)])
+        except Exception as e:
+            logger.warning("Não foi possível criar o índice da coleção 'export_jobs': %s", e)
+        export_jobs_collection = collection
+    return export_jobs_collection
+
+def get_analytics_cache_collection():
+    """ Coleção 'analytics_daily' (agregados dos dias fechados); o índice TTL remove os filtros que deixaram de ser usados. """
+    global analytics_cache_collection
+    if not mongo_connection.disponivel():
+        return None
+    if analytics_cache_collection is None:
+        if db is None:
+            _connect_db()
+        if db is None:
+            return None
+        collection = db["analytics_daily"]
+        try:
+            collection.create_index([("filter", ASCENDING), ("day", ASCENDING)])
+            collection.create_index("last_used", expireAfterSeconds=getattr(settings, 'ANALYTICS_CACHE_TTL_SECONDS', 7 * 86400))
+        except Exception as e:
+            logger.warning("Não foi possível criar os índices da coleção 'analytics_daily': %s", e)
+        analytics_cache_collection = collection
+    return analytics_cache_collection
+
+# Documento da coleção 'analytics_daily' com a geração atual da cache (partilhada por todos os processos)
+GERACAO_ANALISE = "__geracao__"
+
+def geracao_cache_analise(collection) -> int:
+    """ Geração atual da cache de análise: os agregados guardados noutra geração já não contam. """
+    documento = collection.find_one({"_id": GERACAO_ANALISE})
+    return documento["generation"] if documento else 0
+
+def invalidar_cache_analise():
+    """
+    Invalida os agregados guardados (ex: depois de apagar um chat, importar chats antigos ou escrever
+    mensagens de um dia já fechado). Incrementa a geração no MongoDB, por isso vale para todos os processos;
+    deve ser chamada depois da escrita, para um cálculo concorrente não guardar dados antigos na geração nova.
+    """
+    collection = get_analytics_cache_collection()
+    if collection is None:
+        return
+    try:
+        geracao = collection.find_one_and_update(
+            {"_id": GERACAO_ANALISE}, {"$inc": {"generation": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )["generation"]
+        collection.delete_many({"generation": {"$lt": geracao}})
+    except Exception as e:
+        logger.warning("Não foi possível invalidar a cache de análise: %s", e)
+
+def _invalidar_se_dia_fechado(mensagens: List[dict]):
+    """ Mensagens com data de um dia anterior ao atual (UTC) mudam dias que a cache de análise dá como fechados. """
+    inicio_do_dia = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    if any((_instante(m.get("timestamp")) or inicio_do_dia) < inicio_do_dia for m in mensagens):
+        invalidar_cache_analise()
+
+# --- Armazenamento das mensagens em buckets ---
+# Com MONGO_MESSAGE_STORAGE = 'bucketed', o documento do chat guarda só os metadados, o contador
+# 'message_count' e uma cópia curta da última mensagem; as mensagens ficam na coleção 'chat_buckets',
+# em blocos de MONGO_BUCKET_SIZE mensagens com chave (chat_id, seq). Os chats antigos (array 'messages')
+# continuam a ser lidos e escritos normalmente até serem convertidos com `python manage.py migrar_mensagens`.
+
+def _armazenamento_em_buckets() -> bool:
+    return getattr(settings, 'MONGO_MESSAGE_STORAGE', 'embedded') == 'bucketed'
+
+def _tamanho_bucket() -> int:
+    return max(1, getattr(settings, 'MONGO_BUCKET_SIZE', 50))
+
+def _chat_em_buckets(chat: Optional[dict]) -> bool:
+    return bool(chat) and chat.get("message_storage") == "bucketed"
+
+def get_buckets_collection():
+    """ Coleção 'chat_buckets', com índice único em (chat_id, seq). """
+    global buckets_collection
+    if not mongo_connection.disponivel():
+        return None
+    if buckets_collection is None:
+        if db is None:
+            _connect_db()
+        if db is None:
+            return None
+        collection = db["chat_buckets"]
+        try:
+            collection.create_index([("chat_id", 1), ("seq", 1)], unique=True)
+        except Exception as e:
+            logger.warning("Não foi possível criar o índice da coleção 'chat_buckets': %s", e)
+        buckets_collection = collection
+    return buckets_collection
+
+# --- Campos de resumo do chat ---
+# Cada chat guarda, no próprio documento, o que a listagem do histórico precisa: message_count,
+# last_message_preview/role/at, total_processing_time e total_tokens. São atualizados na mesma escrita
+# que acrescenta a mensagem ($inc/$set), por isso a listagem nunca lê as mensagens. Os chats anteriores
+# a estes campos são preenchidos com `python manage.py preencher_resumos`.
+
+TAMANHO_PREVIA = 200
+
+def _resumo_mensagem(message: dict) -> dict:
+    """ Campos ($set) com a última mensagem do chat. """
+    return {
+        "last_message_preview": (message.get("content") or "")[:TAMANHO_PREVIA],
+        "last_message_role": message.get("role"),
+        "last_message_at": message.get("timestamp"),
+    }
+
+def _numero(valor) -> float:
+    return valor if isinstance(valor, (int, float)) and not isinstance(valor, bool) else 0
+
+def _incrementos_mensagem(message: dict) -> dict:
+    """ Campos ($inc) que uma mensagem nova soma aos totais do chat. """
+    return {
+        "message_count": 1,
+        "total_processing_time": _numero(message.get("processing_time")),
+        "total_tokens": _numero(message.get("tokens")),
+    }
+
+def _atualizacao_resumo(message: dict) -> dict:
+    return {"$inc": _incrementos_mensagem(message), "$set": _resumo_mensagem(message)}
+
+def campos_resumo(mensagens: List[dict], created_at: Optional[datetime] = None) -> dict:
+    """ Campos de resumo calculados a partir de todas as mensagens (chat novo, conversão e preenchimento). """
+    campos = {
+        "message_count": len(mensagens),
+        "total_processing_time": sum(_numero(m.get("processing_time")) for m in mensagens),
+        "total_tokens": sum(_numero(m.get("tokens")) for m in mensagens),
+    }
+    if mensagens:
+        campos.update(_resumo_mensagem(mensagens[-1]))
+    else:
+        # Sem mensagens, a última atividade é a criação (ordenar por atividade nunca encontra um valor nulo)
+        campos.update({"last_message_preview": "", "last_message_role": None, "last_message_at": created_at})
+    return campos
+
+def _ler_mensagens_buckets(chat_oid: ObjectId, desde: int = 0) -> List[Dict]:
+    """ Mensagens de um chat em buckets a partir da posição `desde` (só são lidos os buckets necessários). """
+    tamanho = _tamanho_bucket()
+    primeiro = max(0, desde) // tamanho
+    buckets = get_buckets_collection().find(
+        {"chat_id": chat_oid, "seq": {"$gte": primeiro}},
+        {"messages": 1}
+    ).sort("seq", 1)
+    mensagens = [msg for bucket in buckets for msg in bucket.get("messages", [])]
+    return mensagens[max(0, desde) - primeiro * tamanho:]
+
+def _acrescentar_em_bucket(collection, chat_oid: ObjectId, message: dict, projection: dict, condicao: Optional[dict] = None) -> Optional[dict]:
+    """
+    Reserva a posição da mensagem no chat ($inc message_count) e faz $push no bucket correspondente
+    (criado por upsert). Devolve o documento do chat, ou None se não existe um chat em buckets com este ID
+    (que cumpra a `condicao`, se dada).
+    """
+    chat = collection.find_one_and_update(
+        {"_id": chat_oid, "message_storage": "bucketed", **(condicao or {})},
+        _atualizacao_resumo(message),
+        projection={**projection, "message_storage": 1, "message_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if chat is None:
+        return None
+    get_buckets_collection().update_one(
+        {"chat_id": chat_oid, "seq": (chat["message_count"] - 1) // _tamanho_bucket()},
+        {"$push": {"messages": message}, "$setOnInsert": {"created_at": message["timestamp"]}},
+        upsert=True
+    )
+    return chat
+
+def _acrescentar_mensagem(collection, chat_oid: ObjectId, message: dict, projection: dict) -> Optional[dict]:
+    """
+    Acrescenta uma mensagem a um chat, qualquer que seja o seu modo de armazenamento
+    (tenta primeiro o modo configurado). Devolve o documento do chat depois da escrita, ou None se não existe.
+    """
+    modos = ("bucketed", "embedded") if _armazenamento_em_buckets() else ("embedded", "bucketed")
+    for modo in modos:
+        if modo == "bucketed":
+            chat = _acrescentar_em_bucket(collection, chat_oid, message, projection)
+        else:
+            chat = collection.find_one_and_update(
+                {"_id": chat_oid, "message_storage": {"$ne": "bucketed"}},
+                {**_atualizacao_resumo(message), "$push": {"messages": message}},
+                projection={**projection, "message_storage": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        if chat is not None:
+            return chat
+    return None
+
+def _carregar_mensagens(chat: dict) -> dict:
+    """ Junta ao documento de um chat em buckets a lista completa das mensagens (formato dos chats antigos). """
+    if _chat_em_buckets(chat):
+        chat["messages"] = _ler_mensagens_buckets(chat["_id"])
+    return chat
+
+def documentos_buckets(chat_oid: ObjectId, mensagens: List[dict]) -> List[dict]:
+    """ Documentos da coleção 'chat_buckets' com as mensagens de um chat, em blocos de MONGO_BUCKET_SIZE. """
+    tamanho = _tamanho_bucket()
+    return [
+        {
+            "chat_id": chat_oid,
+            "seq": seq,
+            "messages": mensagens[seq * tamanho:(seq + 1) * tamanho],
+            "created_at": mensagens[seq * tamanho].get("timestamp"),
+        }
+        for seq in range((len(mensagens) + tamanho - 1) // tamanho)
+    ]
+
+def converter_chat_para_buckets(chat: dict) -> int:
+    """
+    Converte um chat antigo (array 'messages') para o armazenamento em buckets. Pode ser repetido sem
+    duplicar mensagens: os buckets do chat são recriados antes de o array ser removido.
+    Devolve o número de mensagens movidas.
+    """
+    buckets = get_buckets_collection()
+    mensagens = chat.get("messages") or []
+    buckets.delete_many({"chat_id": chat["_id"]})
+    if mensagens:
+        buckets.insert_many(documentos_buckets(chat["_id"], mensagens))
+    get_chats_collection().update_one(
+        {"_id": chat["_id"]},
+        {
+            "$set": {"message_storage": "bucketed", **campos_resumo(mensagens, chat.get("created_at"))},
+            "$unset": {"messages": "", "last_message": ""}
+        }
+    )
+    return len(mensagens)
+
+def preencher_resumo_chat(chat: dict) -> Optional[bool]:
+    """
+    (Re)calcula os campos de resumo de um chat a partir das suas mensagens (chats anteriores a estes campos).
+    A escrita só é feita se o chat não recebeu mensagens entretanto (condição no número de mensagens);
+    devolve True se foi escrita, False nesse caso (pode ser repetido), ou None se o chat já não existe.
+    """
+    collection = get_chats_collection()
+    if _chat_em_buckets(chat):
+        mensagens = _ler_mensagens_buckets(chat["_id"])
+        condicao = {"_id": chat["_id"], "message_count": chat.get("message_count", 0)}
+    else:
+        mensagens = chat.get("messages") or []
+        condicao = {"_id": chat["_id"], "messages": {"$size": len(mensagens)}}
+    campos = campos_resumo(mensagens, chat.get("created_at"))
+    if _chat_em_buckets(chat) and campos["message_count"] != chat.get("message_count", 0):
+        # Posição reservada por uma escrita ainda a decorrer: o contador do chat é o que vale
+        del campos["message_count"]
+    resultado = collection.update_one(condicao, {"$set": campos, "$unset": {"last_message": ""}})
+    if resultado.matched_count:
+        return True
+    return False if collection.count_documents({"_id": chat["_id"]}, limit=1) else None
+
 # --- Funções CRUD (create_chat, add_message, etc.) ---
 # ... (O restante das funções CRUD: create_chat, add_message, get_chat_history, update_last_assistant_message_metadata ... permanecem iguais) ...
 def create_chat(title="Novo Chat") -> str | None:
     collection = get_chats_collection()
     if collection is None:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Não foi possível obter a coleção 'chats' para criar um novo chat.")
+        logger.error("Não foi possível obter a coleção 'chats' para criar um novo chat.")
         return None
-    model_name = "desconhecido"
-    try:
-        from . import nlp_service
-        model_name = nlp_service.MODEL_NAME if nlp_service.is_model_loaded else "modelo_nao_carregado"
-    except Exception as e:
-         print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Erro ao obter nome do modelo do nlp_service: {e}")
     chat_document = {
         "title": title,
         "created_at": datetime.now(timezone.utc),
         "messages": [],
-        "model_name": model_name
+        "model_name": _nome_modelo_atual()
     }
+    chat_document.update(campos_resumo([], chat_document["created_at"]))
+    if _armazenamento_em_buckets():
+        del chat_document["messages"]
+        chat_document["message_storage"] = "bucketed"
     try:
         result = collection.insert_one(chat_document)
         new_id = str(result.inserted_id)
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Novo chat criado com ID: {new_id}")
+        logger.debug("Novo chat criado com ID: %s", new_id)
         return new_id
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao criar chat no MongoDB:")
-        traceback.print_exc()
+        logger.exception("Erro ao criar chat no MongoDB")
         return None
 
 def add_message(chat_id: str, role: str, content: str):
     collection = get_chats_collection()
     if collection is None:
-         print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Coleção 'chats' não disponível para adicionar mensagem ao chat {chat_id}.")
+         logger.error("Coleção 'chats' não disponível para adicionar mensagem ao chat %s.", chat_id)
          return False
     if role not in ['user', 'assistant']:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Role inválido '{role}' ao adicionar mensagem ao chat {chat_id}.")
+        logger.error("Role inválido '%s' ao adicionar mensagem ao chat %s.", role, chat_id)
         return False
     message = {
         "role": role,
@@ -81,96 +452,344 @@ def add_message(chat_id: str, role: str, content: str):
     }
     try:
         if not ObjectId.is_valid(chat_id):
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: ID do chat inválido '{chat_id}' ao adicionar mensagem.")
+             logger.error("ID do chat inválido '%s' ao adicionar mensagem.", chat_id)
              return False
-        result = collection.update_one(
-            {"_id": ObjectId(chat_id)},
-            {"$push": {"messages": message}}
-        )
-        if result.matched_count == 0:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Chat com ID {chat_id} não encontrado para adicionar mensagem.")
+        chat = _acrescentar_mensagem(collection, ObjectId(chat_id), message, {"_id": 1})
+        if chat is None:
+            logger.warning("Chat com ID %s não encontrado para adicionar mensagem.", chat_id)
             return False
         else:
             return True
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao adicionar mensagem ao chat {chat_id}:")
-        traceback.print_exc()
+        logger.exception("Erro ao adicionar mensagem ao chat %s", chat_id)
         return False
 
-def get_chat_history(chat_id: str) -> Optional[List[Dict]]:
+def get_chat_history(chat_id: str, last_n: Optional[int] = None) -> Optional[List[Dict]]:
+    """ Mensagens do chat; com `last_n`, só as últimas `last_n` (e só os buckets que as contêm). """
     collection = get_chats_collection()
     if collection is None:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Coleção 'chats' não disponível para obter histórico do chat {chat_id}.")
+        logger.error("Coleção 'chats' não disponível para obter histórico do chat %s.", chat_id)
         return None
     try:
         if not ObjectId.is_valid(chat_id):
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: ID do chat inválido '{chat_id}' ao obter histórico.")
+             logger.error("ID do chat inválido '%s' ao obter histórico.", chat_id)
              return None
-        chat = collection.find_one({"_id": ObjectId(chat_id)})
-        if chat:
+        projection = {"messages": {"$slice": -last_n}, "message_storage": 1, "message_count": 1} if last_n else None
+        chat = collection.find_one({"_id": ObjectId(chat_id)}, projection)
+        if chat and _chat_em_buckets(chat):
+            total = chat.get("message_count", 0)
+            return _ler_mensagens_buckets(chat["_id"], desde=max(0, total - last_n) if last_n else 0)
+        elif chat:
             return chat.get("messages", [])
         else:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Chat com ID {chat_id} não encontrado ao obter histórico.")
+            logger.warning("Chat com ID %s não encontrado ao obter histórico.", chat_id)
             return []
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao obter histórico do chat {chat_id}:")
-        traceback.print_exc()
+        logger.exception("Erro ao obter histórico do chat %s", chat_id)
         return None
 
 def update_last_assistant_message_metadata(chat_id: str, metadata: dict):
     collection = get_chats_collection()
     if collection is None:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Coleção 'chats' não disponível para atualizar metadados no chat {chat_id}.")
+        logger.error("Coleção 'chats' não disponível para atualizar metadados no chat %s.", chat_id)
         return False
     try:
         if not ObjectId.is_valid(chat_id):
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: ID do chat inválido '{chat_id}' ao atualizar metadados.")
+             logger.error("ID do chat inválido '%s' ao atualizar metadados.", chat_id)
              return False
-        chat_document = collection.find_one({"_id": ObjectId(chat_id)})
+        # Só os papéis (e os valores que entram nos totais) das mensagens são lidos, e só os campos alterados são escritos
+        chat_document = collection.find_one({"_id": ObjectId(chat_id)}, {**_PROJECAO_METADADOS, "message_storage": 1})
         if not chat_document:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Chat {chat_id} não encontrado para atualizar metadados.")
+            logger.warning("Chat %s não encontrado para atualizar metadados.", chat_id)
             return False
+        if _chat_em_buckets(chat_document):
+            return _atualizar_metadados_em_bucket(chat_document["_id"], metadata)
         messages = chat_document.get("messages", [])
         last_assistant_index = -1
         for i in range(len(messages) - 1, -1, -1):
-            if messages[i].get("role") == "assistant":
+            if isinstance(messages[i], dict) and messages[i].get("role") == "assistant":
                 last_assistant_index = i
                 break
         if last_assistant_index != -1:
-            for key, value in metadata.items():
-                if isinstance(chat_document["messages"][last_assistant_index], dict):
-                     chat_document["messages"][last_assistant_index][key] = value
-                else:
-                     print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Mensagem no índice {last_assistant_index} do chat {chat_id} não é um dicionário.")
-                     return False
-            result = collection.replace_one({"_id": ObjectId(chat_id)}, chat_document)
+            atualizacao = {f"messages.{last_assistant_index}.{key}": value for key, value in metadata.items()}
+            ajuste = _ajuste_totais(messages[last_assistant_index], metadata)
+            result = collection.update_one({"_id": ObjectId(chat_id)}, {"$set": atualizacao, **({"$inc": ajuste} if ajuste else {})})
             if result.modified_count > 0:
                 return True
             else:
-                print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Nenhuma modificação feita nos metadados do chat {chat_id}.")
+                logger.warning("Nenhuma modificação feita nos metadados do chat %s.", chat_id)
                 return False
         else:
-            print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Nenhuma mensagem 'assistant' encontrada no chat {chat_id} para atualizar metadados.")
+            logger.warning("Nenhuma mensagem 'assistant' encontrada no chat %s para atualizar metadados.", chat_id)
             return False
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao atualizar metadados 'assistant' no chat {chat_id}:")
-        traceback.print_exc()
+        logger.exception("Erro ao atualizar metadados 'assistant' no chat %s", chat_id)
+        return False
+
+_PROJECAO_METADADOS = {"messages.role": 1, "messages.processing_time": 1, "messages.tokens": 1}
+
+def _ajuste_totais(mensagem: dict, metadata: dict) -> dict:
+    """ $inc dos totais do chat quando os metadados de uma mensagem já guardada mudam. """
+    return {
+        f"total_{campo}": _numero(metadata[campo]) - _numero(mensagem.get(campo))
+        for campo in ("processing_time", "tokens") if campo in metadata
+    }
+
+def _atualizar_metadados_em_bucket(chat_oid: ObjectId, metadata: dict) -> bool:
+    """ Igual a update_last_assistant_message_metadata, para chats em buckets (percorre os buckets do fim para o início). """
+    buckets = get_buckets_collection()
+    for bucket in buckets.find({"chat_id": chat_oid}, _PROJECAO_METADADOS).sort("seq", -1):
+        messages = bucket.get("messages", [])
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get("role") == "assistant":
+                atualizacao = {f"messages.{i}.{key}": value for key, value in metadata.items()}
+                ajuste = _ajuste_totais(messages[i], metadata)
+                if ajuste:
+                    get_chats_collection().update_one({"_id": chat_oid}, {"$inc": ajuste})
+                return buckets.update_one({"_id": bucket["_id"]}, {"$set": atualizacao}).modified_count > 0
+    logger.warning("Nenhuma mensagem 'assistant' encontrada no chat %s para atualizar metadados.", chat_oid)
+    return False
+
+# --- Persistência de um turno do chat (uma ida ao MongoDB por escrita) ---
+
+def _nome_modelo_atual() -> str:
+    try:
+        from . import nlp_service
+        return nlp_service.nome_modelo() if nlp_service.is_model_loaded else "modelo_nao_carregado"
+    except Exception as e:
+        logger.warning("Erro ao obter nome do modelo do nlp_service: %s", e)
+        return "desconhecido"
+
+def _documento_novo_chat(title: str, message: dict) -> dict:
+    """ Documento de um chat criado pela primeira mensagem (no modo de armazenamento configurado). """
+    chat_document = {
+        "title": title,
+        "created_at": message["timestamp"],
+        "messages": [message],
+        "model_name": _nome_modelo_atual(),
+        **campos_resumo([message])
+    }
+    if _armazenamento_em_buckets():
+        del chat_document["messages"]
+        chat_document["message_storage"] = "bucketed"
+    return chat_document
+
+def registrar_mensagem_utilizador(chat_id: Optional[str], content: str, title: str = "Novo Chat") -> Optional[Dict]:
+    """
+    Início de um turno: guarda a mensagem do utilizador e devolve o que é preciso para gerar a resposta,
+    numa única operação (insert_one para um chat novo; find_one_and_update com $push para um existente).
+    Devolve {'chat_id', 'messages', 'first_message', 'context_summary', 'context_summary_upto'} ou None em caso de erro.
+    Nos chats em buckets, 'messages' começa na primeira mensagem ainda não resumida (posição 'first_message').
+    """
+    collection = get_chats_collection()
+    if collection is None:
+        logger.error("Coleção 'chats' não disponível para registar a mensagem do utilizador.")
+        return None
+    message = {
+        "role": "user",
+        "content": content,
+        "timestamp": datetime.now(timezone.utc)
+    }
+    try:
+        if not chat_id:
+            new_oid = collection.insert_one(_documento_novo_chat(title, message)).inserted_id
+            if _armazenamento_em_buckets():
+                get_buckets_collection().insert_one({"chat_id": new_oid, "seq": 0, "messages": [message], "created_at": message["timestamp"]})
+            new_id = str(new_oid)
+            logger.debug("Novo chat criado com ID: %s", new_id)
+            return {"chat_id": new_id, "messages": [message], "first_message": 0, "context_summary": None, "context_summary_upto": 0}
+
+        if not ObjectId.is_valid(chat_id):
+            logger.error("ID do chat inválido '%s' ao registar mensagem.", chat_id)
+            return None
+        # Respostas anteriores ainda na fila de escrita diferida vão primeiro (a conversa fica pela ordem certa)
+        if write_behind.ativo() and write_behind.tem_pendentes(chat_id) and not write_behind.escrever_chat(chat_id):
+            logger.error("Mensagem não registada: o chat %s tem respostas por escrever na fila de escrita diferida.", chat_id)
+            return None
+        chat = _acrescentar_mensagem(
+            collection, ObjectId(chat_id), message,
+            {"messages": 1, "context_summary": 1, "context_summary_upto": 1}
+        )
+        if not chat:
+            logger.warning("Chat com ID %s não encontrado para registar mensagem.", chat_id)
+            return None
+        first_message = 0
+        if _chat_em_buckets(chat):
+            # Só as mensagens ainda não resumidas são lidas: o resto já está no resumo do contexto
+            first_message = min(chat.get("context_summary_upto", 0), chat["message_count"] - 1)
+            messages = _ler_mensagens_buckets(chat["_id"], desde=first_message)
+        else:
+            messages = chat.get("messages", [])
+        return {
+            "chat_id": chat_id,
+            "messages": messages,
+            "first_message": first_message,
+            "context_summary": chat.get("context_summary"),
+            "context_summary_upto": chat.get("context_summary_upto", 0),
+        }
+    except Exception as e:
+        logger.exception("Erro ao registar a mensagem do utilizador no chat %s", chat_id)
+        return None
+
+def registrar_resposta_assistente(chat_id: str, content: str, metadata: Optional[dict] = None) -> bool:
+    """
+    Fim de um turno: acrescenta a resposta do assistente já com os metadados, num único $push.
+    Com MONGO_WRITE_BEHIND a resposta vai para a fila de write_behind e é escrita em segundo plano.
+    """
+    if not ObjectId.is_valid(chat_id):
+        logger.error("ID do chat inválido '%s' ao registar resposta.", chat_id)
+        return False
+    message = {
+        "role": "assistant",
+        "content": content,
+        "timestamp": datetime.now(timezone.utc),
+        **(metadata or {})
+    }
+    if write_behind.ativo() and write_behind.enfileirar(chat_id, message):
+        return True
+    collection = get_chats_collection()
+    if collection is None:
+        logger.error("Coleção 'chats' não disponível para registar a resposta no chat %s.", chat_id)
+        return False
+    try:
+        if _acrescentar_mensagem(collection, ObjectId(chat_id), message, {"_id": 1}) is None:
+            logger.warning("Chat com ID %s não encontrado para registar resposta.", chat_id)
+            return False
+        return True
+    except Exception as e:
+        logger.exception("Erro ao registar a resposta do assistente no chat %s", chat_id)
+        return False
+
+def _instante(valor) -> Optional[datetime]:
+    """ Data em UTC sem fuso e com a precisão do MongoDB (milissegundos), para comparar com as datas lidas. """
+    if not isinstance(valor, datetime):
+        return None
+    if valor.tzinfo:
+        valor = valor.astimezone(timezone.utc).replace(tzinfo=None)
+    return valor.replace(microsecond=valor.microsecond // 1000 * 1000)
+
+def ja_escrita(ultima: dict, message: dict) -> bool:
+    """
+    Se `message` é a última mensagem do chat, dada pelos campos de resumo (last_message_at/role/preview).
+    A data sozinha não chega: a pergunta e uma resposta rápida podem ter o mesmo milissegundo.
+    """
+    return (
+        _instante(ultima.get("last_message_at")) == _instante(message.get("timestamp"))
+        and ultima.get("last_message_role") == message.get("role")
+        and ultima.get("last_message_preview") == (message.get("content") or "")[:TAMANHO_PREVIA]
+    )
+
+def acrescentar_mensagens_em_lote(entradas: List[tuple]) -> List[str]:
+    """
+    Escreve mensagens de vários chats (pares (chat_id, mensagem), pela ordem dada) com um find e um bulk_write
+    (os chats em buckets são escritos um a um). Usado pela escrita diferida (write_behind), por isso pode ser
+    repetido: uma mensagem que já é a última do chat (ja_escrita) não é escrita outra vez.
+    Devolve, por entrada: 'escrita', 'repetida' ou 'sem_chat' (chat apagado ou ID inválido).
+    Levanta a exceção do MongoDB se a escrita falhar (quem chama tenta outra vez).
+    """
+    collection = get_chats_collection()
+    if collection is None:
+        raise MongoErrors.ConnectionFailure("Coleção 'chats' indisponível.")
+    oids = {chat_id: ObjectId(chat_id) for chat_id, _ in entradas if ObjectId.is_valid(chat_id)}
+    chats = {
+        chat["_id"]: chat
+        for chat in collection.find(
+            {"_id": {"$in": list(set(oids.values()))}},
+            {"message_storage": 1, "last_message_at": 1, "last_message_role": 1, "last_message_preview": 1}
+        )
+    }
+    resultados, operacoes, em_buckets = [], [], []
+    for chat_id, message in entradas:
+        chat = chats.get(oids.get(chat_id))
+        if chat is None:
+            resultados.append("sem_chat")
+        elif ja_escrita(chat, message):
+            resultados.append("repetida")
+        else:
+            # A mesma verificação na escrita: duas escritas da mesma mensagem ao mesmo tempo não a duplicam
+            condicao = {"$nor": [{"last_message_at": message.get("timestamp"), **_resumo_mensagem(message)}]}
+            if _chat_em_buckets(chat):
+                em_buckets.append((chat["_id"], message, condicao))
+            else:
+                operacoes.append(UpdateOne(
+                    {"_id": chat["_id"], "message_storage": {"$ne": "bucketed"}, **condicao},
+                    {**_atualizacao_resumo(message), "$push": {"messages": message}}
+                ))
+            resultados.append("escrita")
+    if operacoes:
+        collection.bulk_write(operacoes, ordered=True) # Mensagens do mesmo chat ficam pela ordem da fila
+    for chat_oid, message, condicao in em_buckets:
+        _acrescentar_em_bucket(collection, chat_oid, message, {"_id": 1}, condicao)
+    # Uma resposta escrita depois da meia-noite com a data do dia anterior muda um dia fechado
+    _invalidar_se_dia_fechado([message for (_, message), resultado in zip(entradas, resultados) if resultado == "escrita"])
+    return resultados
+
+# --- Resumo incremental do contexto (usado pelo context_service) ---
+
+def get_chat_summary(chat_id: str) -> tuple[str | None, int]:
+    """ Devolve (resumo, número de mensagens já resumidas) guardados no documento do chat. """
+    collection = get_chats_collection()
+    if collection is None or not ObjectId.is_valid(chat_id):
+        return None, 0
+    try:
+        chat = collection.find_one(
+            {"_id": ObjectId(chat_id)},
+            {"context_summary": 1, "context_summary_upto": 1}
+        )
+        if not chat:
+            return None, 0
+        return chat.get("context_summary"), chat.get("context_summary_upto", 0)
+    except Exception as e:
+        logger.exception("Erro ao obter o resumo do chat %s", chat_id)
+        return None, 0
+
+def update_chat_summary(chat_id: str, summary: str, upto: int) -> bool:
+    """ Guarda o resumo das primeiras `upto` mensagens do chat. """
+    collection = get_chats_collection()
+    if collection is None or not ObjectId.is_valid(chat_id):
+        return False
+    try:
+        result = collection.update_one(
+            {"_id": ObjectId(chat_id)},
+            {"$set": {"context_summary": summary, "context_summary_upto": upto}}
+        )
+        return result.matched_count > 0
+    except Exception as e:
+        logger.exception("Erro ao guardar o resumo do chat %s", chat_id)
         return False
 
 # --- Lógica de Filtro (Função Auxiliar) ---
 
-def _build_mongo_query(filters: Optional[dict] = None) -> dict:
-    """ Constrói a query do MongoDB a partir dos filtros. """
-    query = {}
-    if not filters:
-        return query
+def _pesquisa_por_palavras(filters: dict, tem_indice_texto) -> bool:
+    """ Se a pesquisa usa $text: modo 'text' (pedido ou MONGO_SEARCH_MODE) e o índice de texto existe. """
+    modo = filters.get('search_mode') or getattr(settings, 'MONGO_SEARCH_MODE', 'text')
+    return modo == 'text' and tem_indice_texto()
+
+def _condicao_mensagens(termo: str, por_texto: bool) -> dict:
+    """ Condição da pesquisa sobre o conteúdo das mensagens (serve também para a coleção dos buckets). """
+    if por_texto:
+        return {'$text': {'$search': termo}}
+    return {'messages.content': re.compile(re.escape(termo), re.IGNORECASE)}
 
+def _montar_query(filters: dict, por_texto: bool, chat_ids_buckets: Optional[list] = None) -> dict:
+    """ Query sobre a coleção 'chats', dados o modo de pesquisa e os chats em buckets que correspondem ao termo. """
+    query = {}
     if filters.get('search_query'):
-        search_regex = re.compile(re.escape(filters['search_query']), re.IGNORECASE)
-        query['$or'] = [
-            {'title': search_regex},
-            {'messages.content': search_regex}
-        ]
+        if por_texto:
+            # Pesquisa por palavras ($text, usa o índice 'busca_texto' e permite ordenar por relevância)
+            query['$or'] = [_condicao_mensagens(filters['search_query'], True)]
+        else:
+            # Pesquisa por substring (regex sem âncora: percorre a coleção inteira)
+            search_regex = re.compile(re.escape(filters['search_query']), re.IGNORECASE)
+            query['$or'] = [
+                {'title': search_regex},
+                {'messages.content': search_regex}
+            ]
+        if chat_ids_buckets:
+            # Chats em buckets: as mensagens estão noutra coleção
+            query['$or'].append({'_id': {'$in': chat_ids_buckets}})
+        if len(query['$or']) == 1:
+            query.update(query.pop('$or')[0])
     
     date_query = {}
     try:
@@ -183,111 +802,345 @@ def _build_mongo_query(filters: Optional[dict] = None) -> dict:
             date_query['$lte'] = datetime.combine(date_to_obj.date(), time.max, tzinfo=timezone.utc)
     
     except ValueError:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: Formato de data inválido nos filtros.")
+        logger.error("Formato de data inválido nos filtros.")
         date_query = {}
 
     if date_query:
         query['created_at'] = date_query
+
+    if filters.get('min_messages'):
+        # Campo de resumo: não é preciso ler as mensagens
+        query['message_count'] = {'$gte': filters['min_messages']}
         
     return query
 
+def _pipeline_chats_em_buckets(termo: str, por_texto: bool) -> list:
+    """
+    Chats em buckets com mensagens que contêm o termo. Ao contrário do distinct, o $group devolve
+    um documento por chat (sem o limite de 16 MB numa só resposta) e o $limit mantém o $in da query
+    sobre os chats bem abaixo desse limite.
+    """
+    return [
+        {"$match": _condicao_mensagens(termo, por_texto)},
+        {"$group": {"_id": "$chat_id"}},
+        {"$limit": getattr(settings, 'MONGO_SEARCH_MAX_BUCKET_CHATS', 10000)},
+    ]
+
+def _verificar_limite_buckets(chat_ids: list) -> list:
+    if len(chat_ids) >= getattr(settings, 'MONGO_SEARCH_MAX_BUCKET_CHATS', 10000):
+        logger.warning("A pesquisa encontrou mais de %s chats em buckets; os restantes ficam fora dos resultados.", len(chat_ids))
+    return chat_ids
+
+def _chats_em_buckets_com_termo(termo: str, por_texto: bool) -> Optional[list]:
+    """ IDs dos chats em buckets que correspondem ao termo (None se não há buckets: evita percorrer a coleção). """
+    buckets = get_buckets_collection()
+    if buckets is None or buckets.estimated_document_count() == 0:
+        return None
+    try:
+        linhas = list(buckets.aggregate(_pipeline_chats_em_buckets(termo, por_texto)))
+    except MongoErrors.OperationFailure:
+        # Sem índice de texto nos buckets
+        linhas = list(buckets.aggregate(_pipeline_chats_em_buckets(termo, False)))
+    return _verificar_limite_buckets([linha["_id"] for linha in linhas])
+
+def _build_mongo_query(filters: Optional[dict] = None) -> dict:
+    """ Constrói a query do MongoDB a partir dos filtros. """
+    if not filters:
+        return {}
+    por_texto = False
+    chat_ids = None
+    if filters.get('search_query'):
+        por_texto = _pesquisa_por_palavras(filters, _tem_indice_texto)
+        chat_ids = _chats_em_buckets_com_termo(filters['search_query'], por_texto)
+    return _montar_query(filters, por_texto, chat_ids)
+
 # --- Funções de Busca (Atualizada e Nova) ---
 
-def get_all_chats_paginated(page: int = 1, per_page: int = 10, filters: Optional[dict] = None):
-    """ Obtém todos os chats com paginação e filtros. """
+def _pesquisa_por_texto(query: dict) -> bool:
+    return '$text' in query or any('$text' in condicao for condicao in query.get('$or', []))
+
+# --- Paginação por cursor (keyset) ---
+# A listagem é ordenada por (campo, _id) descendente e cada página começa logo a seguir à última
+# entrada da anterior, por isso qualquer página custa o mesmo que a primeira (sem skip nem count).
+# O campo é o da ordenação escolhida (ORDENACOES_HISTORICO); numa pesquisa por texto a ordem é (relevância, campo, _id).
+
+# Ordenação pedida -> campo do documento do chat (todos com índice (campo, _id) em _indices_esperados)
+ORDENACOES_HISTORICO = {
+    "created": "created_at",       # Mais recentes primeiro (padrão)
+    "activity": "last_message_at", # Última atividade
+    "messages": "message_count",   # Mais mensagens
+}
+_CAMPOS_DATA = ("created_at", "last_message_at")
+_CAMPOS_QUE_PODEM_FALTAR = ("last_message_at", "message_count") # Campos de resumo, em falta nos chats antigos
+
+def _campo_ordenacao(sort: Optional[str]) -> str:
+    return ORDENACOES_HISTORICO.get(sort or "created", "created_at")
+
+def codificar_cursor(chat: dict, campo: str = "created_at") -> str:
+    """ Token opaco com a posição de um chat na listagem ordenada por `campo` (vai na querystring). """
+    valor = chat.get(campo)
+    posicao = {"c": valor.isoformat() if isinstance(valor, datetime) else valor, "i": str(chat["_id"])}
+    if campo != "created_at":
+        posicao["o"] = campo
+    if "score" in chat:
+        posicao["s"] = chat["score"]
+    return base64.urlsafe_b64encode(json.dumps(posicao, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def descodificar_cursor(token: Optional[str], campo: str = "created_at") -> Optional[dict]:
+    """ Posição guardada num token de codificar_cursor, ou None se o token for inválido (ou de outra ordenação). """
+    if not token:
+        return None
+    try:
+        posicao = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if posicao.get("o", "created_at") != campo:
+            return None
+        valor = posicao.get("c")
+        return {
+            "campo": campo,
+            "valor": datetime.fromisoformat(valor) if valor and campo in _CAMPOS_DATA else valor,
+            "_id": ObjectId(posicao["i"]),
+            "score": posicao.get("s"),
+        }
+    except Exception:
+        return None
+
+def _condicao_keyset(posicao: dict, depois: bool, com_score: bool) -> dict:
+    """
+    Condição "vem depois de `posicao`" (ou antes, com depois=False) na ordem descendente da listagem.
+    Para (a, b, c) descendente: a < A ou (a == A e (b < B ou (b == B e c < C))).
+    """
+    chaves = [(posicao["campo"], posicao["valor"]), ("_id", posicao["_id"])]
+    if com_score:
+        chaves.insert(0, ("score", posicao.get("score") or 0))
+    condicao = _comparar_keyset(*chaves[-1], depois)
+    for campo, valor in reversed(chaves[:-1]):
+        empate = {"$and": [{campo: valor}, condicao]} # {campo: None} também apanha o campo em falta
+        comparacao = _comparar_keyset(campo, valor, depois)
+        condicao = {"$or": [comparacao, empate]} if comparacao else empate
+    return condicao
+
+def _comparar_keyset(campo: str, valor, depois: bool) -> Optional[dict]:
+    """
+    `campo` estritamente depois (ou antes) de `valor` na ordem descendente, ou None se nada o está.
+    Null ou em falta fica no fim, como no sort do MongoDB: os chats que preencher_resumos ainda não preencheu
+    (sem last_message_at/message_count) aparecem nas últimas páginas dessas ordenações.
+    """
+    comparacao = {campo: {"$lt" if depois else "$gt": valor}}
+    if campo not in _CAMPOS_QUE_PODEM_FALTAR:
+        return comparacao
+    if valor is None:
+        return None if depois else {campo: {"$ne": None}}
+    return {"$or": [comparacao, {campo: None}]} if depois else comparacao
+
+_contagens_cache: Dict[str, tuple] = {} # chave do filtro -> (total, aproximado, expira_em)
+_contagens_cache_lock = threading.Lock() # Partilhada pelos pedidos em threads diferentes
+
+def limpar_contagens_cache():
+    """ Esquece as contagens guardadas (depois de importações e preenchimentos, e nos testes). """
+    with _contagens_cache_lock:
+        _contagens_cache.clear()
+
+def _contagem_em_cache(filters: dict) -> Optional[tuple[int, bool]]:
+    with _contagens_cache_lock:
+        em_cache = _contagens_cache.get(json.dumps(filters, sort_keys=True, default=str))
+    if em_cache and em_cache[2] > datetime.now(timezone.utc).timestamp():
+        return em_cache[0], em_cache[1]
+    return None
+
+def _guardar_contagem(filters: dict, total: int, limite: int) -> tuple[int, bool]:
+    aproximado = bool(limite) and total >= limite
+    with _contagens_cache_lock:
+        if len(_contagens_cache) > 1000:
+            _contagens_cache.clear()
+        _contagens_cache[json.dumps(filters, sort_keys=True, default=str)] = (
+            total, aproximado, datetime.now(timezone.utc).timestamp() + getattr(settings, 'MONGO_COUNT_CACHE_SECONDS', 60)
+        )
+    return total, aproximado
+
+def contar_chats(filters: Optional[dict] = None) -> tuple[int, bool]:
+    """
+    Total de chats para mostrar na listagem: (total, truncado), em que truncado indica "pelo menos `total`".
+    Sem filtros usa estimated_document_count (metadados da coleção, O(1)); com filtros faz um
+    count_documents limitado a MONGO_COUNT_LIMIT e guarda o resultado MONGO_COUNT_CACHE_SECONDS por filtro.
+    """
     collection = get_chats_collection()
-    if collection is None: 
-        return [], 0, 0 # Lista, total, páginas
+    if collection is None:
+        return 0, False
+    query = _build_mongo_query(filters)
+    if not query:
+        return collection.estimated_document_count(), False
 
-    if page < 1: page = 1
-    if per_page < 1: per_page = 10
+    em_cache = _contagem_em_cache(filters)
+    if em_cache:
+        return em_cache
+
+    limite = getattr(settings, 'MONGO_COUNT_LIMIT', 10000)
+    total = collection.count_documents(query, limit=limite) if limite else collection.count_documents(query)
+    return _guardar_contagem(filters, total, limite)
 
-    skip = (page - 1) * per_page
-    query = _build_mongo_query(filters) # Usa a função auxiliar de filtro
+# Só os campos de resumo: a listagem não lê as mensagens, qualquer que seja o tamanho do chat
+# ('last_message' é o resumo dos chats em buckets anteriores a estes campos)
+PROJECAO_LISTAGEM = {
+    "_id": 1, "title": 1, "created_at": 1, "model_name": 1, "message_count": 1, "last_message_preview": 1,
+    "last_message_at": 1, "total_processing_time": 1, "total_tokens": 1, "last_message": 1,
+}
 
+def _consulta_pagina(query: dict, posicao: Optional[dict], para_tras: bool, per_page: int, campo: str = "created_at") -> dict:
+    """
+    Como obter uma página: {'pipeline': [...]} numa pesquisa por texto (a relevância não pode ser usada
+    num filtro de find(), por isso a página é obtida por agregação), senão {'filter', 'sort'} para um find().
+    Em ambos os casos são pedidos per_page + 1 documentos, para saber se há mais páginas.
+    """
+    sentido = ASCENDING if para_tras else DESCENDING
+    ordenacao = {campo: sentido, "_id": sentido}
+    if _pesquisa_por_texto(query):
+        pipeline = [{"$match": query}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+        if posicao is not None:
+            pipeline.append({"$match": _condicao_keyset(posicao, not para_tras, True)})
+        pipeline += [
+            {"$sort": {"score": sentido, **ordenacao}},
+            {"$limit": per_page + 1},
+            {"$project": {**PROJECAO_LISTAGEM, "score": 1}},
+        ]
+        return {"pipeline": pipeline}
+    if posicao is not None:
+        query = {"$and": [query, _condicao_keyset(posicao, not para_tras, False)]} if query else _condicao_keyset(posicao, not para_tras, False)
+    return {"filter": query, "sort": list(ordenacao.items())}
+
+def _montar_pagina(documentos: List[dict], per_page: int, posicao: Optional[dict], para_tras: bool, campo: str = "created_at") -> dict:
+    """ Converte os documentos lidos (até per_page + 1) no resultado de get_chats_page. """
+    ha_mais = len(documentos) > per_page
+    documentos = documentos[:per_page]
+    if para_tras:
+        documentos.reverse()
+
+    chats_list = []
+    for chat in documentos:
+         antigo = chat.get("last_message") or {}
+         previa = chat.get("last_message_preview", antigo.get("content"))
+         chats_list.append({
+            "chat_id": str(chat["_id"]),
+            "title": chat.get("title", "Sem título"),
+            "created_at": chat.get("created_at"),
+            "model_name": chat.get("model_name", "desconhecido"),
+            "last_message_preview": previa[:50] + "..." if previa else "[Chat vazio]",
+            "last_message_time": chat.get("last_message_at", antigo.get("timestamp")),
+            "message_count": chat.get("message_count"),
+            "total_processing_time": chat.get("total_processing_time"),
+            "total_tokens": chat.get("total_tokens"),
+        })
+
+    tem_seguinte = ha_mais if not para_tras else True
+    tem_anterior = (ha_mais if para_tras else posicao is not None) and bool(documentos)
+    return {
+        "chats": chats_list,
+        "next_cursor": codificar_cursor(documentos[-1], campo) if documentos and tem_seguinte else None,
+        "prev_cursor": codificar_cursor(documentos[0], campo) if tem_anterior else None,
+    }
+
+def get_chats_page(filters: Optional[dict] = None, per_page: int = 10, cursor: Optional[str] = None, direction: str = "next",
+                   sort: Optional[str] = None) -> dict:
+    """
+    Uma página da listagem do histórico, a seguir (direction='next') ou antes ('prev') do `cursor`.
+    Devolve {'chats', 'next_cursor', 'prev_cursor'}; os cursores são None quando não há mais páginas nesse sentido.
+    `sort` é uma chave de ORDENACOES_HISTORICO (padrão: 'created'). Numa pesquisa por texto, os chats mais relevantes aparecem primeiro.
+    """
+    vazia = {"chats": [], "next_cursor": None, "prev_cursor": None}
+    collection = get_chats_collection()
+    if collection is None:
+        return vazia
+    if per_page < 1: per_page = 10
+
+    campo = _campo_ordenacao(sort)
+    posicao = descodificar_cursor(cursor, campo)
+    para_tras = posicao is not None and direction == "prev"
     try:
-        total_chats = collection.count_documents(query)
-        total_pages = (total_chats + per_page - 1) // per_page if per_page > 0 else 0
-
-        chats_cursor = collection.find(
-            query,
-            {"_id": 1, "title": 1, "created_at": 1, "model_name": 1, "messages": {"$slice": -1}}
-        ).sort("created_at", -1).skip(skip).limit(per_page)
-
-        chats_list = []
-        for chat in chats_cursor:
-             last_message = chat.get("messages", [{}])[0]
-             chats_list.append({
-                "chat_id": str(chat["_id"]),
-                "title": chat.get("title", "Sem título"),
-                "created_at": chat.get("created_at"),
-                "model_name": chat.get("model_name", "desconhecido"),
-                "last_message_preview": last_message.get("content", "")[:50] + "..." if last_message.get("content") else "[Chat vazio]",
-                "last_message_time": last_message.get("timestamp")
-            })
-        return chats_list, total_chats, total_pages
+        consulta = _consulta_pagina(_build_mongo_query(filters), posicao, para_tras, per_page, campo) # Usa a função auxiliar de filtro
+        if "pipeline" in consulta:
+            documentos = list(collection.aggregate(consulta["pipeline"]))
+        else:
+            documentos = list(collection.find(consulta["filter"], PROJECAO_LISTAGEM).sort(consulta["sort"]).limit(per_page + 1))
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao buscar chats paginados:")
-        traceback.print_exc()
-        return [], 0, 0
+        logger.exception("Erro ao buscar chats paginados")
+        return vazia
+    pagina = _montar_pagina(documentos, per_page, posicao, para_tras, campo)
+    if write_behind.ativo():
+        write_behind.atualizar_listagem(pagina["chats"])
+    return pagina
 
-# --- NOVA FUNÇÃO PARA EXPORTAÇÃO ---
-def get_all_chats_for_export(filters: Optional[dict] = None) -> List[Dict]:
-    """ Obtém TODOS os chats (sem paginação) para exportação, aplicando filtros. """
-    collection = get_chats_collection()
-    if collection is None: 
-        return []
+# --- Exportação (em streaming: um chat de cada vez) ---
+
+CAMPOS_EXPORTACAO = {"_id": 1, "title": 1, "created_at": 1, "model_name": 1, "messages": 1, "message_storage": 1}
+
+def _serializar_para_exportacao(chat: dict) -> dict:
+    """ Converte ObjectId e datetimes em strings (bom para JSON/CSV); as mensagens já devem estar no documento. """
+    chat.pop("message_storage", None)
+    chat['_id'] = str(chat['_id'])
+    if 'created_at' in chat and isinstance(chat['created_at'], datetime):
+        chat['created_at'] = chat['created_at'].isoformat()
+    for msg in chat.get('messages') or []:
+        if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
+            msg['timestamp'] = msg['timestamp'].isoformat()
+    return chat
 
+def _preparar_para_exportacao(chat: dict) -> dict:
+    return _serializar_para_exportacao(_carregar_mensagens(chat))
+
+def iterar_chats_para_exportacao(filters: Optional[dict] = None, batch_size: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Gera os chats que correspondem aos filtros, um de cada vez e já prontos a serializar.
+    O cursor traz os documentos em lotes de `batch_size` (MONGO_EXPORT_BATCH_SIZE), por isso a memória
+    usada não depende do número de chats exportados.
+    """
+    collection = get_chats_collection()
+    if collection is None:
+        return
     query = _build_mongo_query(filters) # Reutiliza a lógica de filtro
+    cursor = collection.find(query, CAMPOS_EXPORTACAO).sort([("created_at", DESCENDING), ("_id", DESCENDING)]).batch_size(
+        batch_size or getattr(settings, 'MONGO_EXPORT_BATCH_SIZE', 100)
+    )
+    try:
+        for chat in cursor:
+            yield _preparar_para_exportacao(chat)
+    finally:
+        cursor.close()
 
+def get_all_chats_for_export(filters: Optional[dict] = None) -> List[Dict]:
+    """ Obtém TODOS os chats (sem paginação) para exportação, aplicando filtros. Para exportações grandes use iterar_chats_para_exportacao. """
     try:
-        # Busca todos os documentos que correspondem ao filtro, ordenados
-        chats_cursor = collection.find(query).sort("created_at", -1)
-        
-        chats_list = []
-        for chat in chats_cursor:
-            # Converte ObjectId para string para serialização
-            chat['_id'] = str(chat['_id'])
-            # Converte datetimes para strings (bom para JSON)
-            if 'created_at' in chat and isinstance(chat['created_at'], datetime):
-                chat['created_at'] = chat['created_at'].isoformat()
-            if 'messages' in chat:
-                for msg in chat['messages']:
-                    if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
-                        msg['timestamp'] = msg['timestamp'].isoformat()
-            chats_list.append(chat)
-            
-        return chats_list
-        
+        return list(iterar_chats_para_exportacao(filters))
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao buscar todos os chats para exportação:")
-        traceback.print_exc()
+        logger.exception("Erro ao buscar todos os chats para exportação")
         return []
 
 # ... (funções get_chat_details e delete_chat permanecem iguais) ...
+def _formatar_detalhes(chat: dict) -> dict:
+    """ Datas em ISO 8601 (UTC) e _id em string, para o template de detalhe. """
+    chat['_id'] = str(chat['_id'])
+    if 'created_at' in chat and isinstance(chat['created_at'], datetime):
+        chat['created_at'] = chat['created_at'].isoformat() + 'Z'
+    if 'messages' in chat:
+        for msg in chat['messages']:
+            if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
+                msg['timestamp'] = msg['timestamp'].isoformat() + 'Z'
+    return chat
+
 def get_chat_details(chat_id: str) -> Optional[dict]:
     collection = get_chats_collection()
     if collection is None: return None
     try:
         if not ObjectId.is_valid(chat_id):
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: ID do chat inválido '{chat_id}' ao buscar detalhes.")
+             logger.error("ID do chat inválido '%s' ao buscar detalhes.", chat_id)
              return None
+        pendentes = write_behind.pendentes(chat_id) if write_behind.ativo() else [] # Lidas antes do chat (ver write_behind.pendentes)
         chat = collection.find_one({"_id": ObjectId(chat_id)})
         if chat:
-            chat['_id'] = str(chat['_id'])
-            if 'created_at' in chat and isinstance(chat['created_at'], datetime):
-                chat['created_at'] = chat['created_at'].isoformat() + 'Z'
-            if 'messages' in chat:
-                for msg in chat['messages']:
-                    if 'timestamp' in msg and isinstance(msg['timestamp'], datetime):
-                        msg['timestamp'] = msg['timestamp'].isoformat() + 'Z'
-            return chat
+            return _formatar_detalhes(write_behind.juntar_pendentes(_carregar_mensagens(chat), pendentes))
         else:
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Chat {chat_id} não encontrado ao buscar detalhes.")
+             logger.warning("Chat %s não encontrado ao buscar detalhes.", chat_id)
              return None
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao buscar detalhes do chat {chat_id}:")
-        traceback.print_exc()
+        logger.exception("Erro ao buscar detalhes do chat %s", chat_id)
         return None
 
 def delete_chat(chat_id: str) -> bool:
@@ -295,17 +1148,20 @@ def delete_chat(chat_id: str) -> bool:
     if collection is None: return False
     try:
         if not ObjectId.is_valid(chat_id):
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro: ID do chat inválido '{chat_id}' para deleção.")
+             logger.error("ID do chat inválido '%s' para deleção.", chat_id)
              return False
         result = collection.delete_one({"_id": ObjectId(chat_id)})
+        buckets = get_buckets_collection()
+        if buckets is not None:
+            buckets.delete_many({"chat_id": ObjectId(chat_id)})
         if result.deleted_count > 0:
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Chat {chat_id} deletado com sucesso.")
+             invalidar_cache_analise()
+             logger.debug("Chat %s deletado com sucesso.", chat_id)
              return True
         else:
-             print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Aviso: Chat {chat_id} não encontrado para deleção.")
+             logger.warning("Chat %s não encontrado para deleção.", chat_id)
              return False
     except Exception as e:
-        print(f"[{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')}] Erro ao deletar chat {chat_id}:")
-        traceback.print_exc()
+        logger.exception("Erro ao deletar chat %s", chat_id)
         return False
 
@@ -1,96 +1,694 @@
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+import contextvars
 import time
-from typing import List, Dict
-import traceback # Para log detalhado
+import threading
+from typing import Any, Callable, List, Dict, Iterator, Optional
+import logging
+from django.conf import settings
+from .batch_scheduler import GenerationScheduler
+from .kv_cache import KVCacheStore
+from . import inference_client, metrics
 
-# --- Carregamento Singleton do Modelo de IA ---
+logger = logging.getLogger(__name__)
+
+# --- Carregamento Singleton do Modelo de IA (preguiçoso, em segundo plano) ---
 MODEL_NAME = "Qwen/Qwen2-0.5B-Instruct" # Mesmo modelo do main.py original
+SYSTEM_PROMPT = "Você é um assistente prestativo que responde em português."
+MAX_NEW_TOKENS = 512
+# Início das mensagens de erro devolvidas como resposta (não devem ser guardadas na cache de respostas)
+PREFIXO_RESPOSTA_ERRO = "Desculpe, ocorreu um"
 tokenizer = None
 model = None
 is_model_loaded = False
 
-try:
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Iniciando o carregamento do modelo de IA: {MODEL_NAME}...")
-    start_load_time = time.time()
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        torch_dtype="auto", # Usa o tipo de dado recomendado
+# O modelo já não é carregado na importação: o carregamento corre numa thread iniciada
+# pelo arranque do worker (project/wsgi.py, project/asgi.py) ou pelo primeiro pedido.
+# Estados possíveis: 'not_loaded' -> 'loading' -> 'ready' | 'failed'
+_estado_carregamento = {
+    "status": "not_loaded",
+    "model_name": MODEL_NAME, # Pode ser outro, indicado em iniciar_carregamento (ver nome_modelo)
+    "precision": None,
+    "started_at": None,
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "error": None,
+}
+_carregamento_lock = threading.Lock()
+_backend_escolhido: Optional[str] = None # Substitui NLP_INFERENCE_BACKEND neste processo (ver iniciar_carregamento)
+_ultima_falha = 0.0
+INTERVALO_NOVA_TENTATIVA = 60 # Segundos entre tentativas após uma falha de carregamento
+
+# --- Precisão da inferência em CPU ---
+# 'auto': dtype recomendado pelo checkpoint | 'fp32' | 'bf16' (se o CPU suportar) | 'int8': quantização dinâmica das Linear
+PRECISOES = ("auto", "fp32", "bf16", "int8")
+
+def cpu_suporta_bf16() -> bool:
+    """ True se o CPU tem instruções bfloat16 nativas (AVX512-BF16 ou AMX); sem elas o bf16 é emulado e mais lento. """
+    try:
+        if torch.cpu._is_avx512_bf16_supported():
+            return True
+        return bool(getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)())
+    except Exception:
+        return False
+
+def quantizar_int8(modelo):
+    """ Quantização dinâmica int8 das camadas Linear (pesos em int8, ativações quantizadas em tempo de execução). """
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(modelo, {torch.nn.Linear}, dtype=torch.qint8)
+
+def guardar_checkpoint_int8(modelo, caminho: str, nome: Optional[str] = None):
+    """ Guarda os pesos já quantizados (state_dict) e o nome do modelo de origem; ver carregar_checkpoint_int8. """
+    torch.save({"model_name": nome or nome_modelo(), "state_dict": modelo.state_dict()}, caminho)
+
+def carregar_checkpoint_int8(caminho: str, nome: Optional[str] = None):
+    """
+    Carrega um checkpoint de `quantizar_modelo`: a arquitetura vem da configuração do modelo `nome`, as Linear
+    são convertidas para int8 (sem calcular pesos) e os pesos quantizados vêm do ficheiro. O ficheiro é lido
+    com weights_only=True, por isso só contém tensores e nunca executa código.
+    """
+    nome = nome or nome_modelo()
+    dados = torch.load(caminho, weights_only=True, map_location="cpu")
+    if dados.get("model_name") != nome:
+        raise ValueError(f"O checkpoint '{caminho}' foi gerado para '{dados.get('model_name')}', não para '{nome}'.")
+    modelo = quantizar_int8(AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(nome), torch_dtype=torch.float32))
+    modelo.load_state_dict(dados["state_dict"])
+    modelo.eval()
+    return modelo
+
+def carregar_modelo_e_tokenizer(precisao: str = "auto", checkpoint: str = "", nome: Optional[str] = None):
+    """
+    Carrega o tokenizer e o modelo `nome` (por omissão, nome_modelo()) na precisão pedida.
+    Devolve (tokenizer, modelo, precisão efetiva).
+    `checkpoint` aponta para um modelo já quantizado guardado com `python manage.py quantizar_modelo`.
+    """
+    if precisao not in PRECISOES:
+        raise ValueError(f"Precisão desconhecida '{precisao}'. Opções: {', '.join(PRECISOES)}.")
+    nome = nome or nome_modelo()
+    novo_tokenizer = AutoTokenizer.from_pretrained(nome)
+
+    if checkpoint:
+        novo_model = carregar_checkpoint_int8(checkpoint, nome)
+        return novo_tokenizer, novo_model, f"checkpoint:{checkpoint}"
+
+    if precisao == "bf16" and not cpu_suporta_bf16():
+        logger.warning("Este CPU não suporta bfloat16 nativo; a usar fp32.")
+        precisao = "fp32"
+    dtypes = {"auto": "auto", "fp32": torch.float32, "bf16": torch.bfloat16, "int8": torch.float32}
+    novo_model = AutoModelForCausalLM.from_pretrained(
+        nome,
+        torch_dtype=dtypes[precisao], # 'auto' usa o tipo de dado recomendado
         device_map="cpu" # Força CPU para consistência
     )
+    if precisao == "int8":
+        novo_model = quantizar_int8(novo_model)
+    novo_model.eval()
+    return novo_tokenizer, novo_model, precisao
+
+def nome_modelo() -> str:
+    """ Nome do modelo deste processo (MODEL_NAME, ou o indicado em iniciar_carregamento); usado nas métricas e caches. """
+    return _estado_carregamento["model_name"]
+
+def _backend() -> str:
+    return _backend_escolhido or getattr(settings, 'NLP_INFERENCE_BACKEND', 'local')
+
+def _backend_remoto() -> bool:
+    """ True se a inferência é feita pelo servidor de inferência dedicado (NLP_INFERENCE_BACKEND = 'remote'). """
+    return _backend() == 'remote'
+
+def _verificar_modelo():
+    if not is_model_loaded or not tokenizer or (model is None and not _backend_remoto()):
+        raise Exception("O modelo de IA não foi carregado corretamente.")
+
+def _ligar_servidor_inferencia():
+    """
+    Modo remoto: neste processo só é carregado o tokenizer (para contar tokens da janela de contexto);
+    o modelo vive nas réplicas do servidor de inferência. Fica em 'loading' até o servidor estar pronto.
+    """
+    global tokenizer, is_model_loaded
+    start_load_time = time.time()
+    tokenizer = AutoTokenizer.from_pretrained(nome_modelo())
+    while True:
+        try:
+            estado_servidor = inference_client.estado()
+        except Exception as e:
+            estado_servidor = {"status": "unreachable", "error": str(e)}
+        if estado_servidor.get("status") == "ready":
+            break
+        _estado_carregamento["error"] = estado_servidor.get("error")
+        time.sleep(2)
     is_model_loaded = True
-    end_load_time = time.time()
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Modelo '{MODEL_NAME}' carregado com sucesso em {round(end_load_time - start_load_time, 2)} segundos.")
-except Exception as e:
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO CRÍTICO: Não foi possível carregar o modelo '{MODEL_NAME}'.")
-    traceback.print_exc() # Loga o erro completo
+    _estado_carregamento.update(status="ready", error=None, load_seconds=round(time.time() - start_load_time, 2))
+    logger.info("Servidor de inferência pronto em %s.", settings.NLP_INFERENCE_ADDRESS)
+
+def _carregar_modelo():
+    global tokenizer, model, is_model_loaded, _ultima_falha
+    try:
+        if _backend_remoto():
+            _ligar_servidor_inferencia()
+            return
+        logger.info("Iniciando o carregamento do modelo de IA: %s...", nome_modelo())
+        start_load_time = time.time()
+        novo_tokenizer, novo_model, precisao = carregar_modelo_e_tokenizer(
+            getattr(settings, 'NLP_PRECISION', 'auto'),
+            getattr(settings, 'NLP_QUANTIZED_CHECKPOINT', '')
+        )
+        tokenizer, model = novo_tokenizer, novo_model
+        end_load_time = time.time()
+        _estado_carregamento["load_seconds"] = round(end_load_time - start_load_time, 2)
+        _estado_carregamento["precision"] = precisao
+        logger.info("Modelo '%s' (%s) carregado com sucesso em %s segundos.", nome_modelo(), precisao, round(end_load_time - start_load_time, 2))
+        if _modo_especulativo() == "draft":
+            _obter_modelo_rascunho()
+
+        if getattr(settings, 'NLP_WARMUP', True):
+            _aquecer_modelo()
+        is_model_loaded = True
+        _estado_carregamento["status"] = "ready"
+    except Exception as e:
+        logger.critical("Não foi possível carregar o modelo '%s'.", nome_modelo(), exc_info=True)
+        _ultima_falha = time.time()
+        _estado_carregamento["status"] = "failed"
+        _estado_carregamento["error"] = str(e)
+
+def _aquecer_modelo():
+    """
+    Geração curta logo após o carregamento, para que o primeiro pedido real
+    não pague as alocações e inicializações feitas na primeira chamada ao model.generate.
+    """
+    inicio = time.time()
+    try:
+        _gerar_lote([_montar_prompt([{"role": "user", "content": "Olá"}])], max_new_tokens=8)
+        _estado_carregamento["warmup_seconds"] = round(time.time() - inicio, 2)
+        logger.info("Aquecimento do modelo concluído em %s segundos.", _estado_carregamento['warmup_seconds'])
+    except Exception as e:
+        # O aquecimento é opcional: uma falha aqui não impede o uso do modelo
+        logger.warning("Falha no aquecimento do modelo: %s", e)
+
+def iniciar_carregamento(nome: Optional[str] = None, backend: Optional[str] = None):
+    """
+    Inicia o carregamento do modelo numa thread em segundo plano (se ainda não começou).
+    Pode ser chamada várias vezes; após uma falha, só tenta de novo passado INTERVALO_NOVA_TENTATIVA.
+    `nome` e `backend` substituem MODEL_NAME e NLP_INFERENCE_BACKEND neste processo (ex: `gerar_em_lote --modelo`,
+    sempre com geração local); só podem mudar antes de o modelo estar carregado ou a carregar.
+    """
+    global _backend_escolhido
+    with _carregamento_lock:
+        status = _estado_carregamento["status"]
+        if status in ("loading", "ready"):
+            if (nome and nome != nome_modelo()) or (backend and backend != _backend()):
+                raise RuntimeError(f"O modelo '{nome_modelo()}' já foi carregado (ou está a carregar) neste processo.")
+            return
+        if status == "failed" and time.time() - _ultima_falha < INTERVALO_NOVA_TENTATIVA:
+            return
+        if nome:
+            _estado_carregamento["model_name"] = nome
+        if backend:
+            _backend_escolhido = backend
+        _estado_carregamento.update(status="loading", started_at=time.time(), error=None)
+        threading.Thread(target=_carregar_modelo, name="nlp-model-loader", daemon=True).start()
+
+def modelo_pronto() -> bool:
+    return is_model_loaded
+
+def estado_modelo() -> dict:
+    """ Estado do carregamento do modelo (para o endpoint de prontidão). """
+    estado = dict(_estado_carregamento)
+    estado["backend"] = _backend()
+    if estado["status"] == "loading" and estado["started_at"]:
+        estado["elapsed_seconds"] = round(time.time() - estado["started_at"], 2)
+    return estado
+
+def _montar_prompt(chat_history: List[Dict], resumo: Optional[str] = None) -> str:
+    """
+    Monta o texto de entrada do modelo (instrução de sistema + histórico) com o template do Qwen2.
+    Se houver um resumo das mensagens mais antigas (ver context_service), ele vai na instrução de sistema.
+    """
+    system_prompt = SYSTEM_PROMPT
+    if resumo:
+        system_prompt = f"{SYSTEM_PROMPT}\n\nResumo da conversa até aqui:\n{resumo}"
+    # Prepara a conversa para o modelo, incluindo a instrução de sistema e o histórico
+    messages_for_model = [{"role": "system", "content": system_prompt}]
+    # Adiciona o histórico formatado
+    for msg in chat_history:
+         # Garante que só passa 'role' e 'content'
+         messages_for_model.append({"role": msg.get("role"), "content": msg.get("content")})
+
+    # Formata o texto usando o template do modelo Qwen2
+    # É crucial usar add_generation_prompt=True para indicar ao modelo que ele deve responder
+    with metrics.TOKENIZACAO.medir(operation="chat_template"):
+        return tokenizer.apply_chat_template(
+            messages_for_model,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+
+def e_resposta_de_erro(texto: str) -> bool:
+    return texto.startswith(PREFIXO_RESPOSTA_ERRO)
+
+def calcular_embedding(texto: str) -> torch.Tensor:
+    """
+    Embedding normalizado de um texto: média dos estados ocultos da última camada do modelo.
+    Usado pela camada semântica da cache de respostas (só no modo local).
+    """
+    _verificar_modelo()
+    if _backend_remoto():
+        raise Exception("Embeddings não disponíveis com o servidor de inferência remoto.")
+    inputs = tokenizer([texto], return_tensors="pt").to("cpu")
+
+    def calcular():
+        with torch.inference_mode():
+            hidden = model.base_model(input_ids=inputs.input_ids, attention_mask=inputs.attention_mask).last_hidden_state
+        return hidden[0].mean(dim=0).float()
+
+    # Na vez do scheduler, como as gerações: não corre em paralelo com o generate (threads do torch partilhadas)
+    return torch.nn.functional.normalize(_executar_individual(calcular), dim=0)
+
+def contar_tokens(texto: str) -> int:
+    """ Número de tokens de um texto (sem tokens especiais). """
+    with metrics.TOKENIZACAO.medir(operation="count"):
+        return len(tokenizer(texto, add_special_tokens=False).input_ids)
+
+def resumir_conversa(resumo_anterior: Optional[str], mensagens: List[Dict]) -> str:
+    """
+    Atualiza incrementalmente o resumo de uma conversa: junta ao resumo anterior
+    as mensagens que deixaram de caber na janela de contexto.
+    """
+    _verificar_modelo()
+    if _backend_remoto():
+        return inference_client.resumir(resumo_anterior, mensagens)
+    nomes = {"user": "Utilizador", "assistant": "Assistente"}
+    transcricao = "\n".join(f"{nomes.get(m.get('role'), m.get('role'))}: {m.get('content')}" for m in mensagens)
+    pedido = (
+        f"Resumo atual:\n{resumo_anterior or '(vazio)'}\n\n"
+        f"Novas mensagens:\n{transcricao}\n\n"
+        "Escreva um novo resumo curto que junte o resumo atual e as novas mensagens, "
+        "mantendo factos, nomes e pedidos importantes."
+    )
+    text = tokenizer.apply_chat_template(
+        [
+            {"role": "system", "content": "Você resume conversas de forma concisa, em português."},
+            {"role": "user", "content": pedido},
+        ],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    max_tokens = getattr(settings, 'NLP_CONTEXT_SUMMARY_MAX_TOKENS', 200)
+    return _executar_individual(lambda: _gerar_lote([text], max_new_tokens=max_tokens)[0]["texto"])
+
+def _gerar_lote(textos: List[str], max_new_tokens: Optional[int] = None) -> List[Dict]:
+    """
+    Gera as respostas para vários prompts (já formatados com _montar_prompt) num único model.generate.
+    Devolve, para cada prompt, {'texto', 'tokens_prompt', 'tokens_gerados'}.
+    """
+    # Padding à esquerda: num modelo causal os tokens gerados têm de vir logo a seguir ao prompt
+    tokenizer.padding_side = "left"
+    with metrics.TOKENIZACAO.medir(operation="encode"):
+        model_inputs = tokenizer(textos, return_tensors="pt", padding=True).to("cpu")
+
+    cronometro = metrics.CronometroGeracao()
+    generated_ids = model.generate(
+        model_inputs.input_ids,
+        attention_mask=model_inputs.attention_mask,
+        max_new_tokens=max_new_tokens or MAX_NEW_TOKENS,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=StoppingCriteriaList([cronometro])
+    )
+    cronometro.registar("batch")
+
+    # Com padding à esquerda, todos os prompts do lote terminam na mesma posição
+    input_length = model_inputs.input_ids.shape[1]
+    resultados = []
+    for i in range(len(textos)):
+        output_ids = generated_ids[i][input_length:]
+        response_text = tokenizer.decode(output_ids, skip_special_tokens=True)
+        if tokenizer.pad_token_id is not None:
+            tokens_gerados = int((output_ids != tokenizer.pad_token_id).sum())
+        else:
+            tokens_gerados = len(output_ids)
+        resultados.append({
+            "texto": response_text.replace("<|im_end|>", "").strip(),
+            "tokens_prompt": int(model_inputs.attention_mask[i].sum()),
+            "tokens_gerados": tokens_gerados,
+        })
+    return resultados
+
+# --- Scheduler de micro-batching (partilhado por todos os pedidos do processo) ---
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+class _GeracaoIndividual:
+    """
+    Geração que não pode ser agrupada (cache KV por chat, especulativa, streaming): passa pela mesma
+    fila do scheduler e corre na thread dele, para nunca competir pelo CPU com os lotes nem com outras.
+    Guarda o contexto do pedido (ID de trace e tempos por etapa das métricas).
+    """
+    __slots__ = ("funcao", "contexto")
+
+    def __init__(self, funcao: Callable[[], Any]):
+        self.funcao = funcao
+        self.contexto = contextvars.copy_context()
+
+def _processar_lote(itens: List[Any]) -> List[Any]:
+    """
+    Processa um lote do scheduler: os prompts (str) vão juntos num único model.generate e as
+    gerações individuais correm a seguir, uma de cada vez. O erro de uma geração individual é
+    devolvido como resultado dela, para não falhar os restantes pedidos do lote.
+    """
+    resultados: List[Any] = [None] * len(itens)
+    textos = [i for i, item in enumerate(itens) if isinstance(item, str)]
+    if textos:
+        for i, resultado in zip(textos, _gerar_lote([itens[i] for i in textos])):
+            resultados[i] = resultado
+    for i, item in enumerate(itens):
+        if isinstance(item, _GeracaoIndividual):
+            try:
+                resultados[i] = item.contexto.run(item.funcao)
+            except Exception as e:
+                resultados[i] = e
+    return resultados
+
+def _obter_scheduler() -> GenerationScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GenerationScheduler(
+                _processar_lote,
+                max_batch_size=getattr(settings, 'NLP_BATCH_MAX_SIZE', 4),
+                max_wait_ms=getattr(settings, 'NLP_BATCH_MAX_WAIT_MS', 20)
+            )
+            _scheduler.iniciar()
+        return _scheduler
+
+def _executar_geracao(text: str) -> Dict:
+    """ Gera a resposta para um prompt, através do scheduler de micro-batching se estiver ativo. """
+    if getattr(settings, 'NLP_BATCH_ENABLED', True):
+        return _obter_scheduler().submeter(text).result()
+    return _gerar_lote([text])[0]
+
+def _executar_individual(funcao: Callable[[], Any]) -> Any:
+    """ Corre uma geração não agrupável na thread do scheduler (serializada com os lotes), se o micro-batching estiver ativo. """
+    if not getattr(settings, 'NLP_BATCH_ENABLED', True):
+        return funcao()
+    resultado = _obter_scheduler().submeter(_GeracaoIndividual(funcao)).result()
+    if isinstance(resultado, Exception):
+        raise resultado
+    return resultado
+
+# --- Cache KV por chat (reutiliza o prefill dos turnos anteriores) ---
+_kv_cache = None
+_kv_cache_lock = threading.Lock()
+
+def _obter_kv_cache() -> Optional[KVCacheStore]:
+    global _kv_cache
+    if not getattr(settings, 'NLP_KV_CACHE_ENABLED', True):
+        return None
+    with _kv_cache_lock:
+        if _kv_cache is None:
+            _kv_cache = KVCacheStore(
+                max_bytes=int(getattr(settings, 'NLP_KV_CACHE_MAX_MB', 512) * 1024 * 1024),
+                idle_seconds=getattr(settings, 'NLP_KV_CACHE_IDLE_SECONDS', 600)
+            )
+        return _kv_cache
 
-def gerar_resposta_com_contexto(chat_history: List[Dict]) -> str:
+def _gerar_com_cache_kv(chat_id: str, text: str, kv_cache: KVCacheStore, **generate_kwargs) -> Dict:
+    """
+    Gera a resposta de um único prompt reaproveitando o cache KV do turno anterior do chat:
+    se o prompt começa pelos tokens já cobertos pelo cache, só o sufixo novo passa pelo prefill.
+    No fim guarda o cache atualizado (prompt + resposta) para o próximo turno.
+    """
+    with metrics.TOKENIZACAO.medir(operation="encode"):
+        input_ids = tokenizer([text], return_tensors="pt").input_ids.to("cpu")
+    past_key_values, tokens_reutilizados = kv_cache.obter(chat_id, input_ids[0].tolist())
+    if past_key_values is not None:
+        generate_kwargs["past_key_values"] = past_key_values
+
+    cronometro = metrics.CronometroGeracao()
+    generate_kwargs["stopping_criteria"] = StoppingCriteriaList([*generate_kwargs.get("stopping_criteria", []), cronometro])
+    saida = model.generate(
+        input_ids,
+        max_new_tokens=MAX_NEW_TOKENS,
+        return_dict_in_generate=True,
+        **generate_kwargs
+    )
+    cronometro.registar("kv_cache")
+
+    sequencia = saida.sequences[0]
+    if saida.past_key_values is not None:
+        # O cache cobre todos os tokens exceto o último gerado (que nunca chega a ser processado)
+        tokens_cobertos = saida.past_key_values.get_seq_length()
+        kv_cache.guardar(chat_id, sequencia[:tokens_cobertos].tolist(), saida.past_key_values)
+
+    output_ids = sequencia[input_ids.shape[1]:]
+    response_text = tokenizer.decode(output_ids, skip_special_tokens=True)
+    return {
+        "texto": response_text.replace("<|im_end|>", "").strip(),
+        "tokens_prompt": input_ids.shape[1],
+        "tokens_gerados": len(output_ids),
+        "tokens_reutilizados": tokens_reutilizados,
+    }
+
+# --- Decodificação especulativa (geração assistida do transformers) ---
+# 'draft': um modelo de rascunho mais pequeno propõe k tokens e o modelo principal verifica-os num só forward;
+# 'prompt_lookup': os k tokens propostos vêm de n-gramas do próprio prompt (histórico da conversa), sem outro modelo.
+# A geração assistida só aceita lotes de 1: estes turnos são gerados individualmente (na thread do scheduler,
+# sem se juntarem a um lote) e sem a cache KV por chat (o cache devolvido não corresponde à sequência final).
+MODOS_ESPECULATIVOS = ("off", "draft", "prompt_lookup")
+draft_model = None
+_draft_lock = threading.Lock()
+_estatisticas_especulacao = {"generations": 0, "steps": 0, "tokens": 0, "proposed": 0}
+_estatisticas_especulacao_lock = threading.Lock()
+
+def _modo_especulativo() -> str:
+    modo = getattr(settings, 'NLP_SPECULATIVE_MODE', 'off')
+    if modo not in MODOS_ESPECULATIVOS:
+        raise ValueError(f"Modo especulativo desconhecido '{modo}'. Opções: {', '.join(MODOS_ESPECULATIVOS)}.")
+    return modo
+
+def _tokens_especulativos() -> int:
+    return max(1, getattr(settings, 'NLP_SPECULATIVE_TOKENS', 5))
+
+def _obter_modelo_rascunho():
+    """ Modelo de rascunho (NLP_DRAFT_MODEL), carregado uma vez; tem de usar o mesmo tokenizer do modelo principal. """
+    global draft_model
+    with _draft_lock:
+        if draft_model is None:
+            nome = getattr(settings, 'NLP_DRAFT_MODEL', '')
+            if not nome:
+                raise ValueError("NLP_SPECULATIVE_MODE='draft' requer NLP_DRAFT_MODEL.")
+            logger.info("A carregar o modelo de rascunho: %s...", nome)
+            rascunho = AutoModelForCausalLM.from_pretrained(nome, torch_dtype="auto", device_map="cpu")
+            if rascunho.config.vocab_size != model.config.vocab_size:
+                raise ValueError(f"O modelo de rascunho '{nome}' não tem o vocabulário do modelo principal.")
+            # Sempre k tokens propostos por passo (sem o ajuste automático), para a taxa de aceitação ser comparável
+            rascunho.generation_config.num_assistant_tokens_schedule = "constant"
+            rascunho.generation_config.assistant_confidence_threshold = 0
+            rascunho.eval()
+            draft_model = rascunho
+        return draft_model
+
+def _kwargs_especulativos() -> dict:
+    """ Argumentos do model.generate para o modo especulativo configurado. """
+    modo = _modo_especulativo()
+    if modo == "prompt_lookup":
+        return {"prompt_lookup_num_tokens": _tokens_especulativos()}
+    rascunho = _obter_modelo_rascunho()
+    rascunho.generation_config.num_assistant_tokens = _tokens_especulativos()
+    return {"assistant_model": rascunho}
+
+def _gerar_especulativo(text: str, **generate_kwargs) -> Dict:
+    """ Gera a resposta de um único prompt com decodificação especulativa e regista os tokens aceites por passo. """
+    with metrics.TOKENIZACAO.medir(operation="encode"):
+        input_ids = tokenizer([text], return_tensors="pt").input_ids.to("cpu")
+
+    cronometro = metrics.CronometroGeracao()
+    generate_kwargs["stopping_criteria"] = StoppingCriteriaList([*generate_kwargs.get("stopping_criteria", []), cronometro])
+    k = _tokens_especulativos()
+    generated_ids = model.generate(
+        input_ids,
+        max_new_tokens=MAX_NEW_TOKENS,
+        **_kwargs_especulativos(),
+        **generate_kwargs
+    )
+    output_ids = generated_ids[0][input_ids.shape[1]:]
+    cronometro.registar("speculative", tokens=len(output_ids))
+
+    # O critério de paragem corre uma vez por forward do modelo principal: cada passo aceita 0..k tokens
+    # propostos e acrescenta sempre um token do próprio modelo
+    with _estatisticas_especulacao_lock:
+        _estatisticas_especulacao["generations"] += 1
+        _estatisticas_especulacao["steps"] += cronometro.passos
+        _estatisticas_especulacao["tokens"] += len(output_ids)
+        _estatisticas_especulacao["proposed"] += cronometro.passos * k
+
+    response_text = tokenizer.decode(output_ids, skip_special_tokens=True)
+    return {
+        "texto": response_text.replace("<|im_end|>", "").strip(),
+        "tokens_prompt": input_ids.shape[1],
+        "tokens_gerados": len(output_ids),
+    }
+
+def estatisticas_especulacao() -> dict:
+    """
+    Tokens por forward do modelo principal e taxa de aceitação: fração dos k tokens que podiam ser
+    propostos em cada passo que foram aceites (no 'prompt_lookup', os passos sem n-grama contam como 0).
+    """
+    modo = getattr(settings, 'NLP_SPECULATIVE_MODE', 'off')
+    with _estatisticas_especulacao_lock:
+        estatisticas = dict(_estatisticas_especulacao)
+    passos = estatisticas["steps"]
+    estatisticas.update(
+        mode=modo,
+        tokens_per_step=round(estatisticas["tokens"] / passos, 3) if passos else None,
+        acceptance_rate=round((estatisticas["tokens"] - passos) / estatisticas["proposed"], 4) if estatisticas["proposed"] else None,
+    )
+    return estatisticas
+
+def estatisticas_kv_cache() -> dict:
+    """ Hits/misses e memória ocupada pela cache KV por chat. """
+    kv_cache = _obter_kv_cache()
+    if kv_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **kv_cache.estatisticas()}
+
+def estatisticas_scheduler() -> dict:
+    """ Profundidade da fila e tamanhos de lote do scheduler, para afinar NLP_BATCH_* sob carga. """
+    if not getattr(settings, 'NLP_BATCH_ENABLED', True):
+        return {"enabled": False}
+    if _scheduler is None:
+        return {"enabled": True, "started": False}
+    return {"enabled": True, "started": True, **_scheduler.estatisticas()}
+
+def gerar_resposta_com_contexto(chat_history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> str:
     """
     Gera uma resposta usando o modelo carregado, considerando o histórico.
     Adapta a lógica do main.py original.
+    Com chat_id e a cache KV ativa, o turno reaproveita o prefill dos turnos anteriores do chat
+    (e é gerado individualmente, na vez dele na fila do scheduler). Com NLP_SPECULATIVE_MODE, é usada a
+    decodificação especulativa (também individualmente, sem a cache KV).
+    `resumo` é o resumo das mensagens antigas que ficaram fora da janela de contexto.
     """
-    if not is_model_loaded or not model or not tokenizer:
-        raise Exception("O modelo de IA não foi carregado corretamente.")
+    _verificar_modelo()
 
     try:
         if not chat_history:
             # Se o histórico estiver vazio (primeira mensagem), retorna um erro ou uma resposta padrão
             # Isto não deve acontecer porque a view sempre adiciona a mensagem do user primeiro
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Aviso: Tentativa de gerar resposta com histórico vazio.")
+            logger.warning("Tentativa de gerar resposta com histórico vazio.")
             return "Desculpe, ocorreu um problema ao processar o histórico."
 
         # Obtem o último prompt do utilizador para log
         last_user_prompt = chat_history[-1]['content']
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Gerando resposta para: '{last_user_prompt[:50]}...' com {len(chat_history)} mensagens no histórico.")
+        logger.debug("Gerando resposta para: '%s...' com %s mensagens no histórico.", last_user_prompt[:50], len(chat_history))
         start_gen_time = time.time()
 
-        # Prepara a conversa para o modelo, incluindo a instrução de sistema e o histórico
-        messages_for_model = [{"role": "system", "content": "Você é um assistente prestativo que responde em português."}]
-        # Adiciona o histórico formatado
-        for msg in chat_history:
-             # Garante que só passa 'role' e 'content'
-             messages_for_model.append({"role": msg.get("role"), "content": msg.get("content")})
+        if _backend_remoto():
+            response_text = inference_client.gerar(chat_history, chat_id=chat_id, resumo=resumo)
+            logger.debug("Resposta recebida do servidor de inferência em %s segundos.", round(time.time() - start_gen_time, 2))
+            return response_text
 
-        # Formata o texto usando o template do modelo Qwen2
-        # É crucial usar add_generation_prompt=True para indicar ao modelo que ele deve responder
-        text = tokenizer.apply_chat_template(
-            messages_for_model,
-            tokenize=False,
-            add_generation_prompt=True
-        )
+        text = _montar_prompt(chat_history, resumo)
 
-        # Converte para tensores e move para CPU
-        model_inputs = tokenizer([text], return_tensors="pt").to("cpu")
-
-        # Gera os IDs da resposta
-        # NOTA: Ajuste max_new_tokens conforme necessário
-        generated_ids = model.generate(
-            model_inputs.input_ids,
-            max_new_tokens=512
-        )
-
-        # Ignora os tokens do input original ao descodificar
-        # Pega todos os tokens gerados APÓS o final do input
-        output_ids = generated_ids[0][len(model_inputs.input_ids[0]):]
-        response_text = tokenizer.decode(output_ids, skip_special_tokens=True)
+        kv_cache = _obter_kv_cache() if chat_id else None
+        if _modo_especulativo() != "off":
+            resultado = _executar_individual(lambda: _gerar_especulativo(text))
+        elif kv_cache is not None:
+            resultado = _executar_individual(lambda: _gerar_com_cache_kv(chat_id, text, kv_cache))
+        else:
+            # Gera a resposta (agrupada com outros pedidos concorrentes, se o micro-batching estiver ativo)
+            resultado = _executar_geracao(text)
+        response_text = resultado["texto"]
 
         end_gen_time = time.time()
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Resposta gerada em {round(end_gen_time - start_gen_time, 2)} segundos.")
-
-        # Tratamento de possíveis artefactos no final da resposta (comum em alguns modelos)
-        response_text = response_text.replace("<|im_end|>", "").strip()
-        # Remove a repetição do prompt inicial se ocorrer (menos comum com apply_chat_template)
-        # if response_text.startswith(last_user_prompt):
-        #    response_text = response_text[len(last_user_prompt):].strip()
-
+        logger.debug("Resposta gerada em %s segundos (%s tokens).", round(end_gen_time - start_gen_time, 2), resultado['tokens_gerados'])
 
         return response_text
 
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Erro durante a geração da resposta com contexto:")
-        traceback.print_exc()
+        logger.exception("Erro durante a geração da resposta com contexto")
         # Retorna uma mensagem de erro que será mostrada ao utilizador
         return f"Desculpe, ocorreu um erro ao gerar a resposta: {e}"
 
+class _CancelamentoCriteria(StoppingCriteria):
+    """ Interrompe o model.generate quando o cliente do streaming desiste (ex: fecha a página). """
+    def __init__(self, evento: threading.Event):
+        self.evento = evento
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.evento.is_set()
+
+def gerar_resposta_stream(chat_history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> Iterator[str]:
+    """
+    Versão em streaming de gerar_resposta_com_contexto: devolve os pedaços de texto
+    à medida que o modelo os gera (via TextIteratorStreamer), em vez de esperar pela resposta completa.
+    O model.generate corre numa thread separada (na vez dele na fila do scheduler, se o micro-batching
+    estiver ativo); se o consumidor parar de iterar, a geração é cancelada.
+    """
+    _verificar_modelo()
+    if not chat_history:
+        logger.warning("Tentativa de gerar resposta (stream) com histórico vazio.")
+        yield "Desculpe, ocorreu um problema ao processar o histórico."
+        return
+
+    last_user_prompt = chat_history[-1]['content']
+    logger.debug("Gerando resposta (stream) para: '%s...' com %s mensagens no histórico.", last_user_prompt[:50], len(chat_history))
+    start_gen_time = time.time()
+
+    if _backend_remoto():
+        yield from inference_client.gerar_stream(chat_history, chat_id=chat_id, resumo=resumo)
+        return
+
+    text = _montar_prompt(chat_history, resumo)
+    especulativo = _modo_especulativo() != "off"
+    kv_cache = _obter_kv_cache() if chat_id and not especulativo else None
+
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    cancelado = threading.Event()
+    erros = []
+
+    def _gerar_na_vez():
+        if cancelado.is_set():
+            # O cliente desistiu enquanto o pedido esperava na fila do scheduler
+            streamer.end()
+            return
+        stopping_criteria = StoppingCriteriaList([_CancelamentoCriteria(cancelado)])
+        if especulativo:
+            _gerar_especulativo(text, streamer=streamer, stopping_criteria=stopping_criteria)
+        elif kv_cache is not None:
+            _gerar_com_cache_kv(chat_id, text, kv_cache, streamer=streamer, stopping_criteria=stopping_criteria)
+        else:
+            with metrics.TOKENIZACAO.medir(operation="encode"):
+                model_inputs = tokenizer([text], return_tensors="pt").to("cpu")
+            cronometro = metrics.CronometroGeracao()
+            stopping_criteria.append(cronometro)
+            model.generate(
+                model_inputs.input_ids,
+                max_new_tokens=MAX_NEW_TOKENS,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria
+            )
+            cronometro.registar("stream")
+
+    def _gerar():
+        try:
+            _executar_individual(_gerar_na_vez)
+        except Exception as e:
+            erros.append(e)
+            # Desbloqueia o consumidor do streamer, que de outra forma ficaria à espera para sempre
+            streamer.end()
+
+    # A thread herda o contexto do pedido (ID de trace e tempos por etapa das métricas)
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(_gerar,), daemon=True)
+    thread.start()
+    try:
+        for pedaco in streamer:
+            pedaco = pedaco.replace("<|im_end|>", "")
+            if pedaco:
+                yield pedaco
+    finally:
+        cancelado.set()
+        thread.join()
+
+    if erros:
+        raise erros[0]
+    logger.debug("Resposta (stream) gerada em %s segundos.", round(time.time() - start_gen_time, 2))
@@ -0,0 +1,286 @@
+"""
+Cache de respostas à frente de nlp_service.gerar_resposta_com_contexto.
+
+- Camada exata: chave = hash normalizado (instrução de sistema, modelo, parâmetros de geração,
+  resumo e mensagens da janela de contexto), guardada num LRU em memória ou numa coleção
+  MongoDB com índice TTL (RESPONSE_CACHE_BACKEND).
+- Camada semântica (opcional): para prompts de um só turno, procura um prompt anterior
+  suficientemente parecido por similaridade de embeddings.
+
+Só conversas curtas (até RESPONSE_CACHE_MAX_HISTORY_MESSAGES mensagens na janela) são guardadas:
+em conversas longas a probabilidade de repetição é baixa e a cache só ocuparia memória.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import mongo_service, nlp_service
+
+logger = logging.getLogger(__name__)
+
+
+def _normalizar(texto: Optional[str]) -> str:
+    texto = unicodedata.normalize("NFC", texto or "")
+    return re.sub(r"\s+", " ", texto).strip().lower()
+
+def calcular_chave(history: List[Dict], resumo: Optional[str] = None) -> Optional[str]:
+    """ Chave da cache exata, ou None se a conversa não deve ser guardada. """
+    if not history or len(history) > getattr(settings, 'RESPONSE_CACHE_MAX_HISTORY_MESSAGES', 4):
+        return None
+    conteudo = {
+        "system": nlp_service.SYSTEM_PROMPT,
+        "model": nlp_service.nome_modelo(),
+        "params": {
+            "max_new_tokens": nlp_service.MAX_NEW_TOKENS,
+            "precision": getattr(settings, 'NLP_PRECISION', 'auto'),
+            "do_sample": False,
+        },
+        "summary": _normalizar(resumo),
+        "history": [[m.get("role"), _normalizar(m.get("content"))] for m in history],
+    }
+    return hashlib.sha256(json.dumps(conteudo, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+# --- Backends da camada exata ---
+
+class _CacheMemoria:
+    """ LRU em memória, com número máximo de entradas e TTL. """
+
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave: str) -> Optional[str]:
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is None:
+                return None
+            resposta, expira_em = entrada
+            if expira_em < time.monotonic():
+                del self._entradas[chave]
+                return None
+            self._entradas.move_to_end(chave)
+            return resposta
+
+    def guardar(self, chave: str, resposta: str):
+        with self._lock:
+            self._entradas[chave] = (resposta, time.monotonic() + self.ttl)
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entradas)
+
+
+class _CacheMongo:
+    """ Coleção 'response_cache' partilhada por todos os workers; o índice TTL remove as entradas expiradas. """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    def obter(self, chave: str) -> Optional[str]:
+        collection = mongo_service.get_response_cache_collection(int(self.ttl))
+        if collection is None:
+            return None
+        documento = collection.find_one({"_id": chave}, {"response": 1})
+        return documento.get("response") if documento else None
+
+    def guardar(self, chave: str, resposta: str):
+        collection = mongo_service.get_response_cache_collection(int(self.ttl))
+        if collection is None:
+            return
+        collection.replace_one(
+            {"_id": chave},
+            {"_id": chave, "response": resposta, "created_at": datetime.now(timezone.utc)},
+            upsert=True
+        )
+
+    def __len__(self):
+        collection = mongo_service.get_response_cache_collection(int(self.ttl))
+        return collection.estimated_document_count() if collection is not None else 0
+
+
+# --- Camada semântica (prompts de um só turno) ---
+
+class _CacheSemantica:
+
+    def __init__(self, max_entradas: int, limiar: float, ttl: float):
+        self.max_entradas = max_entradas
+        self.limiar = limiar
+        self.ttl = ttl
+        self._entradas: List[Tuple[object, str, float]] = [] # (embedding, resposta, expira_em)
+        self._lock = threading.Lock()
+
+    def obter(self, embedding) -> Optional[str]:
+        import torch
+        with self._lock:
+            agora = time.monotonic()
+            self._entradas = [e for e in self._entradas if e[2] >= agora]
+            if not self._entradas:
+                return None
+            matriz = torch.stack([e[0] for e in self._entradas])
+            similaridades = matriz @ embedding # Embeddings normalizados: produto interno = cosseno
+            melhor = int(similaridades.argmax())
+            if float(similaridades[melhor]) >= self.limiar:
+                return self._entradas[melhor][1]
+            return None
+
+    def guardar(self, embedding, resposta: str):
+        with self._lock:
+            self._entradas.append((embedding, resposta, time.monotonic() + self.ttl))
+            if len(self._entradas) > self.max_entradas:
+                self._entradas = self._entradas[-self.max_entradas:]
+
+    def __len__(self):
+        return len(self._entradas)
+
+
+# --- Singleton e estatísticas ---
+_exata = None
+_semantica = None
+_singleton_lock = threading.Lock()
+_estatisticas = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0}
+_estatisticas_lock = threading.Lock() # Os pedidos correm em threads diferentes (executor e to_thread)
+
+def _somar(chave: str):
+    with _estatisticas_lock:
+        _estatisticas[chave] += 1
+
+def _cache_exata():
+    global _exata
+    with _singleton_lock:
+        if _exata is None:
+            ttl = getattr(settings, 'RESPONSE_CACHE_TTL_SECONDS', 86400)
+            if getattr(settings, 'RESPONSE_CACHE_BACKEND', 'memory') == 'mongo':
+                _exata = _CacheMongo(ttl)
+            else:
+                _exata = _CacheMemoria(getattr(settings, 'RESPONSE_CACHE_MAX_ENTRIES', 1000), ttl)
+        return _exata
+
+def _cache_semantica() -> Optional[_CacheSemantica]:
+    global _semantica
+    if not getattr(settings, 'RESPONSE_CACHE_SEMANTIC', False) or nlp_service._backend_remoto():
+        return None
+    with _singleton_lock:
+        if _semantica is None:
+            _semantica = _CacheSemantica(
+                getattr(settings, 'RESPONSE_CACHE_SEMANTIC_MAX_ENTRIES', 500),
+                getattr(settings, 'RESPONSE_CACHE_SEMANTIC_THRESHOLD', 0.95),
+                getattr(settings, 'RESPONSE_CACHE_TTL_SECONDS', 86400)
+            )
+        return _semantica
+
+def limpar():
+    """ Esvazia as caches em memória (usado nos testes). """
+    global _exata, _semantica
+    with _singleton_lock:
+        _exata = None
+        _semantica = None
+    with _estatisticas_lock:
+        for chave in _estatisticas:
+            _estatisticas[chave] = 0
+
+def estatisticas() -> dict:
+    if not getattr(settings, 'RESPONSE_CACHE_ENABLED', True):
+        return {"enabled": False}
+    semantica = _cache_semantica()
+    with _estatisticas_lock:
+        contadores = dict(_estatisticas)
+    return {
+        "enabled": True,
+        "backend": getattr(settings, 'RESPONSE_CACHE_BACKEND', 'memory'),
+        "entries": len(_cache_exata()),
+        "semantic_entries": len(semantica) if semantica is not None else None,
+        **contadores,
+    }
+
+def _procurar(history: List[Dict], resumo: Optional[str]):
+    """ Devolve (resposta em cache ou None, info, função para guardar a resposta nova). """
+    chave = calcular_chave(history, resumo)
+    if chave is None:
+        return None, {"cache_hit": False}, lambda resposta: None
+
+    try:
+        resposta = _cache_exata().obter(chave)
+        if resposta is not None:
+            _somar("exact_hits")
+            return resposta, {"cache_hit": True, "cache_tier": "exact"}, lambda r: None
+
+        semantica = _cache_semantica()
+        embedding = None
+        if semantica is not None and len(history) == 1 and not resumo:
+            embedding = nlp_service.calcular_embedding(history[0].get("content") or "")
+            resposta = semantica.obter(embedding)
+            if resposta is not None:
+                _somar("semantic_hits")
+                return resposta, {"cache_hit": True, "cache_tier": "semantic"}, lambda r: None
+    except Exception as e:
+        # Uma falha na cache nunca impede a geração
+        logger.warning("Erro ao consultar a cache de respostas", exc_info=True)
+        return None, {"cache_hit": False}, lambda resposta: None
+
+    _somar("misses")
+
+    def guardar(resposta: str):
+        if not resposta or nlp_service.e_resposta_de_erro(resposta):
+            return
+        try:
+            _cache_exata().guardar(chave, resposta)
+            if embedding is not None:
+                semantica.guardar(embedding, resposta)
+            _somar("stores")
+        except Exception:
+            logger.warning("Erro ao guardar na cache de respostas", exc_info=True)
+
+    return None, {"cache_hit": False}, guardar
+
+def gerar_com_cache(history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None) -> Tuple[str, dict]:
+    """
+    Igual a nlp_service.gerar_resposta_com_contexto, mas consulta a cache antes de gerar.
+    Devolve (resposta, info) em que info['cache_hit'] indica se a resposta veio da cache.
+    """
+    if not getattr(settings, 'RESPONSE_CACHE_ENABLED', True):
+        return nlp_service.gerar_resposta_com_contexto(history, chat_id=chat_id, resumo=resumo), {"cache_hit": False}
+
+    resposta, info, guardar = _procurar(history, resumo)
+    if resposta is not None:
+        return resposta, info
+    resposta = nlp_service.gerar_resposta_com_contexto(history, chat_id=chat_id, resumo=resumo)
+    guardar(resposta)
+    return resposta, info
+
+def gerar_stream_com_cache(history: List[Dict], chat_id: Optional[str] = None, resumo: Optional[str] = None, info: Optional[dict] = None) -> Iterator[str]:
+    """
+    Versão em streaming de gerar_com_cache: num hit a resposta é enviada de uma vez;
+    num miss os pedaços são reencaminhados e a resposta completa é guardada no fim.
+    O dicionário `info` (se dado) é preenchido com 'cache_hit'.
+    """
+    info = info if info is not None else {}
+    if not getattr(settings, 'RESPONSE_CACHE_ENABLED', True):
+        info["cache_hit"] = False
+        yield from nlp_service.gerar_resposta_stream(history, chat_id=chat_id, resumo=resumo)
+        return
+
+    resposta, dados, guardar = _procurar(history, resumo)
+    info.update(dados)
+    if resposta is not None:
+        yield resposta
+        return
+    partes = []
+    for pedaco in nlp_service.gerar_resposta_stream(history, chat_id=chat_id, resumo=resumo):
+        partes.append(pedaco)
+        yield pedaco
+    # Só chega aqui se o stream terminou normalmente (não guarda respostas interrompidas)
+    guardar("".join(partes).strip())
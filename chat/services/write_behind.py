@@ -0,0 +1,385 @@
+"""
+Escrita diferida (write-behind) das respostas do assistente, com MONGO_WRITE_BEHIND = True: o pedido de chat
+responde sem esperar pela escrita no MongoDB.
+
+- enfileirar: a resposta (já com os metadados: tempo de processamento, tokens, cache, trace) é gravada num
+  ficheiro próprio em WRITE_BEHIND_DIR/<chat_id>/ (temporário + fsync + os.replace, por isso um ficheiro
+  existe completo ou não existe). O nome começa pelo instante em nanossegundos: a ordem dos nomes é a da fila.
+- Uma thread por processo junta os ficheiros pendentes em lotes de até WRITE_BEHIND_BATCH_SIZE e escreve-os
+  com mongo_service.acrescentar_mensagens_em_lote (um find + um bulk_write). Os ficheiros só são apagados
+  depois da escrita; se o MongoDB falhar, o lote é repetido com backoff exponencial (com jitter).
+- Vários processos partilham a pasta: cada ficheiro é reservado por um só escritor (rename atómico para
+  '<nome>.json.<token>'). Uma reserva que não é renovada em WRITE_BEHIND_CLAIM_SECONDS (processo que morreu)
+  é retomada por outro escritor; o que ficou na pasta depois de um reinício é escrito no arranque.
+- Repetir uma escrita não duplica a mensagem: uma mensagem que já é a última do chat (mesma data, papel e prévia
+  nos campos de resumo) é ignorada.
+- Leituras (read-your-writes): o detalhe e a listagem de um chat juntam as mensagens ainda na fila (pendentes,
+  atualizar_listagem); antes de guardar uma nova mensagem do utilizador, as pendentes desse chat são escritas
+  primeiro (escrever_chat), para que a conversa fique pela ordem certa.
+"""
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+from bson import ObjectId, json_util
+from django.conf import settings
+
+from . import mongo_service
+
+logger = logging.getLogger(__name__)
+
+PASTA_INVALIDOS = "_invalidos" # Ficheiros que não podem ser lidos (guardados para análise, nunca apagados)
+
+_contador = itertools.count()
+_estatisticas = {"queued": 0, "written": 0, "duplicates": 0, "orphaned": 0, "invalid": 0, "batches": 0,
+                 "retries": 0, "last_batch_size": 0, "last_flush_ms": None, "last_error": None}
+_estatisticas_lock = threading.Lock()
+
+
+def ativo() -> bool:
+    return getattr(settings, 'MONGO_WRITE_BEHIND', False)
+
+def _pasta() -> str:
+    return getattr(settings, 'WRITE_BEHIND_DIR', os.path.join(settings.BASE_DIR, 'write_behind'))
+
+def _somar(**valores):
+    with _estatisticas_lock:
+        for chave, valor in valores.items():
+            _estatisticas[chave] += valor
+
+
+# --- Ficheiros da fila ---
+
+def _base(nome: str) -> str:
+    """ Nome do ficheiro sem o token da reserva (define a ordem na fila). """
+    return nome.split(".json", 1)[0]
+
+def _ficheiros(pasta_chat: str) -> List[str]:
+    """ Ficheiros da fila de um chat (pendentes e reservados), por ordem; os temporários ('.tmp-...') ficam de fora. """
+    try:
+        nomes = os.listdir(pasta_chat)
+    except FileNotFoundError:
+        return []
+    return sorted((nome for nome in nomes if not nome.startswith(".") and ".json" in nome), key=_base)
+
+def _ler(caminho: str) -> tuple:
+    with open(caminho, encoding="utf-8") as ficheiro:
+        entrada = json_util.loads(ficheiro.read()) # Datas em UTC sem fuso, como as lidas do MongoDB
+    return entrada["chat_id"], entrada["message"]
+
+def enfileirar(chat_id: str, message: dict) -> bool:
+    """
+    Grava a mensagem na fila do chat. Devolve False se não foi possível (ex: disco cheio):
+    quem chama escreve então diretamente no MongoDB.
+    """
+    if not ObjectId.is_valid(chat_id):
+        return False
+    pasta_chat = os.path.join(_pasta(), chat_id)
+    nome = f"{time.time_ns():020d}-{os.getpid()}-{next(_contador) % 1000000:06d}.json"
+    dados = json_util.dumps({"chat_id": chat_id, "message": message})
+    for tentativa in range(3):
+        temporario = os.path.join(pasta_chat, f".tmp-{nome}")
+        try:
+            os.makedirs(pasta_chat, exist_ok=True)
+            with open(temporario, "w", encoding="utf-8") as ficheiro:
+                ficheiro.write(dados)
+                ficheiro.flush()
+                if getattr(settings, 'WRITE_BEHIND_FSYNC', True):
+                    os.fsync(ficheiro.fileno())
+            os.replace(temporario, os.path.join(pasta_chat, nome))
+            break
+        except FileNotFoundError:
+            continue # A pasta do chat foi apagada pelo escritor entre o makedirs e a escrita
+        except OSError:
+            logger.exception("Não foi possível pôr a resposta do chat %s na fila de escrita diferida", chat_id)
+            return False
+    else:
+        return False
+    _somar(queued=1)
+    iniciar() # O escritor junta o que chegar em cada WRITE_BEHIND_FLUSH_MS num só lote
+    return True
+
+
+# --- Reservas ---
+
+def _reservar(caminho: str) -> Optional[str]:
+    """ Reserva um ficheiro (rename atómico com um token novo); None se outro escritor o reservou primeiro. """
+    novo = os.path.join(os.path.dirname(caminho), f"{_base(os.path.basename(caminho))}.json.{uuid.uuid4().hex[:12]}")
+    try:
+        os.rename(caminho, novo)
+        os.utime(novo) # A reserva vale WRITE_BEHIND_CLAIM_SECONDS a partir de agora
+    except FileNotFoundError:
+        return None
+    return novo
+
+def _livre(pasta_chat: str, nome: str) -> bool:
+    """ Pendente, ou reservado por um escritor que deixou de renovar a reserva (processo que morreu). """
+    if nome.endswith(".json"):
+        return True
+    try:
+        idade = time.time() - os.path.getmtime(os.path.join(pasta_chat, nome))
+    except FileNotFoundError:
+        return False
+    return idade > getattr(settings, 'WRITE_BEHIND_CLAIM_SECONDS', 60)
+
+def _reservar_lote(limite: int, chat_id: Optional[str] = None) -> List[str]:
+    """ Reserva até `limite` ficheiros livres (de um chat, ou dos chats com escritas mais antigas primeiro). """
+    pasta = _pasta()
+    if chat_id:
+        chats = [chat_id]
+    else:
+        try:
+            chats = [nome for nome in os.listdir(pasta) if not nome.startswith((".", "_"))]
+        except FileNotFoundError:
+            return []
+    reservados = []
+    for chat in chats:
+        pasta_chat = os.path.join(pasta, chat)
+        for nome in _ficheiros(pasta_chat):
+            if len(reservados) >= limite:
+                return reservados
+            if _livre(pasta_chat, nome):
+                caminho = _reservar(os.path.join(pasta_chat, nome))
+                if caminho:
+                    reservados.append(caminho)
+    return reservados
+
+def _renovar(reservados: List[str]):
+    for caminho in reservados:
+        try:
+            os.utime(caminho)
+        except FileNotFoundError:
+            pass
+
+def _libertar(reservados: List[str]):
+    """ Devolve os ficheiros à fila (sem esperar que a reserva expire). """
+    for caminho in reservados:
+        try:
+            os.rename(caminho, os.path.join(os.path.dirname(caminho), _base(os.path.basename(caminho)) + ".json"))
+        except FileNotFoundError:
+            pass
+
+def _escrever_lote(reservados: List[str]):
+    """ Escreve os ficheiros reservados no MongoDB (pela ordem da fila) e apaga-os. Levanta a exceção se a escrita falhar. """
+    inicio = time.perf_counter()
+    reservados = sorted(reservados, key=lambda caminho: _base(os.path.basename(caminho)))
+    entradas, lidos = [], []
+    for caminho in reservados:
+        try:
+            entradas.append(_ler(caminho))
+            lidos.append(caminho)
+        except FileNotFoundError:
+            continue # Retomado por outro escritor (a reserva tinha expirado)
+        except (ValueError, KeyError, TypeError):
+            destino = os.path.join(_pasta(), PASTA_INVALIDOS)
+            os.makedirs(destino, exist_ok=True)
+            os.replace(caminho, os.path.join(destino, os.path.basename(caminho)))
+            _somar(invalid=1)
+            logger.error("Ficheiro inválido na fila de escrita diferida, movido para %s: %s", destino, caminho)
+    if not entradas:
+        return
+    resultados = mongo_service.acrescentar_mensagens_em_lote(entradas)
+
+    for caminho in lidos:
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(os.path.dirname(caminho)) # Só apaga a pasta do chat se ficou vazia
+        except OSError:
+            pass
+    for (chat_id, _), resultado in zip(entradas, resultados):
+        if resultado == "sem_chat":
+            logger.warning("Resposta na fila descartada: o chat %s já não existe.", chat_id)
+    segundos = time.perf_counter() - inicio
+    _somar(written=resultados.count("escrita"), duplicates=resultados.count("repetida"),
+           orphaned=resultados.count("sem_chat"), batches=1)
+    with _estatisticas_lock:
+        _estatisticas.update(last_batch_size=len(entradas), last_flush_ms=round(segundos * 1000, 2))
+    logger.debug("Escrita diferida: %s mensagens escritas no MongoDB em %sms.", len(entradas), round(segundos * 1000, 2))
+
+
+# --- Leituras (read-your-writes) ---
+
+def tem_pendentes(chat_id: str) -> bool:
+    return bool(chat_id) and ObjectId.is_valid(chat_id) and bool(_ficheiros(os.path.join(_pasta(), chat_id)))
+
+def pendentes(chat_id: str) -> List[dict]:
+    """
+    Mensagens do chat ainda na fila (pendentes ou a ser escritas), pela ordem da fila. Deve ser chamada antes
+    de ler o chat do MongoDB: uma mensagem escrita entretanto aparece nas duas leituras e é ignorada por
+    juntar_pendentes, em vez de não aparecer em nenhuma.
+    """
+    if not chat_id or not ObjectId.is_valid(chat_id):
+        return []
+    pasta_chat = os.path.join(_pasta(), chat_id)
+    for tentativa in range(3):
+        try:
+            return [_ler(os.path.join(pasta_chat, nome))[1] for nome in _ficheiros(pasta_chat)]
+        except FileNotFoundError:
+            continue # Reservado ou escrito enquanto era lido: volta a listar
+        except (ValueError, KeyError, TypeError):
+            break
+    return []
+
+def _novas(mensagens: List[dict], ultima: Optional[dict]) -> List[dict]:
+    """
+    As mensagens da fila que ainda não estão no MongoDB: as que vêm depois da última mensagem guardada
+    (`ultima`, com os campos de resumo), se esta for uma delas; senão, todas.
+    """
+    if ultima:
+        for posicao in range(len(mensagens) - 1, -1, -1):
+            if mongo_service.ja_escrita(ultima, mensagens[posicao]):
+                return mensagens[posicao + 1:]
+    return mensagens
+
+def juntar_pendentes(chat: dict, mensagens: List[dict]) -> dict:
+    """ Acrescenta ao chat lido do MongoDB (com as mensagens carregadas) as mensagens da fila que ainda lá não estão. """
+    if mensagens:
+        guardadas = list(chat.get("messages") or [])
+        novas = _novas(mensagens, mongo_service._resumo_mensagem(guardadas[-1]) if guardadas else None)
+        if novas:
+            chat["messages"] = guardadas + novas
+            chat["message_count"] = len(chat["messages"])
+    return chat
+
+def atualizar_listagem(chats: List[dict]) -> List[dict]:
+    """ Atualiza os campos de resumo das linhas da listagem com as mensagens da fila de cada chat. """
+    for linha in chats:
+        mensagens = pendentes(linha["chat_id"])
+        if not mensagens:
+            continue
+        # A linha só tem a prévia cortada: compara com a de cada mensagem da fila, cortada da mesma forma
+        for posicao in range(len(mensagens) - 1, -1, -1):
+            previa = (mensagens[posicao].get("content") or "")[:50] + "..."
+            if (mongo_service._instante(linha.get("last_message_time")) == mongo_service._instante(mensagens[posicao].get("timestamp"))
+                    and linha.get("last_message_preview") == previa):
+                mensagens = mensagens[posicao + 1:]
+                break
+        if not mensagens:
+            continue
+        previa = mensagens[-1].get("content") or ""
+        linha.update(
+            last_message_preview=previa[:50] + "..." if previa else "[Chat vazio]",
+            last_message_time=mensagens[-1].get("timestamp"),
+            message_count=(linha.get("message_count") or 0) + len(mensagens),
+            total_processing_time=(linha.get("total_processing_time") or 0) + sum(mongo_service._numero(m.get("processing_time")) for m in mensagens),
+            total_tokens=(linha.get("total_tokens") or 0) + sum(mongo_service._numero(m.get("tokens")) for m in mensagens),
+        )
+    return chats
+
+def escrever_chat(chat_id: str) -> bool:
+    """
+    Escreve já as mensagens do chat que estão na fila e espera pelas que outro escritor está a escrever
+    (até WRITE_BEHIND_WAIT_SECONDS). Devolve False se a fila do chat não ficou vazia (ex: MongoDB indisponível).
+    """
+    limite = time.monotonic() + getattr(settings, 'WRITE_BEHIND_WAIT_SECONDS', 5)
+    while True:
+        reservados = _reservar_lote(getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100), chat_id)
+        if reservados:
+            try:
+                _escrever_lote(reservados)
+            except Exception as e:
+                _libertar(reservados)
+                logger.warning("Não foi possível escrever a fila do chat %s: %s", chat_id, e)
+                return False
+        if not tem_pendentes(chat_id):
+            return True
+        if time.monotonic() > limite:
+            logger.warning("A fila de escrita diferida do chat %s não ficou vazia a tempo.", chat_id)
+            return False
+        time.sleep(0.02)
+
+
+# --- Escritor em segundo plano ---
+
+_escritor: Optional[threading.Thread] = None
+_escritor_lock = threading.Lock()
+_parar = threading.Event()
+
+def _espera_repeticao(falhas: int) -> float:
+    """ Backoff exponencial com jitter entre as tentativas (os mesmos limites da religação ao MongoDB). """
+    teto = min(getattr(settings, 'MONGO_RECONNECT_MAX_SECONDS', 30.0),
+               getattr(settings, 'MONGO_RECONNECT_BASE_SECONDS', 0.5) * 2 ** max(0, falhas - 1))
+    return teto / 2 + random.uniform(0, teto / 2)
+
+def _ciclo_escritor():
+    intervalo = getattr(settings, 'WRITE_BEHIND_FLUSH_MS', 100) / 1000
+    reservados: List[str] = []
+    falhas = 0
+    while not _parar.is_set():
+        if not reservados:
+            try:
+                reservados = _reservar_lote(getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100))
+            except OSError:
+                logger.exception("Erro ao ler a fila de escrita diferida")
+        if reservados:
+            try:
+                _escrever_lote(reservados)
+                reservados, falhas = [], 0
+                continue # Pode haver mais ficheiros à espera: o lote seguinte vai já
+            except Exception as e:
+                falhas += 1
+                _somar(retries=1)
+                with _estatisticas_lock:
+                    _estatisticas["last_error"] = str(e)
+                espera = _espera_repeticao(falhas)
+                logger.warning("Falha na escrita diferida de %s mensagens (tentativa %s, nova tentativa dentro de %ss): %s",
+                               len(reservados), falhas, round(espera, 1), e)
+                _renovar(reservados)
+                _parar.wait(espera)
+                continue
+        _parar.wait(intervalo)
+    _libertar(reservados)
+
+def iniciar():
+    """ Inicia (uma vez por processo) o escritor; escreve também o que ficou na fila de uma execução anterior. """
+    global _escritor
+    if not ativo() or _escritor is not None:
+        return
+    with _escritor_lock:
+        if _escritor is None:
+            _parar.clear()
+            _escritor = threading.Thread(target=_ciclo_escritor, name="write-behind", daemon=True)
+            _escritor.start()
+
+def parar(escrever: bool = True):
+    """ Pára o escritor; com `escrever`, tenta ainda escrever o que está na fila (ex: ao desligar o processo). """
+    global _escritor
+    with _escritor_lock:
+        if _escritor is not None:
+            _parar.set()
+            _escritor.join(timeout=10)
+            _escritor = None
+    if escrever:
+        reservados = _reservar_lote(getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100))
+        while reservados:
+            try:
+                _escrever_lote(reservados)
+            except Exception:
+                _libertar(reservados)
+                logger.warning("Ficaram %s+ mensagens na fila de escrita diferida (serão escritas no próximo arranque).", len(reservados))
+                return
+            reservados = _reservar_lote(getattr(settings, 'WRITE_BEHIND_BATCH_SIZE', 100))
+
+def estatisticas() -> dict:
+    """ Estado da fila (para /chat/estatisticas/): mensagens à espera, escritas, repetições e último lote. """
+    pasta = _pasta()
+    try:
+        chats = [nome for nome in os.listdir(pasta) if not nome.startswith((".", "_"))]
+    except FileNotFoundError:
+        chats = []
+    with _estatisticas_lock:
+        dados = dict(_estatisticas)
+    return {
+        "enabled": ativo(),
+        "pending": sum(len(_ficheiros(os.path.join(pasta, chat))) for chat in chats),
+        "pending_chats": len(chats),
+        **dados,
+    }
@@ -1,9 +1,36 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, AsyncClient, override_settings
+import asyncio
 from django.urls import reverse
+import gzip
+import importlib
+import io
+import os
+import tempfile
+import queue
 import json
-from unittest.mock import patch, MagicMock # Usaremos 'patch' para simular a IA
+import logging
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from unittest.mock import patch, MagicMock, AsyncMock # Usaremos 'patch' para simular a IA
 import mongomock # Importa o mongomock
+import threading
+import tracemalloc
+import time
+from asgiref.sync import async_to_sync
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import torch
 from .services import mongo_service # Importa o nosso serviço
+from .services import context_service
+from .services import nlp_service
+from .services.inference_server import InferenceServer, parse_endereco
+from .services import response_cache
+from .services import analytics_service
+from .services import export_service, import_service
+from .services import mongo_async_service, mongo_connection, inference_executor, metrics, write_behind
+from .services.batch_scheduler import GenerationScheduler
+from .services.kv_cache import KVCacheStore
+from .log_handlers import FilaHandler, TraceIdFilter
 
 # --- Testes Unitários para o Serviço MongoDB ---
 
@@ -33,6 +60,9 @@ class TestMongoService(TestCase):
         mongo_service.client = self.mock_client
         mongo_service.db = self.mock_client[mongo_service.settings.MONGO_DB_NAME]
         mongo_service.chats_collection = mongo_service.db["chats"]
+        mongo_service.buckets_collection = None
+        mongo_service.analytics_cache_collection = None
+        mongo_service._indice_texto_disponivel = None
 
 
     def tearDown(self):
@@ -59,14 +89,1006 @@ class TestMongoService(TestCase):
         self.assertEqual(chat_criado['title'], "Teste de Chat")
         self.assertEqual(len(chat_criado['messages']), 0) # Deve começar sem mensagens
 
+    def test_20_turno_completo_sem_reescrever_o_chat(self, mock_connect_db):
+        """
+        Um turno = um insert/find_one_and_update para a mensagem do utilizador (que devolve o histórico)
+        + um $push da resposta já com os metadados; o documento nunca é substituído.
+        """
+        print("Executando: Teste 20 - mongo_service.registrar_mensagem_utilizador / registrar_resposta_assistente")
+        turno = mongo_service.registrar_mensagem_utilizador(None, "Olá", title="Turnos")
+        chat_id = turno["chat_id"]
+        self.assertEqual([m["content"] for m in turno["messages"]], ["Olá"])
+        self.assertTrue(mongo_service.registrar_resposta_assistente(chat_id, "Oi!", {"processing_time": 1.5, "cache_hit": False}))
+
+        mongo_service.update_chat_summary(chat_id, "resumo", 1)
+        with patch.object(mongo_service.chats_collection, 'replace_one') as mock_replace:
+            turno = mongo_service.registrar_mensagem_utilizador(chat_id, "Tudo bem?")
+            mock_replace.assert_not_called()
+        self.assertEqual([m["role"] for m in turno["messages"]], ["user", "assistant", "user"])
+        self.assertEqual((turno["context_summary"], turno["context_summary_upto"]), ("resumo", 1))
+
+        chat = mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(chat_id)})
+        self.assertEqual(chat["messages"][1]["processing_time"], 1.5)
+        self.assertIsNone(mongo_service.registrar_mensagem_utilizador(str(mongo_service.ObjectId()), "Órfã"))
+
+    def test_21_armazenamento_em_buckets(self, mock_connect_db):
+        """
+        Chats antigos são convertidos para buckets pelo comando migrar_mensagens; depois disso
+        as mensagens novas vão para o bucket certo e o histórico pode ser lido só pelo fim.
+        """
+        print("Executando: Teste 21 - mensagens em buckets (chat_buckets)")
+        chat_id = mongo_service.create_chat(title="Antigo")
+        for i in range(5):
+            mongo_service.add_message(chat_id, 'user' if i % 2 == 0 else 'assistant', f"m{i}")
+
+        with self.settings(MONGO_MESSAGE_STORAGE='bucketed', MONGO_BUCKET_SIZE=2):
+            call_command('migrar_mensagens', stdout=io.StringIO())
+            chat = mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(chat_id)})
+            self.assertNotIn("messages", chat)
+            self.assertEqual(chat["message_count"], 5)
+            self.assertEqual(mongo_service.buckets_collection.count_documents({"chat_id": chat["_id"]}), 3)
+
+            mongo_service.update_chat_summary(chat_id, "resumo", 4)
+            turno = mongo_service.registrar_mensagem_utilizador(chat_id, "m5")
+            self.assertEqual(turno["first_message"], 4)
+            self.assertEqual([m["content"] for m in turno["messages"]], ["m4", "m5"])
+            mongo_service.registrar_resposta_assistente(chat_id, "m6", {"processing_time": 0.5})
+
+            self.assertEqual([m["content"] for m in mongo_service.get_chat_history(chat_id, last_n=3)], ["m4", "m5", "m6"])
+            self.assertEqual(len(mongo_service.get_chat_details(chat_id)["messages"]), 7)
+            self.assertTrue(mongo_service.update_last_assistant_message_metadata(chat_id, {"processing_time": 0.7}))
+            self.assertEqual(mongo_service.get_chat_history(chat_id)[-1]["processing_time"], 0.7)
+            chats = mongo_service.get_chats_page(filters={"search_query": "m5"})["chats"]
+            self.assertEqual([c["last_message_preview"] for c in chats], ["m6..."])
+
+            self.assertTrue(mongo_service.delete_chat(chat_id))
+            self.assertEqual(mongo_service.buckets_collection.count_documents({}), 0)
+
+    def test_22_indices_e_modos_de_pesquisa(self, mock_connect_db):
+        """
+        criar_indices cria os índices em falta (e só os verifica na segunda vez); com o índice de texto
+        a pesquisa usa $text, e o modo 'substring' continua a usar regex.
+        """
+        print("Executando: Teste 22 - criar_indices e pesquisa $text / substring")
+        call_command('criar_indices', stdout=io.StringIO())
+        relatorio = mongo_service.garantir_indices()
+        self.assertEqual(relatorio["chats"], {
+            "created_at_-1__id_-1": "ok", "last_message_at_-1__id_-1": "ok", "message_count_-1__id_-1": "ok", "busca_texto": "ok"
+        })
+        self.assertIn("busca_texto", mongo_service.chats_collection.index_information())
+
+        with patch.object(mongo_service, 'get_buckets_collection', MagicMock(return_value=None)):
+            self.assertEqual(
+                mongo_service._build_mongo_query({'search_query': 'python'}),
+                {'$text': {'$search': 'python'}}
+            )
+            query = mongo_service._build_mongo_query({'search_query': 'pyth', 'search_mode': 'substring'})
+        self.assertNotIn('$text', query)
+        self.assertEqual(query['$or'][0]['title'].pattern, 'pyth')
+
+    def test_40_pesquisa_so_le_buckets_se_existirem(self, mock_connect_db):
+        """
+        Sem chats em buckets, a pesquisa não percorre a coleção dos buckets; com eles, os chats
+        correspondentes vêm de uma agregação limitada a MONGO_SEARCH_MAX_BUCKET_CHATS.
+        """
+        print("Executando: Teste 40 - pesquisa nos buckets só quando existem")
+        buckets = mongo_service.get_buckets_collection()
+        filtros = {'search_query': 'pyth', 'search_mode': 'substring'}
+        with patch.object(buckets, 'aggregate', wraps=buckets.aggregate) as mock_aggregate:
+            self.assertEqual(len(mongo_service._build_mongo_query(filtros)['$or']), 2)
+            mock_aggregate.assert_not_called()
+
+            chats = [mongo_service.ObjectId() for _ in range(3)]
+            buckets.insert_many([{"chat_id": c, "seq": 0, "messages": [{"content": "Python"}]} for c in chats])
+            with self.settings(MONGO_SEARCH_MAX_BUCKET_CHATS=2):
+                query = mongo_service._build_mongo_query(filtros)
+            mock_aggregate.assert_called_once()
+        self.assertEqual(len(query['$or'][2]['_id']['$in']), 2)
+        self.assertLessEqual(set(query['$or'][2]['_id']['$in']), set(chats))
+
+    def test_44_indice_de_texto_com_outro_nome(self, mock_connect_db):
+        """ Qualquer índice de texto ativa a pesquisa por palavras, nos caminhos síncrono e assíncrono. """
+        print("Executando: Teste 44 - índice de texto com outro nome")
+        from .benchmarking.mongomock_assincrono import BaseMongomockAssincrona
+        mongo_service.chats_collection.create_index([("title", "text")], name="pesquisa")
+        self.assertTrue(mongo_service._tem_indice_texto())
+        with patch.object(mongo_async_service, 'get_db', MagicMock(return_value=BaseMongomockAssincrona(mongo_service.db))), \
+                patch.object(mongo_async_service, '_indice_texto_disponivel', None):
+            self.assertTrue(async_to_sync(mongo_async_service._tem_indice_texto)())
+
+    def test_23_paginacao_por_cursor(self, mock_connect_db):
+        """
+        Percorrer a listagem com next_cursor devolve todos os chats uma só vez, pela ordem (created_at, _id),
+        mesmo com datas repetidas; prev_cursor volta à página anterior.
+        """
+        print("Executando: Teste 23 - paginação por cursor (keyset)")
+        base = datetime(2024, 1, 1)
+        mongo_service.chats_collection.insert_many([
+            {"title": f"c{i}", "created_at": base + timedelta(minutes=i // 3), "messages": []} for i in range(11)
+        ])
+        esperado = [str(c["_id"]) for c in mongo_service.chats_collection.find().sort([("created_at", -1), ("_id", -1)])]
+
+        paginas, cursor = [], None
+        while True:
+            pagina = mongo_service.get_chats_page(per_page=4, cursor=cursor)
+            paginas.append(pagina)
+            cursor = pagina["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual([c["chat_id"] for p in paginas for c in p["chats"]], esperado)
+        self.assertEqual([len(p["chats"]) for p in paginas], [4, 4, 3])
+        self.assertIsNone(paginas[0]["prev_cursor"])
+
+        anterior = mongo_service.get_chats_page(per_page=4, cursor=paginas[2]["prev_cursor"], direction="prev")
+        self.assertEqual(anterior["chats"], paginas[1]["chats"])
+        primeira = mongo_service.get_chats_page(per_page=4, cursor=anterior["prev_cursor"], direction="prev")
+        self.assertEqual(primeira["chats"], paginas[0]["chats"])
+        self.assertIsNone(primeira["prev_cursor"])
+
+        # Token inválido = primeira página
+        self.assertEqual(mongo_service.get_chats_page(per_page=4, cursor="lixo")["chats"], paginas[0]["chats"])
+        with self.settings(MONGO_COUNT_LIMIT=5):
+            self.assertEqual(mongo_service.contar_chats({"date_from": "2024-01-01"}), (5, True))
+
+    def test_33_campos_de_resumo_e_ordenacao_por_atividade(self, mock_connect_db):
+        """
+        Os campos de resumo do chat são mantidos a cada escrita (embedded e buckets), preencher_resumos
+        recalcula-os nos chats antigos, e a listagem ordena por última atividade sem projetar as mensagens.
+        """
+        print("Executando: Teste 33 - campos de resumo do chat e ordenação por atividade")
+        antigo = mongo_service.chats_collection.insert_one({
+            "title": "Antigo", "created_at": datetime(2024, 1, 1), "messages": [
+                {"role": "user", "content": "olá", "timestamp": datetime(2024, 1, 1, 0, 1)},
+                {"role": "assistant", "content": "resposta antiga", "timestamp": datetime(2024, 1, 1, 0, 2), "processing_time": 2.0, "tokens": 5},
+            ]
+        }).inserted_id
+        novo = mongo_service.registrar_mensagem_utilizador(None, "primeira")["chat_id"]
+        mongo_service.registrar_resposta_assistente(novo, "segunda", {"processing_time": 1.5, "tokens": 3})
+        self.assertTrue(mongo_service.update_last_assistant_message_metadata(novo, {"processing_time": 0.5}))
+        chat = mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(novo)})
+        self.assertEqual((chat["message_count"], chat["total_processing_time"], chat["total_tokens"]), (2, 0.5, 3))
+        self.assertEqual((chat["last_message_preview"], chat["last_message_role"]), ("segunda", "assistant"))
+
+        with self.settings(MONGO_MESSAGE_STORAGE='bucketed'):
+            em_buckets = mongo_service.registrar_mensagem_utilizador(None, "em buckets")["chat_id"]
+            mongo_service.registrar_resposta_assistente(em_buckets, "x" * 300, {"processing_time": 1.0, "tokens": 7})
+        chat = mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(em_buckets)})
+        self.assertEqual((chat["message_count"], chat["total_tokens"], len(chat["last_message_preview"])), (2, 7, mongo_service.TAMANHO_PREVIA))
+
+        call_command('preencher_resumos', stdout=io.StringIO())
+        chat = mongo_service.chats_collection.find_one({"_id": antigo})
+        self.assertEqual((chat["message_count"], chat["total_processing_time"], chat["total_tokens"]), (2, 2.0, 5))
+        self.assertEqual(chat["last_message_at"], datetime(2024, 1, 1, 0, 2))
+
+        # O chat antigo foi criado primeiro mas tem a atividade mais antiga; o chat novo volta ao topo com uma mensagem
+        mongo_service.add_message(novo, 'user', "de volta")
+        with patch.object(mongo_service.chats_collection, 'find', wraps=mongo_service.chats_collection.find) as mock_find:
+            primeira = mongo_service.get_chats_page(per_page=2, sort="activity")
+        self.assertNotIn("messages", mock_find.call_args.args[1])
+        self.assertEqual([c["chat_id"] for c in primeira["chats"]], [novo, em_buckets])
+        self.assertEqual(primeira["chats"][0]["message_count"], 3)
+        segunda = mongo_service.get_chats_page(per_page=2, cursor=primeira["next_cursor"], sort="activity")
+        self.assertEqual([c["chat_id"] for c in segunda["chats"]], [str(antigo)])
+        # Um cursor de outra ordenação é ignorado (primeira página)
+        self.assertEqual(mongo_service.get_chats_page(per_page=2, cursor=primeira["next_cursor"])["chats"][0]["chat_id"], em_buckets)
+        self.assertEqual([c["chat_id"] for c in mongo_service.get_chats_page(filters={"min_messages": 3})["chats"]], [novo])
+
+        # Chats ainda sem campos de resumo (antes de preencher_resumos) ficam no fim dessas ordenações, em todas as páginas
+        sem_resumo = [str(i) for i in mongo_service.chats_collection.insert_many(
+            [{"title": f"sem resumo {i}", "created_at": datetime(2023, 1, 1), "messages": []} for i in range(3)]).inserted_ids]
+        for ordenacao in ("activity", "messages"):
+            paginas, cursor = [], None
+            while True:
+                pagina = mongo_service.get_chats_page(per_page=2, cursor=cursor, sort=ordenacao)
+                paginas.append([c["chat_id"] for c in pagina["chats"]])
+                if not (cursor := pagina["next_cursor"]):
+                    break
+            vistos = [chat_id for p in paginas for chat_id in p]
+            self.assertEqual(len(vistos), 6, ordenacao)
+            self.assertEqual(set(vistos[3:]), set(sem_resumo))
+            anterior = mongo_service.get_chats_page(per_page=2, cursor=pagina["prev_cursor"], direction="prev", sort=ordenacao)
+            self.assertEqual([c["chat_id"] for c in anterior["chats"]], paginas[-2])
+
+    def test_34_importacao_em_lote_dos_formatos_da_exportacao(self, mock_connect_db):
+        """
+        Um histórico exportado em JSON, NDJSON ou CSV volta a ser importado igual (em lotes, com os campos
+        de resumo); importar outra vez não duplica chats, e a API aceita o corpo comprimido com gzip.
+        """
+        print("Executando: Teste 34 - importação em lote (JSON, NDJSON, CSV)")
+        for i in range(5):
+            chat_id = mongo_service.registrar_mensagem_utilizador(None, f"pergunta {i};\ncom \"aspas\"")["chat_id"]
+            mongo_service.registrar_resposta_assistente(chat_id, f"resposta {i}", {"processing_time": 1.25, "tokens": 4})
+        mongo_service.create_chat(title="Vazio")
+        original = {c["_id"]: c for c in mongo_service.iterar_chats_para_exportacao()}
+        geradores = {"json": export_service.gerar_json, "ndjson": export_service.gerar_ndjson, "csv": export_service.gerar_csv}
+        campos = ("title", "created_at", "model_name")
+
+        for formato, gerar in geradores.items():
+            ficheiro = io.BytesIO("".join(gerar(list(original.values()))).encode("utf-8"))
+            mongo_service.chats_collection.delete_many({})
+            resultado = import_service.importar_de(ficheiro, formato, tamanho_lote=4)
+            self.assertEqual((resultado["chats"], resultado["batches"], resultado["messages"]), (6, 2, 10), formato)
+            importado = {c["_id"]: c for c in mongo_service.iterar_chats_para_exportacao()}
+            self.assertEqual(importado.keys(), original.keys())
+            for chat_id, chat in original.items():
+                self.assertEqual([importado[chat_id][c] for c in campos], [chat[c] for c in campos], formato)
+                self.assertEqual(
+                    [(m["role"], m["content"], m["timestamp"], m.get("processing_time")) for m in importado[chat_id]["messages"]],
+                    [(m["role"], m["content"], m["timestamp"], m.get("processing_time")) for m in chat["messages"]], formato
+                )
+        self.assertEqual(mongo_service.get_chats_page(sort="messages")["chats"][0]["total_processing_time"], 1.25)
+
+        # Reimportar pela API: os chats que já existem são ignorados, os inválidos contados
+        corpo = "".join(export_service.gerar_ndjson(list(original.values()))) + '"nao e um chat"\n'
+        url = reverse('chat:importar_historico', args=['ndjson']) + '?batch_size=3'
+        with self.settings(IMPORT_API_TOKEN='segredo'):
+            self.assertEqual(Client().post(url + '&on_duplicate=replace', data=corpo, content_type='application/x-ndjson').status_code, 403)
+            self.assertEqual(Client().post(url, data=corpo, content_type='application/x-ndjson', HTTP_AUTHORIZATION='Bearer outro').status_code, 403)
+            resposta = Client().post(
+                url, data=gzip.compress(corpo.encode("utf-8")), content_type='application/x-ndjson',
+                HTTP_CONTENT_ENCODING='gzip', HTTP_AUTHORIZATION='Bearer segredo'
+            )
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual({k: resposta.json()[k] for k in ("chats", "duplicates", "invalid")}, {"chats": 0, "duplicates": 6, "invalid": 1})
+        self.assertEqual(mongo_service.chats_collection.count_documents({}), 6)
+        with self.assertRaises(ValueError):
+            import_service.importar_de(io.BytesIO(b'[{"title": "cortado"'), "json")
+        with self.assertRaises(ValueError):
+            list(import_service.ler_json(io.BytesIO(b'[{"title": "completo"}, ')))
+        # Um erro a meio do corpo falha logo, sem ler (e acumular) o resto do upload
+        fonte = io.BytesIO(b'[{"title": "a"}, {"title": x}, ' + b'{"title": "c"}, ' * 10000 + b']')
+        chats = import_service.ler_json(fonte)
+        self.assertEqual(next(chats), {"title": "a"})
+        with self.assertRaises(ValueError):
+            next(chats)
+        self.assertEqual(fonte.tell(), 64 * 1024)
+
+    @patch('chat.services.nlp_service.modelo_pronto', MagicMock(return_value=True))
+    @patch('chat.services.nlp_service.tokenizer', None)
+    @patch('chat.services.nlp_service._montar_prompt', MagicMock(side_effect=lambda mensagens: " ".join(m["content"] for m in mensagens)))
+    @patch('chat.services.nlp_service.contar_tokens', MagicMock(side_effect=lambda texto: len(texto.split())))
+    def test_35_geracao_em_lote_com_checkpoint(self, mock_connect_db):
+        """
+        gerar_em_lote gera os pedidos em lotes ordenados por tamanho e escreve-os no JSONL de saída;
+        depois de uma interrupção, --retomar só gera os que faltam (e não duplica os chats no MongoDB).
+        """
+        print("Executando: Teste 35 - geração em lote offline (gerar_em_lote)")
+        def gerar_lote(textos, max_new_tokens=None):
+            return [{"texto": f"resposta a {t}", "tokens_prompt": len(t.split()), "tokens_gerados": 3} for t in textos]
+
+        with tempfile.TemporaryDirectory() as pasta:
+            entrada, saida = f"{pasta}/prompts.jsonl", f"{pasta}/saida.jsonl"
+            with open(entrada, "w", encoding="utf-8") as ficheiro:
+                for i, tamanho in enumerate([1, 5, 3, 4, 2]):
+                    ficheiro.write(json.dumps({"id": f"p{i}", "prompt": " ".join(["palavra"] * tamanho), "expected": i}) + "\n")
+                ficheiro.write(json.dumps({"messages": [{"role": "user", "content": "a b c d e f"}, {"role": "assistant", "content": "ok"},
+                                                        {"role": "user", "content": "mais"}]}) + "\n")
+
+            with patch('chat.services.nlp_service._gerar_lote', MagicMock(side_effect=gerar_lote)) as mock_lote:
+                call_command('gerar_em_lote', entrada, saida, lote=2, mongo=True, stdout=io.StringIO())
+            self.assertEqual([len(c.args[0]) for c in mock_lote.call_args_list], [2, 2, 2])
+            self.assertEqual([len(t.split()) for c in mock_lote.call_args_list for t in c.args[0]], [8, 5, 4, 3, 2, 1])
+            with open(saida, encoding="utf-8") as ficheiro:
+                linhas = [json.loads(linha) for linha in ficheiro]
+            self.assertEqual([l["id"] for l in linhas], ["6", "p1", "p3", "p2", "p4", "p0"])
+            self.assertEqual((linhas[1]["expected"], linhas[1]["response"], linhas[1]["batch"]), (1, "resposta a " + " ".join(["palavra"] * 5), 1))
+            self.assertEqual(mongo_service.chats_collection.count_documents({}), 6)
+
+            # Interrupção a meio do segundo lote: uma linha escrita pela metade
+            with open(saida, "w", encoding="utf-8") as ficheiro:
+                ficheiro.write("".join(json.dumps(l) + "\n" for l in linhas[:3]) + '{"id": "p2", "resp')
+            with self.assertRaises(CommandError):
+                call_command('gerar_em_lote', entrada, saida, stdout=io.StringIO())
+            with patch('chat.services.nlp_service._gerar_lote', MagicMock(side_effect=gerar_lote)) as mock_lote:
+                call_command('gerar_em_lote', entrada, saida, lote=2, mongo=True, retomar=True, stdout=io.StringIO())
+            self.assertEqual([len(t.split()) for c in mock_lote.call_args_list for t in c.args[0]], [3, 2, 1])
+            with open(saida, encoding="utf-8") as ficheiro:
+                self.assertEqual(sorted(json.loads(linha)["id"] for linha in ficheiro), ["6", "p0", "p1", "p2", "p3", "p4"])
+            self.assertEqual(mongo_service.chats_collection.count_documents({}), 6)
+
+    def test_36_ligacao_configuravel_e_disjuntor(self, mock_connect_db):
+        """
+        As opções do cliente vêm das settings (compressores sem pacote instalado são ignorados); depois de
+        MONGO_BREAKER_FAILURES falhas os pedidos falham logo, com backoff com jitter, e uma ligação bem-sucedida
+        fecha o disjuntor.
+        """
+        print("Executando: Teste 36 - opções da ligação ao MongoDB e disjuntor")
+        import_module = importlib.import_module
+        def importar(nome, *args):
+            if nome == "snappy":
+                raise ImportError(nome)
+            return import_module(nome, *args)
+
+        with override_settings(MONGO_COMPRESSORS='snappy,zlib,lz4', MONGO_MAX_POOL_SIZE=7, MONGO_WAIT_QUEUE_TIMEOUT_MS=250,
+                               MONGO_READ_PREFERENCE='secondaryPreferred'), \
+                patch('chat.services.mongo_connection.importlib.import_module', side_effect=importar):
+            opcoes = mongo_connection.opcoes_cliente()
+        self.assertEqual((opcoes["compressors"], opcoes["maxPoolSize"], opcoes["waitQueueTimeoutMS"], opcoes["readPreference"]),
+                         ("zlib", 7, 250, 'secondaryPreferred'))
+        self.assertNotIn("maxIdleTimeMS", opcoes)
+        self.assertIn(mongo_connection._ouvinte_pool, opcoes["event_listeners"])
+
+        self.addCleanup(mongo_connection.reiniciar)
+        with override_settings(MONGO_BREAKER_FAILURES=2, MONGO_RECONNECT_BASE_SECONDS=1, MONGO_RECONNECT_MAX_SECONDS=4):
+            mongo_connection.reiniciar()
+            disjuntor = mongo_connection.obter_disjuntor()
+            self.assertTrue(0.5 <= disjuntor.registar_falha("ping falhou") <= 1)
+            self.assertIsNotNone(mongo_service.get_chats_collection())
+            disjuntor.registar_falha("ping falhou")
+            self.assertIsNone(mongo_service.get_chats_collection()) # Falha logo, sem contactar o servidor
+            self.assertIsNone(mongo_service.get_buckets_collection())
+            with self.assertRaises(mongo_connection.MongoIndisponivel):
+                mongo_connection.verificar_disponivel()
+            for _ in range(5):
+                self.assertTrue(2 <= disjuntor.registar_falha("ping falhou") <= 4)
+            self.assertIn("mongo_circuit_open 1", mongo_connection.expor_metricas())
+
+            # Passado o backoff (sem verificação em segundo plano), um pedido serve de tentativa e o seguinte espera
+            disjuntor.proxima_tentativa = 0
+            self.assertIsNotNone(mongo_service.get_chats_collection())
+            self.assertIsNone(mongo_service.get_chats_collection())
+            mongo_connection._ouvinte_pool.connection_checked_out(MagicMock(duration=0.002))
+            self.assertIsNotNone(mongo_service.get_chats_collection())
+            estatisticas = mongo_connection.estatisticas()
+            self.assertEqual((estatisticas["circuit"]["state"], estatisticas["circuit"]["times_opened"]), ("closed", 1))
+            self.assertEqual(estatisticas["pool"]["connections_in_use"], 1)
+
+            # Com o disjuntor fechado, uma ligação obtida zera as falhas isoladas: não se acumulam até o abrir
+            mongo_connection._ouvinte_pool.pool_cleared(MagicMock(address=("localhost", 27017)))
+            mongo_connection._ouvinte_pool.connection_checked_out(MagicMock(duration=0.001))
+            mongo_connection._ouvinte_pool.pool_cleared(MagicMock(address=("localhost", 27017)))
+            self.assertEqual((disjuntor.estado, disjuntor.falhas), ("closed", 1))
+
+    def test_37_escrita_diferida_das_respostas(self, mock_connect_db):
+        """
+        Com MONGO_WRITE_BEHIND a resposta fica num ficheiro da fila: o detalhe e a listagem já a mostram, a mensagem
+        seguinte do utilizador espera que seja escrita, repetir a escrita não a duplica e uma falha do MongoDB
+        devolve-a à fila.
+        """
+        print("Executando: Teste 37 - escrita diferida das respostas (write-behind)")
+        original = mongomock.collection.BulkOperationBuilder.add_update
+        def add_update(builder, *args, sort=None, **kwargs): # O mongomock ainda não aceita o 'sort' do UpdateOne do pymongo 4.18
+            return original(builder, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as pasta, override_settings(MONGO_WRITE_BEHIND=True, WRITE_BEHIND_DIR=pasta), \
+                patch.object(mongomock.collection.BulkOperationBuilder, 'add_update', add_update), \
+                patch('chat.services.write_behind.iniciar'): # Sem a thread: as escritas são feitas pelo teste
+            chat_id = mongo_service.registrar_mensagem_utilizador(None, "Olá")["chat_id"]
+            self.assertTrue(mongo_service.registrar_resposta_assistente(chat_id, "Resposta 1", {"processing_time": 1.5, "tokens": 3}))
+            self.assertEqual(len(mongo_service.get_chat_history(chat_id)), 1) # Ainda não está no MongoDB
+            detalhe = mongo_service.get_chat_details(chat_id)
+            self.assertEqual([m["content"] for m in detalhe["messages"]], ["Olá", "Resposta 1"])
+            self.assertTrue(detalhe["messages"][1]["timestamp"].endswith("Z"))
+            linha = mongo_service.get_chats_page()["chats"][0]
+            self.assertEqual((linha["message_count"], linha["total_tokens"], linha["last_message_preview"]), (2, 3, "Resposta 1..."))
+
+            # Escrita pelo escritor; um reinício antes de apagar o ficheiro não duplica a mensagem
+            reservados = write_behind._reservar_lote(10)
+            with open(reservados[0], encoding="utf-8") as ficheiro:
+                conteudo = ficheiro.read()
+            write_behind._escrever_lote(reservados)
+            self.assertFalse(write_behind.tem_pendentes(chat_id))
+            os.makedirs(f"{pasta}/{chat_id}") # A pasta do chat é apagada quando fica vazia
+            with open(f"{pasta}/{chat_id}/00000000000000000001-1-000000.json", "w", encoding="utf-8") as ficheiro:
+                ficheiro.write(conteudo)
+            self.assertTrue(write_behind.escrever_chat(chat_id))
+            chat = mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(chat_id)})
+            self.assertEqual((len(chat["messages"]), chat["message_count"], chat["total_tokens"]), (2, 2, 3))
+
+            # Uma nova mensagem do utilizador só é guardada depois das respostas que estão na fila
+            mongo_service.registrar_resposta_assistente(chat_id, "Resposta 2")
+            turno = mongo_service.registrar_mensagem_utilizador(chat_id, "E agora?")
+            self.assertEqual([m["content"] for m in turno["messages"]], ["Olá", "Resposta 1", "Resposta 2", "E agora?"])
+
+            # MongoDB indisponível: a resposta volta à fila e a mensagem seguinte não passa à frente dela
+            mongo_service.registrar_resposta_assistente(chat_id, "Resposta 3")
+            with patch('chat.services.mongo_service.get_chats_collection', return_value=None):
+                self.assertFalse(write_behind.escrever_chat(chat_id))
+            self.assertTrue(all(nome.endswith(".json") for nome in os.listdir(f"{pasta}/{chat_id}")))
+            self.assertTrue(write_behind.escrever_chat(chat_id))
+            self.assertEqual(mongo_service.chats_collection.find_one({"_id": mongo_service.ObjectId(chat_id)})["last_message_preview"], "Resposta 3")
+
+            # Respostas de um chat apagado entretanto são descartadas
+            write_behind.enfileirar(str(mongo_service.ObjectId()), {"role": "assistant", "content": "x", "timestamp": datetime.now()})
+            write_behind._escrever_lote(write_behind._reservar_lote(10))
+            self.assertEqual(write_behind.estatisticas()["pending"], 0)
+
+    def test_26_estatisticas_do_historico(self, mock_connect_db):
+        """
+        As estatísticas juntam chats em array e em buckets por dia e modelo (percentis do processing_time,
+        tokens); os dias fechados ficam em cache e só o dia atual volta a ser agregado, exceto com filtros que
+        dependem das mensagens (pesquisa, mínimo de mensagens).
+        """
+        print("Executando: Teste 26 - analytics_service.analisar_historico")
+        def mensagens(dia, tempos):
+            resultado = []
+            for i, tempo in enumerate(tempos):
+                resultado.append({"role": "user", "content": f"pergunta {i}", "timestamp": dia})
+                resultado.append({"role": "assistant", "content": "resposta", "timestamp": dia, "processing_time": tempo, "tokens": 10})
+            return resultado
+        dia1, dia2 = datetime(2024, 1, 1, 12), datetime(2024, 1, 2, 12)
+        mongo_service.chats_collection.insert_many([
+            {"title": "python a", "model_name": "qwen", "created_at": dia1, "messages": mensagens(dia1, [1.0, 2.0, 3.0])},
+            {"title": "outro", "model_name": "llama", "created_at": dia2, "messages": mensagens(dia2, [4.0])},
+        ])
+        with self.settings(MONGO_MESSAGE_STORAGE='bucketed'):
+            chat_id = mongo_service.create_chat(title="python b")
+        mongo_service.chats_collection.update_one({"_id": mongo_service.ObjectId(chat_id)}, {"$set": {"created_at": dia2, "model_name": "qwen"}})
+        mongo_service.get_buckets_collection().insert_one({"chat_id": mongo_service.ObjectId(chat_id), "seq": 0, "messages": mensagens(dia2, [5.0])})
+
+        analise = analytics_service.analisar_historico()
+        self.assertEqual(analise["totals"]["chats"], 3)
+        self.assertEqual(analise["totals"]["messages"], 10)
+        self.assertEqual(analise["totals"]["tokens"], 50)
+        self.assertEqual(analise["totals"]["processing_time"], {"count": 5, "avg": 3.0, "p50": 3.0, "p95": 5.0, "p99": 5.0})
+        self.assertEqual([(d["date"], d["chats"], d["assistant_messages"]) for d in analise["days"]],
+                         [("2024-01-01", 1, 3), ("2024-01-02", 2, 2)])
+        self.assertEqual({m["model_name"]: m["processing_time"]["p50"] for m in analise["models"]}, {"llama": 4.0, "qwen": 2.0})
+        self.assertEqual(analise["cache"], {"days_cached": 0, "days_computed": 2})
+
+        # Segundo pedido: os dias fechados vêm da cache, só as mensagens novas são agregadas
+        agora = datetime.utcnow()
+        mongo_service.chats_collection.insert_one({"title": "hoje", "model_name": "qwen", "created_at": agora, "messages": mensagens(agora, [0.5])})
+        analise = analytics_service.analisar_historico()
+        self.assertEqual(analise["cache"], {"days_cached": 2, "days_computed": 1})
+        self.assertEqual((analise["totals"]["chats"], analise["totals"]["processing_time"]["count"]), (4, 6))
+
+        # Os filtros são os da listagem
+        analise = analytics_service.analisar_historico({"search_query": "python", "search_mode": "substring"})
+        self.assertEqual((analise["totals"]["chats"], analise["totals"]["assistant_messages"]), (2, 4))
+
+        # A pesquisa não usa a cache: um chat de um dia fechado que passa a corresponder conta nos seus dias antigos
+        filtro = {"search_query": "javascript", "search_mode": "substring"}
+        self.assertEqual(analytics_service.analisar_historico(filtro)["totals"]["messages"], 0)
+        mongo_service.chats_collection.update_one({"title": "outro"}, {"$push": {"messages": {"role": "user", "content": "e javascript?", "timestamp": agora}}})
+        analise = analytics_service.analisar_historico(filtro)
+        self.assertEqual((analise["totals"]["chats"], analise["totals"]["messages"]), (1, 3))
+        self.assertEqual(analise["cache"]["days_cached"], 0)
+        mongo_service.chats_collection.update_one({"title": "outro"}, {"$pop": {"messages": 1}})
+
+        # Uma resposta diferida com a data de um dia fechado muda a geração da cache (em todos os processos)
+        outro = mongo_service.chats_collection.find_one({"title": "outro"})
+        with patch.object(mongo_service.chats_collection, 'bulk_write',
+                          side_effect=lambda operacoes, ordered: [mongo_service.chats_collection.update_one(o._filter, o._doc) for o in operacoes]):
+            mongo_service.acrescentar_mensagens_em_lote([(str(outro["_id"]), {"role": "assistant", "content": "tardia", "timestamp": dia2, "processing_time": 6.0})])
+        self.assertEqual(mongo_service.geracao_cache_analise(mongo_service.get_analytics_cache_collection()), 1)
+        analise = analytics_service.analisar_historico()
+        self.assertEqual(analise["cache"], {"days_cached": 0, "days_computed": 3})
+        self.assertEqual(analise["totals"]["processing_time"]["count"], 7)
+
+
+# --- Testes da Janela de Contexto (orçamento de tokens + resumo) ---
+
+@patch('chat.services.nlp_service.is_model_loaded', True)
+@patch('chat.services.nlp_service.contar_tokens', MagicMock(side_effect=lambda texto: len(texto.split())))
+class TestContextService(TestCase):
+
+    def setUp(self):
+        self.mock_client = mongomock.MongoClient()
+        mongo_service.client = self.mock_client
+        mongo_service.db = self.mock_client[mongo_service.settings.MONGO_DB_NAME]
+        mongo_service.chats_collection = mongo_service.db["chats"]
+        mongo_service.buckets_collection = None
+        mongo_service._indice_texto_disponivel = None
+
+    def tearDown(self):
+        self.mock_client.drop_database(mongo_service.settings.MONGO_DB_NAME)
+
+    def _historico(self, n):
+        # Cada mensagem custa 10 palavras + TOKENS_POR_MENSAGEM
+        return [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join([f"m{i}"] * 10)}
+            for i in range(n)
+        ]
+
+    def test_10_historico_curto_passa_inteiro(self):
+        """ Se a conversa cabe no orçamento, é enviada inteira e sem resumo. """
+        print("Executando: Teste 10 - context_service sem corte")
+        history = self._historico(4)
+        with self.settings(NLP_CONTEXT_TOKEN_BUDGET=1000):
+            janela, resumo = context_service.construir_contexto("qualquer", history)
+        self.assertEqual(janela, history)
+        self.assertIsNone(resumo)
+
+    @patch('chat.services.nlp_service.resumir_conversa', MagicMock(return_value="resumo das antigas"))
+    def test_11_historico_longo_e_resumido(self):
+        """
+        Acima do orçamento, as mensagens antigas vão para um resumo guardado no chat
+        e a janela mantém apenas os turnos recentes.
+        """
+        print("Executando: Teste 11 - context_service resume mensagens antigas")
+        chat_id = mongo_service.create_chat(title="Longo")
+        history = self._historico(20)
+        with self.settings(NLP_CONTEXT_TOKEN_BUDGET=150, NLP_CONTEXT_SUMMARY_MAX_TOKENS=20, NLP_CONTEXT_TRIM_RATIO=0.5):
+            janela, resumo = context_service.construir_contexto(chat_id, history)
+
+            self.assertEqual(resumo, "resumo das antigas")
+            self.assertEqual(janela[-1], history[-1])
+            self.assertEqual(janela[0]["role"], "user")
+            self.assertLess(len(janela), len(history))
+
+            resumo_guardado, resumidas = mongo_service.get_chat_summary(chat_id)
+            self.assertEqual(resumo_guardado, "resumo das antigas")
+            self.assertEqual(history[resumidas:], janela)
+
+            # No turno seguinte o resumo guardado é reutilizado sem gerar outro
+            nlp_resumir = context_service.nlp_service.resumir_conversa
+            nlp_resumir.reset_mock()
+            history += self._historico(2)
+            janela2, resumo2 = context_service.construir_contexto(chat_id, history)
+            nlp_resumir.assert_not_called()
+            self.assertEqual(resumo2, "resumo das antigas")
+            self.assertEqual(janela2, history[resumidas:])
+
+    def test_41_falha_do_resumo_nao_avanca_o_resumo_guardado(self):
+        """ Se o resumo falhar, a janela é cortada na mesma mas nada é guardado: o turno seguinte volta a tentar. """
+        print("Executando: Teste 41 - context_service com falha no resumo")
+        chat_id = mongo_service.create_chat(title="Longo")
+        history = self._historico(20)
+        with self.settings(NLP_CONTEXT_TOKEN_BUDGET=150, NLP_CONTEXT_SUMMARY_MAX_TOKENS=20, NLP_CONTEXT_TRIM_RATIO=0.5):
+            with patch.object(nlp_service, 'resumir_conversa', MagicMock(side_effect=RuntimeError("modelo ocupado"))):
+                janela, resumo = context_service.construir_contexto(chat_id, history)
+            self.assertIsNone(resumo)
+            self.assertLess(len(janela), len(history))
+            self.assertEqual(mongo_service.get_chat_summary(chat_id), (None, 0))
+
+            with patch.object(nlp_service, 'resumir_conversa', MagicMock(return_value="resumo")) as mock_resumir:
+                janela, resumo = context_service.construir_contexto(chat_id, history)
+            self.assertEqual(mock_resumir.call_args.args[1][0], history[0])
+            self.assertEqual(mongo_service.get_chat_summary(chat_id)[0], "resumo")
+
+
+# --- Testes do Scheduler de Micro-batching ---
+
+class TestGenerationScheduler(TestCase):
+
+    def test_06_agrupa_pedidos_concorrentes(self):
+        """
+        Pedidos que chegam dentro da janela de espera são processados num único lote
+        e cada chamador recebe o seu próprio resultado.
+        """
+        print("Executando: Teste 6 - GenerationScheduler agrupa pedidos")
+        lotes = []
+        pode_processar = threading.Event()
+
+        def processar_lote(itens):
+            pode_processar.wait(5)
+            lotes.append(list(itens))
+            return [item.upper() for item in itens]
+
+        scheduler = GenerationScheduler(processar_lote, max_batch_size=3, max_wait_ms=500)
+        try:
+            futures = [scheduler.submeter(texto) for texto in ["a", "b", "c", "d"]]
+            pode_processar.set()
+            resultados = [f.result(timeout=5) for f in futures]
+        finally:
+            scheduler.parar()
+
+        self.assertEqual(resultados, ["A", "B", "C", "D"])
+        self.assertEqual([len(lote) for lote in lotes], [3, 1])
+
+        stats = scheduler.estatisticas()
+        self.assertEqual(stats['total_requests'], 4)
+        self.assertEqual(stats['total_batches'], 2)
+        self.assertEqual(stats['largest_batch'], 3)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_07_erro_no_lote_chega_a_todos_os_chamadores(self):
+        """ Uma exceção em processar_lote é propagada para o Future de cada pedido do lote. """
+        print("Executando: Teste 7 - GenerationScheduler propaga erros")
+
+        def processar_lote(itens):
+            raise ValueError("falha simulada")
+
+        scheduler = GenerationScheduler(processar_lote, max_batch_size=2, max_wait_ms=1)
+        try:
+            future = scheduler.submeter("x")
+            with self.assertRaises(ValueError):
+                future.result(timeout=5)
+        finally:
+            scheduler.parar()
+
+    @patch('chat.services.nlp_service.is_model_loaded', True)
+    @patch('chat.services.nlp_service.tokenizer', MagicMock())
+    @patch('chat.services.nlp_service.model', MagicMock())
+    @patch('chat.services.nlp_service._montar_prompt', MagicMock(return_value="prompt"))
+    def test_38_cache_kv_passa_pelo_scheduler(self):
+        """
+        Os turnos da cache KV e os embeddings correm na thread do scheduler, depois dos prompts agrupados do mesmo lote;
+        o erro de uma geração individual só chega ao pedido dela.
+        """
+        print("Executando: Teste 38 - geração individual serializada no scheduler")
+        threads = []
+        def gerar_kv(chat_id, text, kv_cache, **kwargs):
+            threads.append(threading.current_thread().name)
+            return {"texto": "resposta kv", "tokens_gerados": 2}
+        def gerar_lote(textos, max_new_tokens=None):
+            return [{"texto": t.upper()} for t in textos]
+
+        with self.settings(NLP_BATCH_ENABLED=True, NLP_KV_CACHE_ENABLED=True), \
+                patch.object(nlp_service, '_gerar_com_cache_kv', side_effect=gerar_kv), \
+                patch.object(nlp_service, '_gerar_lote', side_effect=gerar_lote):
+            resposta = nlp_service.gerar_resposta_com_contexto([{"role": "user", "content": "Olá"}], chat_id="chat1")
+
+            # O embedding da cache semântica também faz um forward pass: corre na mesma thread
+            def base_model(**kwargs):
+                threads.append(threading.current_thread().name)
+                return SimpleNamespace(last_hidden_state=torch.ones(1, 3, 4))
+            nlp_service.model.base_model.side_effect = base_model
+            embedding = nlp_service.calcular_embedding("Olá")
+
+            ordem = []
+            def individual(resultado):
+                ordem.append(resultado)
+                if isinstance(resultado, Exception):
+                    raise resultado
+                return resultado
+            resultados = nlp_service._processar_lote([
+                nlp_service._GeracaoIndividual(lambda: individual("x")), "a",
+                nlp_service._GeracaoIndividual(lambda: individual(ValueError("falha"))), "b",
+            ])
+
+        self.assertEqual(resposta, "resposta kv")
+        self.assertEqual(threads, ["generation-scheduler", "generation-scheduler"])
+        self.assertAlmostEqual(float(embedding.norm()), 1.0, places=5)
+        self.assertEqual(resultados[0], "x")
+        self.assertEqual([resultados[1], resultados[3]], [{"texto": "A"}, {"texto": "B"}])
+        self.assertIsInstance(resultados[2], ValueError)
+        self.assertEqual(len(ordem), 2)
+
+
+# --- Testes do Logging em Fila ---
+
+class TestLogging(TestCase):
+
+    def test_29_handler_em_fila(self):
+        """
+        O FilaHandler escreve pela thread do listener, só formata os registos que passam o nível,
+        inclui o ID de trace e descarta (sem bloquear) quando a fila está cheia.
+        """
+        print("Executando: Teste 29 - logging em fila (FilaHandler)")
+        formatados = []
+
+        class Argumento:
+            def __str__(self):
+                formatados.append(self)
+                return "arg"
+
+        saida = io.StringIO()
+        handler = FilaHandler(stream=saida)
+        handler.setFormatter(logging.Formatter("%(levelname)s [%(trace_id)s] %(message)s"))
+        handler.addFilter(TraceIdFilter())
+        logger = logging.getLogger("chat.tests.fila")
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        try:
+            logger.debug("sucesso %s", Argumento())
+            token = metrics.trace_id.set("pedido-1")
+            try:
+                logger.warning("aviso %s", Argumento())
+            finally:
+                metrics.trace_id.reset(token)
+        finally:
+            logger.removeHandler(handler)
+            handler.close() # Pára o listener depois de escrever o que está na fila
+        self.assertEqual(saida.getvalue(), "WARNING [pedido-1] aviso arg\n")
+        self.assertEqual(len(formatados), 1)
+
+        cheio = FilaHandler(stream=io.StringIO(), capacidade=1)
+        cheio.listener.stop() # Ninguém consome: a fila enche
+        cheio.listener = None
+        registo = logging.LogRecord("x", logging.INFO, __file__, 1, "m", None, None)
+        for _ in range(3):
+            cheio.handle(registo)
+        self.assertEqual(cheio.descartados, 2)
+        cheio.close()
+
+
+# --- Testes da Cache KV por Chat ---
+
+class _CacheFalso:
+    """ Imita um DynamicCache: uma camada com tensores de keys/values de n posições. """
+    def __init__(self, n):
+        self.layers = [SimpleNamespace(keys=torch.zeros(1, 1, n, 4), values=torch.zeros(1, 1, n, 4))]
+
+    def get_seq_length(self):
+        return self.layers[0].keys.shape[2]
+
+    def crop(self, n):
+        camada = self.layers[0]
+        camada.keys, camada.values = camada.keys[:, :, :n], camada.values[:, :, :n]
+
+
+class TestKVCacheStore(TestCase):
+
+    def test_08_reutiliza_prefixo_comum(self):
+        """ Um prompt que continua a conversa reaproveita os tokens em cache (cortados ao prefixo comum). """
+        print("Executando: Teste 8 - KVCacheStore reutiliza o prefixo")
+        store = KVCacheStore(max_bytes=10 ** 6, idle_seconds=60)
+        store.guardar("chat1", [1, 2, 3, 4, 5], _CacheFalso(5))
+        self.assertEqual(store.estatisticas()['bytes'], 2 * 5 * 4 * 4)
+
+        cache, reutilizados = store.obter("chat1", [1, 2, 3, 9, 9, 9])
+        self.assertEqual(reutilizados, 3)
+        self.assertEqual(cache.get_seq_length(), 3)
+
+        # A entrada foi entregue ao chamador: outro pedido para o mesmo chat é um miss
+        self.assertEqual(store.obter("chat1", [1, 2, 3]), (None, 0))
+        stats = store.estatisticas()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 0))
+
+    def test_09_respeita_orcamento_de_memoria(self):
+        """ Ao ultrapassar o orçamento, as entradas menos usadas recentemente são descartadas. """
+        print("Executando: Teste 9 - KVCacheStore respeita o orçamento")
+        tamanho = 2 * 10 * 4 * 4  # bytes de um _CacheFalso(10)
+        store = KVCacheStore(max_bytes=2 * tamanho, idle_seconds=60)
+        for chat_id in ["a", "b", "c"]:
+            store.guardar(chat_id, list(range(10)), _CacheFalso(10))
+
+        stats = store.estatisticas()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 2 * tamanho)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(store.obter("a", list(range(12))), (None, 0))
+
+
+# --- Testes do Servidor de Inferência Dedicado ---
+
+class TestInferenceServer(TestCase):
+
+    def test_13_encaminhamento_por_chat(self):
+        """ Pedidos do mesmo chat vão para a mesma réplica (para aproveitar a cache KV dela). """
+        print("Executando: Teste 13 - InferenceServer encaminha por chat_id")
+        self.assertEqual(parse_endereco("127.0.0.1:8765"), ("127.0.0.1", 8765))
+        self.assertEqual(parse_endereco("/tmp/inferencia.sock"), "/tmp/inferencia.sock")
+
+        servidor = InferenceServer("127.0.0.1:0", b"chave", replicas=3)
+        self.assertEqual(
+            {servidor._escolher_replica("chat-abc") for _ in range(5)},
+            {servidor._escolher_replica("chat-abc")}
+        )
+        self.assertEqual({servidor._escolher_replica(None) for _ in range(3)}, {0, 1, 2})
+
+        # A réplica carrega o modelo com o backend local sem mexer nas settings do processo
+        from django.conf import settings
+        from .services import inference_server
+        pedidos, resultados = queue.Queue(), queue.Queue()
+        pedidos.put(None)
+        with patch('django.setup'), patch('torch.set_num_threads'), \
+                patch.object(nlp_service, 'iniciar_carregamento') as mock_iniciar, \
+                patch.object(nlp_service, 'modelo_pronto', MagicMock(side_effect=[False, True])), \
+                patch.object(nlp_service, 'estado_modelo', MagicMock(return_value={"status": "loading"})), \
+                self.settings(NLP_INFERENCE_BACKEND='remote'):
+            inference_server._replica_main(0, pedidos, resultados, 1, 1)
+            self.assertEqual(settings.NLP_INFERENCE_BACKEND, 'remote')
+        mock_iniciar.assert_called_once_with(backend="local")
+        self.assertEqual(resultados.qsize(), 2) # Estado 'loading' e o estado depois do carregamento
+
+    def test_39_replicas_mortas_nao_bloqueiam_pedidos(self):
+        """
+        Réplicas mortas ou que falharam o carregamento são saltadas no encaminhamento; um pedido
+        cuja réplica morre ou deixa de responder recebe 'erro' em vez de ficar à espera para sempre.
+        """
+        print("Executando: Teste 39 - InferenceServer salta réplicas mortas")
+        servidor = InferenceServer("127.0.0.1:0", b"chave", replicas=3, timeout=0.2)
+        vivos = [MagicMock(is_alive=MagicMock(return_value=v)) for v in (True, False, True)]
+        servidor._processos = vivos
+        servidor._filas = [MagicMock() for _ in range(3)]
+        servidor._estados = {0: {"status": "failed"}}
+
+        self.assertEqual({servidor._escolher_replica(f"chat-{i}") for i in range(20)}, {2})
+        self.assertEqual({servidor._escolher_replica(None) for _ in range(3)}, {2})
+        evento, mensagem = servidor._esperar_evento(7, queue.Queue(), 1)
+        self.assertEqual(evento, "erro")
+        self.assertIn("terminou", mensagem)
+
+        evento, mensagem = servidor._esperar_evento(8, queue.Queue(), 2)
+        self.assertEqual(evento, "erro")
+        servidor._filas[2].put.assert_called_once_with((8, "cancelar", None))
+
+        vivos[2].is_alive.return_value = False
+        self.assertIsNone(servidor._escolher_replica("chat-1"))
+
+    @patch('chat.services.nlp_service.is_model_loaded', True)
+    @patch('chat.services.nlp_service.tokenizer', MagicMock())
+    @patch('chat.services.inference_client.gerar', MagicMock(return_value="resposta remota"))
+    def test_14_modo_remoto_delega_no_servidor(self):
+        """ Com NLP_INFERENCE_BACKEND='remote', a geração é feita pelo servidor de inferência. """
+        print("Executando: Teste 14 - nlp_service em modo remoto")
+        history = [{"role": "user", "content": "Olá"}]
+        with self.settings(NLP_INFERENCE_BACKEND='remote'):
+            resposta = nlp_service.gerar_resposta_com_contexto(history, chat_id="chat1")
+        self.assertEqual(resposta, "resposta remota")
+        nlp_service.inference_client.gerar.assert_called_once_with(history, chat_id="chat1", resumo=None)
+
+
+# --- Testes dos Modos de Precisão ---
+
+class TestPrecisao(TestCase):
+
+    def test_15_concordancia_com_referencia(self):
+        """ A concordância compara as saídas de um modo com as do fp32, token a token. """
+        print("Executando: Teste 15 - concordância entre modos de precisão")
+        from .benchmarking import precisao
+        from .benchmarking.precisao import concordancia
+        referencia = [[1, 2, 3, 4], [5, 6]]
+        outras = [[1, 2, 9, 4], [5, 6]]
+        resultado = concordancia(referencia, outras)
+        self.assertEqual(resultado['token_agreement'], 0.875)
+        self.assertEqual(resultado['exact_match_rate'], 0.5)
+
+        # Sem o módulo resource (Windows) o pico de memória vem do psutil ou do tracemalloc
+        with patch.object(precisao, 'resource', None):
+            tracemalloc.start()
+            try:
+                self.assertGreater(precisao.pico_rss_mb(), 0)
+            finally:
+                tracemalloc.stop()
+
+    def test_16_precisao_desconhecida(self):
+        """ Uma precisão inválida em NLP_PRECISION falha logo, antes de carregar o modelo. """
+        print("Executando: Teste 16 - precisão desconhecida")
+        with self.assertRaises(ValueError):
+            nlp_service.carregar_modelo_e_tokenizer('fp8')
+
+    def test_42_processo_de_medicao_que_morre(self):
+        """ Um processo de medição que morre sem enviar o resultado conta como modo falhado, sem bloquear o comando. """
+        print("Executando: Teste 42 - benchmark_precisao com processo morto")
+        from .management.commands.benchmark_precisao import Command
+        processo = MagicMock(exitcode=-9, is_alive=MagicMock(return_value=False))
+        resultado = Command()._esperar_resultado(queue.Queue(), processo, 'int8', timeout=60)
+        self.assertEqual(resultado['mode'], 'int8')
+        self.assertIn("-9", resultado['error'])
+        processo.join.assert_called_once()
+
+    def test_43_checkpoint_int8_so_com_pesos(self):
+        """ O checkpoint de quantizar_modelo guarda só os pesos int8 e volta a dar o mesmo modelo; um módulo serializado é recusado. """
+        print("Executando: Teste 43 - checkpoint int8 carregado com weights_only")
+        from transformers import AutoModelForCausalLM, Qwen2Config
+        config = Qwen2Config(vocab_size=64, hidden_size=16, intermediate_size=32, num_hidden_layers=1,
+                             num_attention_heads=2, num_key_value_heads=1)
+        modelo = nlp_service.quantizar_int8(AutoModelForCausalLM.from_config(config)).eval()
+        with tempfile.TemporaryDirectory() as pasta, \
+                patch.object(nlp_service.AutoConfig, 'from_pretrained', MagicMock(return_value=config)):
+            nlp_service.guardar_checkpoint_int8(modelo, f"{pasta}/int8.pt")
+            carregado = nlp_service.carregar_checkpoint_int8(f"{pasta}/int8.pt")
+            entrada = torch.tensor([[1, 2, 3]])
+            self.assertTrue(torch.equal(modelo(entrada).logits, carregado(entrada).logits))
+
+            torch.save(modelo, f"{pasta}/modulo.pt")
+            with self.assertRaises(Exception):
+                nlp_service.carregar_checkpoint_int8(f"{pasta}/modulo.pt")
+
+
+# --- Testes da Decodificação Especulativa ---
+
+class _ModeloEspeculativoFalso:
+    """ Imita o model.generate assistido: cada passo (uma chamada aos critérios de paragem) acrescenta vários tokens. """
+    def __init__(self, tokens_por_passo):
+        self.tokens_por_passo = tokens_por_passo
+        self.kwargs = None
+    def generate(self, input_ids, **kwargs):
+        self.kwargs = kwargs
+        sequencia = input_ids
+        for n in self.tokens_por_passo:
+            sequencia = torch.cat([sequencia, torch.ones((1, n), dtype=torch.long)], dim=1)
+            kwargs["stopping_criteria"](sequencia, None)
+        return sequencia
+
+class TestDecodificacaoEspeculativa(TestCase):
+
+    @patch('chat.services.nlp_service.is_model_loaded', True)
+    @patch('chat.services.nlp_service._montar_prompt', MagicMock(return_value="prompt"))
+    @patch('chat.services.nlp_service._executar_geracao', MagicMock(side_effect=AssertionError("não deve usar o micro-batching")))
+    def test_31_prompt_lookup_regista_tokens_aceites(self):
+        """
+        Com NLP_SPECULATIVE_MODE='prompt_lookup', o turno é gerado individualmente (sem scheduler nem cache KV)
+        e as estatísticas contam os tokens aceites por forward do modelo principal.
+        """
+        print("Executando: Teste 31 - decodificação especulativa (prompt lookup)")
+        tokenizer = MagicMock(return_value=SimpleNamespace(input_ids=torch.zeros((1, 3), dtype=torch.long)))
+        tokenizer.decode.return_value = "resposta especulativa"
+        modelo = _ModeloEspeculativoFalso([5, 1, 5]) # 4 + 0 + 4 tokens aceites, mais 1 do modelo em cada passo
+        zeros = {"generations": 0, "steps": 0, "tokens": 0, "proposed": 0}
+        with self.settings(NLP_SPECULATIVE_MODE='prompt_lookup', NLP_SPECULATIVE_TOKENS=4), \
+                patch.object(nlp_service, 'tokenizer', tokenizer), patch.object(nlp_service, 'model', modelo), \
+                patch.dict(nlp_service._estatisticas_especulacao, zeros):
+            resposta = nlp_service.gerar_resposta_com_contexto([{"role": "user", "content": "Olá"}], chat_id="chat1")
+            estatisticas = nlp_service.estatisticas_especulacao()
+
+        self.assertEqual(resposta, "resposta especulativa")
+        self.assertEqual(modelo.kwargs["prompt_lookup_num_tokens"], 4)
+        self.assertNotIn("past_key_values", modelo.kwargs)
+        self.assertEqual((estatisticas['steps'], estatisticas['tokens']), (3, 11))
+        self.assertEqual(estatisticas['tokens_per_step'], round(11 / 3, 3))
+        self.assertEqual(estatisticas['acceptance_rate'], round(8 / 12, 4))
+
+    @patch('chat.services.nlp_service.is_model_loaded', True)
+    @patch('chat.services.nlp_service.tokenizer', MagicMock())
+    @patch('chat.services.nlp_service.model', MagicMock())
+    def test_32_modo_draft_sem_modelo_de_rascunho(self):
+        """ O modo 'draft' sem NLP_DRAFT_MODEL devolve a mensagem de erro em vez de gerar sem o rascunho. """
+        print("Executando: Teste 32 - decodificação especulativa sem modelo de rascunho")
+        with self.settings(NLP_SPECULATIVE_MODE='draft', NLP_DRAFT_MODEL=''), patch.object(nlp_service, 'draft_model', None):
+            resposta = nlp_service.gerar_resposta_com_contexto([{"role": "user", "content": "Olá"}])
+        self.assertTrue(nlp_service.e_resposta_de_erro(resposta))
+        self.assertIn("NLP_DRAFT_MODEL", resposta)
+        nlp_service.model.generate.assert_not_called()
+
+
+# --- Testes da Cache de Respostas ---
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        response_cache.limpar()
+
+    @patch('chat.services.nlp_service.gerar_resposta_com_contexto', MagicMock(return_value="Olá! Como posso ajudar?"))
+    def test_17_hit_exato_com_prompt_normalizado(self):
+        """ O mesmo prompt (a menos de maiúsculas/espaços) é servido pela cache, sem nova geração. """
+        print("Executando: Teste 17 - cache de respostas (hit exato)")
+        gerar = response_cache.nlp_service.gerar_resposta_com_contexto
+
+        resposta1, info1 = response_cache.gerar_com_cache([{"role": "user", "content": "Olá,   tudo bem?"}])
+        resposta2, info2 = response_cache.gerar_com_cache([{"role": "user", "content": "olá, tudo bem? "}])
+
+        self.assertEqual(resposta1, resposta2)
+        self.assertFalse(info1['cache_hit'])
+        self.assertTrue(info2['cache_hit'])
+        self.assertEqual(info2['cache_tier'], 'exact')
+        gerar.assert_called_once()
+
+    @patch('chat.services.nlp_service.gerar_resposta_com_contexto', MagicMock(return_value="Desculpe, ocorreu um erro ao gerar a resposta: x"))
+    def test_18_erros_e_conversas_longas_nao_sao_guardados(self):
+        """ Respostas de erro e conversas acima do limite de mensagens não entram na cache. """
+        print("Executando: Teste 18 - cache de respostas ignora erros e conversas longas")
+        history = [{"role": "user", "content": "Olá"}]
+        response_cache.gerar_com_cache(history)
+        _, info = response_cache.gerar_com_cache(history)
+        self.assertFalse(info['cache_hit'])
+
+        longa = [{"role": "user", "content": f"mensagem {i}"} for i in range(10)]
+        with self.settings(RESPONSE_CACHE_MAX_HISTORY_MESSAGES=4):
+            self.assertIsNone(response_cache.calcular_chave(longa))
+        self.assertEqual(response_cache.estatisticas()['stores'], 0)
+
+    @patch('chat.services.nlp_service.gerar_resposta_com_contexto', MagicMock(return_value="Resposta guardada no Mongo"))
+    def test_19_backend_mongo(self):
+        """ Com RESPONSE_CACHE_BACKEND='mongo', as respostas ficam na coleção 'response_cache'. """
+        print("Executando: Teste 19 - cache de respostas no MongoDB")
+        mock_client = mongomock.MongoClient()
+        mongo_service.db = mock_client[mongo_service.settings.MONGO_DB_NAME]
+        mongo_service.response_cache_collection = None
+        try:
+            with self.settings(RESPONSE_CACHE_BACKEND='mongo'):
+                response_cache.limpar()
+                response_cache.gerar_com_cache([{"role": "user", "content": "Qual é o horário?"}])
+                resposta, info = response_cache.gerar_com_cache([{"role": "user", "content": "Qual é o horário?"}])
+            self.assertTrue(info['cache_hit'])
+            self.assertEqual(resposta, "Resposta guardada no Mongo")
+            self.assertEqual(mongo_service.db["response_cache"].count_documents({}), 1)
+        finally:
+            mongo_service.response_cache_collection = None
+            response_cache.limpar()
+
 
 # --- Testes das Views (Páginas) ---
 
+def _ler_stream(response) -> bytes:
+    """ Conteúdo de uma StreamingHttpResponse das views assíncronas (iterador assíncrono). """
+    async def ler():
+        return b"".join([parte async for parte in response.streaming_content])
+    return async_to_sync(ler)()
+
 class TestViews(TestCase):
 
     def setUp(self):
         # Cria um cliente de teste do Django para fazer requisições
         self.client = Client()
+        # Garante que respostas de um teste não são servidas pela cache noutro
+        response_cache.limpar()
+        mongo_async_service._indice_texto_disponivel = None
 
     def test_01_index_page_loads(self):
         """
@@ -85,7 +1107,8 @@ class TestViews(TestCase):
         self.assertTemplateUsed(response, 'core/base.html')
 
     # Para testar o histórico, precisamos simular (mockar) a chamada ao MongoDB
-    @patch('chat.services.mongo_service.get_all_chats_paginated')
+    @patch('chat.services.mongo_async_service.contar_chats', AsyncMock(return_value=(0, False)))
+    @patch('chat.services.mongo_async_service.get_chats_page', new_callable=AsyncMock)
     def test_02_historico_page_loads(self, mock_get_chats):
         """
         Plano de Ação 2: Testa se a página de histórico (/chat/historico/) carrega.
@@ -93,8 +1116,8 @@ class TestViews(TestCase):
         print("Executando: Teste 2 - Página de Histórico (/chat/historico/)")
         
         # Configura o mock: Simula o retorno da função do MongoDB
-        # Retorna uma lista vazia, 0 chats no total, 0 páginas
-        mock_get_chats.return_value = ([], 0, 0) 
+        # Retorna uma página vazia, sem cursores
+        mock_get_chats.return_value = {"chats": [], "next_cursor": None, "prev_cursor": None}
         
         # Faz um request GET para a URL do histórico
         response = self.client.get(reverse('chat:historico'))
@@ -111,11 +1134,10 @@ class TestViews(TestCase):
     # Para testar a API, precisamos simular (mockar):
     # 1. A geração da IA (para ser rápido e não carregar o modelo)
     # 2. As chamadas ao MongoDB (para não usar o banco real)
-    @patch('chat.services.mongo_service.create_chat', MagicMock(return_value="mock_chat_id_123"))
-    @patch('chat.services.mongo_service.add_message', MagicMock(return_value=True))
-    @patch('chat.services.mongo_service.get_chat_history', MagicMock(return_value=[{"role": "user", "content": "teste"}]))
-    @patch('chat.services.mongo_service.update_last_assistant_message_metadata', MagicMock(return_value=True))
+    @patch('chat.services.mongo_async_service.registrar_mensagem_utilizador', AsyncMock(return_value={"chat_id": "mock_chat_id_123", "messages": [{"role": "user", "content": "teste"}], "first_message": 0, "context_summary": None, "context_summary_upto": 0}))
+    @patch('chat.services.mongo_async_service.registrar_resposta_assistente', AsyncMock(return_value=True))
     @patch('chat.services.nlp_service.gerar_resposta_com_contexto', MagicMock(return_value="Esta é uma resposta mockada da IA"))
+    @patch('chat.services.nlp_service.modelo_pronto', MagicMock(return_value=True))
     def test_03_gerar_resposta_api(self):
         """
         Plano de Ação 3: Simula um "POST" para a API (/chat/gerar/)
@@ -148,3 +1170,269 @@ class TestViews(TestCase):
         self.assertIn('response', data)
         self.assertEqual(data['chat_id'], "mock_chat_id_123") # O valor que definimos no mock
         self.assertEqual(data['response'], "Esta é uma resposta mockada da IA") # O valor do mock da IA
+
+    @patch('chat.services.mongo_async_service.registrar_mensagem_utilizador', AsyncMock(return_value={"chat_id": "mock_chat_id_123", "messages": [{"role": "user", "content": "teste"}], "first_message": 0, "context_summary": None, "context_summary_upto": 0}))
+    @patch('chat.services.nlp_service.gerar_resposta_stream', MagicMock(return_value=iter(["Olá", ", mundo"])))
+    @patch('chat.services.nlp_service.modelo_pronto', MagicMock(return_value=True))
+    @patch('chat.services.mongo_async_service.registrar_resposta_assistente', new_callable=AsyncMock)
+    def test_05_gerar_resposta_stream_api(self, mock_registrar_resposta):
+        """
+        Testa o endpoint de streaming (/chat/gerar/stream/): os tokens chegam como eventos SSE
+        e a resposta completa é guardada uma única vez no fim.
+        """
+        print("Executando: Teste 5 - API POST em streaming (/chat/gerar/stream/)")
+
+        response = self.client.post(
+            reverse('chat:gerar_resposta_stream'),
+            data=json.dumps({'prompt': 'Olá, mundo!', 'chat_id': ''}),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+
+        conteudo = _ler_stream(response).decode('utf-8')
+        self.assertIn('event: inicio', conteudo)
+        self.assertIn('"texto": "Olá"', conteudo)
+        self.assertIn('event: fim', conteudo)
+
+        # Uma única mensagem do assistente com o texto completo
+        mock_registrar_resposta.assert_awaited_once()
+        self.assertEqual(mock_registrar_resposta.call_args.args[:2], ("mock_chat_id_123", "Olá, mundo"))
+
+        # Sem nenhum token (ex: o cliente desligou antes do primeiro) não fica um turno vazio no histórico
+        mock_registrar_resposta.reset_mock()
+        with patch('chat.services.nlp_service.gerar_resposta_stream', MagicMock(return_value=iter([]))), \
+                self.settings(RESPONSE_CACHE_ENABLED=False):
+            response = self.client.post(
+                reverse('chat:gerar_resposta_stream'),
+                data=json.dumps({'prompt': 'Olá?', 'chat_id': ''}),
+                content_type='application/json'
+            )
+            self.assertIn('event: fim', _ler_stream(response).decode('utf-8'))
+        mock_registrar_resposta.assert_not_awaited()
+
+    def test_24_exportacao_em_streaming(self):
+        """
+        A exportação é uma StreamingHttpResponse em todos os formatos e lê os chats por um cursor
+        (iterar_chats_para_exportacao), sem construir a lista completa.
+        """
+        print("Executando: Teste 24 - exportação em streaming (JSON, NDJSON, CSV)")
+        from .benchmarking.mongomock_assincrono import BaseMongomockAssincrona
+        mock_client = mongomock.MongoClient()
+        with patch.multiple(mongo_service, client=mock_client, db=mock_client['export'],
+                            chats_collection=mock_client['export']['chats'], buckets_collection=None), \
+                patch.object(mongo_async_service, 'get_db', MagicMock(return_value=BaseMongomockAssincrona(mock_client['export']))):
+            for i in range(3):
+                chat_id = mongo_service.create_chat(title=f"Chat {i}")
+                mongo_service.add_message(chat_id, 'user', f"pergunta {i}")
+                mongo_service.add_message(chat_id, 'assistant', f"resposta {i}")
+            mongo_service.create_chat(title="Vazio")
+
+            with patch.object(mongo_service, 'get_all_chats_for_export') as mock_lista:
+                respostas = {formato: self.client.get(reverse('chat:exportar_historico', args=[formato]))
+                             for formato in ('json', 'ndjson', 'csv')}
+                conteudos = {formato: _ler_stream(r).decode('utf-8') for formato, r in respostas.items()}
+                mock_lista.assert_not_called()
+
+        self.assertTrue(all(r.streaming for r in respostas.values()))
+        chats = json.loads(conteudos['json'])
+        self.assertEqual([c['title'] for c in chats], ["Vazio", "Chat 2", "Chat 1", "Chat 0"])
+        self.assertEqual(chats[1]['messages'][1]['content'], "resposta 2")
+        self.assertEqual([json.loads(linha) for linha in conteudos['ndjson'].splitlines()], chats)
+        linhas = conteudos['csv'].lstrip('\ufeff').splitlines()
+        self.assertEqual(linhas[0].split(';')[0], 'Chat_ID')
+        self.assertEqual(len(linhas), 1 + 1 + 3 * 2)
+        self.assertEqual(self.client.get(reverse('chat:exportar_historico', args=['xml'])).status_code, 400)
+
+    def test_25_jobs_de_exportacao(self):
+        """
+        Um job escreve o NDJSON comprimido em disco e reporta o progresso; o ficheiro é servido com Range
+        e um segundo pedido com os mesmos filtros reutiliza o ficheiro.
+        """
+        print("Executando: Teste 25 - jobs de exportação (gzip, Range, reutilização)")
+        mock_client = mongomock.MongoClient()
+        executor_sincrono = SimpleNamespace(submit=lambda funcao, *args: funcao(*args))
+        with tempfile.TemporaryDirectory() as diretorio, \
+                self.settings(EXPORT_JOBS_DIR=diretorio), \
+                patch('chat.services.export_service._obter_executor', MagicMock(return_value=executor_sincrono)), \
+                patch.multiple(mongo_service, client=mock_client, db=mock_client['jobs'], chats_collection=mock_client['jobs']['chats'],
+                               buckets_collection=None, export_jobs_collection=None):
+            for i in range(3):
+                chat_id = mongo_service.create_chat(title=f"Chat {i}")
+                mongo_service.add_message(chat_id, 'user', f"pergunta {i}")
+
+            criado = self.client.post(reverse('chat:criar_job_exportacao'), data=json.dumps({'format': 'ndjson', 'compression': 'gzip'}), content_type='application/json')
+            self.assertEqual(criado.status_code, 202)
+            estado = self.client.get(criado.json()['status_url']).json()
+            self.assertEqual((estado['status'], estado['chats'], estado['rows']), ('done', 3, 3))
+            self.assertGreater(estado['bytes'], 0)
+
+            completo = b''.join(self.client.get(estado['download_url']).streaming_content)
+            self.assertEqual(len(completo), estado['bytes'])
+            linhas = gzip.decompress(completo).decode('utf-8').splitlines()
+            self.assertEqual([json.loads(l)['title'] for l in linhas], ["Chat 2", "Chat 1", "Chat 0"])
+
+            parcial = self.client.get(estado['download_url'], HTTP_RANGE='bytes=10-')
+            self.assertEqual(parcial.status_code, 206)
+            self.assertEqual(b''.join(parcial.streaming_content), completo[10:])
+            self.assertEqual(parcial['Content-Range'], f"bytes 10-{len(completo) - 1}/{len(completo)}")
+            self.assertEqual(self.client.get(estado['download_url'], HTTP_RANGE=f'bytes={len(completo)}-').status_code, 416)
+
+            repetido = self.client.post(reverse('chat:criar_job_exportacao'), data=json.dumps({'format': 'ndjson'}), content_type='application/json')
+            self.assertEqual(repetido.status_code, 200)
+            self.assertTrue(repetido.json()['reused'])
+            self.assertEqual(repetido.json()['job_id'], estado['job_id'])
+            self.assertEqual(self.client.post(reverse('chat:criar_job_exportacao'), data=json.dumps({'format': 'xlsx'}), content_type='application/json').status_code, 400)
+
+            # Parquet: um processing_time nulo (como fica num chat importado) é uma célula nula, não falha o job
+            mongo_service.chats_collection.update_one({"title": "Chat 0"}, {"$push": {"messages": {"role": "assistant", "content": "r", "timestamp": None, "processing_time": None}}})
+            criado = self.client.post(reverse('chat:criar_job_exportacao'), data=json.dumps({'format': 'parquet', 'compression': 'zstd'}), content_type='application/json')
+            estado = self.client.get(criado.json()['status_url']).json()
+            self.assertEqual(estado['status'], 'done')
+            import pyarrow.parquet as pq
+            tabela = pq.read_table(io.BytesIO(b''.join(self.client.get(estado['download_url']).streaming_content))).to_pylist()
+            self.assertEqual(len(tabela), 4)
+            resposta = [linha for linha in tabela if linha['mensagem_role'] == 'assistant']
+            self.assertEqual([(l['mensagem_timestamp'], l['msg_tempo_processamento_sec']) for l in resposta], [(None, None)])
+
+    @patch('chat.services.nlp_service.modelo_pronto', MagicMock(return_value=True))
+    def test_27_views_assincronas_com_pool_de_inferencia(self):
+        """
+        Com as views assíncronas, muitos pedidos de chat em simultâneo ficam à espera no event loop:
+        só NLP_ASYNC_WORKERS gerações correm ao mesmo tempo e todos os turnos ficam guardados pelo cliente assíncrono.
+        """
+        print("Executando: Teste 27 - views assíncronas (AsyncMongoClient + pool de inferência)")
+        from .benchmarking.mongomock_assincrono import BaseMongomockAssincrona
+        mock_client = mongomock.MongoClient()
+        db = mock_client['assincrono']
+        em_curso, maximo = [0], [0]
+        lock = threading.Lock()
+
+        def gerar_lento(history, chat_id=None, resumo=None):
+            with lock:
+                em_curso[0] += 1
+                maximo[0] = max(maximo[0], em_curso[0])
+            time.sleep(0.05)
+            with lock:
+                em_curso[0] -= 1
+            return f"resposta para {history[-1]['content']}"
+
+        async def pedidos():
+            cliente = AsyncClient()
+            return await asyncio.gather(*[
+                cliente.post(reverse('chat:gerar_resposta'), data=json.dumps({'prompt': f'pergunta {i}'}), content_type='application/json')
+                for i in range(8)
+            ])
+
+        with self.settings(NLP_ASYNC_WORKERS=2), \
+                patch.object(inference_executor, '_executor', None), \
+                patch.object(mongo_async_service, '_ativo', True), \
+                patch.object(mongo_async_service, 'get_db', MagicMock(return_value=BaseMongomockAssincrona(db))), \
+                patch('chat.services.nlp_service.gerar_resposta_com_contexto', MagicMock(side_effect=gerar_lento)):
+            respostas = async_to_sync(pedidos)()
+            estatisticas = inference_executor.estatisticas()
+
+        self.assertEqual([r.status_code for r in respostas], [200] * 8)
+        self.assertEqual(maximo[0], 2)
+        self.assertEqual((estatisticas['running'], estatisticas['waiting']), (0, 0))
+        self.assertEqual(db['chats'].count_documents({}), 8)
+        chat = db['chats'].find_one({"_id": mongo_service.ObjectId(respostas[3].json()['chat_id'])})
+        self.assertEqual([m['content'] for m in chat['messages']], ['pergunta 3', 'resposta para pergunta 3'])
+
+        # Sob WSGI (cada pedido num event loop efémero) as views usam o cliente síncrono, sem abrir um AsyncMongoClient por pedido
+        with patch.multiple(mongo_service, client=mock_client, db=db, chats_collection=db['chats'], buckets_collection=None), \
+                patch.object(mongo_async_service, 'get_db', MagicMock(side_effect=AssertionError("cliente assíncrono fora do ASGI"))):
+            detalhe = self.client.get(reverse('chat:chat_detalhe', args=[str(chat['_id'])]))
+            historico = self.client.get(reverse('chat:historico'))
+        self.assertEqual(detalhe.context['chat']['messages'][1]['content'], 'resposta para pergunta 3')
+        self.assertEqual(len(historico.context['chats']), 8)
+
+    @patch('chat.services.mongo_async_service.contar_chats', AsyncMock(return_value=(0, False)))
+    @patch('chat.services.mongo_async_service.get_chats_page', AsyncMock(return_value={"chats": [], "next_cursor": None, "prev_cursor": None}))
+    def test_28_metricas_e_ids_de_trace(self):
+        """
+        /metrics expõe os histogramas no formato Prometheus (pedidos, comandos MongoDB, prefill/decode);
+        com METRICS_TRACE_IDS a resposta traz o X-Request-ID (o recebido, se válido) e o Server-Timing por etapa.
+        """
+        print("Executando: Teste 28 - métricas (/metrics) e IDs de trace")
+        metrics.limpar()
+        with self.settings(METRICS_TRACE_IDS=True):
+            response = self.client.get(reverse('chat:historico'), HTTP_X_REQUEST_ID='pedido-123')
+            self.assertEqual(response['X-Request-ID'], 'pedido-123')
+            self.assertIn('template;dur=', response['Server-Timing'])
+            self.assertEqual(len(self.client.get(reverse('chat:historico'), HTTP_X_REQUEST_ID='inválido "id"')['X-Request-ID']), 32)
+        self.assertNotIn('X-Request-ID', self.client.get(reverse('chat:historico')))
+
+        ouvinte = metrics.OuvinteComandosMongo()
+        ouvinte.succeeded(SimpleNamespace(duration_micros=1500, command_name='find'))
+        ouvinte.failed(SimpleNamespace(duration_micros=20000, command_name='insert'))
+        cronometro = metrics.CronometroGeracao()
+        for _ in range(5):
+            cronometro(None, None)
+        cronometro.registar("batch")
+
+        texto = self.client.get(reverse('metrics')).content.decode('utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', texto)
+        self.assertIn('http_request_duration_seconds_count{view="chat:historico",method="GET",status="200"} 3', texto)
+        self.assertIn('mongo_command_duration_seconds_bucket{command="find",outcome="ok",le="0.0025"} 1', texto)
+        self.assertIn('mongo_command_duration_seconds_bucket{command="insert",outcome="error",le="0.01"} 0', texto)
+        self.assertIn('nlp_prefill_duration_seconds_count{path="batch"} 1', texto)
+        self.assertIn('nlp_decode_tokens_per_second_count{path="batch"} 1', texto)
+        with self.settings(METRICS_ENABLED=False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    def test_30_benchmark_do_caminho_dos_pedidos(self):
+        """
+        `benchmark_desempenho` corre os cenários com mongomock e o modelo simulado e escreve o JSON;
+        a comparação com uma execução anterior assinala as regressões.
+        """
+        print("Executando: Teste 30 - benchmark_desempenho (JSON e comparação)")
+        from .benchmarking import desempenho
+        db_anterior = mongo_service.db
+        with tempfile.TemporaryDirectory() as pasta:
+            saida = f"{pasta}/resultados.json"
+            call_command('benchmark_desempenho', clientes='1,2', pedidos=2, tamanhos='30', paginas='1,2', linhas='15',
+                         formatos='ndjson,csv', repeticoes=1, tokens_simulados=4, tokens_por_segundo=10000, saida=saida, stdout=io.StringIO())
+            with open(saida, encoding='utf-8') as ficheiro:
+                relatorio = json.load(ficheiro)
+
+        resultados = relatorio['results']
+        self.assertEqual([(l['clients'], l['requests'], l['errors']) for l in resultados['chat']], [(1, 2, 0), (2, 4, 0)])
+        self.assertEqual(resultados['tokens']['tokens'], 4 * len(desempenho.PROMPTS_PADRAO))
+        self.assertEqual([(l['chats'], l['page']) for l in resultados['historico']], [(30, 1), (30, 2)])
+        self.assertEqual([(l['chats'], l['format']) for l in resultados['exportacao']], [(15, 'ndjson'), (15, 'csv')])
+        self.assertGreater(resultados['exportacao'][0]['bytes'], 0)
+        self.assertIs(mongo_service.db, db_anterior) # A base descartável não fica ligada
+
+        pior = json.loads(json.dumps(relatorio))
+        pior['results']['chat'][1]['requests_per_second'] = resultados['chat'][1]['requests_per_second'] / 2
+        pior['results']['exportacao'][1]['peak_python_mb'] = resultados['exportacao'][1]['peak_python_mb'] * 0.5
+        variacoes = {v['metric']: v for v in desempenho.comparar_resultados(relatorio, pior)}
+        self.assertEqual(set(variacoes), {'chat[clients=2].requests_per_second', 'exportacao[chats=15,format=csv].peak_python_mb'})
+        self.assertTrue(variacoes['chat[clients=2].requests_per_second']['regression'])
+        self.assertFalse(variacoes['exportacao[chats=15,format=csv].peak_python_mb']['regression'])
+
+    @patch('chat.services.nlp_service.iniciar_carregamento')
+    @patch('chat.services.mongo_async_service.registrar_mensagem_utilizador', new_callable=AsyncMock)
+    def test_12_gerar_resposta_503_enquanto_modelo_carrega(self, mock_registrar, mock_iniciar):
+        """
+        Enquanto o modelo carrega, /chat/gerar/ responde logo 503 (sem tocar no MongoDB)
+        e o endpoint de prontidão indica o estado 'loading'.
+        """
+        print("Executando: Teste 12 - 503 durante o carregamento do modelo")
+        with patch.dict('chat.services.nlp_service._estado_carregamento', {'status': 'loading', 'started_at': None}):
+            response = self.client.post(
+                reverse('chat:gerar_resposta'),
+                data=json.dumps({'prompt': 'Olá', 'chat_id': ''}),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json()['model_status'], 'loading')
+            self.assertIn('Retry-After', response.headers)
+            mock_iniciar.assert_called_once()
+            mock_registrar.assert_not_called()
+
+            estado = self.client.get(reverse('chat:estado_modelo'))
+            self.assertEqual(estado.status_code, 503)
+            self.assertEqual(estado.json()['status'], 'loading')
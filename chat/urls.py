@@ -7,15 +7,35 @@ app_name = 'chat'
 urlpatterns = [
     # Rota da API para gerar respostas
     path('gerar/', views.gerar_resposta_view, name='gerar_resposta'),
+
+    # Rota da API para gerar respostas em streaming (Server-Sent Events)
+    path('gerar/stream/', views.gerar_resposta_stream_view, name='gerar_resposta_stream'),
     
+    # Rota de prontidão do modelo de IA (loading / ready / failed)
+    path('modelo/estado/', views.estado_modelo_view, name='estado_modelo'),
+
+    # Rota com as estatísticas da geração (fila do scheduler, tamanhos de lote, cache KV)
+    path('estatisticas/', views.estatisticas_view, name='estatisticas'),
+
     # Rota para a lista de histórico (com paginação e filtros)
     path('historico/', views.historico_view, name='historico'),
     
+    # Rota da API com as estatísticas do histórico (chats/mensagens por dia, latência, tokens, por modelo)
+    path('historico/analise/', views.analise_historico_view, name='analise_historico'),
+
     # Rota para ver um chat específico
     path('historico/<str:chat_id>/', views.chat_detail_view, name='chat_detalhe'),
 
+    # Jobs de exportação em segundo plano: criar (POST), estado/progresso e download do ficheiro (com Range)
+    path('exportar/jobs/', views.criar_job_exportacao_view, name='criar_job_exportacao'),
+    path('exportar/jobs/<str:job_id>/', views.estado_job_exportacao_view, name='estado_job_exportacao'),
+    path('exportar/jobs/<str:job_id>/ficheiro/', views.descarregar_job_exportacao_view, name='descarregar_job_exportacao'),
+
     # --- NOVA ROTA PARA EXPORTAÇÃO ---
     # Captura o tipo de formato (csv ou json) pela URL
     path('exportar/<str:format_type>/', views.exportar_historico_view, name='exportar_historico'),
+
+    # Importação em lote (JSON, NDJSON ou CSV no formato da exportação, no corpo do pedido)
+    path('importar/<str:format_type>/', views.importar_historico_view, name='importar_historico'),
 ]
 
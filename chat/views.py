@@ -1,22 +1,111 @@
+import asyncio
+import gzip
+import hmac
 import json
 import time
-import traceback
-import csv # Importa a biblioteca CSV do Python
-import io # Importa a biblioteca IO para lidar com streams de texto
+import logging
+import os
+import re
 
-from django.http import JsonResponse, HttpRequest, Http404, HttpResponse # Importa HttpResponse
+from django.http import JsonResponse, HttpRequest, Http404, HttpResponse, StreamingHttpResponse # Importa HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods, require_GET
 from django.shortcuts import render
-from .services import nlp_service, mongo_service
-from django.core.paginator import Paginator
+from django.urls import reverse
+from django.conf import settings
+from .services import nlp_service, mongo_service, mongo_async_service, context_service, response_cache, export_service, import_service, analytics_service, inference_executor, metrics, mongo_connection, write_behind
 from datetime import datetime # Importa datetime
 
+logger = logging.getLogger(__name__)
+
+# --- Funções auxiliares partilhadas pelas views de geração ---
+# As views de chat, histórico, detalhe e exportação são assíncronas (ASGI): o MongoDB é acedido pelo
+# cliente assíncrono e o trabalho bloqueante (contexto, geração) corre no pool de inference_executor.
+
+async def _iniciar_turno(prompt: str, chat_id: str):
+    """
+    Cria o chat (se necessário), guarda a mensagem do utilizador e devolve o contexto a enviar ao modelo.
+    A escrita e a leitura do histórico (e do resumo) são feitas numa única operação no MongoDB.
+    Retorna (chat_id, history, resumo, None) ou (None, None, None, JsonResponse de erro).
+    """
+    turno = await mongo_async_service.registrar_mensagem_utilizador(chat_id, prompt, title=f"Chat: {prompt[:30]}...")
+    if turno is None:
+        if not chat_id:
+            logger.critical("Não foi possível criar chat no MongoDB.")
+            return None, None, None, JsonResponse({'error': 'Não foi possível criar um novo chat no MongoDB.'}, status=500)
+        logger.error("Não foi possível guardar a mensagem no chat %s.", chat_id)
+        return None, None, None, JsonResponse({'error': f'Não foi possível guardar a mensagem no chat {chat_id}.'}, status=500)
+    if not chat_id:
+        logger.debug("Novo chat ID criado: %s", turno['chat_id'])
+    chat_id = turno['chat_id']
+    # Aplica o orçamento de tokens: mensagens recentes + resumo das antigas
+    history, resumo = await inference_executor.executar(
+        context_service.construir_contexto, chat_id, turno['messages'],
+        resumo_guardado=(turno['context_summary'], turno['context_summary_upto']),
+        primeira_mensagem=turno['first_message']
+    )
+    return chat_id, history, resumo, None
+
+async def _guardar_resposta(chat_id: str, response_text: str, start_time: float, cache_hit: bool = False, trace_id: str = None):
+    """ Guarda a resposta do assistente já com os metadados (tempo de processamento, modelo, cache), numa só escrita. """
+    end_time = time.time()
+    processing_time = round(end_time - start_time, 2)
+    logger.debug("Tempo total de processamento da requisição: %ss", processing_time)
+    metadata = {'processing_time': processing_time, 'model_used': nlp_service.nome_modelo(), 'cache_hit': cache_hit}
+    trace_id = trace_id or metrics.trace_id.get()
+    if trace_id:
+        metadata['trace_id'] = trace_id # Liga a mensagem ao pedido (X-Request-ID)
+    try:
+        # Para as estatísticas do histórico; a tokenização é bloqueante, por isso corre no pool
+        metadata['tokens'] = await inference_executor.executar(nlp_service.contar_tokens, response_text)
+    except Exception:
+        pass # Sem tokenizer (ex: modelo ainda a carregar) a resposta é guardada sem contagem
+    await mongo_async_service.registrar_resposta_assistente(chat_id, response_text, metadata)
+
+def _modelo_indisponivel():
+    """
+    Resposta 503 rápida enquanto o modelo de IA aquece (ou se o carregamento falhou).
+    Garante também que o carregamento foi iniciado (modo preguiçoso, sem NLP_PRELOAD).
+    """
+    if nlp_service.modelo_pronto():
+        return None
+    nlp_service.iniciar_carregamento()
+    estado = nlp_service.estado_modelo()
+    if estado['status'] == 'failed':
+        mensagem = 'O modelo de IA não pôde ser carregado. Tente novamente mais tarde.'
+    else:
+        mensagem = 'O modelo de IA ainda está a carregar. Tente novamente dentro de alguns segundos.'
+    response = JsonResponse({'error': mensagem, 'model_status': estado['status']}, status=503)
+    response['Retry-After'] = '5'
+    return response
+
+def _render(request: HttpRequest, template_name: str, context: dict = None, status: int = None):
+    """ render() com o tempo de renderização do template registado nas métricas. """
+    with metrics.TEMPLATE.medir(template=template_name):
+        return render(request, template_name, context, status=status)
+
+def _filtros_do_pedido(params) -> dict:
+    """ Filtros do histórico (termo, modo de busca, datas e mínimo de mensagens) a partir dos parâmetros do pedido. """
+    filters = {}
+    if params.get('query'):
+        filters['search_query'] = params.get('query')
+        filters['search_mode'] = params.get('search_mode', '') # 'text' (palavras) ou 'substring'
+    if params.get('date_from'):
+        filters['date_from'] = params.get('date_from')
+    if params.get('date_to'):
+        filters['date_to'] = params.get('date_to')
+    if params.get('min_messages', '').isdigit() and int(params['min_messages']) > 0:
+        filters['min_messages'] = int(params['min_messages'])
+    return filters
+
+def _evento_sse(evento: str, dados: dict) -> str:
+    """ Formata um evento no formato Server-Sent Events. """
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
 # --- View da API do Chat (permanece igual) ---
 @csrf_exempt
 @require_http_methods(["POST"])
-def gerar_resposta_view(request: HttpRequest):
-    # ... (Esta view permanece igual à da etapa anterior) ...
+async def gerar_resposta_view(request: HttpRequest):
     try:
         start_time = time.time()
         data = json.loads(request.body)
@@ -24,194 +113,376 @@ def gerar_resposta_view(request: HttpRequest):
         chat_id = data.get('chat_id')
         if not prompt:
             return JsonResponse({'error': 'O prompt não pode estar vazio.'}, status=400)
-        if not chat_id:
-            chat_id = mongo_service.create_chat(title=f"Chat: {prompt[:30]}...")
-            if not chat_id:
-                 print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO CRÍTICO: Não foi possível criar chat no MongoDB.")
-                 return JsonResponse({'error': 'Não foi possível criar um novo chat no MongoDB.'}, status=500)
-            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Novo chat ID criado: {chat_id}")
-        mongo_service.add_message(chat_id, 'user', prompt)
-        history = mongo_service.get_chat_history(chat_id)
-        if history is None:
-             print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO: Não foi possível obter histórico para o chat {chat_id}.")
-             return JsonResponse({'error': f'Não foi possível obter o histórico do chat {chat_id}.'}, status=500)
-        response_text = nlp_service.gerar_resposta_com_contexto(history)
-        mongo_service.add_message(chat_id, 'assistant', response_text)
-        end_time = time.time()
-        processing_time = round(end_time - start_time, 2)
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Tempo total de processamento da requisição: {processing_time}s")
-        mongo_service.update_last_assistant_message_metadata(chat_id, {'processing_time': processing_time, 'model_used': nlp_service.MODEL_NAME})
-        return JsonResponse({'chat_id': chat_id, 'response': response_text})
+        indisponivel = _modelo_indisponivel()
+        if indisponivel:
+            return indisponivel
+        chat_id, history, resumo, error_response = await _iniciar_turno(prompt, chat_id)
+        if error_response:
+            return error_response
+        # A geração corre no pool de inferência: o event loop continua a atender outros pedidos
+        response_text, info = await inference_executor.executar(response_cache.gerar_com_cache, history, chat_id=chat_id, resumo=resumo)
+        await _guardar_resposta(chat_id, response_text, start_time, cache_hit=info['cache_hit'])
+        return JsonResponse({'chat_id': chat_id, 'response': response_text, 'cache_hit': info['cache_hit']})
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO na view gerar_resposta_view:")
-        traceback.print_exc()
+        logger.exception("Erro na view gerar_resposta_view")
         return JsonResponse({'error': f'Ocorreu um erro interno ao processar o pedido.'}, status=500)
 
+# --- View da API do Chat em streaming (Server-Sent Events) ---
+@csrf_exempt
+@require_http_methods(["POST"])
+async def gerar_resposta_stream_view(request: HttpRequest):
+    """
+    Igual a gerar_resposta_view, mas envia os tokens ao cliente à medida que são gerados.
+    Eventos enviados: 'inicio' (chat_id), 'token' (texto parcial), 'erro' e 'fim' (resposta completa).
+    A resposta do assistente é guardada no MongoDB uma única vez, no fim do stream.
+    """
+    try:
+        start_time = time.time()
+        data = json.loads(request.body)
+        prompt = data.get('prompt')
+        chat_id = data.get('chat_id')
+        if not prompt:
+            return JsonResponse({'error': 'O prompt não pode estar vazio.'}, status=400)
+        indisponivel = _modelo_indisponivel()
+        if indisponivel:
+            return indisponivel
+        chat_id, history, resumo, error_response = await _iniciar_turno(prompt, chat_id)
+        if error_response:
+            return error_response
+    except Exception as e:
+        logger.exception("Erro na view gerar_resposta_stream_view")
+        return JsonResponse({'error': f'Ocorreu um erro interno ao processar o pedido.'}, status=500)
+
+    trace_id = metrics.trace_id.get() # O stream é consumido depois de o middleware terminar
+
+    async def eventos():
+        yield _evento_sse('inicio', {'chat_id': chat_id})
+        partes = []
+        erro = None
+        info = {'cache_hit': False}
+        try:
+            pedacos = inference_executor.iterar(
+                lambda: response_cache.gerar_stream_com_cache(history, chat_id=chat_id, resumo=resumo, info=info)
+            )
+            async for pedaco in pedacos:
+                partes.append(pedaco)
+                yield _evento_sse('token', {'texto': pedaco})
+        except Exception as e:
+            logger.exception("Erro durante a geração da resposta em streaming")
+            erro = f"Desculpe, ocorreu um erro ao gerar a resposta: {e}"
+        finally:
+            # Corre também se o cliente desligar a meio: guarda o que já foi gerado
+            # (shield: a escrita termina mesmo que o pedido seja cancelado)
+            response_text = erro or "".join(partes).strip()
+            if response_text:
+                await asyncio.shield(_guardar_resposta(chat_id, response_text, start_time, cache_hit=info.get('cache_hit', False), trace_id=trace_id))
+            else:
+                # Cliente desligou antes do primeiro token: um turno vazio só poluiria o histórico e o contexto seguinte
+                logger.info("Resposta em streaming do chat %s interrompida antes do primeiro token; nada a guardar.", chat_id)
+        if erro:
+            yield _evento_sse('erro', {'error': erro})
+        yield _evento_sse('fim', {'chat_id': chat_id, 'response': response_text, 'cache_hit': info.get('cache_hit', False)})
+
+    response = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Evita que proxies (ex: nginx) acumulem o stream
+    return response
+
+# --- Prontidão do modelo de IA (loading / ready / failed + tempo de carregamento) ---
+@require_GET
+def estado_modelo_view(request: HttpRequest):
+    estado = nlp_service.estado_modelo()
+    return JsonResponse(estado, status=200 if estado['status'] == 'ready' else 503)
+
+# --- Estatísticas da geração (micro-batching, cache KV e cache de respostas), para afinar sob carga ---
+@require_GET
+def estatisticas_view(request: HttpRequest):
+    return JsonResponse({
+        'scheduler': nlp_service.estatisticas_scheduler(),
+        'kv_cache': nlp_service.estatisticas_kv_cache(),
+        'speculative': nlp_service.estatisticas_especulacao(),
+        'response_cache': response_cache.estatisticas(),
+        'async_executor': inference_executor.estatisticas(),
+        'mongo': mongo_connection.estatisticas(),
+        'write_behind': write_behind.estatisticas(),
+    })
+
+# --- Métricas no formato de texto do Prometheus (histogramas por etapa do pedido) ---
+@require_GET
+def metricas_view(request: HttpRequest):
+    if not metrics.ativas():
+        raise Http404("Métricas desativadas (METRICS_ENABLED).")
+    return HttpResponse(metrics.expor() + mongo_connection.expor_metricas(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # --- View de Histórico (permanece igual) ---
 @require_GET
-def historico_view(request: HttpRequest):
+async def historico_view(request: HttpRequest):
     # ... (Esta view permanece igual à da etapa anterior, com filtros e paginação) ...
     try:
         search_query = request.GET.get('query', '')
         date_from = request.GET.get('date_from', '')
         date_to = request.GET.get('date_to', '')
-        filters = {}
-        if search_query:
-            filters['search_query'] = search_query
-        if date_from:
-            filters['date_from'] = date_from
-        if date_to:
-            filters['date_to'] = date_to
-        page_num = request.GET.get('page', 1)
-        try:
-            page_num = int(page_num)
-        except ValueError:
-            page_num = 1
-        if page_num < 1:
-            page_num = 1
+        filters = _filtros_do_pedido(request.GET)
         per_page = 10
-        chats_list, total_chats, total_pages = mongo_service.get_all_chats_paginated(
-            page=page_num,
+        pagina = await mongo_async_service.get_chats_page(
+            filters=filters,
             per_page=per_page,
-            filters=filters
+            cursor=request.GET.get('cursor'),
+            direction=request.GET.get('dir', 'next'),
+            sort=request.GET.get('sort')
         )
-        paginator = Paginator(range(total_chats), per_page)
-        page_obj = paginator.get_page(page_num)
+        total_chats, total_aproximado = None, False
+        if getattr(settings, 'HISTORY_SHOW_TOTAL', True):
+            total_chats, total_aproximado = await mongo_async_service.contar_chats(filters)
         filter_params = request.GET.copy()
-        if 'page' in filter_params:
-            del filter_params['page']
+        for param in ('cursor', 'dir', 'page'):
+            if param in filter_params:
+                del filter_params[param]
         context = {
-            'chats': chats_list,
-            'page_obj': page_obj,
-            'total_pages': total_pages,
-            'current_page': page_num,
+            'chats': pagina['chats'],
+            'next_cursor': pagina['next_cursor'],
+            'prev_cursor': pagina['prev_cursor'],
+            'total_chats': total_chats,
+            'total_aproximado': total_aproximado,
             'current_query': search_query,
+            'current_search_mode': request.GET.get('search_mode', ''),
             'current_date_from': date_from,
             'current_date_to': date_to,
+            'current_sort': request.GET.get('sort', 'created'),
+            'current_min_messages': request.GET.get('min_messages', ''),
             'filter_params': filter_params.urlencode(),
         }
-        return render(request, 'chat/historico.html', context)
+        return _render(request, 'chat/historico.html', context)
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO na view historico_view:")
-        traceback.print_exc()
-        return render(request, 'chat/historico.html', {'error': str(e)})
+        logger.exception("Erro na view historico_view")
+        return _render(request, 'chat/historico.html', {'error': str(e)})
+
+# --- Estatísticas do histórico (por dia e por modelo), com os mesmos filtros da listagem ---
+@require_GET
+def analise_historico_view(request: HttpRequest):
+    try:
+        return JsonResponse(analytics_service.analisar_historico(_filtros_do_pedido(request.GET)))
+    except Exception as e:
+        logger.exception("Erro na view analise_historico_view")
+        return JsonResponse({'error': f'Erro ao calcular as estatísticas do histórico: {e}'}, status=500)
 
 # --- View de Detalhe do Chat (permanece igual) ---
 @require_GET
-def chat_detail_view(request: HttpRequest, chat_id: str):
-    # ... (Esta view permanece igual à da etapa anterior) ...
+async def chat_detail_view(request: HttpRequest, chat_id: str):
     try:
-        chat = mongo_service.get_chat_details(chat_id)
+        chat = await mongo_async_service.get_chat_details(chat_id)
         if chat is None:
             raise Http404("Chat não encontrado.")
         context = {
             'chat': chat
         }
-        return render(request, 'chat/chat_detalhe.html', context)
+        return _render(request, 'chat/chat_detalhe.html', context)
     except Http404:
          context = {'error': f"O Chat com ID '{chat_id}' não foi encontrado."}
-         return render(request, 'chat/historico.html', context, status=404)
+         return _render(request, 'chat/historico.html', context, status=404)
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO na view chat_detail_view:")
-        traceback.print_exc()
-        return render(request, 'chat/chat_detalhe.html', {'error': str(e)}, status=500)
+        logger.exception("Erro na view chat_detail_view")
+        return _render(request, 'chat/chat_detalhe.html', {'error': str(e)}, status=500)
+
 
+# --- Exportação em streaming ---
+
+FORMATOS_EXPORTACAO = {
+    # formato: (content type, extensão)
+    'json': ('application/json', 'json'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+async def _com_registo_de_erros(pedacos):
+    """ Depois de a resposta começar já não é possível devolver um 500: o erro fica só no log. """
+    try:
+        async for pedaco in pedacos:
+            yield pedaco
+    except Exception:
+        logger.exception("Erro durante a exportação em streaming")
 
 # --- NOVA VIEW DE EXPORTAÇÃO ---
 
 @require_GET
-def exportar_historico_view(request: HttpRequest, format_type: str):
+async def exportar_historico_view(request: HttpRequest, format_type: str):
     """
-    Exporta o histórico de chats (filtrado) em formato JSON ou CSV.
+    Exporta o histórico de chats (filtrado) em formato JSON, NDJSON ou CSV.
+    A resposta é gerada em streaming, por isso a memória usada não depende do tamanho do histórico.
     """
     try:
         # 1. Reutiliza a lógica de filtro da view de histórico
-        search_query = request.GET.get('query', '')
-        date_from = request.GET.get('date_from', '')
-        date_to = request.GET.get('date_to', '')
-        
-        filters = {}
-        if search_query:
-            filters['search_query'] = search_query
-        if date_from:
-            filters['date_from'] = date_from
-        if date_to:
-            filters['date_to'] = date_to
-            
-        # 2. Busca TODOS os chats (sem paginação) que correspondem aos filtros
-        chats = mongo_service.get_all_chats_for_export(filters=filters)
+        filters = _filtros_do_pedido(request.GET)
+
+        if format_type not in FORMATOS_EXPORTACAO:
+            return JsonResponse({'error': 'Formato de exportação não suportado.'}, status=400)
+        content_type, extensao = FORMATOS_EXPORTACAO[format_type]
+
+        # 2. Percorre os chats que correspondem aos filtros um de cada vez (cursor assíncrono em lotes),
+        #    escrevendo o ficheiro à medida que são lidos
+        chats = mongo_async_service.iterar_chats_para_exportacao(filters=filters)
         
         # Define o nome do arquivo
         filename = f"historico_chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
 
-        # 3. Processa o formato solicitado
-        if format_type == 'json':
-            # Converte os dados (que já são dicts) para uma string JSON
-            json_data = json.dumps(chats, indent=2, ensure_ascii=False)
-            
-            # Cria a resposta HTTP como um arquivo JSON
-            response = HttpResponse(json_data, content_type='application/json')
-            response['Content-Disposition'] = f'attachment; filename="{filename}.json"'
-            return response
-
-        elif format_type == 'csv':
-            # Cria uma resposta HTTP do tipo CSV
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
-            
-            # Garante que o CSV seja escrito corretamente com caracteres UTF-8
-            response.write(u'\ufeff'.encode('utf8')) # Adiciona BOM para o Excel entender UTF-8
-            
-            # Cria um "escritor" de CSV que escreve na resposta HTTP
-            writer = csv.writer(response, delimiter=';') # Usa ponto e vírgula, comum no Brasil/Excel
-            
-            # Escreve o cabeçalho (Header) do CSV
-            # Como as mensagens são aninhadas, "achatamos" os dados
-            writer.writerow([
-                'Chat_ID', 
-                'Chat_Titulo', 
-                'Chat_Criado_Em', 
-                'Modelo',
-                'Mensagem_Role', 
-                'Mensagem_Conteudo', 
-                'Mensagem_Timestamp', 
-                'Msg_Tempo_Processamento_Sec'
-            ])
-            
-            # Escreve os dados
-            for chat in chats:
-                chat_id = chat.get('_id', '')
-                chat_title = chat.get('title', '')
-                chat_created_at = chat.get('created_at', '')
-                model_name = chat.get('model_name', '')
-                
-                # Se não houver mensagens, escreve uma linha para o chat
-                if not chat.get('messages'):
-                    writer.writerow([
-                        chat_id, chat_title, chat_created_at, model_name,
-                        '', '', '', '' # Células vazias para a mensagem
-                    ])
-                else:
-                    # Itera sobre cada mensagem dentro do chat
-                    for message in chat.get('messages', []):
-                        writer.writerow([
-                            chat_id,
-                            chat_title,
-                            chat_created_at,
-                            model_name,
-                            message.get('role', ''),
-                            message.get('content', ''),
-                            message.get('timestamp', ''),
-                            message.get('processing_time', '') # Pega o tempo de processamento
-                        ])
-            return response
-
-        else:
-            return JsonResponse({'error': 'Formato de exportação não suportado.'}, status=400)
+        # 3. Envia o ficheiro em streaming
+        response = StreamingHttpResponse(_com_registo_de_erros(export_service.gerar_assincrono(format_type, chats)), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}.{extensao}"'
+        return response
 
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERRO na view exportar_historico_view:")
-        traceback.print_exc()
+        logger.exception("Erro na view exportar_historico_view")
         # Retorna um erro (poderia ser uma página HTML de erro também)
         return HttpResponse(f"Ocorreu um erro ao exportar os dados: {e}", status=500)
 
+
+
+# --- Jobs de exportação (em segundo plano) ---
+
+def _estado_job(request: HttpRequest, job: dict) -> dict:
+    estado = export_service.estado_publico(job)
+    estado['status_url'] = request.build_absolute_uri(reverse('chat:estado_job_exportacao', args=[estado['job_id']]))
+    if estado['status'] == 'done':
+        estado['download_url'] = request.build_absolute_uri(reverse('chat:descarregar_job_exportacao', args=[estado['job_id']]))
+    return estado
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def criar_job_exportacao_view(request: HttpRequest):
+    """
+    Cria um job de exportação com os mesmos filtros do histórico (no corpo JSON ou na querystring),
+    mais 'format' (ndjson, csv ou parquet) e 'compression' (gzip ou zstd).
+    Responde 202 com o estado do job; se um ficheiro recente com os mesmos filtros já existir, responde 200.
+    """
+    try:
+        dados = request.GET.dict()
+        if request.body:
+            dados.update(json.loads(request.body))
+        job, reutilizado = export_service.criar_job(
+            _filtros_do_pedido(dados),
+            formato=dados.get('format', 'ndjson'),
+            compressao=dados.get('compression', 'gzip')
+        )
+        estado = _estado_job(request, job)
+        estado['reused'] = reutilizado
+        return JsonResponse(estado, status=200 if estado['status'] == 'done' else 202)
+    except (ValueError, json.JSONDecodeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Erro na view criar_job_exportacao_view")
+        return JsonResponse({'error': 'Não foi possível criar o job de exportação.'}, status=500)
+
+@require_GET
+def estado_job_exportacao_view(request: HttpRequest, job_id: str):
+    """ Progresso do job (chats, linhas e bytes escritos) e, quando concluído, o link para o ficheiro. """
+    job = export_service.obter_job(job_id)
+    if job is None:
+        return JsonResponse({'error': 'Job de exportação não encontrado.'}, status=404)
+    return JsonResponse(_estado_job(request, job))
+
+def _intervalo_pedido(cabecalho: str, tamanho: int):
+    """
+    Interpreta um cabeçalho Range com um único intervalo ('bytes=inicio-fim', 'bytes=inicio-' ou 'bytes=-sufixo').
+    Devolve (inicio, fim) inclusivos, None se o cabeçalho não for suportado (envia-se o ficheiro inteiro)
+    ou False se o intervalo estiver fora do ficheiro.
+    """
+    correspondencia = re.fullmatch(r'bytes=(\d*)-(\d*)', cabecalho.strip())
+    if not correspondencia or correspondencia.groups() == ('', ''):
+        return None
+    inicio, fim = correspondencia.groups()
+    if inicio == '':
+        inicio, fim = max(0, tamanho - int(fim)), tamanho - 1
+    else:
+        inicio, fim = int(inicio), min(int(fim), tamanho - 1) if fim else tamanho - 1
+    if inicio >= tamanho or inicio > fim:
+        return False
+    return inicio, fim
+
+def _ler_intervalo(caminho: str, inicio: int, fim: int, bloco: int = 64 * 1024):
+    with open(caminho, 'rb') as ficheiro:
+        ficheiro.seek(inicio)
+        restante = fim - inicio + 1
+        while restante > 0:
+            dados = ficheiro.read(min(bloco, restante))
+            if not dados:
+                break
+            restante -= len(dados)
+            yield dados
+
+@require_GET
+def descarregar_job_exportacao_view(request: HttpRequest, job_id: str):
+    """ Ficheiro de um job concluído, com suporte a Range para retomar downloads interrompidos. """
+    job = export_service.obter_job(job_id)
+    if job is None or job.get('status') != 'done' or not os.path.exists(job.get('path', '')):
+        return JsonResponse({'error': 'Ficheiro de exportação não disponível.'}, status=404)
+
+    caminho = job['path']
+    tamanho = os.path.getsize(caminho)
+    etag = f'"{job_id}-{tamanho}"'
+    intervalo = None
+    if request.headers.get('Range') and request.headers.get('If-Range', etag) == etag:
+        intervalo = _intervalo_pedido(request.headers['Range'], tamanho)
+    if intervalo is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{tamanho}'
+        return response
+
+    inicio, fim = intervalo or (0, tamanho - 1)
+    response = StreamingHttpResponse(
+        _ler_intervalo(caminho, inicio, fim),
+        status=206 if intervalo else 200,
+        content_type=export_service.CONTENT_TYPES[job['format']]
+    )
+    response['Content-Length'] = str(fim - inicio + 1)
+    if intervalo:
+        response['Content-Range'] = f'bytes {inicio}-{fim}/{tamanho}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = f'attachment; filename="{os.path.basename(caminho)}"'
+    return response
+
+# --- Importação em lote ---
+def _token_importacao_valido(request: HttpRequest) -> bool:
+    """ Cabeçalho 'Authorization: Bearer <IMPORT_API_TOKEN>'; sem IMPORT_API_TOKEN a importação por HTTP fica desligada. """
+    esperado = getattr(settings, 'IMPORT_API_TOKEN', '')
+    recebido = request.headers.get('Authorization', '')
+    return bool(esperado) and hmac.compare_digest(recebido.encode('utf-8'), f"Bearer {esperado}".encode('utf-8'))
+
+# Sem CSRF: a autorização vem de um cabeçalho que um formulário de outro site não consegue enviar (não de um cookie)
+@csrf_exempt
+@require_http_methods(["POST"])
+def importar_historico_view(request: HttpRequest, format_type: str):
+    """
+    Importa chats no formato da exportação (json, ndjson ou csv). O ficheiro vai no corpo do pedido
+    (lido em streaming, com Content-Encoding: gzip opcional) ou num upload multipart no campo 'file'.
+    Querystring: 'batch_size' (chats por escrita) e 'on_duplicate' ('skip' ou 'replace').
+    Requer o token de IMPORT_API_TOKEN no cabeçalho Authorization (com 'replace' pode substituir qualquer chat).
+    Responde com as contagens e o débito da importação.
+    """
+    if not _token_importacao_valido(request):
+        return JsonResponse({'error': 'Importação não autorizada.'}, status=403)
+    if format_type not in import_service.FORMATOS_IMPORTACAO:
+        return JsonResponse({'error': f"Formato de importação inválido: '{format_type}'."}, status=400)
+    if request.GET.get('on_duplicate', 'skip') not in ('skip', 'replace'):
+        return JsonResponse({'error': "on_duplicate deve ser 'skip' ou 'replace'."}, status=400)
+    try:
+        if request.content_type == 'multipart/form-data':
+            if 'file' not in request.FILES:
+                return JsonResponse({'error': "Envie o ficheiro no campo 'file'."}, status=400)
+            fonte = request.FILES['file']
+        else:
+            fonte = request # O corpo é lido aos poucos, sem passar por request.body
+        if request.headers.get('Content-Encoding') == 'gzip':
+            fonte = gzip.GzipFile(fileobj=fonte, mode='rb')
+        lote = request.GET.get('batch_size', '')
+        resultado = import_service.importar_de(
+            fonte, format_type,
+            tamanho_lote=int(lote) if lote.isdigit() else None,
+            substituir=request.GET.get('on_duplicate') == 'replace'
+        )
+        return JsonResponse(resultado)
+    except (ValueError, OSError, EOFError) as e: # Inclui gzip inválido ou cortado
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Erro na view importar_historico_view")
+        return JsonResponse({'error': 'Não foi possível importar o histórico.'}, status=500)
@@ -14,3 +14,19 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_asgi_application()
+
+# Sob ASGI o event loop dura tanto como o worker: as views assíncronas usam um único AsyncMongoClient
+from chat.services import mongo_async_service
+mongo_async_service.ativar()
+
+# Começa a carregar o modelo de IA em segundo plano assim que o worker arranca,
+# sem bloquear o arranque (os pedidos de chat recebem 503 até o modelo estar pronto).
+from django.conf import settings
+if settings.NLP_PRELOAD:
+    from chat.services import nlp_service
+    nlp_service.iniciar_carregamento()
+
+# Escrita diferida: o escritor em segundo plano começa já, para escrever o que ficou na fila de uma execução anterior
+if getattr(settings, 'MONGO_WRITE_BEHIND', False):
+    from chat.services import write_behind
+    write_behind.iniciar()
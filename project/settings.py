@@ -38,6 +38,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.middleware.MetricasMiddleware', # Duração dos pedidos e IDs de trace (ver METRICS_*)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -121,3 +122,174 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'nostalgic_elbakyan') # Nome da DB usada no main.py original
 
+# Ligação ao MongoDB (ver chat/services/mongo_connection.py): pool, timeouts, compressão e read preference
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '0')) # 0 = as ligações inativas não são fechadas
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '0')) # Espera por uma ligação do pool esgotado (0 = até ao timeout do pedido)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '20000'))
+MONGO_COMPRESSORS = os.getenv('MONGO_COMPRESSORS', '') # Ex: 'zstd,snappy,zlib' (por ordem de preferência; requerem 'zstandard'/'python-snappy')
+MONGO_READ_PREFERENCE = os.getenv('MONGO_READ_PREFERENCE', 'primary') # Ex: 'primaryPreferred', 'secondaryPreferred' (réplicas)
+# Verificação de saúde em segundo plano (0 = desligada: 'ping' na primeira ligação) e disjuntor: depois de
+# MONGO_BREAKER_FAILURES falhas seguidas os pedidos falham logo, e a ligação é tentada outra vez com backoff
+# exponencial (com jitter) entre MONGO_RECONNECT_BASE_SECONDS e MONGO_RECONNECT_MAX_SECONDS
+MONGO_HEALTH_CHECK_SECONDS = float(os.getenv('MONGO_HEALTH_CHECK_SECONDS', '10'))
+MONGO_HEALTH_CHECK_TIMEOUT_MS = int(os.getenv('MONGO_HEALTH_CHECK_TIMEOUT_MS', '2000'))
+MONGO_BREAKER_FAILURES = int(os.getenv('MONGO_BREAKER_FAILURES', '3'))
+MONGO_RECONNECT_BASE_SECONDS = float(os.getenv('MONGO_RECONNECT_BASE_SECONDS', '0.5'))
+MONGO_RECONNECT_MAX_SECONDS = float(os.getenv('MONGO_RECONNECT_MAX_SECONDS', '30'))
+
+# Armazenamento das mensagens: 'embedded' (array 'messages' no documento do chat) ou 'bucketed'
+# (coleção 'chat_buckets' com blocos de MONGO_BUCKET_SIZE mensagens; o documento do chat deixa de crescer).
+# Os chats existentes são convertidos com `python manage.py migrar_mensagens`.
+MONGO_MESSAGE_STORAGE = os.getenv('MONGO_MESSAGE_STORAGE', 'embedded')
+MONGO_BUCKET_SIZE = int(os.getenv('MONGO_BUCKET_SIZE', '50'))
+
+# Índices: criados/verificados ao ligar ao MongoDB (ou com `python manage.py criar_indices`)
+MONGO_CREATE_INDEXES = os.getenv('MONGO_CREATE_INDEXES', 'True') == 'True'
+# Pesquisa do histórico: 'text' (índice de texto, palavras inteiras, por relevância) ou 'substring' (regex)
+MONGO_SEARCH_MODE = os.getenv('MONGO_SEARCH_MODE', 'text')
+MONGO_TEXT_SEARCH_LANGUAGE = os.getenv('MONGO_TEXT_SEARCH_LANGUAGE', 'portuguese') # Stemming e stop words do índice de texto
+MONGO_SEARCH_MAX_BUCKET_CHATS = int(os.getenv('MONGO_SEARCH_MAX_BUCKET_CHATS', '10000')) # Máximo de chats em buckets por pesquisa (vão num $in)
+
+# Listagem do histórico (paginação por cursor): o total de chats é opcional. Sem filtros é uma estimativa
+# da coleção; com filtros, uma contagem limitada a MONGO_COUNT_LIMIT e guardada MONGO_COUNT_CACHE_SECONDS por filtro
+HISTORY_SHOW_TOTAL = os.getenv('HISTORY_SHOW_TOTAL', 'True') == 'True'
+MONGO_COUNT_LIMIT = int(os.getenv('MONGO_COUNT_LIMIT', '10000'))
+MONGO_COUNT_CACHE_SECONDS = int(os.getenv('MONGO_COUNT_CACHE_SECONDS', '60'))
+
+# Exportação em streaming: documentos trazidos do MongoDB por cada ida ao servidor
+MONGO_EXPORT_BATCH_SIZE = int(os.getenv('MONGO_EXPORT_BATCH_SIZE', '100'))
+
+# Jobs de exportação (POST /chat/exportar/jobs/): ficheiros comprimidos escritos em segundo plano
+EXPORT_JOBS_DIR = os.getenv('EXPORT_JOBS_DIR', os.path.join(BASE_DIR, 'exports'))
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '1')) # Jobs em simultâneo por processo
+EXPORT_JOB_FRESH_SECONDS = int(os.getenv('EXPORT_JOB_FRESH_SECONDS', '3600')) # Reutiliza ficheiros com os mesmos filtros mais recentes do que isto
+EXPORT_JOB_STALE_SECONDS = int(os.getenv('EXPORT_JOB_STALE_SECONDS', '300')) # Job em curso sem progresso há mais tempo = abandonado
+EXPORT_JOB_RETENTION_SECONDS = int(os.getenv('EXPORT_JOB_RETENTION_SECONDS', '86400')) # Jobs e ficheiros mais antigos são apagados
+
+# Importação (POST /chat/importar/<formato>/ ou `python manage.py importar_historico`): chats no formato da
+# exportação escritos com insert_many não ordenado, IMPORT_BATCH_SIZE chats por ida ao MongoDB
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '500'))
+IMPORT_API_TOKEN = os.getenv('IMPORT_API_TOKEN', '') # Token do cabeçalho 'Authorization: Bearer ...' do POST; vazio = importação por HTTP desligada
+
+# Escrita diferida (write-behind): a resposta do assistente é guardada num ficheiro em WRITE_BEHIND_DIR e escrita no
+# MongoDB em segundo plano, em lotes de até WRITE_BEHIND_BATCH_SIZE (ver chat/services/write_behind.py). Os pedidos de
+# chat deixam de esperar por essa escrita; o detalhe e a listagem do chat mostram as respostas ainda na fila
+MONGO_WRITE_BEHIND = os.getenv('MONGO_WRITE_BEHIND', 'False') == 'True'
+WRITE_BEHIND_DIR = os.getenv('WRITE_BEHIND_DIR', os.path.join(BASE_DIR, 'write_behind')) # Partilhada pelos workers da mesma máquina
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '100'))
+WRITE_BEHIND_FLUSH_MS = int(os.getenv('WRITE_BEHIND_FLUSH_MS', '100')) # Intervalo entre as verificações da fila
+WRITE_BEHIND_FSYNC = os.getenv('WRITE_BEHIND_FSYNC', 'True') == 'True' # fsync de cada ficheiro (sobrevive a uma falha de energia)
+WRITE_BEHIND_WAIT_SECONDS = float(os.getenv('WRITE_BEHIND_WAIT_SECONDS', '5')) # Espera máxima pela fila de um chat antes de uma nova mensagem
+WRITE_BEHIND_CLAIM_SECONDS = int(os.getenv('WRITE_BEHIND_CLAIM_SECONDS', '60')) # Reserva de um ficheiro não renovada = escritor morto
+
+# Métricas (GET /metrics, formato Prometheus): duração dos pedidos, comandos MongoDB, templates, tokenização,
+# prefill/decode e espera nas filas. Com METRICS_TRACE_IDS cada resposta leva X-Request-ID e Server-Timing.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_TRACE_IDS = os.getenv('METRICS_TRACE_IDS', 'False') == 'True'
+
+# Estatísticas do histórico (GET /chat/historico/analise/): os agregados dos dias fechados ficam guardados no MongoDB
+ANALYTICS_CACHE_ENABLED = os.getenv('ANALYTICS_CACHE_ENABLED', 'True') == 'True'
+ANALYTICS_CACHE_TTL_SECONDS = int(os.getenv('ANALYTICS_CACHE_TTL_SECONDS', str(7 * 86400))) # Filtros sem pedidos há mais tempo são apagados
+
+
+# --- Configurações do Modelo de IA (nlp_service) ---
+
+# Carregamento do modelo: em segundo plano ao arrancar o worker (wsgi/asgi) e aquecimento com uma geração curta
+NLP_PRELOAD = os.getenv('NLP_PRELOAD', 'True') == 'True'
+NLP_WARMUP = os.getenv('NLP_WARMUP', 'True') == 'True'
+
+# Precisão da inferência em CPU: 'auto' (dtype do checkpoint), 'fp32', 'bf16' (se o CPU suportar) ou 'int8'
+# (quantização dinâmica das camadas Linear). Compare os modos com `python manage.py benchmark_precisao`.
+NLP_PRECISION = os.getenv('NLP_PRECISION', 'auto')
+NLP_QUANTIZED_CHECKPOINT = os.getenv('NLP_QUANTIZED_CHECKPOINT', '') # Pesos int8 pré-quantizados (`python manage.py quantizar_modelo`), lidos só como tensores
+
+# Servidor de inferência dedicado: com 'remote', os workers Django não carregam o modelo e enviam os pedidos
+# para o processo iniciado com `python manage.py servidor_inferencia` (N réplicas do modelo x T threads cada)
+NLP_INFERENCE_BACKEND = os.getenv('NLP_INFERENCE_BACKEND', 'local') # 'local' ou 'remote'
+NLP_INFERENCE_ADDRESS = os.getenv('NLP_INFERENCE_ADDRESS', '127.0.0.1:8765') # 'host:porta' ou caminho de socket Unix
+NLP_INFERENCE_AUTHKEY = os.getenv('NLP_INFERENCE_AUTHKEY', '') # Vazio = usa a SECRET_KEY
+NLP_INFERENCE_REPLICAS = int(os.getenv('NLP_INFERENCE_REPLICAS', '1'))
+NLP_INFERENCE_THREADS = int(os.getenv('NLP_INFERENCE_THREADS', '4')) # Threads intra-op (torch) por réplica
+NLP_INFERENCE_TIMEOUT_SECONDS = float(os.getenv('NLP_INFERENCE_TIMEOUT_SECONDS', '300')) # Sem notícias da réplica há mais tempo = pedido falhado
+
+# Micro-batching: pedidos concorrentes são agrupados num único model.generate
+NLP_BATCH_ENABLED = os.getenv('NLP_BATCH_ENABLED', 'True') == 'True'
+NLP_BATCH_MAX_SIZE = int(os.getenv('NLP_BATCH_MAX_SIZE', '4')) # Máximo de prompts por lote
+NLP_BATCH_MAX_WAIT_MS = float(os.getenv('NLP_BATCH_MAX_WAIT_MS', '20')) # Janela de espera para completar um lote
+
+# Views assíncronas (ASGI): a geração e o contexto correm num pool de threads com este tamanho; os restantes
+# pedidos esperam na fila sem ocupar threads. Convém ser >= NLP_BATCH_MAX_SIZE para os lotes se poderem formar.
+NLP_ASYNC_WORKERS = int(os.getenv('NLP_ASYNC_WORKERS', str(NLP_BATCH_MAX_SIZE * 2)))
+
+# Cache KV por chat: reutiliza o prefill dos turnos anteriores quando o prompt novo começa pelos mesmos tokens.
+# Os turnos servidos por esta cache são gerados individualmente, mas passam pela fila do scheduler de micro-batching
+# e correm na thread dele (um de cada vez, entre lotes), para não competirem pelo CPU com os lotes.
+NLP_KV_CACHE_ENABLED = os.getenv('NLP_KV_CACHE_ENABLED', 'True') == 'True'
+NLP_KV_CACHE_MAX_MB = float(os.getenv('NLP_KV_CACHE_MAX_MB', '512')) # Orçamento de memória da cache
+NLP_KV_CACHE_IDLE_SECONDS = float(os.getenv('NLP_KV_CACHE_IDLE_SECONDS', '600')) # Remove chats inativos há mais tempo
+
+# Decodificação especulativa: vários tokens propostos são verificados num só forward do modelo principal.
+# 'off', 'draft' (modelo de rascunho mais pequeno com o mesmo tokenizer) ou 'prompt_lookup' (n-gramas do histórico).
+# Estes turnos são gerados individualmente (sem micro-batching nem cache KV); compare com `benchmark_desempenho`.
+NLP_SPECULATIVE_MODE = os.getenv('NLP_SPECULATIVE_MODE', 'off')
+NLP_DRAFT_MODEL = os.getenv('NLP_DRAFT_MODEL', '') # Ex: um Qwen2 mais pequeno ou quantizado
+NLP_SPECULATIVE_TOKENS = int(os.getenv('NLP_SPECULATIVE_TOKENS', '5')) # Tokens propostos por passo
+
+# Janela de contexto: orçamento de tokens do prompt (instrução de sistema + resumo + mensagens recentes).
+# Quando a conversa não cabe, as mensagens antigas são juntadas a um resumo guardado no documento do chat.
+NLP_CONTEXT_TOKEN_BUDGET = int(os.getenv('NLP_CONTEXT_TOKEN_BUDGET', '2048'))
+NLP_CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv('NLP_CONTEXT_SUMMARY_MAX_TOKENS', '200')) # Tamanho máximo do resumo
+NLP_CONTEXT_TRIM_RATIO = float(os.getenv('NLP_CONTEXT_TRIM_RATIO', '0.6')) # Fração do orçamento ocupada pela janela após resumir
+NLP_TOKEN_COUNT_CACHE_SIZE = int(os.getenv('NLP_TOKEN_COUNT_CACHE_SIZE', '10000')) # Contagens de tokens por mensagem em cache
+
+# --- Cache de respostas (à frente do modelo) ---
+# Camada exata: hash normalizado de (instrução de sistema, modelo, parâmetros, resumo e mensagens recentes)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'True') == 'True'
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory') # 'memory' (LRU por processo) ou 'mongo' (coleção com índice TTL)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000')) # Só para o backend 'memory'
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '86400'))
+RESPONSE_CACHE_MAX_HISTORY_MESSAGES = int(os.getenv('RESPONSE_CACHE_MAX_HISTORY_MESSAGES', '4')) # Conversas mais longas não são guardadas
+# Camada semântica (opcional): prompts de um só turno quase iguais, por similaridade de embeddings do próprio modelo
+RESPONSE_CACHE_SEMANTIC = os.getenv('RESPONSE_CACHE_SEMANTIC', 'False') == 'True'
+RESPONSE_CACHE_SEMANTIC_THRESHOLD = float(os.getenv('RESPONSE_CACHE_SEMANTIC_THRESHOLD', '0.95'))
+RESPONSE_CACHE_SEMANTIC_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_SEMANTIC_MAX_ENTRIES', '500'))
+
+# --- Logging ---
+# Os registos dos serviços passam por uma fila e são escritos na consola por uma thread à parte (chat.log_handlers),
+# para não bloquear os pedidos. As mensagens de sucesso (chat criado, resposta gerada...) são DEBUG.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO') # Nível da aplicação ('chat.*')
+LOG_LEVEL_MONGO = os.getenv('LOG_LEVEL_MONGO', LOG_LEVEL) # mongo_service e mongo_async_service
+LOG_LEVEL_NLP = os.getenv('LOG_LEVEL_NLP', LOG_LEVEL) # nlp_service
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000')) # Registos em espera; acima disto são descartados
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'trace_id': {'()': 'chat.log_handlers.TraceIdFilter'},
+    },
+    'formatters': {
+        'padrao': {
+            'format': '[%(asctime)s] %(levelname)s %(name)s [%(trace_id)s] %(message)s',
+            'datefmt': '%Y-%m-%d %H:%M:%S',
+        },
+    },
+    'handlers': {
+        'fila': {
+            '()': 'chat.log_handlers.FilaHandler',
+            'capacidade': LOG_QUEUE_SIZE,
+            'formatter': 'padrao',
+            'filters': ['trace_id'],
+        },
+    },
+    'loggers': {
+        'chat': {'handlers': ['fila'], 'level': LOG_LEVEL, 'propagate': False},
+        'chat.services.mongo_service': {'level': LOG_LEVEL_MONGO},
+        'chat.services.mongo_async_service': {'level': LOG_LEVEL_MONGO},
+        'chat.services.nlp_service': {'level': LOG_LEVEL_NLP},
+    },
+}
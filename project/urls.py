@@ -2,9 +2,11 @@ from django.contrib import admin
 from django.urls import path, include
 # Volta a ser simples
 from core.views import index_view
+from chat.views import metricas_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', index_view, name='index'),
     path('chat/', include('chat.urls')),
+    path('metrics', metricas_view, name='metrics'), # Métricas no formato Prometheus
 ]
\ No newline at end of file
@@ -14,3 +14,15 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_wsgi_application()
+
+# Começa a carregar o modelo de IA em segundo plano assim que o worker arranca,
+# sem bloquear o arranque (os pedidos de chat recebem 503 até o modelo estar pronto).
+from django.conf import settings
+if settings.NLP_PRELOAD:
+    from chat.services import nlp_service
+    nlp_service.iniciar_carregamento()
+
+# Escrita diferida: o escritor em segundo plano começa já, para escrever o que ficou na fila de uma execução anterior
+if getattr(settings, 'MONGO_WRITE_BEHIND', False):
+    from chat.services import write_behind
+    write_behind.iniciar()
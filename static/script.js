@@ -23,6 +23,39 @@ function addMessage(sender, text) {
     return contentDiv; // Retorna o elemento para atualizações futuras (loading)
 }
 
+// Lê uma resposta Server-Sent Events (vinda de um fetch POST) e chama onEvento(evento, dados) para cada evento
+async function lerEventosSSE(response, onEvento) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Cada evento termina com uma linha em branco
+        let separador;
+        while ((separador = buffer.indexOf('\n\n')) !== -1) {
+            const bloco = buffer.slice(0, separador);
+            buffer = buffer.slice(separador + 2);
+
+            let evento = 'message';
+            let dados = '';
+            for (const linha of bloco.split('\n')) {
+                if (linha.startsWith('event:')) {
+                    evento = linha.slice(6).trim();
+                } else if (linha.startsWith('data:')) {
+                    dados += linha.slice(5).trim();
+                }
+            }
+            if (dados) {
+                onEvento(evento, JSON.parse(dados));
+            }
+        }
+    }
+}
+
 // Lida com o envio do formulário
 form.addEventListener('submit', async (e) => {
     e.preventDefault();
@@ -47,8 +80,8 @@ form.addEventListener('submit', async (e) => {
     promptInput.disabled = true;
 
     try {
-        // Envia o prompt e o chat_id (se existir) para o backend Django
-        const response = await fetch('/chat/gerar/', { // URL da API Django
+        // Envia o prompt e o chat_id (se existir) para o endpoint de streaming do Django
+        const response = await fetch('/chat/gerar/stream/', { // URL da API Django (Server-Sent Events)
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -61,33 +94,39 @@ form.addEventListener('submit', async (e) => {
             }),
         });
 
-        // Tenta ler a resposta como JSON, mesmo se houver erro HTTP
-        let data;
-        try {
-            data = await response.json();
-        } catch (jsonError) {
-             // Se a resposta não for JSON (ex: erro 500 HTML), cria um erro genérico
-             console.error("Erro ao parsear JSON:", jsonError);
-             const responseText = await response.text(); // Lê como texto para depuração
-             console.error("Resposta recebida (não JSON):", responseText);
-             throw new Error(`Erro HTTP ${response.status}: Resposta inválida do servidor.`);
-        }
-
         if (!response.ok) {
-            // Usa a mensagem de erro do JSON se disponível, senão usa uma genérica
+            // Erros antes do início do stream continuam a vir em JSON
+            let data = {};
+            try {
+                data = await response.json();
+            } catch (jsonError) {
+                console.error("Erro ao parsear JSON:", jsonError);
+            }
             console.error("Erro da API:", data); // Loga o erro recebido
             throw new Error(data.error || `Erro HTTP ${response.status}.`);
         }
 
-
-        // Guarda/Atualiza o chat_id retornado pelo backend
-        if (data.chat_id) {
-            chatIdInput.value = data.chat_id;
-             console.log("Chat ID atualizado/confirmado:", data.chat_id); // Log para depuração
-        }
-
-        // Atualiza a mensagem de "a carregar" com a resposta final
-        loadingMessage.textContent = data.response;
+        // Lê o stream e mostra os tokens à medida que chegam
+        let textoRecebido = '';
+        await lerEventosSSE(response, (evento, dados) => {
+            if (evento === 'inicio' || evento === 'fim') {
+                // Guarda/Atualiza o chat_id retornado pelo backend
+                if (dados.chat_id) {
+                    chatIdInput.value = dados.chat_id;
+                    console.log("Chat ID atualizado/confirmado:", dados.chat_id); // Log para depuração
+                }
+                if (evento === 'fim') {
+                    loadingMessage.textContent = dados.response;
+                }
+            } else if (evento === 'token') {
+                textoRecebido += dados.texto;
+                // Substitui o indicador de "a carregar" pelo texto parcial
+                loadingMessage.textContent = textoRecebido;
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            } else if (evento === 'erro') {
+                console.error("Erro da API:", dados);
+            }
+        });
 
     } catch (error) {
         // Atualiza a mensagem de "a carregar" com a mensagem de erro